@@ -957,6 +957,7 @@ if 'clean' in sys.argv or 'sdist' in sys.argv:
                    "xpra/server/cystats.c",
                    "xpra/server/window/region.c",
                    "xpra/server/window/motion.c",
+                   "xpra/server/window/tile_hash.c",
                    "xpra/server/pam.c",
                    "xpra/server/sd_listen.c",
                    "etc/xpra/xpra.conf",
@@ -1943,6 +1944,9 @@ if server_ENABLED:
     cython_add(Extension("xpra.server.window.motion",
                 ["xpra/server/window/motion.pyx"],
                 **O3_pkgconfig))
+    cython_add(Extension("xpra.server.window.tile_hash",
+                ["xpra/server/window/tile_hash.pyx"],
+                **O3_pkgconfig))
 
 if sd_listen_ENABLED:
     sdp = pkgconfig("libsystemd")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+#compares the time it takes to extract packets from the network reads
+#using string concatenation (the old parser) and the ReadBuffer
+
+import time
+
+from xpra.net.read_buffer import ReadBuffer
+from xpra.net.header import pack_header, unpack_header
+from xpra.simple_stats import std_unit
+
+
+def make_stream(packet_sizes):
+    data = b""
+    for size in packet_sizes:
+        data += pack_header(0, 0, 0, size)+b"x"*size
+    return data
+
+def split_reads(data, read_size):
+    return [data[i:i+read_size] for i in range(0, len(data), read_size)]
+
+
+def concat_parse(reads):
+    read_buffer = b""
+    payload_size = -1
+    count = 0
+    for buf in reads:
+        read_buffer = read_buffer + buf
+        while True:
+            if payload_size<0:
+                if len(read_buffer)<8:
+                    break
+                payload_size = unpack_header(read_buffer[:8])[-1]
+                read_buffer = read_buffer[8:]
+            if len(read_buffer)<payload_size:
+                break
+            _ = read_buffer[:payload_size]
+            read_buffer = read_buffer[payload_size:]
+            payload_size = -1
+            count += 1
+    return count
+
+def read_buffer_parse(reads):
+    read_buffer = ReadBuffer()
+    payload_size = -1
+    count = 0
+    for buf in reads:
+        read_buffer.add(buf)
+        while True:
+            if payload_size<0:
+                if len(read_buffer)<8:
+                    break
+                payload_size = unpack_header(read_buffer.peek(8))[-1]
+                read_buffer.consume(8)
+            payload = read_buffer.read(payload_size)
+            if payload is None:
+                break
+            payload_size = -1
+            count += 1
+    return count
+
+
+def time_parse(name, parse_fn, reads, n=3):
+    start = time.time()
+    for _ in range(n):
+        count = parse_fn(reads)
+    elapsed = (time.time()-start)/n
+    print("  %-12s: %6.1fms for %i packets" % (name, elapsed*1000, count))
+
+
+def main():
+    for desc, packet_sizes in {
+                               "small packets"  : [100]*10000,
+                               "mixed packets"  : [100, 20000, 500, 1024*1024]*10,
+                               "large packets"  : [4*1024*1024]*2,
+                               }.items():
+        data = make_stream(packet_sizes)
+        for read_size in (1024, 16384, 65536):
+            reads = split_reads(data, read_size)
+            print("%s, %sB total, %i reads of %sB:" % (desc, std_unit(len(data)), len(reads), std_unit(read_size)))
+            time_parse("concatenate", concat_parse, reads)
+            time_parse("read-buffer", read_buffer_parse, reads)
+
+
+if __name__ == "__main__":
+    main()
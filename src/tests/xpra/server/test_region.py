@@ -8,7 +8,7 @@ import time
 import gobject
 gobject.threads_init()
 
-from xpra.server.window.region import rectangle, add_rectangle, remove_rectangle, merge_all, contains_rect #@UnresolvedImport (cython)
+from xpra.server.window.region import rectangle, banded_region, add_rectangle, remove_rectangle, merge_all, contains_rect #@UnresolvedImport (cython)
 
 
 #collected with the server "-d encoding"
@@ -528,6 +528,13 @@ R2 = [
 
 N = 1000
 
+def make_terminal_damage(count, seed=0):
+    #simulates a terminal updating lots of character cells (8x15 pixels)
+    #scattered over 200 columns and 60 rows:
+    import random
+    r = random.Random(seed)
+    return [(r.randint(0, 199)*8, 59+r.randint(0, 59)*15, 8*r.randint(1, 5), 15) for _ in range(count)]
+
 def test_gvim_damage_performance(rectangles):
     start = time.time()
     for _ in range(N):
@@ -565,6 +572,59 @@ def test_gvim_damage_performance(rectangles):
     print("contains_rect %s rectangles %s times in %.2fms" % (len(rectangles), n, (end-start)*1000.0/N))
 
 
+def test_banded_region_performance(rectangles):
+    #same as above, but using a banded_region:
+    start = time.time()
+    for _ in range(N):
+        region = banded_region()
+        for x,y,width,height in rectangles:
+            region.add(x, y, width, height)
+    end = time.time()
+    print("banded_region.add %s rectangles %s times in %.2fms" % (len(rectangles), N, (end-start)*1000.0/N))
+    #bulk API:
+    start = time.time()
+    for _ in range(N):
+        region = banded_region(rectangles)
+    end = time.time()
+    print("banded_region(rectangles) %s rectangles %s times in %.2fms" % (len(rectangles), N, (end-start)*1000.0/N))
+    start = time.time()
+    for _ in range(N):
+        for x,y,width,height in rectangles:
+            region.remove(x+width//4, y+height//3, width//2, height//2)
+    end = time.time()
+    print("banded_region.remove %s rectangles %s times in %.2fms" % (len(rectangles), N, (end-start)*1000.0/N))
+    region = banded_region(rectangles)
+    start = time.time()
+    for _ in range(N):
+        rects = region.get_rectangles()
+    end = time.time()
+    print("banded_region.get_rectangles: %s rectangles from %s bands %s times in %.2fms" % (len(rects), len(region.get_bands()), N, (end-start)*1000.0/N))
+    start = time.time()
+    for _ in range(N):
+        for r in rects:
+            region.contains_rect(r)
+    end = time.time()
+    print("banded_region.contains_rect %s rectangles %s times in %.2fms" % (len(rects), N, (end-start)*1000.0/N))
+
+
+def test_terminal_damage_scaling():
+    for count in (100, 500, 2000):
+        rectangles = make_terminal_damage(count)
+        n = max(1, N//count)
+        start = time.time()
+        for _ in range(n):
+            rects = []
+            for x,y,width,height in rectangles:
+                add_rectangle(rects, rectangle(x, y, width, height))
+        end = time.time()
+        print("add_rectangle %5i terminal cells: %8.2fms, %i rectangles" % (count, (end-start)*1000.0/n, len(rects)))
+        start = time.time()
+        for _ in range(n):
+            region = banded_region(rectangles)
+        end = time.time()
+        print("banded_region %5i terminal cells: %8.2fms, %i rectangles" % (count, (end-start)*1000.0/n, len(region)))
+
+
 def test_merge_all():
     start = time.time()
     R = [rectangle(*v) for v in R1+R2]
@@ -578,9 +638,15 @@ def test_merge_all():
 def main():
     print("R1:")
     test_gvim_damage_performance(R1)
+    test_banded_region_performance(R1)
     print("")
     print("R2:")
     test_gvim_damage_performance(R2)
+    test_banded_region_performance(R2)
+
+    print("")
+    print("terminal:")
+    test_terminal_damage_scaling()
 
     print("")
     test_merge_all()
@@ -8,7 +8,7 @@ import unittest
 
 from xpra.os_util import strtobytes, monotonic_time
 try:
-    from xpra.codecs.xor.cyxor import xor_str       #@UnresolvedImport
+    from xpra.codecs.xor.cyxor import xor_str, delta_spans, apply_spans       #@UnresolvedImport
 except:
     xor_str = None
 import binascii
@@ -62,6 +62,45 @@ class TestHMAC(unittest.TestCase):
             #print("%iMB/s: took %ims on average (%s iterations)" % (speed, 1000*(end-start)/count, count))
             assert speed>0, "running the xor speed test took too long"
 
+    def check_spans(self, ref, buf, max_size=2**20):
+        spans = delta_spans(buf, ref, max_size)
+        assert spans is not None
+        assert len(spans)<=max_size
+        out = apply_spans(ref, spans)
+        assert out.tobytes()==buf, "spans did not produce the expected buffer: %s vs %s" % (h(out.tobytes()), h(buf))
+        return spans
+
+    def test_delta_spans(self):
+        ref = bytes(bytearray(range(256))*4)
+        #identical:
+        assert len(self.check_spans(ref, ref))==0
+        #one byte changed, at the start, in the middle, in the trailing bytes:
+        for size in (1024, 1023, 1017, 7, 1):
+            r = ref[:size]
+            for pos in (0, size//2, size-1):
+                b = bytearray(r)
+                b[pos] ^= 0xff
+                spans = self.check_spans(r, bytes(b))
+                #one span header and a small number of bytes:
+                assert len(spans)<=8+16, "spans too big for a single byte change: %i" % len(spans)
+        #two changes close to each other are merged into one span:
+        b = bytearray(ref)
+        b[100] ^= 1
+        b[110] ^= 1
+        assert len(self.check_spans(ref, bytes(b)))<=8+24
+        #everything changed:
+        b = bytes(bytearray((x+1)%256 for x in bytearray(ref)))
+        self.check_spans(ref, b)
+        #too big for the limit:
+        assert delta_spans(b, ref, 512) is None
+        #invalid spans:
+        try:
+            apply_spans(ref, b"\0\0\0\0\xff\xff\0\0")
+        except Exception:
+            pass
+        else:
+            raise Exception("invalid spans should have failed")
+
 
 
 def main():
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.codecs.encoding_cache import EncodingCache, get_cache_key
+
+
+class TestEncodingCache(unittest.TestCase):
+
+    def test_keys(self):
+        pixels = b"\0"*64
+        k = get_cache_key(pixels, "png", 1, 4, 4)
+        assert k==get_cache_key(pixels, "png", 1, 4, 4)
+        assert k!=get_cache_key(pixels, "png", 2, 4, 4)
+        assert k!=get_cache_key(b"\1"+pixels[1:], "png", 1, 4, 4)
+        assert k==get_cache_key(memoryview(pixels), "png", 1, 4, 4)
+
+    def test_eviction(self):
+        c = EncodingCache(100)
+        assert c.get("a") is None
+        c.add("a", "A", 40)
+        c.add("b", "B", 40)
+        assert c.get("a")=="A"
+        #"b" is now the least recently used:
+        c.add("c", "C", 40)
+        assert c.get("b") is None
+        assert c.get("a")=="A" and c.get("c")=="C"
+        assert c.size==80
+        #replacing a value updates the size:
+        c.add("a", "AA", 10)
+        assert c.size==50 and c.get("a")=="AA"
+        #too big to be cached at all:
+        c.add("d", "D", 101)
+        assert c.get("d") is None and len(c)==2
+        info = c.get_info()
+        assert info["evicted"]==1 and info["hits"]==4
+        c.clear()
+        assert len(c)==0 and c.size==0
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import unittest
+
+from xpra.net import compression
+from xpra.net.compression import AdaptiveCompressor, ADAPTIVE_MIN_SAMPLES, ADAPTIVE_PROBE_INTERVAL
+
+
+class TestAdaptiveCompressor(unittest.TestCase):
+
+    def test_skip_incompressible(self):
+        ac = AdaptiveCompressor(["zlib"], "zlib")
+        data = os.urandom(4096)
+        for _ in range(ADAPTIVE_MIN_SAMPLES):
+            cl, _ = ac.compress("sound-data", data, 1)
+            assert cl>0
+        #now it should be skipped:
+        for _ in range(ADAPTIVE_PROBE_INTERVAL):
+            cl, cdata = ac.compress("sound-data", data, 1)
+            assert cl==0 and cdata==data
+        #and probed again:
+        cl, _ = ac.compress("sound-data", data, 1)
+        assert cl>0
+        #other packet types are not affected:
+        cl, _ = ac.compress("window-metadata", b"a"*4096, 1)
+        assert cl>0
+        info = ac.get_info()
+        assert info["packet"]["window-metadata"]["count"]==1
+
+    def test_compressor_choice(self):
+        if not compression.use_lz4:
+            return
+        ac = AdaptiveCompressor(["lz4", "zlib"], "lz4")
+        data = b"0123456789"*1000
+        cl, cdata = ac.compress("cursor", data, 1)
+        assert compression.get_compression_type(cl)=="lz4"
+        assert compression.decompress(cdata, cl)==data
+        cl, cdata = ac.compress("window-metadata", data, 1)
+        assert compression.get_compression_type(cl)=="zlib"
+        assert compression.decompress(cdata, cl)==data
+
+
+class TestDecompress(unittest.TestCase):
+
+    def test_buffers(self):
+        data = b"0123456789"*1000
+        for name in compression.get_enabled_compressors():
+            cl, cdata = compression.get_compressor(name)(data, 1)
+            for buf in (memoryview(cdata), memoryview(bytearray(cdata))):
+                assert compression.decompress(buf, cl)==data, "%s failed to decompress %s" % (name, type(buf))
+
+
+class TestZstd(unittest.TestCase):
+
+    def test_roundtrip(self):
+        if not compression.use_zstd:
+            return
+        data = b"0123456789"*1000
+        for level in (1, 5, 9):
+            cl, cdata = compression.zstd_compress(data, level)
+            assert compression.get_compression_type(cl)=="zstd"
+            assert len(cdata)<len(data)
+            assert compression.decompress(cdata, cl)==data
+
+    def test_dictionary(self):
+        if not compression.use_zstd:
+            return
+        from xpra.net.bencode import bencode
+        samples = [bencode(["damage-sequence", i, 1+i%5, 640, 480, i*3, ""]) for i in range(1000)]
+        samples += [bencode(["pointer-position", i%10, [i, 2*i], ["mod2"], []]) for i in range(1000)]
+        dict_data = compression.train_zstd_dictionary(samples, 4096)
+        saved = compression.zstd_dictionary
+        try:
+            compression.zstd_dictionary = compression.zstandard.ZstdCompressionDict(dict_data)
+            data = bencode(["damage-sequence", 5000, 3, 640, 480, 12, ""])
+            cl, cdata = compression.zstd_dict_compress(data, 1)
+            assert compression.decompress(cdata, cl)==data
+            _, nodict = compression.zstd_compress(data, 1)
+            assert len(cdata)<len(nodict), "dictionary did not help: %i vs %i bytes" % (len(cdata), len(nodict))
+        finally:
+            compression.zstd_dictionary = saved
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from xpra.net import file_transfer
+from xpra.net.file_transfer import FileTransferHandler
+from xpra.os_util import Queue
+import xpra.platform.paths
+
+CHUNK_SIZE = 1024
+
+
+class LoopbackHandler(FileTransferHandler):
+    """ delivers the packets to the other end when pump() is called """
+
+    def __init__(self):
+        self.timers = {}
+        self.packets = []
+        self.sent = []
+        #called from the 'process-download' thread:
+        self.downloaded = Queue()
+        self.peer = None
+        #simulates a connection loss after this many packets:
+        self.max_packets = -1
+        FileTransferHandler.__init__(self)
+        self.init_attributes(True, 10, False, False, None)
+        self.file_chunks = CHUNK_SIZE
+
+    def timeout_add(self, delay, fn, *args):
+        tid = len(self.timers)+1
+        self.timers[tid] = (fn, args)
+        return tid
+
+    def source_remove(self, tid):
+        del self.timers[tid]
+
+    def idle_add(self, fn, *args):
+        fn(*args)
+
+    def compressed_wrapper(self, datatype, data):
+        return data
+
+    def send(self, *packet):
+        self.sent.append(packet[0])
+        if self.max_packets<0 or len(self.sent)<=self.max_packets:
+            self.peer.packets.append(packet)
+
+    def pump(self):
+        while self.packets:
+            packet = self.packets.pop(0)
+            handler = {
+                "send-file"         : self._process_send_file,
+                "send-file-chunk"   : self._process_send_file_chunk,
+                "ack-file-chunk"    : self._process_ack_file_chunk,
+                }[packet[0]]
+            handler(packet)
+            self.peer.pump()
+
+    def do_process_downloaded_file(self, filename, *args):
+        self.downloaded.put(filename)
+
+
+def connect(stream=True):
+    a = LoopbackHandler()
+    b = LoopbackHandler()
+    a.peer, b.peer = b, a
+    caps = file_transfer.typedict(b.get_file_transfer_features())
+    if not stream:
+        caps["file-stream"] = False
+    a.parse_file_transfer_caps(caps)
+    b.parse_file_transfer_caps(file_transfer.typedict(a.get_file_transfer_features()))
+    return a, b
+
+
+class TestFileTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved_get_download_dir = xpra.platform.paths.get_download_dir
+        xpra.platform.paths.get_download_dir = lambda : os.path.join(self.tmpdir, "downloads")
+        os.mkdir(os.path.join(self.tmpdir, "downloads"))
+        self.filename = os.path.join(self.tmpdir, "test-file")
+        self.data = os.urandom(CHUNK_SIZE*20+123)
+        with open(self.filename, "wb") as f:
+            f.write(self.data)
+        file_transfer.partial_files.clear()
+
+    def tearDown(self):
+        xpra.platform.paths.get_download_dir = self.saved_get_download_dir
+        shutil.rmtree(self.tmpdir)
+        file_transfer.partial_files.clear()
+
+    def check_download(self, receiver):
+        filename = receiver.downloaded.get(timeout=5)
+        assert receiver.downloaded.empty()
+        with open(filename, "rb") as f:
+            assert f.read()==self.data
+
+    def test_stream_from_disk(self):
+        sender, receiver = connect()
+        assert sender.send_file(self.filename, "", None, len(self.data))
+        sender.pump()
+        receiver.pump()
+        #the chunks are sent before the previous ones are acknowledged:
+        chunk_packets = [x for x in sender.sent if x=="send-file-chunk"]
+        assert len(chunk_packets)==21
+        assert sender.sent[:file_transfer.FILE_CHUNKS_WINDOW+1]==["send-file"]+["send-file-chunk"]*file_transfer.FILE_CHUNKS_WINDOW
+        self.check_download(receiver)
+        assert not sender.send_chunks_in_progress and not receiver.receive_chunks_in_progress
+        assert not sender.timers and not receiver.timers
+
+    def test_digest_upfront(self):
+        sender, receiver = connect(False)
+        options = {}
+        assert sender.send_file(self.filename, "", None, len(self.data), options=options)
+        assert not options, "the caller's options should not be modified"
+        assert receiver.packets[0][7]["sha1"]==hashlib.sha1(self.data).hexdigest()
+        receiver.pump()
+        self.check_download(receiver)
+
+    def test_in_memory_data(self):
+        sender, receiver = connect()
+        assert sender.send_file(self.filename, "", self.data+b"\0", len(self.data))
+        receiver.pump()
+        self.check_download(receiver)
+
+    def test_resume(self):
+        sender, receiver = connect()
+        #connection lost after the first 4 chunks:
+        sender.max_packets = 5
+        assert sender.send_file(self.filename, "", None, len(self.data))
+        receiver.pump()
+        receiver.cleanup()
+        sender.cleanup()
+        assert len(file_transfer.partial_files)==1
+        #reconnect and send it again:
+        sender, receiver = connect()
+        assert sender.send_file(self.filename, "", None, len(self.data))
+        receiver.pump()
+        chunk_packets = [x for x in sender.sent if x=="send-file-chunk"]
+        assert len(chunk_packets)==21-4, "expected %i chunks but sent %i" % (21-4, len(chunk_packets))
+        self.check_download(receiver)
+        assert not file_transfer.partial_files
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import mmap
+import unittest
+
+from xpra.net.mmap_pipe import MmapRing, mmap_ring_read, mmap_ring_free
+
+SIZE = 4096
+
+
+class TestMmapRing(unittest.TestCase):
+
+    def test_write_read(self):
+        area = mmap.mmap(-1, SIZE)
+        ring = MmapRing(area, SIZE)
+        chunks = []
+        for i in range(4):
+            data = bytes(bytearray([i])*(100+i))
+            mmap_data, free = ring.write(data)
+            assert len(mmap_data)==1
+            offset, length = mmap_data[0]
+            assert length==len(data)
+            assert mmap_ring_read(area, offset, length).raw==data
+            chunks.append(mmap_data)
+        assert ring.get_info()["chunks"]==4
+        assert free==ring.get_free_size()
+        #frees can happen in any order,
+        #but the space is only reclaimed from the oldest chunk:
+        mmap_ring_free(area, *chunks[1])
+        ring.reclaim()
+        assert ring.get_info()["chunks"]==4
+        mmap_ring_free(area, *chunks[0])
+        ring.reclaim()
+        assert ring.get_info()["chunks"]==2
+        for c in chunks[2:]:
+            mmap_ring_free(area, *c)
+        ring.reclaim()
+        assert ring.get_free_size()==SIZE-8
+        assert ring.get_info()["head"]==8
+
+    def test_full_and_wrap(self):
+        area = mmap.mmap(-1, SIZE)
+        ring = MmapRing(area, SIZE)
+        data = b"x"*1000
+        chunks = []
+        while True:
+            mmap_data, free = ring.write(data)
+            if mmap_data is None:
+                break
+            chunks.append(mmap_data)
+        assert len(chunks)==4 and free<0
+        #too big for the area:
+        assert ring.write(b"x"*SIZE)[0] is None
+        #free the first chunk, the next write wraps around to the start:
+        mmap_ring_free(area, *chunks.pop(0))
+        mmap_data = ring.write(data)[0]
+        assert mmap_data[0][0]==8+8
+        #the area is full again:
+        assert ring.write(b"y")[0] is None
+        for c in chunks:
+            mmap_ring_free(area, *c)
+        #only the chunk we wrapped around to remains:
+        assert ring.write(b"y"*2000)[0] is not None
+        assert ring.get_info()["chunks"]==2
+        mmap_ring_free(area, *mmap_data)
+        ring.reclaim()
+        assert ring.get_info()["chunks"]==1
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
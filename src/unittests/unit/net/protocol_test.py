@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import socket
+import unittest
+
+from xpra.util import AdHocStruct
+from xpra.os_util import Queue, strtobytes
+from xpra.net.protocol import Protocol
+from xpra.net.read_buffer import COPY_SIZE
+from xpra.net.bytestreams import SocketConnection
+from xpra.net.header import pack_header, FLAGS_ZLIB_STREAM
+
+
+class PartialWriteConnection(SocketConnection):
+    """ only writes a few bytes at a time to exercise partial writes """
+
+    def writev(self, buffers):
+        return self._write(self._socket.sendmsg, [memoryview(buffers[0])[:3]])
+
+    def write(self, buf):
+        return self._write(self._socket.send, memoryview(buf)[:3])
+
+
+def make_protocol(conn, process_packet_cb=None):
+    scheduler = AdHocStruct()
+    scheduler.timeout_add = lambda *args : None
+    scheduler.idle_add = lambda *args : None
+    return Protocol(scheduler, conn, process_packet_cb)
+
+
+class TestVectoredWrite(unittest.TestCase):
+
+    def do_test_write(self, conn_class):
+        s1, s2 = socket.socketpair()
+        try:
+            conn = conn_class(s1, "local", "remote", "test", "socket")
+            p = make_protocol(conn)
+            assert p._writev==conn.can_writev()
+            events = []
+            def cb(name):
+                def f(bytecount):
+                    events.append((name, bytecount))
+                return f
+            items = [
+                     (b"head", cb("start"), None),
+                     (b"", None, None),
+                     (bytearray(b"payload"), None, None),
+                     (memoryview(b"0123456789")[2:8], None, cb("end")),
+                     ]
+            if p._writev:
+                assert p._write_vectored(items)
+            else:
+                #ie: python2 sockets have no sendmsg,
+                #so the buffers are written one at a time:
+                p._write_queue.put(items)
+                assert p._write()
+            expected = b"head"+b"payload"+b"234567"
+            data = b""
+            while len(data)<len(expected):
+                data += s2.recv(1024)
+            assert data==expected, "expected %r but got %r" % (expected, data)
+            assert events==[("start", 0), ("end", len(expected))], "invalid callback events: %s" % (events,)
+        finally:
+            s1.close()
+            s2.close()
+
+    def test_writev(self):
+        self.do_test_write(SocketConnection)
+
+    def test_partial_writev(self):
+        self.do_test_write(PartialWriteConnection)
+
+
+class TestReadParse(unittest.TestCase):
+
+    def do_test_parse(self, chunk_size, stream=False):
+        s1, s2 = socket.socketpair()
+        try:
+            packets = []
+            def process_packet(proto, packet):
+                packets.append(packet)
+            conn = SocketConnection(s1, "local", "remote", "test", "socket")
+            p = make_protocol(conn, process_packet)
+            p.enable_encoder("bencode")
+            p.enable_compressor("zlib")
+            p.enable_stream_compression(stream)
+            sent = [
+                    ["hello", {"foo" : "bar"}],
+                    ["draw", 1, 2, 3, 4, "x"*100000, 0],
+                    ["small"],
+                    ["large", "y"*50000],
+                    ["large", "z"*50000],
+                    ]
+            data = b""
+            for packet in sent:
+                p.set_compression_level(int(packet[0]=="large"))
+                for proto_flags, index, level, chunk in p.encode(packet):
+                    assert bool(proto_flags & FLAGS_ZLIB_STREAM)==(stream and level>0)
+                    data += pack_header(proto_flags, level, index, len(chunk))+chunk
+            p._read_queue = Queue()
+            for i in range(0, len(data), chunk_size):
+                p._read_queue.put(data[i:i+chunk_size])
+            p._read_queue.put(None)
+            p.do_read_parse_thread_loop()
+            assert len(packets)==len(sent), "expected %i packets but got %i" % (len(sent), len(packets))
+            for i, packet in enumerate(packets):
+                assert strtobytes(packet[0])==strtobytes(sent[i][0])
+                assert len(packet)==len(sent[i])
+            #the packet handlers are given bytes, not buffers:
+            assert type(packets[1][5])==bytes
+            assert packets[3][1]==b"y"*50000
+            assert packets[4][1]==b"z"*50000
+        finally:
+            s1.close()
+            s2.close()
+
+    def test_small_reads(self):
+        self.do_test_parse(7)
+
+    def test_medium_reads(self):
+        #some packets are contained in a single read, others span multiple reads:
+        self.do_test_parse(1000)
+
+    def test_large_reads(self):
+        self.do_test_parse(65536)
+
+    def test_stream_compression(self):
+        self.do_test_parse(1024, True)
+
+
+class TestRawPackets(unittest.TestCase):
+
+    def test_raw_forwarding(self):
+        p = make_protocol(AdHocStruct())
+        p.enable_encoder("bencode")
+        p.enable_compressor("zlib")
+        p.set_compression_level(1)
+        data = b""
+        for packet in (["disconnect", "reason"], ["draw", 1, 2, 3, 4, os.urandom(100000), 0], ["large", "y"*50000]):
+            for proto_flags, index, level, chunk in p.encode(packet, False):
+                data += pack_header(proto_flags, level, index, len(chunk))+chunk
+        raw = []
+        def process_raw_packet(proto, *args):
+            raw.append(args)
+        p.set_raw_packet_callback(process_raw_packet)
+        p._read_queue = Queue()
+        p._read_queue.put(data)
+        p._read_queue.put(None)
+        p.do_read_parse_thread_loop()
+        assert len(raw)==5, "expected 5 raw packets but got %i" % len(raw)
+        assert p.input_packetcount==3
+        #the large payloads are not copied:
+        large = [args[3] for args in raw if len(args[3])>=COPY_SIZE]
+        assert large
+        for payload in large:
+            assert isinstance(payload, memoryview), "expected a memoryview but got %s" % type(payload)
+        packet = p.decode_raw_packet(*raw[0][:2]+(raw[0][3],))
+        assert strtobytes(packet[0])==b"disconnect"
+        #forward them to another connection:
+        s1, s2 = socket.socketpair()
+        try:
+            conn = SocketConnection(s1, "local", "remote", "test", "socket")
+            fp = make_protocol(conn)
+            for args in raw:
+                fp.write_raw_packet(*args)
+            received = b""
+            while len(received)<len(data):
+                received += s2.recv(65536)
+            assert received==data, "the packets have been modified"
+            assert fp.output_packetcount==3
+        finally:
+            s1.close()
+            s2.close()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
+import os
 import unittest
 
 from xpra.gtk_common.gobject_compat import import_gobject, import_glib
@@ -15,7 +16,9 @@ enable_debug_for("all")
 
 from xpra.gtk_common.gobject_util import one_arg_signal
 from xpra.net.protocol import Protocol
-from xpra.net.subprocess_wrapper import subprocess_caller, subprocess_callee
+from xpra.net.subprocess_wrapper import subprocess_caller, subprocess_callee, mmap_channel
+from xpra.net import mmap_pipe
+from xpra.net.mmap_pipe import init_client_mmap, init_server_mmap
 from xpra.net.bytestreams import Connection
 from xpra.os_util import Queue
 
@@ -152,6 +155,52 @@ class SubprocessWrapperTest(unittest.TestCase):
         assert rss== signal_string, "expected signal string '%s' but got '%s'" % (signal_string, rss)
         assert self.timeout is False, "the test did not exit cleanly (not received the 'end' packet?)"
 
+
+class MmapChannelTest(unittest.TestCase):
+
+    def test_channel(self):
+        success, _, mmap_area, mmap_size, temp_file, filename = init_client_mmap(size=1024*1024)
+        assert success
+        try:
+            caller = mmap_channel(mmap_area, mmap_size, True)
+            callee_area, callee_size = init_server_mmap(filename)
+            callee = mmap_channel(callee_area, callee_size, False)
+            data = os.urandom(1000)
+            #the caller must wait for the callee to open the area:
+            assert caller.encode(("add_data", data, {}))[0]=="add_data"
+            caller.enabled = True
+            for _ in range(5000):
+                packet = caller.encode(("add_data", data, {"foo" : 1}))
+                assert packet[0]=="add_data-mmap" and len(packet)==3
+                assert callee.decode(packet)==["add_data", data, {"foo" : 1}]
+                #and in the other direction:
+                packet = callee.encode(("new-buffer", data, {}, []))
+                assert packet[1][0][0]>=mmap_size//2
+                assert caller.decode(packet)==["new-buffer", data, {}, []]
+            #the space is reclaimed as the data is consumed:
+            assert caller.get_info()["fallback"]==0 and callee.get_info()["fallback"]==0
+            #too big for the area: sent in the packet, only counted
+            warnings = []
+            saved = mmap_pipe.log.warn
+            mmap_pipe.log.warn = lambda *args : warnings.append(args)
+            try:
+                large = b"x"*mmap_size
+                assert caller.encode(("add_data", large))==("add_data", large)
+            finally:
+                mmap_pipe.log.warn = saved
+            assert caller.get_info()["fallback"]==1 and not warnings, "unexpected warnings: %s" % (warnings,)
+            #non binary data goes through the pipe:
+            assert callee.encode(("foo", 1))==("foo", 1)
+            #the caller cannot point us to its own half of the area:
+            assert callee.decode(caller.encode(("add_data", data))) is not None
+            assert callee.decode(("add_data-mmap", [(mmap_size//2, 100)])) is None
+            callee.close()
+            caller.close()
+        finally:
+            temp_file.close()
+        assert not os.path.exists(filename)
+
+
 def main():
     unittest.main()
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+import random
+
+try:
+    from xpra.server.window.region import rectangle, banded_region    #@UnresolvedImport
+except ImportError:
+    rectangle, banded_region = None, None
+
+
+def get_pixels(rects):
+    pixels = set()
+    for r in rects:
+        for x in range(r.x, r.x+r.width):
+            for y in range(r.y, r.y+r.height):
+                pixels.add((x, y))
+    return pixels
+
+
+class TestBandedRegion(unittest.TestCase):
+
+    def verify_bands(self, region):
+        bands = region.get_bands()
+        for i, (y1, y2, spans) in enumerate(bands):
+            assert y1<y2
+            assert len(spans)>0 and len(spans)%2==0
+            assert list(spans)==sorted(set(spans)), "invalid spans: %s" % (spans,)
+            if i>0:
+                py1, py2, pspans = bands[i-1]
+                assert py2<=y1
+                assert py2<y1 or pspans!=spans, "bands %s and %s should have been coalesced" % (bands[i-1], bands[i])
+
+    def test_empty(self):
+        r = banded_region()
+        assert len(r)==0
+        assert r.get_rectangles()==[]
+        assert r.get_extents() is None
+        assert r.get_area()==0
+        assert not r.contains(0, 0, 1, 1)
+        assert not r.intersects(0, 0, 100, 100)
+        #zero sized rectangles are ignored:
+        r.add(10, 10, 0, 10)
+        r.add(10, 10, 10, 0)
+        assert len(r)==0
+
+    def test_add(self):
+        r = banded_region()
+        r.add(0, 0, 100, 100)
+        assert r.get_rectangles()==[rectangle(0, 0, 100, 100)]
+        #already contained:
+        r.add(10, 10, 20, 20)
+        assert r.get_rectangles()==[rectangle(0, 0, 100, 100)]
+        #adjacent rectangles are merged:
+        r.add(100, 0, 50, 100)
+        assert r.get_rectangles()==[rectangle(0, 0, 150, 100)]
+        r.add(0, 100, 150, 50)
+        assert r.get_rectangles()==[rectangle(0, 0, 150, 150)]
+        assert r.get_area()==150*150
+        self.verify_bands(r)
+
+    def test_no_vertical_split(self):
+        #a small rectangle next to a big one does not split it:
+        r = banded_region([(100, 100, 640, 480), (0, 300, 50, 10)])
+        assert len(r)==2
+        assert rectangle(100, 100, 640, 480) in r.get_rectangles()
+        assert len(r.get_bands())==3
+
+    def test_remove(self):
+        r = banded_region([rectangle(0, 0, 100, 100)])
+        r.remove(40, 40, 20, 20)
+        assert r.get_area()==100*100-20*20
+        assert not r.intersects(40, 40, 20, 20)
+        assert r.contains(0, 0, 100, 40)
+        assert not r.contains(0, 0, 100, 41)
+        r.remove(0, 0, 100, 100)
+        assert len(r)==0
+        assert r.get_bands()==[]
+
+    def test_operations(self):
+        a = banded_region([(0, 0, 100, 100)])
+        b = banded_region([(50, 50, 100, 100)])
+        assert a.union(b).get_area()==2*100*100-50*50
+        assert a.intersection(b).get_rectangles()==[rectangle(50, 50, 50, 50)]
+        assert a.substract(b).get_area()==100*100-50*50
+        assert a.intersection_rect(rectangle(50, 50, 100, 100))==a.intersection(b)
+        assert a.substract_rect(rectangle(50, 50, 100, 100))==a.substract(b)
+        assert a.union(b).get_extents()==rectangle(0, 0, 150, 150)
+        #the operations do not modify the original regions:
+        assert a.get_rectangles()==[rectangle(0, 0, 100, 100)]
+        assert b.get_rectangles()==[rectangle(50, 50, 100, 100)]
+        c = a.clone()
+        c.add_region(b)
+        assert c==a.union(b)
+        c.remove_region(b)
+        assert c==a.substract(b)
+
+    def test_random(self):
+        r = random.Random(0)
+        def rr():
+            return r.randint(-5, 20), r.randint(-5, 20), r.randint(0, 10), r.randint(0, 10)
+        for _ in range(200):
+            region = banded_region()
+            pixels = set()
+            for _ in range(r.randint(0, 10)):
+                rect = rectangle(*rr())
+                if r.random()<0.7:
+                    region.add_rect(rect)
+                    pixels |= get_pixels([rect])
+                else:
+                    region.remove_rect(rect)
+                    pixels -= get_pixels([rect])
+                self.verify_bands(region)
+                rects = region.get_rectangles()
+                assert get_pixels(rects)==pixels
+                #no overlapping rectangles:
+                assert sum(x.width*x.height for x in rects)==len(pixels)==region.get_area()
+            other = banded_region([rr() for _ in range(5)])
+            opixels = get_pixels(other)
+            assert get_pixels(region.union(other))==pixels|opixels
+            assert get_pixels(region.intersection(other))==pixels&opixels
+            assert get_pixels(region.substract(other))==pixels-opixels
+            rect = rectangle(*rr())
+            rpixels = get_pixels([rect])
+            assert region.contains_rect(rect)==(rpixels<=pixels)
+            assert region.intersects_rect(rect)==bool(rpixels & pixels)
+
+
+def main():
+    #skip test if import failed (ie: not a server build)
+    if banded_region is not None:
+        unittest.main()
+
+if __name__ == '__main__':
+    main()
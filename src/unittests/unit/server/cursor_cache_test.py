@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.util import AdHocStruct
+from xpra.os_util import memoryview_to_bytes
+from xpra.codecs.tile_cache import TileCache
+from xpra.net.bencode import bencode, bdecode
+try:
+    from xpra.server.source import ServerSource, get_cursor_key
+except ImportError:
+    ServerSource = None
+try:
+    from xpra.client.ui_client_base import UIXpraClient
+except ImportError:
+    UIXpraClient = None
+
+W, H = 4, 4
+
+
+def make_cursor(v):
+    return bytearray([v])*(W*H*4)
+
+
+@unittest.skipIf(ServerSource is None, "server source is not available")
+class TestCursorCacheServer(unittest.TestCase):
+
+    def make_source(self, cache_size):
+        source = ServerSource.__new__(ServerSource)
+        source.send_cursors = True
+        source.suspended = False
+        source.hello_sent = True
+        source.send_cursor_pending = False
+        source.last_cursor_sent = None
+        source.cursor_encodings = ["raw"]
+        source.cursor_cache = TileCache(cache_size)
+        source.global_batch_config = AdHocStruct()
+        source.global_batch_config.delay = 0
+        source.timeout_add = lambda delay, fn, *args : fn(*args)
+        source.packets = []
+        source.send = lambda *packet : source.packets.append(packet)
+        source.cursor = None
+        source.get_cursor_data_cb = lambda : ([0, 0, W, H, 0, 0, 1, source.cursor, "name"], (32, 64))
+        return source
+
+    def send(self, source, pixels):
+        source.cursor = pixels
+        source.send_cursor()
+        return source.packets[-1]
+
+    def test_key(self):
+        #the key does not depend on the type of buffer holding the pixels:
+        pixels = make_cursor(1)
+        key = get_cursor_key(W, H, pixels)
+        assert get_cursor_key(W, H, bytes(pixels))==key
+        assert get_cursor_key(W, H, memoryview(pixels))==key
+        assert get_cursor_key(W, H+1, pixels)!=key
+        assert get_cursor_key(W, H, make_cursor(2))!=key
+
+    def test_send(self):
+        source = self.make_source(2)
+        a, b, c = make_cursor(1), make_cursor(2), make_cursor(3)
+        #miss: the pixels are sent with the key the client must store them under
+        #(small cursors are sent uncompressed and without the encoding):
+        packet = self.send(source, a)
+        assert memoryview_to_bytes(packet[8])==bytes(a)
+        key_a = packet[-1]
+        assert key_a==get_cursor_key(W, H, a)
+        packet = self.send(source, b)
+        assert memoryview_to_bytes(packet[8])==bytes(b)
+        #hit: only the key is sent:
+        packet = self.send(source, a)
+        assert packet[1]=="cache" and packet[9]==key_a
+        #'b' is now the least recently used, so it gets evicted:
+        assert self.send(source, c)[1]!="cache"
+        assert self.send(source, a)[1]=="cache"
+        assert self.send(source, b)[1]!="cache"
+        assert len(source.packets)==6
+        #the client has lost track of its cache:
+        source.reset_cursor_cache()
+        assert len(source.cursor_cache)==1
+        packet = source.packets[-1]
+        assert len(source.packets)==7 and memoryview_to_bytes(packet[8])==bytes(b)
+        assert self.send(source, a)[1]!="cache"
+        assert self.send(source, b)[1]=="cache"
+
+
+@unittest.skipIf(UIXpraClient is None, "client is not available")
+class TestCursorCacheClient(unittest.TestCase):
+
+    def make_client(self, cache_size):
+        client = UIXpraClient.__new__(UIXpraClient)
+        client.cursor_cache = TileCache(cache_size)
+        client.cursors_enabled = True
+        client._id_to_window = {}
+        client.cursors = []
+        client.set_windows_cursor = lambda windows, cursor : client.cursors.append(cursor)
+        client.packets = []
+        client.send = lambda *packet : client.packets.append(packet)
+        return client
+
+    def process(self, client, *packet):
+        #simulate the network layer, which gives us bytes:
+        client._process_cursor(bdecode(bencode(list(packet)))[0])
+        return client.cursors[-1]
+
+    def test_process(self):
+        client = self.make_client(2)
+        a, b, c = bytes(make_cursor(1)), bytes(make_cursor(2)), bytes(make_cursor(3))
+        def cursor(encoding, pixels, *extra):
+            return ["cursor", encoding, 0, 0, W, H, 0, 0, 1, pixels, "name", 32, 64]+list(extra)
+        #miss: store the pixels
+        assert self.process(client, *cursor("raw", a, "key-a"))[8]==a
+        self.process(client, *cursor("raw", b, "key-b"))
+        #hit:
+        new_cursor = self.process(client, *cursor("cache", "key-a"))
+        assert new_cursor[0]==b"raw" and new_cursor[8]==a
+        #evicts 'b', the least recently used:
+        self.process(client, *cursor("raw", c, "key-c"))
+        assert "key-b" not in client.cursor_cache
+        count = len(client.cursors)
+        client._process_cursor(bdecode(bencode(cursor("cache", "key-b")))[0])
+        assert len(client.cursors)==count, "missing cursor should have been ignored"
+        #and the cache is reset on both sides:
+        assert client.packets==[("reset-cursor-cache", )]
+        assert len(client.cursor_cache)==0
+        #cursors are cached even when they are disabled, to stay in sync with the server:
+        client.cursors_enabled = False
+        client._process_cursor(bdecode(bencode(cursor("raw", b, "key-b")))[0])
+        assert len(client.cursors)==count
+        assert "key-b" in client.cursor_cache
+        info = client.cursor_cache.get_info()
+        assert info["hits"]==1 and info["misses"]==1
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
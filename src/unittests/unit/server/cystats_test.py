@@ -109,6 +109,57 @@ class TestCystats(unittest.TestCase):
 			v = cystats.logp(x)
 			assert v>=0 and v<=1
 
+	def test_time_series(self):
+		ts = cystats.TimeSeries(10, 3)
+		assert len(ts)==0 and list(ts)==[]
+		now = monotonic_time()
+		data = []
+		for i in range(25):
+			record = (now-25+i, random.randint(1, 1000), random.random())
+			ts.append(record)
+			data.append(record)
+		#only the last 10 records are kept:
+		data = data[-10:]
+		assert len(ts)==10
+		assert list(ts)==data
+		assert ts[0]==data[0] and ts[-1]==data[-1]
+		try:
+			ts[10]
+		except IndexError:
+			pass
+		else:
+			raise Exception("index should be out of range")
+		values = [v for _, _, v in data]
+		self.assertAlmostEqual(ts.get_sum(), sum(values))
+		self.assertAlmostEqual(ts.get_mean(), sum(values)/10)
+		assert ts.get_min()==min(values) and ts.get_max()==max(values)
+		assert ts.values()==values
+		#same results as the functions operating on lists:
+		a, ra = ts.time_weighted_average()
+		ea, era = cystats.calculate_time_weighted_average([(t, v) for t, _, v in data])
+		self.assertAlmostEqual(a, ea, places=4)
+		self.assertAlmostEqual(ra, era, places=4)
+		a, ra = ts.timesize_weighted_average(1)
+		ea, era = cystats.calculate_timesize_weighted_average(data)
+		assert abs(a-ea)<=ea/1000 and abs(ra-era)<=era/1000
+		from xpra.simple_stats import get_list_stats
+		assert ts.get_list_stats(1000)==get_list_stats([v*1000 for v in values])
+		ts.clear()
+		assert len(ts)==0 and ts.get_list_stats()=={}
+
+	def test_time_series_fields(self):
+		#time and value can be any of the fields:
+		ts = cystats.TimeSeries(5, 4, 1)
+		now = monotonic_time()
+		ts.append((1, now, 100, 0.5))
+		assert ts.time_weighted_average()==(0.5, 0.5)
+		try:
+			ts.append((now, 0.5))
+		except AssertionError:
+			pass
+		else:
+			raise Exception("records with the wrong number of fields should be rejected")
+
 
 def main():
 	if cystats:
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import unittest
+import tempfile
+
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.server.window.damage_trace import DamageTraceRecorder, read_damage_trace
+
+
+class TestDamageTrace(unittest.TestCase):
+
+    def make_trace(self, pixels):
+        f = tempfile.NamedTemporaryFile(prefix="damage-", suffix=".trace", delete=False)
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        recorder = DamageTraceRecorder(f.name, 5, {"title" : b"hello"}, pixels)
+        recorder.record_damage(0, 0, 10, 10, 100, 100)
+        recorder.record_damage(10, 20, 30, 40, 100, 100)
+        image = ImageWrapper(10, 20, 2, 2, b"\1"*16, "BGRX", 24, 8, 4)
+        recorder.record_image(image)
+        recorder.record_damage(0, 0, 200, 100, 200, 100)
+        recorder.close()
+        #closing twice is harmless:
+        recorder.close()
+        return read_damage_trace(f.name)
+
+    def test_damage(self):
+        wid, properties, records = self.make_trace(False)
+        assert wid==5
+        assert properties.get(b"title", properties.get("title"))==b"hello"
+        rtypes = [r[0] for r in records]
+        #the size is only recorded when it changes:
+        assert rtypes==["size", "damage", "damage", "size", "damage"], rtypes
+        assert records[0][2:]==[100, 100]
+        assert records[2][2:]==[10, 20, 30, 40]
+        assert records[3][2:]==[200, 100]
+        times = [r[1] for r in records]
+        assert times==sorted(times)
+
+    def test_pixels(self):
+        _, _, records = self.make_trace(True)
+        pixels = [r for r in records if r[0]=="pixels"]
+        assert len(pixels)==1
+        x, y, w, h, pixel_format, depth, rowstride, bpp, data = pixels[0][2:]
+        assert (x, y, w, h)==(10, 20, 2, 2)
+        assert pixel_format=="BGRX" and depth==24 and rowstride==8 and bpp==4
+        assert data==b"\1"*16
+
+    def test_invalid_file(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(b"not a trace")
+        f.close()
+        self.addCleanup(os.unlink, f.name)
+        try:
+            read_damage_trace(f.name)
+        except (IOError, OSError, ValueError):
+            pass
+        else:
+            raise Exception("should have failed to load %s" % f.name)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
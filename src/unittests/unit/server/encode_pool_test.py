@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+from threading import Event
+
+from xpra.server.encode_pool import EncodePool
+
+
+class TestEncodePool(unittest.TestCase):
+
+    def test_ordering(self):
+        pool = EncodePool("test", 4)
+        results = {}
+        def work(key, i):
+            results.setdefault(key, []).append(i)
+        def not_closed():
+            return False
+        for key in range(8):
+            pool.assign(key)
+        for i in range(100):
+            for key in range(8):
+                pool.queue(key, not_closed, (True, work, key, i))
+        pool.stop()
+        for w in pool.workers:
+            w.thread.join(10)
+        for key in range(8):
+            assert results.get(key)==list(range(100)), "invalid order for %s: %s" % (key, results.get(key))
+        #all the workers should have been used:
+        info = pool.get_info()
+        assert info.get("threads")==4
+        for i in range(4):
+            winfo = info["worker"][i]
+            assert winfo["windows"]==2, "worker %i has %s windows" % (i, winfo["windows"])
+            assert winfo["items"]==200
+
+    def test_concurrency(self):
+        pool = EncodePool("test", 2)
+        blocked = Event()
+        done = Event()
+        def not_closed():
+            return False
+        pool.assign(1)
+        pool.assign(2)
+        pool.queue(1, not_closed, (True, blocked.wait, 10))
+        pool.queue(2, not_closed, (True, done.set))
+        #window 2 must not be blocked by window 1:
+        assert done.wait(10)
+        blocked.set()
+        pool.stop()
+
+    def test_closed(self):
+        pool = EncodePool("test", 1)
+        calls = []
+        def closed():
+            return True
+        pool.assign(1)
+        pool.queue(1, closed, (True, calls.append, "optional"))
+        pool.queue(1, closed, (False, calls.append, "required"))
+        pool.stop()
+        pool.workers[0].thread.join(10)
+        assert calls==["required"]
+        pool.release(1)
+        assert not pool.assignments
+
+    def test_qsize(self):
+        pool = EncodePool("test", 1)
+        blocked = Event()
+        def not_closed():
+            return False
+        pool.assign(1)
+        pool.assign(2)
+        pool.queue(1, not_closed, (True, blocked.wait, 10))
+        for _ in range(3):
+            pool.queue(2, not_closed, (True, len, ""))
+        #both windows share the worker, but each one only sees its own backlog:
+        assert pool.qsize(1)==1
+        assert pool.qsize(2)==3
+        assert pool.qsize()>=3
+        #unknown keys are not assigned by the lookup:
+        assert pool.qsize(3)==0
+        assert 3 not in pool.assignments
+        #work queued after the release is dropped:
+        pool.release(2)
+        assert pool.qsize(2)==0
+        pool.queue(2, not_closed, (True, len, ""))
+        assert 2 not in pool.assignments
+        blocked.set()
+        pool.stop()
+        pool.workers[0].thread.join(10)
+        assert pool.qsize(1)==0
+        assert not pool.workers[0].pending
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import threading
+import unittest
+
+try:
+    from xpra.server import server_base
+    from xpra.server.window.window_source import WindowSource
+    from xpra.server.window.batch_config import DamageBatchConfig
+    from xpra.server.window.window_stats import WindowPerformanceStatistics
+    from xpra.server.source_stats import GlobalPerformanceStatistics
+except ImportError:
+    server_base = None
+
+
+class FakeWindow(object):
+
+    def __init__(self, w=640, h=480, iconic=False):
+        self.w = w
+        self.h = h
+        self.iconic = iconic
+
+    def get_property_names(self):
+        return ["iconic"]
+
+    def get_property(self, prop):
+        assert prop=="iconic"
+        return self.iconic
+
+    def get_dimensions(self):
+        return self.w, self.h
+
+    def acknowledge_changes(self):
+        pass
+
+
+class FakeSource(object):
+
+    def __init__(self):
+        self.damaged = []
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    def damage(self, wid, window, x, y, w, h, options):
+        self.damaged.append((wid, (x, y, w, h), options))
+
+
+@unittest.skipIf(server_base is None, "server is not available")
+class TestInitialDamage(unittest.TestCase):
+
+    def make_server(self, windows, focused):
+        server = server_base.ServerBase.__new__(server_base.ServerBase)
+        server._id_to_window = dict(windows)
+        server.get_root_window_size = lambda : (1024, 768)
+        server.get_focus = lambda : focused
+        server.timers = []
+        server.timeout_add = lambda delay, fn, *args : server.timers.append((delay, fn, args))
+        return server
+
+    def test_priority(self):
+        windows = {
+                   1   : FakeWindow(),
+                   2   : FakeWindow(),
+                   3   : FakeWindow(iconic=True),
+                   4   : FakeWindow(),
+                   5   : FakeWindow(),
+                   6   : FakeWindow(),
+                   }
+        server = self.make_server(windows, 4)
+        ss = FakeSource()
+        server.send_initial_damage(ss, [
+                                        (1, windows[1], 0, 0, 640, 480),
+                                        (2, windows[2], 10, 10, 640, 480),
+                                        (3, windows[3], 0, 0, 640, 480),
+                                        (4, windows[4], 20, 20, 640, 480),
+                                        #off-screen:
+                                        (5, windows[5], -1000, 0, 640, 480),
+                                        #empty:
+                                        (6, windows[6], 0, 0, 0, 0),
+                                        ])
+        #the focused window goes first, then the other visible windows:
+        assert [x[0] for x in ss.damaged]==[4, 1, 2], "invalid order: %s" % ([x[0] for x in ss.damaged],)
+        for _, area, options in ss.damaged:
+            assert area==(0, 0, 640, 480)
+            assert options.get("initial") and options.get("delay")==0
+        #the others are deferred:
+        assert len(server.timers)==1
+        delay, fn, args = server.timers[0]
+        assert delay==server_base.INITIAL_DEFER_DELAY
+        #window 3 is gone by the time the timer fires:
+        del server._id_to_window[3]
+        ss.damaged = []
+        fn(*args)
+        assert [x[0] for x in ss.damaged]==[5]
+        #nothing is sent once the client has disconnected:
+        ss.closed = True
+        ss.damaged = []
+        fn(*args)
+        assert not ss.damaged
+
+
+@unittest.skipIf(server_base is None, "server is not available")
+class TestInitialBatchDelay(unittest.TestCase):
+
+    def make_window_source(self):
+        ws = WindowSource.__new__(WindowSource)
+        ws.wid = 1
+        ws._sequence = 1
+        ws.ui_thread = threading.current_thread()
+        ws.suspended = False
+        ws.window = FakeWindow()
+        ws.window_dimensions = 0, 0
+        ws.damage_trace = None
+        ws.full_frames_only = False
+        ws.encoding = "rgb24"
+        ws._damage_delayed = None
+        ws._damage_delayed_expired = False
+        ws.expire_timer = None
+        ws.statistics = WindowPerformanceStatistics()
+        ws.global_statistics = GlobalPerformanceStatistics()
+        ws.batch_config = DamageBatchConfig()
+        #a new client: the encode queue is full of the other windows
+        ws.queue_size = lambda : 20
+        ws.calls = []
+        ws.idle_add = lambda fn, *args : ws.calls.append(("idle", 0))
+        ws.timeout_add = lambda delay, fn, *args : ws.calls.append(("timeout", delay))
+        return ws
+
+    def test_initial(self):
+        #the window has just been "resized" and the queue is big, so we batch:
+        ws = self.make_window_source()
+        ws.damage(0, 0, 640, 480, {"delay" : 0, "encoding" : "rgb24"})
+        assert len(ws.calls)==1
+        kind, delay = ws.calls[0]
+        assert kind=="timeout" and delay>=ws.batch_config.min_delay, "expected a batch delay but got %s" % (ws.calls,)
+        assert ws._damage_delayed
+        #but not for the initial refresh:
+        ws = self.make_window_source()
+        ws.damage(0, 0, 640, 480, {"initial" : True, "delay" : 0, "encoding" : "rgb24"})
+        assert ws.calls==[("idle", 0)], "expected the damage to be sent now but got %s" % (ws.calls,)
+        assert not ws._damage_delayed
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.metrics import MetricsRegistry, Counter, Gauge, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        r = MetricsRegistry()
+        c = r.get_metric(Counter, "test_total", "A test counter")
+        c.inc()
+        c.inc(2)
+        #getting it again returns the same metric:
+        assert r.get_metric(Counter, "test_total", "A test counter") is c
+        lines = r.generate().splitlines()
+        assert lines==["# HELP test_total A test counter", "# TYPE test_total counter", "test_total 3.0"], lines
+        #but not as a different type:
+        try:
+            r.get_metric(Gauge, "test_total", "")
+        except AssertionError:
+            pass
+        else:
+            raise Exception("metric type mismatch should have failed")
+
+    def test_labels(self):
+        r = MetricsRegistry()
+        g = r.get_metric(Gauge, "test_gauge", "A test gauge", ("client", "wid"))
+        g.labels("1", "2").set(5)
+        g.labels("1", "3").set(1)
+        g.labels("1", "3").dec()
+        g.labels("quote\"", "1").inc()
+        text = r.generate()
+        assert 'test_gauge{client="1",wid="2"} 5.0' in text
+        assert 'test_gauge{client="1",wid="3"} 0.0' in text
+        assert 'test_gauge{client="quote\\"",wid="1"} 1.0' in text
+        g.clear()
+        assert "test_gauge{" not in r.generate()
+
+    def test_histogram(self):
+        r = MetricsRegistry()
+        h = r.get_metric(Histogram, "test_seconds", "A test histogram", buckets=(1, 0.1))
+        for v in (0.05, 0.5, 0.5, 5):
+            h.observe(v)
+        lines = r.generate().splitlines()[2:]
+        assert lines==[
+            'test_seconds_bucket{le="0.1"} 1.0',
+            'test_seconds_bucket{le="1.0"} 3.0',
+            'test_seconds_bucket{le="+Inf"} 4.0',
+            'test_seconds_sum 6.05',
+            'test_seconds_count 4.0',
+            ], lines
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
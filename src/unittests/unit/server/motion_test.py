@@ -224,6 +224,80 @@ class TestMotion(unittest.TestCase):
 				assert y+line+scroll<=wh, "cannot scroll rectangle %i high by %i lines from %i+%i (window height is %i)" % (count, scroll, y, line, wh)
 				scrolls.append((x, y+line, w, count, 0, scroll))
 
+	def test_scroll_detector(self):
+		import random
+		import struct
+		W, H, BPP = 200, 150, 4
+		r = random.Random(0)
+		def rnd(w, h):
+			return [[r.getrandbits(32) for _ in range(w)] for _ in range(h)]
+		def tobytes(img):
+			return b"".join(struct.pack("=%iI" % len(row), *row) for row in img)
+		def apply(old, new, scrolls, paints):
+			#what the client does: scrolls first (all from the old image), then paints
+			client = [list(row) for row in old]
+			for x, y, w, h, dx, dy in scrolls:
+				for j in range(h):
+					client[y+dy+j][x+dx:x+dx+w] = old[y+j][x:x+w]
+			for x, y, w, h in paints:
+				for j in range(h):
+					client[y+j][x:x+w] = new[y+j][x:x+w]
+			return client
+		def t(old, new, max_repaint):
+			sd = motion.ScrollDetector()
+			assert sd.update(tobytes(old), 0, 0, W, H, W*BPP, BPP) is None
+			scrolls, paints = sd.update(tobytes(new), 0, 0, W, H, W*BPP, BPP)
+			assert apply(old, new, scrolls, paints)==new, "invalid scrolls=%s, paints=%s" % (scrolls, paints)
+			repaint = sum(w*h for _, _, w, h in paints)
+			assert repaint<=max_repaint, "too many pixels repainted: %i, scrolls=%s, paints=%s" % (repaint, scrolls, paints)
+			return scrolls
+		#static toolbar (20 lines) and sidebar (40 columns):
+		old = rnd(W, H)
+		#the edges of the scrolled areas which are not aligned to the checksum blocks are repainted:
+		edge = motion.SCROLL_BLOCK_WIDTH*(H-20)
+		#no change at all:
+		assert t(old, old, 0)==[]
+		#vertical scroll of the content pane by 10 lines:
+		content = rnd(W-40, H+20)
+		new = [list(row) for row in old]
+		for y in range(20, H):
+			old[y][40:] = content[y]
+			new[y][40:] = content[y+10]
+		scrolls = t(old, new, (W-40)*10+edge)
+		assert [s[4:] for s in scrolls]==[(0, -10)], "expected a single vertical scroll but got %s" % (scrolls,)
+		#horizontal scroll of the content pane by 7 columns:
+		new = [list(row) for row in old]
+		for y in range(20, H):
+			new[y][40:] = [r.getrandbits(32) for _ in range(7)] + old[y][40:W-7]
+		scrolls = t(old, new, 7*(H-20)+edge)
+		assert [s[4:] for s in scrolls]==[(7, 0)], "expected a single horizontal scroll but got %s" % (scrolls,)
+		#two panes scrolling by different amounts:
+		c1 = rnd(60, H+50)
+		c2 = rnd(80, H+50)
+		new = [list(row) for row in old]
+		for y in range(20, H):
+			old[y][40:100] = c1[y+20]
+			new[y][40:100] = c1[y+25]
+			old[y][120:200] = c2[y+20]
+			new[y][120:200] = c2[y+10]
+		scrolls = t(old, new, 60*5+80*10+2*edge)
+		assert sorted(s[5] for s in scrolls)==[-5, 10], "expected two vertical scrolls but got %s" % (scrolls,)
+		#random changes:
+		t(old, rnd(W, H), W*H)
+
+	def test_scroll_detector_invalidate(self):
+		W, H, BPP = 64, 64, 4
+		sd = motion.ScrollDetector()
+		pixels = bytes(bytearray(range(256))*(W*H*BPP//256))
+		sd.update(pixels, 0, 0, W, H, W*BPP, BPP)
+		sd.invalidate(0, 10, 10, 5)
+		#the client does not have the pixels for those lines any more:
+		scrolls, paints = sd.update(pixels, 0, 0, W, H, W*BPP, BPP)
+		assert scrolls==[] and paints==[(0, 10, W, 5)], "scrolls=%s, paints=%s" % (scrolls, paints)
+		#too much invalidated, start again:
+		sd.invalidate(0, 0, W, H//2+1)
+		assert sd.update(pixels, 0, 0, W, H, W*BPP, BPP) is None
+
 
 def main():
 	if motion:
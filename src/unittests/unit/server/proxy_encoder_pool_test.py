@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import time
+import unittest
+from threading import Thread
+from multiprocessing import Process, Value
+
+from xpra.server.proxy.proxy_encoder_pool import ProxyEncoderPool
+
+
+def encode_frames(session, active, max_active, frames):
+    for _ in range(frames):
+        session.acquire()
+        with active.get_lock():
+            active.value += 1
+            max_active.value = max(max_active.value, active.value)
+        time.sleep(0.01)
+        with active.get_lock():
+            active.value -= 1
+        session.release()
+
+
+class TestProxyEncoderPool(unittest.TestCase):
+
+    def test_concurrency(self):
+        pool = ProxyEncoderPool(2, 10, 8)
+        active = Value("i", 0)
+        max_active = Value("i", 0)
+        processes = []
+        for _ in range(4):
+            session = pool.get_session(pool.add_session())
+            p = Process(target=encode_frames, args=(session, active, max_active, 10))
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join(30)
+            assert p.exitcode==0
+        assert max_active.value==2, "expected 2 concurrent encodings but got %i" % max_active.value
+        info = pool.get_info()
+        assert info["frames"]==40
+        assert info["active"]==0 and info["queue"]["size"]==0
+        for sinfo in info["session"].values():
+            assert sinfo["frames"]==10
+
+    def test_round_robin(self):
+        pool = ProxyEncoderPool(1, 10, 8)
+        a, b, c = [pool.get_session(pool.add_session()) for _ in range(3)]
+        order = []
+        def encode(session, name):
+            session.acquire()
+            order.append(name)
+            session.release()
+        a.acquire()
+        threads = []
+        for session, name in ((b, "b"), (c, "c")):
+            t = Thread(target=encode, args=(session, name))
+            t.start()
+            threads.append(t)
+            #wait for it to be queued:
+            while pool.get_info()["session"][session.index]["waiting"] is False:
+                time.sleep(0.01)
+        a.release()
+        #'a' queues again, it must wait for the others:
+        encode(a, "a")
+        for t in threads:
+            t.join(10)
+        assert order==["b", "c", "a"], "invalid order: %s" % (order,)
+
+    def test_contexts(self):
+        pool = ProxyEncoderPool(1, 2, 8)
+        a = pool.get_session(pool.add_session())
+        b = pool.get_session(pool.add_session())
+        assert a.add_context() and a.add_context()
+        assert not b.add_context()
+        a.remove_context()
+        assert b.add_context()
+        assert a.get_info()["session"]["contexts"]==1
+        #removing a session frees everything it held:
+        a.acquire()
+        pool.remove_session(a.index)
+        assert b.add_context()
+        assert pool.get_info()["active"]==0
+        b.acquire()
+        b.release()
+
+    def test_sessions(self):
+        pool = ProxyEncoderPool(1, 2, 2)
+        assert pool.add_session()==0
+        assert pool.add_session()==1
+        assert pool.add_session() is None
+        pool.remove_session(0)
+        assert pool.add_session()==0
+        assert pool.get_info()["sessions"]==2
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
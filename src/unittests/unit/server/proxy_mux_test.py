@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import socket
+import unittest
+
+from xpra.util import typedict
+from xpra.os_util import bytestostr
+from xpra.net import packet_encoding
+from xpra.net.header import pack_header, unpack_header
+from xpra.net.bytestreams import SocketConnection
+from xpra.server.proxy.proxy_mux import MuxSession, ProxyMuxWorker, can_multiplex, needs_video_proxy, encode_packet
+
+
+def read_packets(sock, count):
+    """ reads 'count' complete packets, returns them with the raw bytes received """
+    data = b""
+    packets = []
+    while len(packets)<count:
+        data += sock.recv(65536)
+        packets = []
+        pos = 0
+        while len(data)>=pos+8:
+            _, flags, level, index, size = unpack_header(data[pos:pos+8])
+            if len(data)<pos+8+size:
+                break
+            if index==0:
+                packets.append(packet_encoding.decode(data[pos+8:pos+8+size], flags))
+            pos += 8+size
+    return packets, data
+
+
+class TestMuxSession(unittest.TestCase):
+
+    def setUp(self):
+        self.client, client_proxy = socket.socketpair()
+        self.server, server_proxy = socket.socketpair()
+        for s in (self.client, self.server):
+            s.settimeout(5)
+        for s in (client_proxy, server_proxy):
+            s.setblocking(0)
+        caps = {"bencode" : True, "encodings" : ["rgb"]}
+        self.session = MuxSession(1, ":10", client_proxy, server_proxy, caps, "bencode", {})
+
+    def tearDown(self):
+        self.session.close()
+        self.client.close()
+        self.server.close()
+
+    def pump(self):
+        """ what the worker's poll loop does, without waiting """
+        for _ in range(10):
+            for endpoint in self.session.endpoints():
+                endpoint.flush()
+                if self.session.wants_read(endpoint) or endpoint is self.session.client:
+                    try:
+                        data = endpoint.sock.recv(65536)
+                    except socket.error:
+                        continue
+                    self.session.process_data(endpoint, data)
+
+    def test_handshake_and_forward(self):
+        self.session.start()
+        self.pump()
+        packets, _ = read_packets(self.server, 1)
+        assert bytestostr(packets[0][0])=="hello"
+        hello = typedict(packets[0][1])
+        assert hello.boolget("proxy")
+        assert not hello.boolget("zlib.stream")
+        #the client sends something before the handshake is complete:
+        early = encode_packet(["ping", 1], "bencode")
+        self.client.send(early)
+        self.pump()
+        assert not self.session.raw
+        #server replies, followed by a packet with a large raw chunk:
+        large = b"x"*100000
+        after_hello = pack_header(0, 0, 1, len(large))+large + encode_packet(["draw", 1, "", 0], "bencode")
+        self.server.send(encode_packet(["hello", {"bencode" : True}], "bencode")+after_hello)
+        self.pump()
+        assert self.session.raw
+        packets, data = read_packets(self.client, 2)
+        assert bytestostr(packets[0][0])=="hello"
+        assert typedict(packets[0][1]).boolget("proxy")
+        #everything after the proxy's hello is forwarded as-is:
+        hello_size = 8+unpack_header(data[:8])[4]
+        assert data[hello_size:]==after_hello, "the packets have been modified"
+        #the early packet is forwarded now:
+        _, data = read_packets(self.server, 1)
+        assert data==early
+        #disconnect from the client:
+        disconnect = encode_packet(["disconnect", "done"], "bencode")
+        self.client.send(disconnect)
+        self.pump()
+        assert self.session.closing
+        _, data = read_packets(self.server, 1)
+        assert data==disconnect
+
+    def test_server_disconnect(self):
+        self.session.start()
+        self.server.send(encode_packet(["disconnect", "no"], "bencode"))
+        self.pump()
+        assert self.session.closing and not self.session.raw
+        packets, _ = read_packets(self.client, 1)
+        assert bytestostr(packets[0][0])=="disconnect"
+
+    def test_invalid_header(self):
+        self.session.start()
+        self.server.send(b"GET / HTTP/1.1\r\n")
+        self.pump()
+        assert self.session.closing
+
+
+class TestMuxWorker(unittest.TestCase):
+
+    def test_update(self):
+        #the worker process is not started, we use its end of the pipe directly:
+        worker = ProxyMuxWorker(0, 0)
+        worker.sessions = {1 : ":10", 2 : ":11"}
+        worker.child_conn.send(("ended", 1))
+        assert worker.update()
+        assert worker.sessions=={2 : ":11"}
+        assert worker.update()
+        #the worker has gone:
+        worker.child_conn.close()
+        assert not worker.update()
+        assert not worker.sessions
+        worker.conn.close()
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_can_multiplex(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            assert can_multiplex(SocketConnection(sock, "local", "remote", "test", "tcp"))
+        finally:
+            sock.close()
+
+    def test_needs_video_proxy(self):
+        caps = typedict({"encodings" : ["rgb", "h264"]})
+        assert not needs_video_proxy([], caps)
+        assert not needs_video_proxy(["none"], caps)
+        assert needs_video_proxy(["nvenc"], caps)
+        assert not needs_video_proxy(["nvenc"], typedict({"encodings" : ["png"]}))
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.codecs.tile_cache import TileCache
+try:
+    from xpra.server.window.tile_hash import hash_tiles    #@UnresolvedImport
+except ImportError:
+    hash_tiles = None
+
+
+class TestTileCache(unittest.TestCase):
+
+    def test_hash_tiles(self):
+        #3x2 tiles of 4x4 pixels, with the right and bottom edges smaller:
+        W, H, BPP, T = 10, 6, 4, 4
+        rowstride = W*BPP+8
+        pixels = bytearray(rowstride*H)
+        hashes = hash_tiles(pixels, W, H, rowstride, BPP, T)
+        assert len(hashes)==3*2
+        assert all(h>=0 for h in hashes)
+        #tiles with the same contents and dimensions have the same checksum:
+        assert hashes[0]==hashes[1]
+        assert hashes[3]==hashes[4]
+        #but not when the dimensions differ:
+        assert len(set((hashes[0], hashes[2], hashes[3], hashes[5])))==4
+        #the rowstride padding is ignored:
+        pixels[W*BPP] = 0xff
+        assert hash_tiles(pixels, W, H, rowstride, BPP, T)==hashes
+        #modify one pixel of the second tile:
+        pixels[rowstride+T*BPP] = 0xff
+        modified = hash_tiles(pixels, W, H, rowstride, BPP, T)
+        assert modified[1]!=hashes[1]
+        assert [h for i,h in enumerate(modified) if i!=1]==[h for i,h in enumerate(hashes) if i!=1]
+
+    def test_lru(self):
+        tc = TileCache(3)
+        for i in range(3):
+            tc.add(i, "tile%i" % i)
+        assert len(tc)==3
+        #using a tile makes it the most recently used one:
+        assert tc.get(0)=="tile0"
+        tc.add(3, "tile3")
+        assert 1 not in tc
+        assert list(tc.tiles.keys())==[2, 0, 3]
+        #re-adding a tile also does:
+        tc.add(2, "tile2")
+        tc.add(4, "tile4")
+        assert list(tc.tiles.keys())==[3, 2, 4]
+        try:
+            tc.get(1)
+        except KeyError:
+            pass
+        else:
+            raise Exception("tile 1 should have been evicted")
+        info = tc.get_info()
+        assert info["hits"]==1 and info["misses"]==1
+        tc.clear()
+        assert len(tc)==0
+
+    def test_mirror(self):
+        #the server mirrors the client's cache without the pixel data,
+        #both must evict the same tiles when applying the same operations:
+        import random
+        r = random.Random(0)
+        client = TileCache(16)
+        server = TileCache(16)
+        for _ in range(1000):
+            key = r.randint(0, 40)
+            if key in server:
+                server.get(key)
+                assert client.get(key)==key*2
+            else:
+                server.add(key)
+                client.add(key, key*2)
+            assert list(server.tiles.keys())==list(client.tiles.keys())
+
+
+def main():
+    #skip test if import failed (ie: not a server build)
+    if hash_tiles is not None:
+        unittest.main()
+
+if __name__ == '__main__':
+    main()
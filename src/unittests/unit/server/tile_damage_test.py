@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.server.shadow.root_window_model import RootWindowModel
+try:
+    from xpra.server.shadow.tile_damage import TileChangeDetector
+except ImportError:
+    TileChangeDetector = None
+
+W, H, BPP = 100, 70, 4
+
+
+class FakeRootWindowModel(RootWindowModel):
+    def __init__(self, pixels):
+        RootWindowModel.__init__(self, None)
+        self.pixels = pixels
+        self.captures = 0
+    def get_image(self, x, y, w, h):
+        image = self.get_frame_image(x, y, w, h)
+        if image:
+            return image
+        self.captures += 1
+        return make_image(self.pixels).get_sub_image(x, y, w, h)
+
+
+def make_image(pixels):
+    return ImageWrapper(0, 0, W, H, bytes(pixels), "BGRX", 24, W*BPP, BPP)
+
+def set_pixel(pixels, x, y, v=0xff):
+    pixels[y*W*BPP+x*BPP] = v
+
+
+class TestTileDamage(unittest.TestCase):
+
+    def test_detector(self):
+        td = TileChangeDetector(16)
+        pixels = bytearray(W*H*BPP)
+        #first frame is always a full update:
+        assert td.update(make_image(pixels))==[(0, 0, W, H)]
+        assert td.update(make_image(pixels))==[]
+        set_pixel(pixels, 20, 5)
+        assert td.update(make_image(pixels))==[(16, 0, 16, 16)]
+        #tiles on the edges are smaller:
+        set_pixel(pixels, W-1, H-1)
+        assert td.update(make_image(pixels))==[(96, 64, 4, 6)]
+        #adjacent tiles are merged horizontally and vertically:
+        for x, y in ((1, 17), (17, 17), (1, 33), (17, 33), (60, 33)):
+            set_pixel(pixels, x, y)
+        assert td.update(make_image(pixels))==[(0, 16, 32, 32), (48, 32, 16, 16)]
+        info = td.get_info()
+        assert info["frames"]==5 and info["idle-frames"]==1
+        #a new geometry triggers a full update:
+        image = ImageWrapper(0, 0, W, H-1, bytes(pixels), "BGRX", 24, W*BPP, BPP)
+        assert td.update(image)==[(0, 0, W, H-1)]
+
+    def test_refresh_delay(self):
+        from xpra.server.shadow import shadow_server_base
+        ShadowServerBase = shadow_server_base.ShadowServerBase
+        pixels = bytearray(W*H*BPP)
+        class FakeRoot(object):
+            def get_size(self):
+                return W, H
+        class FakeShadowServer(ShadowServerBase):
+            def __init__(self):
+                ShadowServerBase.__init__(self, FakeRoot())
+                self.root_window_model = FakeRootWindowModel(pixels)
+                self.damage = []
+                self.timers = []
+            def timeout_add(self, delay, fn):
+                self.timers.append(delay)
+                return len(self.timers)
+            def source_remove(self, timer):
+                pass
+            def _damage(self, window, x, y, w, h):
+                self.damage.append((x, y, w, h))
+        server = FakeShadowServer()
+        server.tile_detector = TileChangeDetector(16)
+        delay = server.refresh_delay
+        server.start_refresh()
+        assert server.timers==[delay]
+        #first frame:
+        assert server.refresh_timer() is True
+        assert server.damage==[(0, 0, W, H)]
+        #nothing changes, so we should back off:
+        assert server.refresh_timer() is False
+        assert server.timers[-1]==delay*2
+        for _ in range(10):
+            server.refresh_timer()
+        assert server.current_refresh_delay==max(delay, shadow_server_base.MAX_REFRESH_DELAY)
+        assert server.damage==[(0, 0, W, H)]
+        #a change brings us back to the normal rate:
+        set_pixel(pixels, 0, 0)
+        server.damage = []
+        server.refresh_timer()
+        assert server.damage==[(0, 0, 16, 16)]
+        assert server.current_refresh_delay==delay
+        server.stop_refresh()
+        assert server.refresh_timer() is False
+        assert server.root_window_model.frame is None
+
+    def test_frame_reuse(self):
+        pixels = bytearray(W*H*BPP)
+        rwm = FakeRootWindowModel(pixels)
+        frame = rwm.get_image(0, 0, W, H)
+        rwm.set_frame(frame)
+        #the damage is served from the frame, even if the screen has changed since:
+        set_pixel(pixels, 20, 5)
+        image = rwm.get_image(16, 0, 16, 16)
+        assert rwm.captures==1
+        assert (image.get_x(), image.get_y(), image.get_width(), image.get_height())==(16, 0, 16, 16)
+        assert image.get_pixels()==b"\0"*(16*16*BPP)
+        #areas outside the frame are captured:
+        rwm.set_frame(frame.get_sub_image(0, 0, W, H//2))
+        assert frame.freed
+        image = rwm.get_image(16, H//2, 16, 16)
+        assert rwm.captures==2
+        #the whole frame is handed over:
+        frame = rwm.frame
+        assert rwm.get_image(0, 0, W, H//2) is frame and rwm.frame is None
+        rwm.cleanup()
+
+
+def main():
+    #skip test if import failed (ie: not a server build)
+    if TileChangeDetector is not None:
+        unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import time
+import unittest
+
+from xpra.server.window.video_stripes import get_stripe_counts, VideoStripe, StripedPipeline, MIN_STRIPE_HEIGHT
+from xpra.server.window.video_scoring import get_speed_score
+
+
+class FakeCodec(object):
+
+    def __init__(self):
+        self.cleaned = False
+
+    def get_type(self):
+        return "fake"
+
+    def clean(self):
+        self.cleaned = True
+
+
+def make_pipeline(n, height=256):
+    stripes = [VideoStripe(i, i*height, height, None, FakeCodec()) for i in range(n)]
+    return StripedPipeline(3840, n*height, "BGRX", 3840, stripes)
+
+
+class TestVideoStripes(unittest.TestCase):
+
+    def test_stripe_counts(self):
+        assert get_stripe_counts(3840, 2160, 0)==[]
+        assert get_stripe_counts(3840, 2160, 1)==[]
+        #too small:
+        assert get_stripe_counts(1920, 1080, 4)==[]
+        counts = get_stripe_counts(3840, 2160, 16)
+        assert counts and counts[0]==2
+        for n in counts:
+            assert 2160//n>=MIN_STRIPE_HEIGHT
+
+    def test_encode_order(self):
+        sp = make_pipeline(4)
+        assert sp.get_covered_height()==4*256
+        assert sp.matches(3840, 4*256, "BGRX")
+        assert not sp.matches(3840, 4*256, "RGB")
+        def encode_stripe(stripe, image, delay):
+            #finish in reverse order:
+            time.sleep(delay*(4-stripe.index))
+            return (image, stripe.index)
+        r = sp.encode(encode_stripe, "image", 0.01)
+        assert r==[("image", i) for i in range(4)], r
+        assert sp.get_info()["frames"]==1
+        stripes = sp.stripes
+        sp.clean()
+        assert sp.is_closed() and not sp.matches(3840, 4*256, "BGRX")
+        for stripe in stripes:
+            assert stripe.ve is None
+
+    def test_encode_error(self):
+        sp = make_pipeline(3)
+        done = []
+        def encode_stripe(stripe, image):
+            if stripe.index==1:
+                raise ValueError("stripe failure")
+            time.sleep(0.01)
+            done.append(stripe.index)
+        try:
+            sp.encode(encode_stripe, None)
+        except ValueError:
+            pass
+        else:
+            raise Exception("stripe error should have been re-raised")
+        #the other stripes have all completed:
+        assert sorted(done)==[0, 2]
+        assert sp.get_info()["frames"]==0
+        sp.clean()
+
+    def test_speed_score(self):
+        class FakeSpec(object):
+            speed = 50
+        single = get_speed_score("BGRX", None, FakeSpec(), (1, 1), 80, 0)
+        striped = get_speed_score("BGRX", None, FakeSpec(), (1, 1), 80, 0, stripes=4)
+        assert striped>single, "%s vs %s" % (striped, single)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+try:
+    from xpra.x11.bindings import ximage      #@UnresolvedImport
+except ImportError:
+    ximage = None
+
+W, H = 64, 32
+
+
+def make_image(size=W*H*4, value=0):
+    #the wrappers copy the pixels into a buffer from the pool,
+    #this does not require an X11 server:
+    image = ximage.XImageWrapper(0, 0, W, H, pixel_format="BGRX", rowstride=W*4)
+    image.set_pixels(bytes(bytearray([value])*size))
+    return image
+
+
+@unittest.skipIf(ximage is None, "ximage bindings are not available")
+class TestPixelBufferPool(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = ximage.POOL_BUFFERS, ximage.POOL_SIZE
+        ximage.free_pixel_buffers()
+
+    def tearDown(self):
+        ximage.POOL_BUFFERS, ximage.POOL_SIZE = self.saved
+        ximage.free_pixel_buffers()
+
+    def counters(self):
+        info = ximage.get_pixel_buffers_info()
+        return info["hits"], info["misses"]
+
+    def test_reuse(self):
+        hits, misses = self.counters()
+        image = make_image(value=1)
+        assert self.counters()==(hits, misses+1)
+        image.free()
+        info = ximage.get_pixel_buffers_info()
+        assert info["buffers"]=={W*H*4 : 1}
+        assert info["size"]==W*H*4
+        #same size: the buffer is re-used, and holds the new pixels:
+        image = make_image(value=2)
+        assert self.counters()==(hits+1, misses+1)
+        assert ximage.get_pixel_buffers_info()["size"]==0
+        assert bytes(image.get_pixels())==bytes(bytearray([2])*W*H*4)
+        #restriding takes a buffer of a different size from the pool,
+        #and returns the old one to it:
+        assert image.restride(W*4+16)
+        assert image.get_rowstride()==W*4+16
+        assert self.counters()==(hits+1, misses+2)
+        assert ximage.get_pixel_buffers_info()["buffers"]=={W*H*4 : 1}
+        image.free()
+        assert len(ximage.get_pixel_buffers_info()["buffers"])==2
+
+    def test_limits(self):
+        ximage.POOL_BUFFERS = 2
+        images = [make_image() for _ in range(4)]
+        for image in images:
+            image.free()
+        info = ximage.get_pixel_buffers_info()
+        assert info["buffers"]=={W*H*4 : 2}
+        assert info["size"]==2*W*H*4
+        #not enough room: the buffers of other sizes are freed first
+        ximage.POOL_SIZE = 3*W*H*4
+        make_image(W*H*4*2).free()
+        info = ximage.get_pixel_buffers_info()
+        assert info["buffers"]=={W*H*4*2 : 1}
+        assert info["size"]==2*W*H*4
+        #too big for the pool:
+        make_image(W*H*4*4).free()
+        assert ximage.get_pixel_buffers_info()["buffers"]=={W*H*4*2 : 1}
+
+    def test_free(self):
+        for image in [make_image() for _ in range(3)]:
+            image.free()
+        assert ximage.get_pixel_buffers_info()["size"]>0
+        ximage.free_pixel_buffers()
+        info = ximage.get_pixel_buffers_info()
+        assert info["buffers"]=={} and info["size"]==0
+        #sub-images do not own their pixels, so they are never added to the pool:
+        image = make_image()
+        sub = image.get_sub_image(0, 0, W//2, H//2)
+        sub.free()
+        assert ximage.get_pixel_buffers_info()["size"]==0
+        image.free()
+        assert ximage.get_pixel_buffers_info()["buffers"]=={W*H*4 : 1}
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -121,7 +121,7 @@ class ClientTray(ClientWidgetBase):
             data = self._backing.data
         self._backing = TrayBacking(self._id, w, h, self._has_alpha, data)
         if self.mmap_enabled:
-            self._backing.enable_mmap(self.mmap)
+            self._backing.enable_mmap(self.mmap, self._client.mmap_ring)
 
     def update_metadata(self, metadata):
         log("%s.update_metadata(%s)", self, metadata)
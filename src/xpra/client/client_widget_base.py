@@ -46,7 +46,7 @@ class ClientWidgetBase(object):
             log("make_new_backing%s effective backing class=%s, server alpha=%s, window alpha=%s", (backing_class, ww, wh, ww, wh), bc, self._has_alpha, self._window_alpha)
             backing = bc(self._id, self._window_alpha, self.pixel_depth)
             if self._client.mmap_enabled:
-                backing.enable_mmap(self._client.mmap)
+                backing.enable_mmap(self._client.mmap, self._client.mmap_ring)
         backing.init(ww, wh, bw, bh)
         return backing
 
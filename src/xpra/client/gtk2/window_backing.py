@@ -32,17 +32,22 @@ class GTK2WindowBacking(GTKWindowBacking):
         """ can be called from any thread """
         if USE_PIL and has_codec("dec_pillow"):
             return GTKWindowBacking.paint_image(self, coding, img_data, x, y, width, height, options, callbacks)
-        #gdk needs UI thread:
-        self.idle_add(self.paint_pixbuf_gdk, coding, img_data, x, y, width, height, options, callbacks)
+        self.paint_pixbuf_gdk(coding, img_data, x, y, width, height, options, callbacks)
         return  False
 
     def do_draw_region(self, x, y, width, height, coding, img_data, rowstride, options, callbacks):
         """ called as last resort when PIL is not available"""
-        self.idle_add(self.paint_pixbuf_gdk, coding, img_data, x, y, width, height, options, callbacks)
+        self.paint_pixbuf_gdk(coding, img_data, x, y, width, height, options, callbacks)
 
 
     def paint_pixbuf_gdk(self, coding, img_data, x, y, width, height, options, callbacks):
-        """ must be called from UI thread """
+        """
+            Can be called from any thread:
+            loading the pixbuf does not use the display,
+            so the pixels are processed and the tiles stored from the calling thread
+            (in the same order as the tile cache lookups from paint_tiles),
+            only the paint itself is done from the UI thread.
+        """
         if coding.startswith("png"):
             coding = "png"
         else:
@@ -59,9 +64,8 @@ class GTK2WindowBacking(GTKWindowBacking):
         rowstride = pixbuf.get_rowstride()
         img_data = self.process_delta(raw_data, width, height, rowstride, options)
         n = pixbuf.get_n_channels()
-        if n==3:
-            self.do_paint_rgb24(img_data, x, y, width, height, rowstride, options, callbacks)
-        else:
-            assert n==4, "invalid number of channels: %s" % n
-            self.do_paint_rgb32(img_data, x, y, width, height, rowstride, options, callbacks)
+        assert n in (3, 4), "invalid number of channels: %s" % n
+        rgb_format = ["RGB", "RGBA"][n==4]
+        self.store_tiles(rgb_format, img_data, width, height, rowstride, options)
+        self.idle_add(self.do_paint_rgb, rgb_format, img_data, x, y, width, height, rowstride, options, callbacks)
         return False
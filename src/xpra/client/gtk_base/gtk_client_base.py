@@ -216,9 +216,11 @@ class GTKXpraClient(UIXpraClient, GObjectXpraClient):
         except:
             pass
         else:
-            if not self.check_file_size("upload", filename, filesize):
-                self.close_file_upload_dialog()
-                return
+            self.close_file_upload_dialog()
+            if self.check_file_size("upload", filename, filesize):
+                #local file: the data is read from disk as it is sent
+                self.send_file(filename, "", None, filesize=filesize, openit=(v==gtk.RESPONSE_ACCEPT))
+            return
         gfile = dialog.get_file()
         self.close_file_upload_dialog()
         filelog("load_contents: filename=%s, response=%s", filename, v)
@@ -468,12 +470,14 @@ class GTKXpraClient(UIXpraClient, GObjectXpraClient):
                "configure.pointer"      : True,
                "frame_sizes"            : self.get_window_frame_sizes()
                })
-        from xpra.client.window_backing_base import DELTA_BUCKETS
+        from xpra.client.window_backing_base import DELTA_BUCKETS, TILE_CACHE_SIZE
         updict(capabilities, "encoding", {
                     "icons.greedy"      : True,         #we don't set a default window icon any more
                     "icons.size"        : (64, 64),     #size we want
                     "icons.max_size"    : (128, 128),   #limit
                     "delta_buckets"     : DELTA_BUCKETS,
+                    "delta_spans"       : True,
+                    "tile_cache"        : TILE_CACHE_SIZE,
                     })
         return capabilities
 
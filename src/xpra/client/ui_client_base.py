@@ -58,6 +58,7 @@ from xpra.scripts.config import parse_bool_or_int, parse_bool, FALSE_OPTIONS, TR
 from xpra.simple_stats import std_unit
 from xpra.net import compression, packet_encoding
 from xpra.net.compression import Compressed
+from xpra.codecs.tile_cache import TileCache
 from xpra.child_reaper import reaper_cleanup
 from xpra.make_thread import make_thread
 from xpra.os_util import BytesIOClass, Queue, platform_name, get_machine_id, get_user_uuid, bytestostr, monotonic_time, strtobytes, WIN32, OSX, POSIX, PYTHON3
@@ -83,6 +84,7 @@ MONITOR_CHANGE_REINIT = envint("XPRA_MONITOR_CHANGE_REINIT")
 
 AV_SYNC_DELTA = envint("XPRA_AV_SYNC_DELTA")
 MOUSE_SHOW = envbool("XPRA_MOUSE_SHOW", True)
+CURSOR_CACHE_SIZE = envint("XPRA_CURSOR_CACHE_SIZE", 64)
 
 PAINT_FAULT_RATE = envint("XPRA_PAINT_FAULT_INJECTION_RATE")
 PAINT_FAULT_TELL = envbool("XPRA_PAINT_FAULT_INJECTION_TELL", True)
@@ -235,6 +237,7 @@ class UIXpraClient(XpraClientBase):
         #mmap:
         self.mmap_enabled = False
         self.mmap = None
+        self.mmap_ring = False
         self.mmap_token = None
         self.mmap_token_index = 0
         self.mmap_token_bytes = 0
@@ -285,6 +288,7 @@ class UIXpraClient(XpraClientBase):
         self.client_clipboard_direction = "both"
         self.clipboard_enabled = False
         self.cursors_enabled = False
+        self.cursor_cache = TileCache(CURSOR_CACHE_SIZE)
         self.default_cursor_data = None
         self.bell_enabled = False
         self.border = None
@@ -1199,6 +1203,14 @@ class UIXpraClient(XpraClientBase):
                 clean_mmap(self.mmap_filename)
                 self.mmap_filename = None
 
+    def mmap_read_data(self, mmap_data):
+        #file data sent via the mmap ring buffer:
+        assert self.mmap_enabled and self.mmap_ring, "mmap ring buffer is not enabled"
+        from xpra.net.mmap_pipe import mmap_ring_free
+        data = b"".join(self.mmap[offset:offset+length] for offset, length in mmap_data)
+        mmap_ring_free(self.mmap, *mmap_data)
+        return data
+
 
     def init_opengl(self, enable_opengl):
         self.opengl_enabled = False
@@ -1441,6 +1453,7 @@ class UIXpraClient(XpraClientBase):
                 "mmap_token"        : self.mmap_token,
                 "mmap_token_index"  : self.mmap_token_index,
                 "mmap_token_bytes"  : self.mmap_token_bytes,
+                "mmap.ring"         : True,
                 })
         #don't try to find the server uuid if this platform cannot run servers..
         #(doing so causes lockups on win32 and startup errors on osx)
@@ -1488,6 +1501,7 @@ class UIXpraClient(XpraClientBase):
             "encodings.core"            : self.get_core_encodings(),
             "encodings.window-icon"     : self.get_window_icon_encodings(),
             "encodings.cursor"          : self.get_cursor_encodings(),
+            "cursor.cache"              : CURSOR_CACHE_SIZE,
             #sound:
             "sound.server_driven"       : True,
             "sound.ogg-latency-fix"     : True,
@@ -1522,6 +1536,7 @@ class UIXpraClient(XpraClientBase):
             #TODO: check for csc support (swscale only?)
             "video_reinit"              : True,
             "video_scaling"             : True,
+            "video_stripes"             : True,
             "video_b_frames"            : video_b_frames,
             "transparency"              : self.has_transparency(),
             "rgb24zlib"                 : True,
@@ -1835,6 +1850,7 @@ class UIXpraClient(XpraClientBase):
                 self.mmap_enabled = False
                 self.quit(EXIT_MMAP_TOKEN_FAILURE)
                 return
+            self.mmap_ring = c.boolget("mmap.ring")
             log.info("enabled fast mmap transfers using %sB shared memory area", std_unit(self.mmap_size, unit=1024))
         #the server will have a handle on the mmap file by now, safe to delete:
         self.clean_mmap()
@@ -3057,14 +3073,17 @@ class UIXpraClient(XpraClientBase):
             def draw_cleanup():
                 if coding=="mmap":
                     assert self.mmap_enabled
-                    from xpra.net.mmap_pipe import int_from_buffer
-                    def free_mmap_area():
-                        #we need to ack the data to free the space!
+                    #we need to ack the data to free the space!
+                    if self.mmap_ring:
+                        from xpra.net.mmap_pipe import mmap_ring_free
+                        mmap_ring_free(self.mmap, *data)
+                    else:
+                        from xpra.net.mmap_pipe import int_from_buffer
                         data_start = int_from_buffer(self.mmap, 0)
                         offset, length = data[-1]
                         data_start.value = offset+length
-                    #clear the mmap area via idle_add so any pending draw requests
-                    #will get a chance to run first (preserving the order)
+                #clear the mmap area via idle_add so any pending draw requests
+                #will get a chance to run first (preserving the order)
                 self.send_damage_sequence(wid, packet_sequence, width, height, -1)
             self.idle_add(draw_cleanup)
             return
@@ -3109,8 +3128,6 @@ class UIXpraClient(XpraClientBase):
             raise
 
     def _process_cursor(self, packet):
-        if not self.cursors_enabled:
-            return
         #trim packet type:
         packet = packet[1:]
         if len(packet)==1:
@@ -3129,7 +3146,19 @@ class UIXpraClient(XpraClientBase):
                 new_cursor = [b"raw"] + packet
             encoding = new_cursor[0]
             pixels = new_cursor[8]
-            if encoding==b"png":
+            if encoding==b"cache":
+                #the pixels field contains the cache key:
+                try:
+                    new_cursor[8] = self.cursor_cache.get(bytestostr(pixels))
+                except KeyError:
+                    cursorlog.warn("Warning: cursor %s not found in cache", bytestostr(pixels))
+                    #start again from an empty cache on both sides,
+                    #the server will send the current cursor again:
+                    self.cursor_cache.clear()
+                    self.send("reset-cursor-cache")
+                    return
+                new_cursor[0] = b"raw"
+            elif encoding==b"png":
                 from PIL import Image
                 buf = BytesIOClass(pixels)
                 img = Image.open(buf)
@@ -3139,6 +3168,12 @@ class UIXpraClient(XpraClientBase):
             elif encoding!=b"raw":
                 cursorlog.warn("Warning: invalid cursor encoding: %s", encoding)
                 return
+            if len(new_cursor)>=13:
+                #the server wants us to cache this cursor,
+                #we must do it even when cursors are disabled to stay in sync:
+                self.cursor_cache.add(bytestostr(new_cursor[12]), new_cursor[8])
+        if not self.cursors_enabled:
+            return
         self.set_windows_cursor(self._id_to_window.values(), new_cursor)
 
     def _process_bell(self, packet):
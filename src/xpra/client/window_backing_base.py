@@ -10,16 +10,18 @@ log = Logger("paint")
 deltalog = Logger("delta")
 
 from threading import Lock
-from xpra.net.mmap_pipe import mmap_read
+from xpra.net.mmap_pipe import mmap_read, mmap_ring_read, mmap_ring_free
 from xpra.net import compression
 from xpra.util import typedict, csv, envint, envbool, repr_ellipsized
 from xpra.codecs.loader import get_codec
 from xpra.codecs.video_helper import getVideoHelper
-from xpra.os_util import BytesIOClass, bytestostr, _buffer
-from xpra.codecs.xor.cyxor import xor_str   #@UnresolvedImport
+from xpra.codecs.tile_cache import TileCache
+from xpra.os_util import BytesIOClass, bytestostr, memoryview_to_bytes, _buffer
+from xpra.codecs.xor.cyxor import xor_str, apply_spans   #@UnresolvedImport
 from xpra.codecs.argb.argb import unpremultiply_argb, unpremultiply_argb_in_place   #@UnresolvedImport
 
 DELTA_BUCKETS = envint("XPRA_DELTA_BUCKETS", 5)
+TILE_CACHE_SIZE = envint("XPRA_TILE_CACHE_SIZE", 256)
 INTEGRITY_HASH = envbool("XPRA_INTEGRITY_HASH", False)
 PAINT_BOX = envint("XPRA_PAINT_BOX", 0) or envint("XPRA_OPENGL_PAINT_BOX", 0)
 
@@ -80,8 +82,11 @@ class WindowBackingBase(object):
         self._alpha_enabled = window_alpha
         self._backing = None
         self._delta_pixel_data = [None for _ in range(DELTA_BUCKETS)]
+        self._tile_cache = TileCache(TILE_CACHE_SIZE)
         self._video_decoder = None
         self._csc_decoder = None
+        #each video stripe uses its own decoders: stripe index -> (video decoder, csc decoder)
+        self._stripe_decoders = {}
         self._decoder_lock = Lock()
         self._PIL_encodings = []
         self.default_paint_box_line_width = PAINT_BOX or 1
@@ -95,11 +100,13 @@ class WindowBackingBase(object):
         self.draw_needs_refresh = True
         self.mmap = None
         self.mmap_enabled = False
+        self.mmap_ring = False
         self.jpeg_decoder = get_codec("dec_jpeg")
 
-    def enable_mmap(self, mmap_area):
+    def enable_mmap(self, mmap_area, mmap_ring=False):
         self.mmap = mmap_area
         self.mmap_enabled = True
+        self.mmap_ring = mmap_ring
 
     def close(self):
         self._backing = None
@@ -119,6 +126,7 @@ class WindowBackingBase(object):
         try:
             self.do_clean_video_decoder()
             self.do_clean_csc_decoder()
+            self.do_clean_stripe_decoders()
             return True
         finally:
             dl.release()
@@ -133,6 +141,14 @@ class WindowBackingBase(object):
             self._csc_decoder.clean()
             self._csc_decoder = None
 
+    def do_clean_stripe_decoders(self):
+        stripe_decoders = self._stripe_decoders
+        self._stripe_decoders = {}
+        for decoders in stripe_decoders.values():
+            for decoder in decoders:
+                if decoder:
+                    decoder.clean()
+
 
     def get_encoding_properties(self):
         return {
@@ -179,13 +195,14 @@ class WindowBackingBase(object):
             if comp:
                 assert len(comp)==1, "more than one compressor specified: %s" % str(comp)
                 img_data = compression.decompress_by_name(raw_data, algo=comp[0])
-        if len(img_data)!=rowstride * height:
-            deltalog.error("invalid img data length: expected %s but got %s (%s: %s)", rowstride * height, len(img_data), type(img_data), repr_ellipsized(img_data))
-            raise Exception("expected %s bytes for %sx%s with rowstride=%s but received %s (%s compressed)" %
-                                (rowstride * height, width, height, rowstride, len(img_data), len(raw_data)))
         delta = options.intget(b"delta", -1)
         bucket = options.intget(b"bucket", 0)
         rgb_format = options.strget(b"rgb_format")
+        spans = delta>=0 and options.boolget(b"delta_spans")
+        if len(img_data)!=rowstride * height and not spans:
+            deltalog.error("invalid img data length: expected %s but got %s (%s: %s)", rowstride * height, len(img_data), type(img_data), repr_ellipsized(img_data))
+            raise Exception("expected %s bytes for %sx%s with rowstride=%s but received %s (%s compressed)" %
+                                (rowstride * height, width, height, rowstride, len(img_data), len(raw_data)))
         rgb_data = img_data
         if delta>=0:
             assert bucket>=0 and bucket<DELTA_BUCKETS, "invalid delta bucket number: %s" % bucket
@@ -195,15 +212,83 @@ class WindowBackingBase(object):
             assert width==lwidth and height==lheight and delta==seq, \
                 "delta bucket %s data does not match: expected %s but got %s" % (bucket, (width, height, delta), (lwidth, lheight, seq))
             assert lrgb_format==rgb_format, "delta region uses %s format, was expecting %s" % (rgb_format, lrgb_format)
-            deltalog("delta: xoring with bucket %i", bucket)
-            rgb_data = xor_str(img_data, ldata)
+            if spans:
+                deltalog("delta: applying %i bytes of spans to bucket %i", len(img_data), bucket)
+                rgb_data = apply_spans(ldata, img_data)
+            else:
+                deltalog("delta: xoring with bucket %i", bucket)
+                rgb_data = xor_str(img_data, ldata)
         #store new pixels for next delta:
         store = options.intget("store", -1)
         if store>=0:
-            deltalog("delta: storing sequence %i in bucket %i", store, bucket)
-            self._delta_pixel_data[bucket] =  width, height, rgb_format, store, rgb_data
+            #the server may want to keep the reference frame:
+            store_bucket = options.intget("store_bucket", bucket)
+            assert store_bucket>=0 and store_bucket<DELTA_BUCKETS, "invalid delta bucket number: %s" % store_bucket
+            deltalog("delta: storing sequence %i in bucket %i", store, store_bucket)
+            self._delta_pixel_data[store_bucket] =  width, height, rgb_format, store, rgb_data
         return rgb_data
 
+    def store_tiles(self, rgb_format, rgb_data, width, height, rowstride, options):
+        """
+            Can be called from any thread,
+            adds the tiles of this screen update to the tile cache if the server asked us to.
+            The tiles must be stored in the same order as the server sent them,
+            so the least recently used tiles are evicted on both sides.
+        """
+        tiles = options.listget(b"tile-store")
+        if not tiles:
+            return
+        tc = self._tile_cache
+        if options.boolget(b"tile-reset"):
+            deltalog("tile cache reset")
+            tc.clear()
+        tile_size = options.intget(b"tile-size")
+        assert tile_size>0, "invalid tile size: %s" % tile_size
+        cols = (width+tile_size-1)//tile_size
+        rows = (height+tile_size-1)//tile_size
+        assert len(tiles)==cols*rows, "expected %i tiles for %ix%i but got %i" % (cols*rows, width, height, len(tiles))
+        Bpp = len(rgb_format)
+        data = memoryview_to_bytes(rgb_data)
+        i = 0
+        for ty in range(0, height, tile_size):
+            th = min(tile_size, height-ty)
+            for tx in range(0, width, tile_size):
+                tw = min(tile_size, width-tx)
+                pos = ty*rowstride + tx*Bpp
+                l = tw*Bpp
+                pixels = b"".join(data[pos+j*rowstride:pos+j*rowstride+l] for j in range(th))
+                tc.add(tiles[i], (rgb_format, tw, th, pixels))
+                i += 1
+        deltalog("stored %i tiles in %s", len(tiles), tc)
+
+    def paint_tiles(self, x, y, width, height, tiles, options, callbacks):
+        """
+            Can be called from any thread,
+            paints tiles from the tile cache (the lookups happen in the calling thread,
+            so they are done in the same order as the server sent them).
+        """
+        tc = self._tile_cache
+        paints = []
+        for tx, ty, tile in tiles:
+            try:
+                paints.append((tx, ty, tc.get(tile)))
+            except KeyError:
+                #the server will re-send the window contents and reset the cache:
+                tc.clear()
+                fire_paint_callbacks(callbacks, False, "tile %#x is missing from the cache" % tile)
+                return
+        def paint():
+            if not paints:
+                fire_paint_callbacks(callbacks)
+                return
+            for i, (tx, ty, (rgb_format, tw, th, pixels)) in enumerate(paints):
+                #only fire the callbacks with the last tile:
+                cb = []
+                if i==len(paints)-1:
+                    cb = callbacks
+                self.do_paint_rgb(rgb_format, pixels, x+tx, y+ty, tw, th, tw*len(rgb_format), typedict(options), cb)
+        self.idle_add(paint)
+
 
     def paint_jpeg(self, img_data, x, y, width, height, options, callbacks):
         img = self.jpeg_decoder.decompress_to_rgb("RGBX", img_data, width, height, options)
@@ -261,6 +346,7 @@ class WindowBackingBase(object):
             img_data = self.process_delta(raw_data, width, height, rowstride, options)
         else:
             raise Exception("invalid image mode: %s" % img.mode)
+        self.store_tiles(rgb_format, img_data, width, height, rowstride, options)
         self.idle_add(self.do_paint_rgb, rgb_format, img_data, x, y, width, height, rowstride, paint_options, callbacks)
         return False
 
@@ -270,6 +356,7 @@ class WindowBackingBase(object):
             before calling _do_paint_rgb from the UI thread via idle_add
         """
         rgb_data = self.process_delta(raw_data, width, height, rowstride, options)
+        self.store_tiles(rgb_format, rgb_data, width, height, rowstride, options)
         self.idle_add(self.do_paint_rgb, rgb_format, rgb_data, x, y, width, height, rowstride, options, callbacks)
 
     def do_paint_rgb(self, rgb_format, img_data, x, y, width, height, rowstride, options, callbacks):
@@ -381,57 +468,79 @@ class WindowBackingBase(object):
                 log(message)
                 fire_paint_callbacks(callbacks, -1, message)
                 return
-            enc_width, enc_height = options.intpair("scaled_size", (width, height))
-            input_colorspace = options.strget("csc")
-            if not input_colorspace:
-                message = "csc mode is missing from the video options!"
-                log.error(message)
-                fire_paint_callbacks(callbacks, False, message)
-                return
-            #do we need a prep step for decoders that cannot handle the input_colorspace directly?
-            decoder_colorspaces = decoder_module.get_input_colorspaces(coding)
-            assert input_colorspace in decoder_colorspaces, "decoder does not support %s for %s" % (input_colorspace, coding)
-
-            vd = self._video_decoder
-            if vd:
-                if options.get("frame", -1)==0:
-                    log("paint_with_video_decoder: first frame of new stream")
-                    self.do_clean_video_decoder()
-                elif vd.get_encoding()!=coding:
-                    log("paint_with_video_decoder: encoding changed from %s to %s", vd.get_encoding(), coding)
-                    self.do_clean_video_decoder()
-                elif vd.get_width()!=enc_width or vd.get_height()!=enc_height:
-                    log("paint_with_video_decoder: video dimensions have changed from %s to %s", (vd.get_width(), vd.get_height()), (enc_width, enc_height))
-                    self.do_clean_video_decoder()
-                elif vd.get_colorspace()!=input_colorspace:
-                    #this should only happen on encoder restart, which means this should be the first frame:
-                    log.warn("Warning: colorspace unexpectedly changed from %s to %s", vd.get_colorspace(), input_colorspace)
+            stripe = options.intget("stripe", -1)
+            if stripe<0:
+                if self._stripe_decoders:
+                    log("paint_with_video_decoder: no longer using stripes")
+                    self.do_clean_stripe_decoders()
+                self.do_paint_with_video_decoder(decoder_module, coding, img_data, x, y, width, height, options, callbacks)
+            else:
+                #each stripe is an independent video stream,
+                #swap in the decoders for this stripe:
+                if self._stripe_decoders.get(stripe) is None:
                     self.do_clean_video_decoder()
-            if self._video_decoder is None:
-                log("paint_with_video_decoder: new %s(%s,%s,%s)", decoder_module.Decoder, width, height, input_colorspace)
-                vd = decoder_module.Decoder()
-                vd.init_context(coding, enc_width, enc_height, input_colorspace)
-                self._video_decoder = vd
-                log("paint_with_video_decoder: info=%s", vd.get_info())
-
-            img = vd.decompress_image(img_data, options)
-            if not img:
-                if options.get("delayed", 0)>0:
-                    #there are further frames queued up,
-                    #and this frame references those, so assume all is well:
-                    fire_paint_callbacks(callbacks)
+                    self.do_clean_csc_decoder()
                 else:
-                    fire_paint_callbacks(callbacks, False, "video decoder %s failed to decode %i bytes of %s data" % (vd.get_type(), len(img_data), coding))
-                    log.error("Error: decode failed on %s bytes of %s data", len(img_data), coding)
-                    log.error(" %sx%s pixels using %s", width, height, vd.get_type())
-                    log.error(" frame options:")
-                    for k,v in options.items():
-                        log.error("   %s=%s", k, v)
-                return
-            self.do_video_paint(img, x, y, enc_width, enc_height, width, height, options, callbacks)
+                    self._video_decoder, self._csc_decoder = self._stripe_decoders.get(stripe)
+                try:
+                    self.do_paint_with_video_decoder(decoder_module, coding, img_data, x, y, width, height, options, callbacks)
+                finally:
+                    self._stripe_decoders[stripe] = (self._video_decoder, self._csc_decoder)
+                    self._video_decoder = None
+                    self._csc_decoder = None
         if self._backing is None:
             self.close_decoder(True)
 
+    def do_paint_with_video_decoder(self, decoder_module, coding, img_data, x, y, width, height, options, callbacks):
+        enc_width, enc_height = options.intpair("scaled_size", (width, height))
+        input_colorspace = options.strget("csc")
+        if not input_colorspace:
+            message = "csc mode is missing from the video options!"
+            log.error(message)
+            fire_paint_callbacks(callbacks, False, message)
+            return
+        #do we need a prep step for decoders that cannot handle the input_colorspace directly?
+        decoder_colorspaces = decoder_module.get_input_colorspaces(coding)
+        assert input_colorspace in decoder_colorspaces, "decoder does not support %s for %s" % (input_colorspace, coding)
+
+        vd = self._video_decoder
+        if vd:
+            if options.get("frame", -1)==0:
+                log("paint_with_video_decoder: first frame of new stream")
+                self.do_clean_video_decoder()
+            elif vd.get_encoding()!=coding:
+                log("paint_with_video_decoder: encoding changed from %s to %s", vd.get_encoding(), coding)
+                self.do_clean_video_decoder()
+            elif vd.get_width()!=enc_width or vd.get_height()!=enc_height:
+                log("paint_with_video_decoder: video dimensions have changed from %s to %s", (vd.get_width(), vd.get_height()), (enc_width, enc_height))
+                self.do_clean_video_decoder()
+            elif vd.get_colorspace()!=input_colorspace:
+                #this should only happen on encoder restart, which means this should be the first frame:
+                log.warn("Warning: colorspace unexpectedly changed from %s to %s", vd.get_colorspace(), input_colorspace)
+                self.do_clean_video_decoder()
+        if self._video_decoder is None:
+            log("paint_with_video_decoder: new %s(%s,%s,%s)", decoder_module.Decoder, width, height, input_colorspace)
+            vd = decoder_module.Decoder()
+            vd.init_context(coding, enc_width, enc_height, input_colorspace)
+            self._video_decoder = vd
+            log("paint_with_video_decoder: info=%s", vd.get_info())
+
+        img = vd.decompress_image(img_data, options)
+        if not img:
+            if options.get("delayed", 0)>0:
+                #there are further frames queued up,
+                #and this frame references those, so assume all is well:
+                fire_paint_callbacks(callbacks)
+            else:
+                fire_paint_callbacks(callbacks, False, "video decoder %s failed to decode %i bytes of %s data" % (vd.get_type(), len(img_data), coding))
+                log.error("Error: decode failed on %s bytes of %s data", len(img_data), coding)
+                log.error(" %sx%s pixels using %s", width, height, vd.get_type())
+                log.error(" frame options:")
+                for k,v in options.items():
+                    log.error("   %s=%s", k, v)
+            return
+        self.do_video_paint(img, x, y, enc_width, enc_height, width, height, options, callbacks)
+
     def do_video_paint(self, img, x, y, enc_width, enc_height, width, height, options, callbacks):
         target_rgb_formats = self.RGB_MODES
         #as some video formats like vpx can forward transparency
@@ -484,8 +593,19 @@ class WindowBackingBase(object):
         """ must be called from UI thread
             see _mmap_send() in server.py for details """
         assert self.mmap_enabled
-        data = mmap_read(self.mmap, *img_data)
         rgb_format = options.strget(b"rgb_format", b"RGB")
+        if self.mmap_ring:
+            #the ring buffer chunk is ours until we free it,
+            #so we can paint straight from the mmap area:
+            assert len(img_data)==1, "ring buffer data must be contiguous"
+            offset, length = img_data[0]
+            data = mmap_ring_read(self.mmap, offset, length)
+            try:
+                self.do_paint_rgb(rgb_format, data, x, y, width, height, rowstride, options, callbacks)
+            finally:
+                mmap_ring_free(self.mmap, *img_data)
+            return
+        data = mmap_read(self.mmap, *img_data)
         #Note: BGR(A) is only handled by gl_window_backing
         self.do_paint_rgb(rgb_format, data, x, y, width, height, rowstride, options, callbacks)
 
@@ -534,6 +654,8 @@ class WindowBackingBase(object):
                 self.paint_image(coding, img_data, x, y, width, height, options, callbacks)
             elif coding == "scroll":
                 self.paint_scroll(x, y, width, height, img_data, options, callbacks)
+            elif coding == "tiles":
+                self.paint_tiles(x, y, width, height, img_data, options, callbacks)
             else:
                 self.do_draw_region(x, y, width, height, coding, img_data, rowstride, options, callbacks)
         except Exception:
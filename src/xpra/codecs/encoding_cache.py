@@ -0,0 +1,104 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+from xpra.util import envint, envbool
+from xpra.os_util import strtobytes
+
+ENCODING_CACHE = envbool("XPRA_ENCODING_CACHE", True)
+#maximum size of the encoded data we keep, in MB:
+ENCODING_CACHE_SIZE = envint("XPRA_ENCODING_CACHE_SIZE", 16)
+#larger images are unlikely to be repeated exactly, so we don't bother:
+MAX_CACHED_PIXELS = envint("XPRA_ENCODING_CACHE_MAX_PIXELS", 256*256)
+
+
+def get_cache_key(pixels, *params):
+    """ a checksum of the pixels and of all the parameters which affect the encoded output """
+    h = hashlib.sha1(strtobytes(repr(params)))
+    h.update(pixels)
+    return h.digest()
+
+
+class EncodingCache(object):
+    """
+        A least-recently-used cache of encoded data, keyed by a checksum of the input,
+        bounded by the total size of the encoded data.
+        Can be used from any thread.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return "EncodingCache(%i entries, %i/%i bytes)" % (len(self.entries), self.size, self.max_size)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_info(self):
+        return {
+                "entries"   : len(self.entries),
+                "size"      : self.size,
+                "max-size"  : self.max_size,
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evicted"   : self.evicted,
+                }
+
+    def get(self, key):
+        """ returns the value for this key (or None) and marks it as recently used """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def add(self, key, value, size):
+        """ adds a value, evicting the least recently used ones if needed """
+        if size>self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size>self.max_size:
+                _, (_, esize) = self.entries.popitem(last=False)
+                self.size -= esize
+                self.evicted += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+#shared by all the windows and all the clients:
+encoding_cache = None
+lock = Lock()
+
+def get_encoding_cache():
+    """ returns the shared cache, or None if it is disabled """
+    global encoding_cache
+    if not ENCODING_CACHE or ENCODING_CACHE_SIZE<=0:
+        return None
+    if encoding_cache is None:
+        with lock:
+            if encoding_cache is None:
+                encoding_cache = EncodingCache(ENCODING_CACHE_SIZE*1024*1024)
+    return encoding_cache
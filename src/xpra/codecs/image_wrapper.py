@@ -173,11 +173,16 @@ class ImageWrapper(object):
         oldstride = self.rowstride
         pos = y*oldstride + x*self.bytesperpixel
         newstride = w*self.bytesperpixel
-        lines = []
-        for _ in range(h):
-            lines.append(memoryview_to_bytes(pixels[pos:pos+newstride]))
-            pos += oldstride
-        return ImageWrapper(self.x+x, self.y+y, w, h, b"".join(lines), self.pixel_format, self.depth, newstride, planes=self.planes, thread_safe=True, palette=self.palette)
+        if newstride==oldstride:
+            #whole rows without padding, so the pixels are contiguous:
+            data = memoryview_to_bytes(pixels[pos:pos+newstride*h])
+        else:
+            lines = []
+            for _ in range(h):
+                lines.append(memoryview_to_bytes(pixels[pos:pos+newstride]))
+                pos += oldstride
+            data = b"".join(lines)
+        return ImageWrapper(self.x+x, self.y+y, w, h, data, self.pixel_format, self.depth, newstride, planes=self.planes, thread_safe=True, palette=self.palette)
 
     def __del__(self):
         #print("ImageWrapper.__del__() calling %s" % self.free)
@@ -11,6 +11,7 @@ log = Logger("encoder", "pillow")
 from xpra.util import envbool
 from xpra.os_util import BytesIOClass, memoryview_to_bytes, _buffer
 from xpra.net.compression import Compressed
+from xpra.codecs.encoding_cache import get_encoding_cache, get_cache_key, MAX_CACHED_PIXELS
 
 from PIL import Image, ImagePalette     #@UnresolvedImport
 from xpra.codecs.pillow import PIL_VERSION
@@ -63,6 +64,26 @@ def encode(coding, image, quality, speed, supports_transparency):
         "BGR"   : "RGB",
         }.get(pixel_format, pixel_format)
     bpp = 32
+    #small images like icons and widgets are often sent again unchanged,
+    #so we cache the encoded data:
+    cache = None
+    cache_key = None
+    if w*h<=MAX_CACHED_PIXELS and not SAVE_TO_FILE:
+        cache = get_encoding_cache()
+    if cache:
+        pixels = image.get_pixels()
+        assert pixels, "failed to get pixels from %s" % image
+        if coding=="jpeg":
+            cparams = (int(min(99, max(1, quality))), speed<50)
+        else:
+            cparams = (max(1, min(5, (125-speed)//25)), speed==0)
+        cache_key = get_cache_key(pixels, coding, cparams, supports_transparency,
+                                  pixel_format, w, h, image.get_rowstride(), image.get_palette())
+        cached = cache.get(cache_key)
+        if cached:
+            coding, data, client_options, bpp = cached
+            log("pillow.encode: using cached %s data", coding)
+            return coding, Compressed(coding, data), client_options.copy(), w, h, 0, bpp
     #remove transparency if it cannot be handled,
     #and deal with non 24-bit formats:
     try:
@@ -191,6 +212,8 @@ def encode(coding, image, quality, speed, supports_transparency):
     log("sending %sx%s %s as %s, mode=%s, options=%s", w, h, pixel_format, coding, im.mode, kwargs)
     data = buf.getvalue()
     buf.close()
+    if cache_key:
+        cache.add(cache_key, (coding, data, client_options.copy(), bpp), len(data))
     return coding, Compressed(coding, data), client_options, image.get_width(), image.get_height(), 0, bpp
 
 def selftest(full=False):
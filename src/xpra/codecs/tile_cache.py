@@ -0,0 +1,62 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from collections import OrderedDict
+
+
+class TileCache(object):
+    """
+        A least-recently-used cache of window tiles, keyed by the checksum of their pixels.
+        The client stores the decoded pixels of each tile,
+        the server uses the same class (without the pixels) to keep track of what the client has.
+        Both sides must apply the exact same sequence of 'add' and 'get' calls,
+        so that the tiles are evicted in the same order.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "TileCache(%i/%i)" % (len(self.tiles), self.size)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __contains__(self, key):
+        #does not update the access order
+        return key in self.tiles
+
+    def get_info(self):
+        return {
+                "size"      : self.size,
+                "tiles"     : len(self.tiles),
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                }
+
+    def get(self, key):
+        """ returns the value for this tile and marks it as recently used """
+        try:
+            value = self.tiles.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.tiles[key] = value
+        self.hits += 1
+        return value
+
+    def add(self, key, value=None):
+        """ adds or replaces a tile, evicting the least recently used ones if needed """
+        tiles = self.tiles
+        tiles.pop(key, None)
+        tiles[key] = value
+        while len(tiles)>self.size:
+            tiles.popitem(last=False)
+
+    def clear(self):
+        self.tiles.clear()
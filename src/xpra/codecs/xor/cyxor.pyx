@@ -5,6 +5,8 @@
 
 #cython: wraparound=False
 
+from libc.stdint cimport uint32_t, uint64_t
+from libc.string cimport memcpy
 from xpra.buffers.membuf cimport getbuf, MemBuf
 from xpra.buffers.membuf cimport object_as_buffer
 
@@ -24,3 +26,145 @@ def xor_str(buf, xor):
     for 0 <= i < cbuf_len:
         obuf[i] = cbuf[i] ^ xbuf[i]
     return memoryview(out_buf)
+
+
+# Delta spans:
+# instead of xoring the whole buffer and compressing the result,
+# we only send the ranges of bytes that have changed.
+# The stream is a list of spans, each one made of:
+# * the number of unchanged bytes to skip (32-bit little endian)
+# * the number of changed bytes that follow (32-bit little endian)
+# * the changed bytes
+# The buffers are compared 64 bits at a time,
+# and changed words separated by only a few unchanged words are merged into the same span
+# (a span header costs 8 bytes, the same as one word)
+DEF SPAN_HEADER_SIZE = 8
+DEF MERGE_WORDS = 2
+
+cdef inline uint64_t load64(const unsigned char *p) nogil:
+    #unaligned load, the compiler turns this into a single instruction:
+    cdef uint64_t v
+    memcpy(&v, p, 8)
+    return v
+
+cdef inline void write_uint32(unsigned char *p, uint32_t v) nogil:
+    p[0] = v & 0xff
+    p[1] = (v >> 8) & 0xff
+    p[2] = (v >> 16) & 0xff
+    p[3] = (v >> 24) & 0xff
+
+cdef inline uint32_t read_uint32(const unsigned char *p) nogil:
+    return p[0] | (p[1] << 8) | (p[2] << 16) | (<uint32_t> p[3] << 24)
+
+
+def delta_spans(buf, ref, Py_ssize_t max_size):
+    """
+        Returns the spans of 'buf' which differ from 'ref',
+        or None if the spans would not fit in 'max_size' bytes.
+    """
+    assert len(buf)==len(ref), "cannot compare buffers of different lengths (%s:%s vs %s:%s)" % (type(buf), len(buf), type(ref), len(ref))
+    cdef const unsigned char * cbuf = NULL          #@DuplicatedSignature
+    cdef Py_ssize_t cbuf_len = 0                    #@DuplicatedSignature
+    assert object_as_buffer(buf, <const void**> &cbuf, &cbuf_len)==0, "cannot get buffer pointer for %s: %s" % (type(buf), buf)
+    cdef const unsigned char * rbuf = NULL
+    cdef Py_ssize_t rbuf_len = 0
+    assert object_as_buffer(ref, <const void**> &rbuf, &rbuf_len)==0, "cannot get buffer pointer for %s: %s" % (type(ref), ref)
+    assert cbuf_len==rbuf_len, "python or cython bug? buffers don't have the same length?"
+    if max_size<=0 or cbuf_len>=2**32:
+        return None
+    cdef MemBuf out_buf = getbuf(max_size)
+    cdef unsigned char *obuf = <unsigned char*> out_buf.get_mem()
+    cdef Py_ssize_t size = -1
+    with nogil:
+        size = do_delta_spans(cbuf, rbuf, cbuf_len, obuf, max_size)
+    if size<0:
+        return None
+    return memoryview(out_buf)[:size]
+
+cdef Py_ssize_t do_delta_spans(const unsigned char *buf, const unsigned char *ref, Py_ssize_t l,
+                               unsigned char *out, Py_ssize_t max_size) nogil:
+    cdef Py_ssize_t words = l//8
+    cdef Py_ssize_t i = 0, j, last, start, end
+    cdef Py_ssize_t pos = 0             #end of the last span in the input buffer
+    cdef Py_ssize_t opos = 0            #position in the output buffer
+    while i<words:
+        if load64(buf+i*8)==load64(ref+i*8):
+            i += 1
+            continue
+        #extend the span until we find enough identical words:
+        last = i
+        j = i+1
+        while j<words and j-last<=MERGE_WORDS:
+            if load64(buf+j*8)!=load64(ref+j*8):
+                last = j
+            j += 1
+        start = i*8
+        end = (last+1)*8
+        if last==words-1 and tail_differs(buf, ref, end, l):
+            end = l
+        if write_span(out, &opos, max_size, buf, start-pos, start, end)<0:
+            return -1
+        pos = end
+        i = last+1
+    #trailing bytes (less than one word), unless already sent:
+    start = words*8
+    if pos<=start and tail_differs(buf, ref, start, l):
+        if write_span(out, &opos, max_size, buf, start-pos, start, l)<0:
+            return -1
+    return opos
+
+cdef inline int tail_differs(const unsigned char *buf, const unsigned char *ref, Py_ssize_t start, Py_ssize_t l) nogil:
+    while start<l:
+        if buf[start]!=ref[start]:
+            return 1
+        start += 1
+    return 0
+
+cdef inline int write_span(unsigned char *out, Py_ssize_t *opos, Py_ssize_t max_size,
+                           const unsigned char *buf, Py_ssize_t skip, Py_ssize_t start, Py_ssize_t end) nogil:
+    cdef Py_ssize_t o = opos[0]
+    if o+SPAN_HEADER_SIZE+(end-start)>max_size:
+        return -1
+    write_uint32(out+o, skip)
+    write_uint32(out+o+4, end-start)
+    memcpy(out+o+SPAN_HEADER_SIZE, buf+start, end-start)
+    opos[0] = o+SPAN_HEADER_SIZE+(end-start)
+    return 0
+
+
+def apply_spans(ref, spans):
+    """
+        Returns a copy of 'ref' with the 'spans' applied to it.
+    """
+    cdef const unsigned char * rbuf = NULL
+    cdef Py_ssize_t rbuf_len = 0
+    assert object_as_buffer(ref, <const void**> &rbuf, &rbuf_len)==0, "cannot get buffer pointer for %s: %s" % (type(ref), ref)
+    cdef const unsigned char * sbuf = NULL
+    cdef Py_ssize_t sbuf_len = 0
+    assert object_as_buffer(spans, <const void**> &sbuf, &sbuf_len)==0, "cannot get buffer pointer for %s: %s" % (type(spans), spans)
+    cdef MemBuf out_buf = getbuf(rbuf_len)
+    cdef unsigned char *obuf = <unsigned char*> out_buf.get_mem()
+    cdef int r
+    with nogil:
+        memcpy(obuf, rbuf, rbuf_len)
+        r = do_apply_spans(obuf, rbuf_len, sbuf, sbuf_len)
+    if r<0:
+        raise Exception("invalid delta spans: %i bytes for a buffer of %i bytes" % (sbuf_len, rbuf_len))
+    return memoryview(out_buf)
+
+cdef int do_apply_spans(unsigned char *buf, Py_ssize_t l, const unsigned char *spans, Py_ssize_t spans_len) nogil:
+    cdef Py_ssize_t pos = 0, spos = 0
+    cdef Py_ssize_t skip, length
+    while spos<spans_len:
+        if spos+SPAN_HEADER_SIZE>spans_len:
+            return -1
+        skip = read_uint32(spans+spos)
+        length = read_uint32(spans+spos+4)
+        spos += SPAN_HEADER_SIZE
+        pos += skip
+        if pos+length>l or spos+length>spans_len:
+            return -1
+        memcpy(buf+pos, spans+spos, length)
+        pos += length
+        spos += length
+    return 0
@@ -21,6 +21,7 @@ from xpra.os_util import WIN32, PYTHON2
 TCP_NODELAY = envbool("XPRA_TCP_NODELAY", True)
 VSOCK_TIMEOUT = envint("XPRA_VSOCK_TIMEOUT", 5)
 SOCKET_TIMEOUT = envint("XPRA_SOCKET_TIMEOUT", 20)
+VECTORED_WRITE = envbool("XPRA_VECTORED_WRITE", True)
 
 
 #on some platforms (ie: OpenBSD), reading and writing from sockets
@@ -180,6 +181,11 @@ class Connection(object):
         #not implemented
         return None
 
+    def can_writev(self):
+        #subclasses that can write a list of buffers in one call
+        #should override this method and implement writev:
+        return False
+
     def _write(self, *args):
         """ wraps do_write with packet accounting """
         w = self.untilConcludes(*args)
@@ -245,6 +251,14 @@ class TwoFileConnection(Connection):
         self.may_abort("write")
         return self._write(self._oswrite, self._write_fd, buf)
 
+    def can_writev(self):
+        #tty devices may need the win32 write workaround:
+        return VECTORED_WRITE and hasattr(os, "writev") and self._oswrite==os.write
+
+    def writev(self, buffers):
+        self.may_abort("write")
+        return self._write(os.writev, self._write_fd, buffers)
+
     def close(self):
         log("%s.close() close callback=%s, readable=%s, writeable=%s", self, self._close_cb, self._readable, self._writeable)
         Connection.close(self)
@@ -298,6 +312,14 @@ class SocketConnection(Connection):
     def write(self, buf):
         return self._write(self._socket.send, buf)
 
+    def can_writev(self):
+        #only plain sockets can use sendmsg,
+        #ssl sockets raise NotImplementedError:
+        return VECTORED_WRITE and type(self._socket)==socket.socket and hasattr(self._socket, "sendmsg")
+
+    def writev(self, buffers):
+        return self._write(self._socket.sendmsg, buffers)
+
     def close(self):
         s = self._socket
         try:
@@ -5,16 +5,33 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
+import os
 import sys
 import zlib
 
 from xpra.log import Logger
 log = Logger("network", "protocol")
-from xpra.net.header import LZ4_FLAG, ZLIB_FLAG, LZO_FLAG
+from xpra.net.header import LZ4_FLAG, ZLIB_FLAG, LZO_FLAG, ZSTD_FLAG, ZSTD_DICT_FLAG
+from xpra.util import envint, envbool, csv
+from xpra.os_util import monotonic_time, memoryview_to_bytes, PYTHON3
 
 
 MAX_SIZE = 256*1024*1024
 
+#keep the zlib compression context across packets:
+STREAM_COMPRESSION = envbool("XPRA_STREAM_COMPRESSION", True)
+ADAPTIVE_COMPRESSION = envbool("XPRA_ADAPTIVE_COMPRESSION", False)
+#number of packets of a given type to compress before making decisions:
+ADAPTIVE_MIN_SAMPLES = envint("XPRA_ADAPTIVE_MIN_SAMPLES", 10)
+#try compressing again after skipping this many packets:
+ADAPTIVE_PROBE_INTERVAL = envint("XPRA_ADAPTIVE_PROBE_INTERVAL", 100)
+#skip compression if the compressed size is above this percentage:
+ADAPTIVE_SKIP_RATIO = envint("XPRA_ADAPTIVE_SKIP_RATIO", 95)
+#packets for which we prefer a fast compressor:
+LATENCY_SENSITIVE_PACKETS = os.environ.get("XPRA_LATENCY_SENSITIVE_PACKETS",
+                                           "cursor,pointer-position,button-action,key-action,damage-sequence,"+
+                                           "sound-data,ping,ping_echo,draw,configure-override-redirect").split(",")
+
 
 python_lz4_version = None
 lz4_version = None
@@ -43,7 +60,10 @@ try:
             return flag, compress(packet)
     else:
         #LZ4_compress_fast is 0.8 or later
-        from lz4 import LZ4_compress, LZ4_uncompress, compressHC        #@UnresolvedImport
+        from lz4 import LZ4_compress, compressHC        #@UnresolvedImport
+        def LZ4_uncompress(data):
+            #the old API does not accept buffers:
+            return lz4.LZ4_uncompress(memoryview_to_bytes(data))
         if hasattr(lz4, "LZ4_compress_fast"):
             from lz4 import LZ4_compress_fast     #@UnresolvedImport
             has_lz4 = True
@@ -69,7 +89,9 @@ try:
     lzo_version = lzo.LZO_VERSION_STRING
     def lzo_compress(packet, level):
         return level | LZO_FLAG, lzo.compress(packet)
-    LZO_decompress = lzo.decompress
+    def LZO_decompress(data):
+        #python-lzo does not accept buffers:
+        return lzo.decompress(memoryview_to_bytes(data))
 except Exception as e:
     log("lzo not found: %s", e)
     LZO_decompress = None
@@ -78,6 +100,93 @@ except Exception as e:
         raise Exception("lzo is not supported!")
 
 
+#zstd dictionary file, trained on the small control packets:
+ZSTD_DICTIONARY = os.environ.get("XPRA_ZSTD_DICTIONARY", "/usr/share/xpra/zstd.dict")
+python_zstd_version = None
+zstd_version = None
+zstd_dictionary = None
+zstd_dictionary_id = 0
+try:
+    import zstandard
+    python_zstd_version = zstandard.__version__
+    zstd_version = ".".join(str(x) for x in zstandard.ZSTD_VERSION)
+    has_zstd = True
+    from threading import local
+    #the compression and decompression contexts are not thread safe,
+    #so we keep one per thread (and per level):
+    zstd_contexts = local()
+    def get_zstd_compressor(level, dict_data=None):
+        cache = zstd_contexts.__dict__.setdefault("compressors", {})
+        key = (level, id(dict_data))
+        c = cache.get(key)
+        if c is None:
+            if dict_data is not None:
+                c = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+            else:
+                c = zstandard.ZstdCompressor(level=level)
+            cache[key] = c
+        return c
+    def get_zstd_decompressor(dict_data=None):
+        cache = zstd_contexts.__dict__.setdefault("decompressors", {})
+        key = id(dict_data)
+        d = cache.get(key)
+        if d is None:
+            if dict_data is not None:
+                d = zstandard.ZstdDecompressor(dict_data=dict_data)
+            else:
+                d = zstandard.ZstdDecompressor()
+            cache[key] = d
+        return d
+    def zstd_compress(packet, level):
+        #low zstd levels are fast, don't go higher than 9:
+        level = max(1, min(9, level))
+        return level | ZSTD_FLAG, get_zstd_compressor(level).compress(packet)
+    def zstd_dict_compress(packet, level):
+        level = max(1, min(9, level))
+        return level | ZSTD_FLAG | ZSTD_DICT_FLAG, get_zstd_compressor(level, zstd_dictionary).compress(packet)
+    def ZSTD_decompress(data, level):
+        if level & ZSTD_DICT_FLAG:
+            if not zstd_dictionary:
+                raise InvalidCompressionException("zstd dictionary is not available")
+            d = get_zstd_decompressor(zstd_dictionary)
+        else:
+            d = get_zstd_decompressor()
+        return d.decompress(data, max_output_size=MAX_SIZE)
+    def load_zstd_dictionary(filename=ZSTD_DICTIONARY):
+        global zstd_dictionary, zstd_dictionary_id
+        if not filename or not os.path.exists(filename):
+            log("zstd dictionary file '%s' not found", filename)
+            return False
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            d = zstandard.ZstdCompressionDict(data)
+            dict_id = d.dict_id()
+            if not dict_id:
+                log.warn("Warning: '%s' is not a valid zstd dictionary", filename)
+                return False
+            zstd_dictionary = d
+            zstd_dictionary_id = dict_id
+            log("loaded zstd dictionary %#x from '%s'", dict_id, filename)
+            return True
+        except Exception as e:
+            log.warn("Warning: failed to load zstd dictionary from '%s':", filename)
+            log.warn(" %s", e)
+            return False
+    def train_zstd_dictionary(samples, size=16384):
+        """ returns a dictionary trained on the given packet samples, as bytes """
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    load_zstd_dictionary()
+except Exception as e:
+    log("zstd not found: %s", e)
+    has_zstd = False
+    ZSTD_decompress = None
+    def zstd_compress(packet, level):
+        raise Exception("zstd is not supported!")
+    def zstd_dict_compress(packet, level):
+        raise Exception("zstd is not supported!")
+
+
 #stupid python version breakage:
 if sys.version > '3':
     def zcompress(packet, level):
@@ -99,18 +208,22 @@ else:
 use_zlib = True
 use_lzo = has_lzo
 use_lz4 = has_lz4
+use_zstd = has_zstd
 
 #all the compressors we know about, in best compatibility order:
-ALL_COMPRESSORS = ["zlib", "lz4", "lzo"]
+ALL_COMPRESSORS = ["zlib", "lz4", "lzo", "zstd"]
 
 #order for performance:
-PERFORMANCE_ORDER = ["lz4", "lzo", "zlib"]
+PERFORMANCE_ORDER = ["lz4", "zstd", "lzo", "zlib"]
 
 
 _COMPRESSORS = {
         "zlib"  : zcompress,
         "lz4"   : lz4_compress,
         "lzo"   : lzo_compress,
+        "zstd"  : zstd_compress,
+        #zstd using the shared dictionary, selected when both ends have the same one:
+        "zstd-dictionary"   : zstd_dict_compress,
         "none"  : nocompress,
                }
 
@@ -132,13 +245,25 @@ def get_compression_caps():
                               ""            : True,
                               "version"     : python_lz4_version,
                               }
+    _zstd = {"" : use_zstd}
+    if zstd_version:
+        _zstd["version"] = zstd_version
+    if zstd_dictionary_id:
+        _zstd["dictionary"] = zstd_dictionary_id
+    if python_zstd_version:
+        caps["python-zstandard"] = {
+                              ""            : True,
+                              "version"     : python_zstd_version,
+                              }
     _zlib = {
              ""             : use_zlib,
-             "version"      : zlib.__version__
+             "version"      : zlib.__version__,
+             "stream"       : use_zlib and STREAM_COMPRESSION,
              }
     caps.update({
                  "lz4"                   : _lz4,
                  "lzo"                   : _lzo,
+                 "zstd"                  : _zstd,
                  "zlib"                  : _zlib,
                  })
     return caps
@@ -147,13 +272,14 @@ def get_enabled_compressors(order=ALL_COMPRESSORS):
     enabled = [x for x,b in {
             "lz4"                   : use_lz4,
             "lzo"                   : use_lzo,
+            "zstd"                  : use_zstd,
             "zlib"                  : use_zlib,
             }.items() if b]
     #order them:
     return [x for x in order if x in enabled]
 
 def get_compressor(c):
-    assert c=="none" or c in ALL_COMPRESSORS
+    assert c in _COMPRESSORS, "invalid compressor: %s" % c
     return _COMPRESSORS[c]
 
 def get_compressor_name(c):
@@ -164,15 +290,145 @@ def get_compressor_name(c):
     raise Exception("impossible bug!")
 
 
+class AdaptiveCompressor(object):
+    """
+        Chooses the compressor to use for each packet type,
+        using the compression ratio and time recorded for the previous packets of the same type:
+        * compression is skipped for packet types which do not compress well
+          (ie: already compressed sound data, icons), re-trying from time to time
+        * latency sensitive packets use the fastest compressor available (lz4)
+        * other packets use the compressor with the best ratio (zlib)
+        The compressors must be supported by both ends of the connection.
+    """
+
+    def __init__(self, compressors, default):
+        self.compressors = [x for x in compressors if x in _COMPRESSORS]
+        self.default = default
+        #per packet type: [count, input bytes, output bytes, time, skipped]
+        self.stats = {}
+        fast = [x for x in PERFORMANCE_ORDER if x in self.compressors]
+        self.fast_compressor = _COMPRESSORS[(fast or [default])[0]]
+        if "zlib" in self.compressors:
+            self.bulk_compressor = zcompress
+        else:
+            self.bulk_compressor = _COMPRESSORS[default]
+
+    def __repr__(self):
+        return "AdaptiveCompressor(%s)" % csv(self.compressors)
+
+    def get_compressor(self, packet_type):
+        if packet_type in LATENCY_SENSITIVE_PACKETS:
+            return self.fast_compressor
+        return self.bulk_compressor
+
+    def select(self, packet_type):
+        """ returns the compressor to use for this packet type, or None to skip compression """
+        stats = self.stats.get(packet_type)
+        if stats is None:
+            stats = [0, 0, 0, 0, 0]
+            self.stats[packet_type] = stats
+        count, size_in, size_out, _, skipped = stats
+        if count>=ADAPTIVE_MIN_SAMPLES and size_out*100>=size_in*ADAPTIVE_SKIP_RATIO:
+            #this packet type does not compress well,
+            #only probe again every ADAPTIVE_PROBE_INTERVAL packets:
+            if skipped<ADAPTIVE_PROBE_INTERVAL:
+                stats[4] = skipped+1
+                return None
+            #reset the stats so we can re-evaluate:
+            stats[:] = [0, 0, 0, 0, 0]
+        return self.get_compressor(packet_type)
+
+    def record(self, packet_type, size_in, size_out, elapsed):
+        stats = self.stats[packet_type]
+        stats[0] += 1
+        stats[1] += size_in
+        stats[2] += size_out
+        stats[3] += elapsed
+
+    def compress(self, packet_type, data, level):
+        compressor = self.select(packet_type)
+        if compressor is None:
+            return nocompress(data, level)
+        start = monotonic_time()
+        cl, cdata = compressor(data, level)
+        self.record(packet_type, len(data), len(cdata), monotonic_time()-start)
+        return cl, cdata
+
+    def get_info(self):
+        info = {
+                "compressors"   : self.compressors,
+                "fast"          : get_compressor_name(self.fast_compressor),
+                "bulk"          : get_compressor_name(self.bulk_compressor),
+                }
+        for packet_type, (count, size_in, size_out, elapsed, skipped) in self.stats.items():
+            if count==0:
+                continue
+            info.setdefault("packet", {})[packet_type] = {
+                "count"     : count,
+                "ratio"     : int(100*size_out/max(1, size_in)),
+                "usecs"     : int(1000*1000*elapsed/count),
+                "skipped"   : skipped,
+                }
+        return info
+
+
+class StreamCompressor(object):
+    """
+        Compresses all the packets of a connection using the same zlib context,
+        so that the packets can refer to the data found in the previous ones.
+        Each packet is terminated with a sync flush, so it can be decompressed
+        as soon as it is received.
+        We use raw deflate streams (no zlib header), so we can start a new context
+        (ie: when the compression level changes) without the peer noticing.
+    """
+
+    def __init__(self):
+        self.level = -1
+        self.compressobj = None
+        self.packets = 0
+
+    def __repr__(self):
+        return "StreamCompressor(%i)" % self.level
+
+    def compress(self, packet, level):
+        if sys.version > '3' and type(packet)!=bytes:
+            packet = bytes(packet, 'UTF-8')
+        level = min(9, level)
+        if level!=self.level:
+            self.compressobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.level = level
+        c = self.compressobj
+        self.packets += 1
+        return level + ZLIB_FLAG, c.compress(packet)+c.flush(zlib.Z_SYNC_FLUSH)
+
+
+class StreamDecompressor(object):
+    """ decompresses the packets compressed using a StreamCompressor """
+
+    def __init__(self):
+        if not STREAM_COMPRESSION:
+            raise InvalidCompressionException("zlib stream compression is not enabled")
+        self.decompressobj = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        if not PYTHON3:
+            data = memoryview_to_bytes(data)
+        d = self.decompressobj
+        v = d.decompress(data, MAX_SIZE)
+        if d.unconsumed_tail:
+            raise Exception("uncompressed data is too large, limit is %iMB" % (MAX_SIZE//1024//1024))
+        return v
+
+
 def sanity_checks():
-    if not use_lzo and not use_lz4:
+    if not use_lzo and not use_lz4 and not use_zstd:
         if not use_zlib:
             log.warn("Warning: all the compressors are disabled,")
             log.warn(" unless you use mmap or have a gigabit connection or better")
             log.warn(" performance will suffer")
         else:
             log.warn("Warning: zlib is the only compressor enabled")
-            log.warn(" install and enable lzo or lz4 support for better performance")
+            log.warn(" install and enable lz4, zstd or lzo support for better performance")
 
 
 class Compressed(object):
@@ -244,6 +500,8 @@ def get_compression_type(level):
         return "lz4"
     elif level & LZO_FLAG:
         return "lzo"
+    elif level & ZSTD_FLAG:
+        return "zstd"
     else:
         return "zlib"
 
@@ -251,7 +509,14 @@ def get_compression_type(level):
 import struct
 LZ4_HEADER = struct.Struct('<L')
 def decompress(data, level):
+    """
+        The data can be a memoryview or a bytearray,
+        it is only converted to bytes for the decompressors that need it.
+    """
     #log.info("decompress(%s bytes, %s) type=%s", len(data), get_compression_type(level))
+    if not PYTHON3:
+        #the python2 decompressors only accept strings:
+        data = memoryview_to_bytes(data)
     if level & LZ4_FLAG:
         if not has_lz4:
             raise InvalidCompressionException("lz4 is not available")
@@ -269,6 +534,12 @@ def decompress(data, level):
         if not use_lzo:
             raise InvalidCompressionException("lzo is not enabled")
         return LZO_decompress(data)
+    elif level & ZSTD_FLAG:
+        if not has_zstd:
+            raise InvalidCompressionException("zstd is not available")
+        if not use_zstd:
+            raise InvalidCompressionException("zstd is not enabled")
+        return ZSTD_decompress(data, level)
     else:
         if not use_zlib:
             raise InvalidCompressionException("zlib is not enabled")
@@ -278,6 +549,7 @@ NAME_TO_FLAG = {
                 "lz4"   : LZ4_FLAG,
                 "zlib"  : 0,
                 "lzo"   : LZO_FLAG,
+                "zstd"  : ZSTD_FLAG,
                 }
 
 def decompress_by_name(data, algo):
@@ -286,7 +558,31 @@ def decompress_by_name(data, algo):
     return decompress(data, flag)
 
 
+def train_main(argv):
+    """
+        Trains a zstd dictionary from packet samples,
+        each sample file should contain one encoded packet (ie: bencoded or rencoded)
+    """
+    if len(argv)<2:
+        print("usage: %s train OUTPUT_DICTIONARY SAMPLE_FILE.." % sys.argv[0])
+        return 1
+    if not has_zstd:
+        print("zstd is not available")
+        return 1
+    samples = []
+    for filename in argv[1:]:
+        with open(filename, "rb") as f:
+            samples.append(f.read())
+    data = train_zstd_dictionary(samples)
+    with open(argv[0], "wb") as f:
+        f.write(data)
+    print("saved %i bytes zstd dictionary trained from %i samples to '%s'" % (len(data), len(samples), argv[0]))
+    return 0
+
+
 def main():
+    if len(sys.argv)>1 and sys.argv[1]=="train":
+        return train_main(sys.argv[2:])
     from xpra.util import print_nested_dict
     from xpra.platform import program_context
     with program_context("Compression", "Compression Info"):
@@ -294,4 +590,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
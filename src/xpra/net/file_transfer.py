@@ -8,13 +8,14 @@ import os
 import subprocess, shlex
 import hashlib
 import uuid
+from collections import OrderedDict
 
 from xpra.log import Logger
 printlog = Logger("printing")
 filelog = Logger("file")
 
 from xpra.child_reaper import getChildReaper
-from xpra.os_util import monotonic_time
+from xpra.os_util import monotonic_time, BytesIOClass
 from xpra.util import typedict, csv, nonl, envint, envbool
 from xpra.simple_stats import std_unit
 from xpra.make_thread import start_thread
@@ -22,6 +23,10 @@ from xpra.make_thread import start_thread
 DELETE_PRINTER_FILE = envbool("XPRA_DELETE_PRINTER_FILE", True)
 FILE_CHUNKS_SIZE = max(0, envint("XPRA_FILE_CHUNKS_SIZE", 65536))
 MAX_CONCURRENT_FILES = max(1, envint("XPRA_MAX_CONCURRENT_FILES", 10))
+#how many chunks we send ahead of the acknowledgements:
+FILE_CHUNKS_WINDOW = max(1, envint("XPRA_FILE_CHUNKS_WINDOW", 8))
+#how many partially received files we remember, so the transfers can be resumed:
+MAX_PARTIAL_FILES = max(0, envint("XPRA_MAX_PARTIAL_FILES", 10))
 CHUNK_TIMEOUT = 10*1000
 
 MIMETYPE_EXTS = {
@@ -60,6 +65,68 @@ def safe_open_download_file(basefilename, mimetype):
     return filename, fd
 
 
+def get_file_key(filename, filesize):
+    """
+        identifies the file being sent so that the transfer can be resumed,
+        the contents are still verified using the digest when the transfer completes
+    """
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        mtime = 0
+    u = hashlib.sha1()
+    u.update(("%s-%i-%i" % (os.path.abspath(filename), filesize, mtime)).encode("utf8"))
+    return u.hexdigest()
+
+def update_digest(digest, source, size, read_size=FILE_CHUNKS_SIZE or 65536):
+    """ reads 'size' bytes from the file object and adds them to the digest """
+    while size>0:
+        data = source.read(min(size, read_size))
+        if not data:
+            raise Exception("missing %i bytes" % size)
+        digest.update(data)
+        size -= len(data)
+
+
+#files we have only received partially, keyed by the 'file-key' the sender gave us,
+#shared by all the connections so that we can resume after a reconnection:
+partial_files = OrderedDict()
+
+def add_partial_file(key, filename, written):
+    if not key or written<=0 or MAX_PARTIAL_FILES<=0:
+        return
+    partial_files[key] = (filename, written)
+    while len(partial_files)>MAX_PARTIAL_FILES:
+        partial_files.popitem(last=False)
+    filelog("saved partial file %s: %i bytes received", filename, written)
+
+def open_partial_file(key, filesize):
+    """ returns the filename, fd, digest and size of the data we already have, or None """
+    if not key:
+        return None
+    filename, written = partial_files.pop(key, (None, 0))
+    if not filename or written>=filesize:
+        return None
+    try:
+        if os.path.getsize(filename)!=written:
+            filelog("partial file %s has been modified", filename)
+            return None
+        digest = hashlib.sha1()
+        with open(filename, "rb") as f:
+            update_digest(digest, f, written)
+        flags = os.O_WRONLY | os.O_APPEND
+        try:
+            flags |= os.O_BINARY                #@UndefinedVariable (win32 only)
+        except:
+            pass
+        fd = os.open(filename, flags)
+    except Exception as e:
+        filelog("cannot resume partial file %s: %s", filename, e)
+        return None
+    filelog("resuming partial file %s from %i bytes", filename, written)
+    return filename, fd, digest, written
+
+
 class FileTransferAttributes(object):
     def __init__(self, opts=None):
         if opts:
@@ -86,6 +153,7 @@ class FileTransferAttributes(object):
                 "file-transfer"     : self.file_transfer,
                 "file-size-limit"   : self.file_size_limit,
                 "file-chunks"       : self.file_chunks,
+                "file-stream"       : True,
                 "open-files"        : self.open_files,
                 "printing"          : self.printing,
                 }
@@ -97,6 +165,8 @@ class FileTransferAttributes(object):
                 "enabled"           : self.file_transfer,
                 "size-limit"        : self.file_size_limit,
                 "open"              : self.open_files,
+                "chunks-window"     : FILE_CHUNKS_WINDOW,
+                "partial-files"     : len(partial_files),
                 }
 
 
@@ -113,6 +183,7 @@ class FileTransferHandler(FileTransferAttributes):
         self.remote_open_files = False
         self.remote_file_size_limit = 0
         self.remote_file_chunks = 0
+        self.remote_file_stream = False
         self.send_chunks_in_progress = {}
         self.receive_chunks_in_progress = {}
         self.file_descriptors = set()
@@ -124,9 +195,13 @@ class FileTransferHandler(FileTransferAttributes):
             self.source_remove = glib.source_remove
 
     def cleanup(self):
-        for x in list(self.file_descriptors):
+        for chunk_id in list(self.send_chunks_in_progress.keys()):
+            self.cancel_sending(chunk_id)
+        for chunk_id in list(self.receive_chunks_in_progress.keys()):
+            self.cancel_receiving(chunk_id, True)
+        for fd in list(self.file_descriptors):
             try:
-                x.close()
+                os.close(fd)
             except:
                 pass
         self.init_attributes()
@@ -137,6 +212,7 @@ class FileTransferHandler(FileTransferAttributes):
         self.remote_open_files = c.boolget("open-files")
         self.remote_file_size_limit = c.intget("file-size-limit")
         self.remote_file_chunks = max(0, min(self.remote_file_size_limit*1024*1024, c.intget("file-chunks")))
+        self.remote_file_stream = c.boolget("file-stream")
 
     def get_info(self):
         info = FileTransferAttributes.get_info(self)
@@ -144,6 +220,7 @@ class FileTransferHandler(FileTransferAttributes):
                           "file-transfer"   : self.remote_file_transfer,
                           "file-size-limit" : self.remote_file_size_limit,
                           "file-chunks"     : self.remote_file_chunks,
+                          "file-stream"     : self.remote_file_stream,
                           "open-files"      : self.remote_open_files,
                           "printing"        : self.remote_printing,
                           }
@@ -158,17 +235,54 @@ class FileTransferHandler(FileTransferAttributes):
             filelog("%s digest matches: %s", algo, digest)
 
 
+    def mmap_write_data(self, data):
+        """
+            Subclasses can send the file data via a shared memory area
+            rather than over the connection:
+            returns the mmap chunks used, or None to send the data in the packet.
+        """
+        return None
+
+    def mmap_read_data(self, mmap_data):
+        raise Exception("cannot receive file data via mmap")
+
+
+    def cancel_receiving(self, chunk_id, keep_partial=False):
+        chunk_state = self.receive_chunks_in_progress.pop(chunk_id, None)
+        if not chunk_state:
+            return
+        fd = chunk_state[1]
+        timer = chunk_state[-2]
+        if timer:
+            chunk_state[-2] = 0
+            self.source_remove(timer)
+        self.file_descriptors.discard(fd)
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+        if keep_partial:
+            #so the sender can resume this transfer later:
+            options = chunk_state[7]
+            add_partial_file(options.strget("file-key"), chunk_state[2], chunk_state[9])
+
     def _check_chunk_receiving(self, chunk_id, chunk_no):
         chunk_state = self.receive_chunks_in_progress.get(chunk_id)
         filelog("_check_chunk_receiving(%s, %s) chunk_state=%s", chunk_id, chunk_no, chunk_state)
         if chunk_state:
             chunk_state[-2] = 0     #this timer has been used
-            if chunk_state[-1]==0:
+            if chunk_state[-1]==chunk_no:
                 filelog.error("Error: chunked file transfer timed out")
-                del self.receive_chunks_in_progress[chunk_id]
+                self.cancel_receiving(chunk_id, True)
 
     def _process_send_file_chunk(self, packet):
         chunk_id, chunk, file_data, has_more = packet[1:5]
+        chunk_options = typedict()
+        if len(packet)>5:
+            chunk_options = typedict(packet[5])
+            mmap_data = chunk_options.listget("mmap")
+            if mmap_data:
+                file_data = self.mmap_read_data(mmap_data)
         filelog("_process_send_file_chunk%s", (chunk_id, chunk, "%i bytes" % len(file_data), has_more))
         chunk_state = self.receive_chunks_in_progress.get(chunk_id)
         if not chunk_state:
@@ -179,8 +293,7 @@ class FileTransferHandler(FileTransferAttributes):
         if chunk_state[-1]+1!=chunk:
             filelog.error("Error: chunk number mismatch, expected %i but got %i", chunk_state[-1]+1, chunk)
             self.send("ack-file-chunk", chunk_id, False, "chunk number mismatch", chunk)
-            del self.receive_chunks_in_progress[chunk_id]
-            os.close(fd)
+            self.cancel_receiving(chunk_id, True)
             return
         #update chunk number:
         chunk_state[-1] = chunk
@@ -195,29 +308,25 @@ class FileTransferHandler(FileTransferAttributes):
             filelog.error("Error: cannot write file chunk")
             filelog.error(" %s", e)
             self.send("ack-file-chunk", chunk_id, False, "write error: %s" % e, chunk)
-            del self.receive_chunks_in_progress[chunk_id]
-            try:
-                os.close(fd)
-            except:
-                pass
+            self.cancel_receiving(chunk_id)
             return
         self.send("ack-file-chunk", chunk_id, True, "", chunk)
         if has_more:
             timer = chunk_state[-2]
             if timer:
                 self.source_remove(timer)
-            #remote end will send more after receiving the ack
+            #the remote end may send more chunks before receiving this ack
             timer = self.timeout_add(CHUNK_TIMEOUT, self._check_chunk_receiving, chunk_id, chunk)
             chunk_state[-2] = timer
             return
-        del self.receive_chunks_in_progress[chunk_id]
-        os.close(fd)
+        self.cancel_receiving(chunk_id)
         #check file size and digest then process it:
         filename, mimetype, printit, openit, filesize, options = chunk_state[2:8]
         if written!=filesize:
             filelog.error("Error: expected a file of %i bytes, got %i", filesize, written)
             return
-        expected_digest = options.get("sha1")
+        #streaming senders only send the digest with the last chunk:
+        expected_digest = options.get("sha1") or chunk_options.strget("sha1")
         if expected_digest:
             self.check_digest(filename, digest.hexdigest(), expected_digest)
         start_time = chunk_state[0]
@@ -230,6 +339,9 @@ class FileTransferHandler(FileTransferAttributes):
         #the remote end is sending us a file
         basefilename, mimetype, printit, openit, filesize, file_data, options = packet[1:8]
         options = typedict(options)
+        mmap_data = options.listget("mmap")
+        if mmap_data:
+            file_data = self.mmap_read_data(mmap_data)
         if printit:
             l = printlog
             assert self.printing
@@ -242,21 +354,32 @@ class FileTransferHandler(FileTransferAttributes):
             l.error("Error: file '%s' is too large:", basefilename)
             l.error(" %iMB, the file size limit is %iMB", filesize//1024//1024, self.file_size_limit)
             return
-        filename, fd = safe_open_download_file(basefilename, mimetype)
-        self.file_descriptors.add(fd)
         chunk_id = options.get("file-chunk-id")
         if chunk_id:
             if len(self.receive_chunks_in_progress)>=MAX_CONCURRENT_FILES:
                 self.send("ack-file-chunk", chunk_id, False, "too many file transfers in progress", 0)
-                os.close(fd)
                 return
-            digest = hashlib.sha1()
             chunk = 0
+            partial = open_partial_file(options.strget("file-key"), filesize)
+            if partial:
+                filename, fd, digest, written = partial
+                l("resuming '%s' from %i bytes", filename, written)
+            else:
+                filename, fd = safe_open_download_file(basefilename, mimetype)
+                digest = hashlib.sha1()
+                written = 0
+            self.file_descriptors.add(fd)
             timer = self.timeout_add(CHUNK_TIMEOUT, self._check_chunk_receiving, chunk_id, chunk)
-            chunk_state = [monotonic_time(), fd, filename, mimetype, printit, openit, filesize, options, digest, 0, timer, chunk]
+            chunk_state = [monotonic_time(), fd, filename, mimetype, printit, openit, filesize, options, digest, written, timer, chunk]
             self.receive_chunks_in_progress[chunk_id] = chunk_state
-            self.send("ack-file-chunk", chunk_id, True, "", chunk)
+            if written:
+                #tell the sender to skip what we already have:
+                self.send("ack-file-chunk", chunk_id, True, "", chunk, {"offset" : written})
+            else:
+                self.send("ack-file-chunk", chunk_id, True, "", chunk)
             return
+        filename, fd = safe_open_download_file(basefilename, mimetype)
+        self.file_descriptors.add(fd)
         #not chunked, full file:
         assert file_data, "no data!"
         if len(file_data)!=filesize:
@@ -276,6 +399,7 @@ class FileTransferHandler(FileTransferAttributes):
         try:
             os.write(fd, file_data)
         finally:
+            self.file_descriptors.discard(fd)
             os.close(fd)
         self.do_process_downloaded_file(filename, mimetype, printit, openit, filesize, options)
 
@@ -380,6 +504,10 @@ class FileTransferHandler(FileTransferAttributes):
         return True
 
     def send_file(self, filename, mimetype, data, filesize=0, printit=False, openit=False, options={}):
+        """
+            'data' may be None, in which case the file is read from disk
+            one chunk at a time as the transfer progresses.
+        """
         if printit:
             if not self.printing:
                 printlog.warn("Warning: printing is not enabled for %s", self)
@@ -401,44 +529,104 @@ class FileTransferHandler(FileTransferAttributes):
         if not printit and openit and not self.remote_open_files:
             l.warn("Warning: opening the file after transfer is disabled on the remote end")
             openit = False
-        assert len(data)>=filesize, "data is smaller then the given file size!"
-        data = data[:filesize]          #gio may null terminate it
+        if data is not None:
+            assert len(data)>=filesize, "data is smaller then the given file size!"
+            data = data[:filesize]          #gio may null terminate it
         l("send_file%s", (filename, mimetype, type(data), "%i bytes" % filesize, printit, openit, options))
+        #don't modify the caller's dictionary (or the default argument):
+        options = dict(options)
         absfile = os.path.abspath(filename)
         if not self.check_file_size(action, filename, filesize):
             return False
-        u = hashlib.sha1()
-        u.update(data)
-        filelog("sha1 digest(%s)=%s", absfile, u.hexdigest())
-        options["sha1"] = u.hexdigest()
+        if data is None:
+            try:
+                source = open(absfile, "rb")
+            except (OSError, IOError) as e:
+                l.error("Error: cannot read file '%s'", filename)
+                l.error(" %s", e)
+                return False
+        else:
+            source = BytesIOClass(data)
         chunk_size = min(self.file_chunks, self.remote_file_chunks)
         if chunk_size>0 and filesize>chunk_size:
             if len(self.send_chunks_in_progress)>=MAX_CONCURRENT_FILES:
+                source.close()
                 raise Exception("too many file transfers in progress")
             #chunking is supported and the file is big enough
+            digest = None
+            if data is not None or not self.remote_file_stream:
+                #old clients need the digest up front:
+                u = hashlib.sha1()
+                try:
+                    update_digest(u, source, filesize)
+                except Exception as e:
+                    source.close()
+                    l.error("Error: cannot read file '%s'", filename)
+                    l.error(" %s", e)
+                    return False
+                source.seek(0)
+                filelog("sha1 digest(%s)=%s", absfile, u.hexdigest())
+                options["sha1"] = u.hexdigest()
+                options["file-key"] = u.hexdigest()
+            else:
+                #the digest is calculated as we read the file,
+                #and sent with the last chunk:
+                digest = hashlib.sha1()
+                options["file-key"] = get_file_key(absfile, filesize)
             chunk_id = uuid.uuid4().hex
             options["file-chunk-id"] = chunk_id
-            timer = self.timeout_add(CHUNK_TIMEOUT, self._check_chunk_sending, chunk_id, 0)
-            chunk_state = [monotonic_time(), data, chunk_size, timer, 0]
+            #timer to check that the other end is requesting more chunks:
+            timer = self.timeout_add(CHUNK_TIMEOUT, self._check_chunk_sending, chunk_id, -1)
+            #start-time, file object, chunk-size, timer, last chunk acked, last chunk sent, digest, position, file-size
+            chunk_state = [monotonic_time(), source, chunk_size, timer, -1, 0, digest, 0, filesize]
             self.send_chunks_in_progress[chunk_id] = chunk_state
             cdata = ""
-            #timer to check that the other end is requesting more chunks:
         else:
             #send everything now:
-            cdata = self.compressed_wrapper("file-data", data)
-            assert len(cdata)<=filesize     #compressed wrapper ensures this is true
+            try:
+                data = source.read(filesize)
+            finally:
+                source.close()
+            if len(data)!=filesize:
+                l.error("Error: cannot read file '%s'", filename)
+                l.error(" expected %i bytes but got %i", filesize, len(data))
+                return False
+            u = hashlib.sha1()
+            u.update(data)
+            filelog("sha1 digest(%s)=%s", absfile, u.hexdigest())
+            options["sha1"] = u.hexdigest()
+            mmap_data = self.mmap_write_data(data)
+            if mmap_data:
+                options["mmap"] = mmap_data
+                cdata = ""
+            else:
+                cdata = self.compressed_wrapper("file-data", data)
+                assert len(cdata)<=filesize     #compressed wrapper ensures this is true
         basefilename = os.path.basename(filename)
         self.send("send-file", basefilename, mimetype, printit, openit, filesize, cdata, options)
         return True
 
+    def cancel_sending(self, chunk_id):
+        chunk_state = self.send_chunks_in_progress.pop(chunk_id, None)
+        if not chunk_state:
+            return
+        timer = chunk_state[3]
+        if timer:
+            chunk_state[3] = 0
+            self.source_remove(timer)
+        try:
+            chunk_state[1].close()
+        except:
+            pass
+
     def _check_chunk_sending(self, chunk_id, chunk_no):
         chunk_state = self.send_chunks_in_progress.get(chunk_id)
         filelog("_check_chunk_sending(%s, %s) chunk_state found: %s", chunk_id, chunk_no, bool(chunk_state))
         if chunk_state:
-            chunk_state[-2] = 0         #timer has fired
-            if chunk_state[-1]==chunk_no:
-                filelog.error("Error: chunked file transfer timed out on chunk %i", chunk_no)
-                del self.send_chunks_in_progress[chunk_id]
+            chunk_state[3] = 0          #timer has fired
+            if chunk_state[4]==chunk_no:
+                filelog.error("Error: chunked file transfer timed out on chunk %i", chunk_no+1)
+                self.cancel_sending(chunk_id)
 
     def _process_ack_file_chunk(self, packet):
         #the other end received our send-file or send-file-chunk,
@@ -448,30 +636,81 @@ class FileTransferHandler(FileTransferAttributes):
         if not state:
             filelog.error("Error: remote end is cancelling the file transfer:")
             filelog.error(" %s", error_message)
-            del self.send_chunks_in_progress[chunk_id]
+            self.cancel_sending(chunk_id)
             return
         chunk_state = self.send_chunks_in_progress.get(chunk_id)
         if not chunk_state:
             filelog.error("Error: cannot find the file transfer id '%s'", nonl(chunk_id))
             return
-        if chunk_state[-1]!=chunk:
-            filelog.error("Error: chunk number mismatch (%i vs %i)", chunk_state, chunk)
-            del self.send_chunks_in_progress[chunk_id]
+        if chunk_state[4]+1!=chunk:
+            filelog.error("Error: chunk number mismatch, expected %i but got %i", chunk_state[4]+1, chunk)
+            self.cancel_sending(chunk_id)
             return
-        start_time, data, chunk_size, timer, chunk = chunk_state
-        if not data:
-            #all sent!
-            elapsed = monotonic_time()-start_time
-            filelog("%i chunks of %i bytes sent in %ims (%sB/s)", chunk, chunk_size, elapsed*1000, std_unit(chunk*chunk_size/elapsed))
-            del self.send_chunks_in_progress[chunk_id]
+        chunk_state[4] = chunk
+        if chunk==0 and len(packet)>5:
+            #the remote end already has the start of this file:
+            offset = typedict(packet[5]).intget("offset")
+            if offset>0:
+                try:
+                    self.skip_file_data(chunk_state, offset)
+                except Exception as e:
+                    filelog.error("Error: cannot resume the file transfer at %i bytes", offset)
+                    filelog.error(" %s", e)
+                    self.cancel_sending(chunk_id)
+                    return
+        self.send_file_chunks(chunk_id, chunk_state)
+
+    def skip_file_data(self, chunk_state, offset):
+        source, digest, filesize = chunk_state[1], chunk_state[6], chunk_state[8]
+        if offset>=filesize:
+            raise Exception("invalid offset %i for a file of %i bytes" % (offset, filesize))
+        filelog("resuming file transfer from %i bytes", offset)
+        if digest:
+            #the digest covers the whole file:
+            update_digest(digest, source, offset)
+        else:
+            source.seek(offset)
+        chunk_state[7] = offset
+
+    def send_file_chunks(self, chunk_id, chunk_state):
+        start_time, source, chunk_size, timer, acked, sent, digest, position, filesize = chunk_state
+        if acked==sent and position>=filesize:
+            #all sent and acknowledged!
+            elapsed = max(0.001, monotonic_time()-start_time)
+            filelog("%i chunks of %i bytes sent in %ims (%sB/s)", sent, chunk_size, elapsed*1000, std_unit(filesize/elapsed))
+            self.cancel_sending(chunk_id)
             return
-        assert chunk_size>0
-        #carve out another chunk:
-        cdata = self.compressed_wrapper("file-data", data[:chunk_size])
-        data = data[chunk_size:]
-        chunk += 1
         if timer:
             self.source_remove(timer)
-        timer = self.timeout_add(CHUNK_TIMEOUT, self._check_chunk_sending, chunk_id, chunk)
-        self.send_chunks_in_progress[chunk_id] = [start_time, data, chunk_size, timer, chunk]
-        self.send("send-file-chunk", chunk_id, chunk, cdata, bool(data))
+        chunk_state[3] = self.timeout_add(CHUNK_TIMEOUT, self._check_chunk_sending, chunk_id, acked)
+        #keep up to FILE_CHUNKS_WINDOW chunks in flight:
+        while sent-acked<FILE_CHUNKS_WINDOW and position<filesize:
+            try:
+                data = source.read(min(chunk_size, filesize-position))
+            except (OSError, IOError):
+                filelog("read error", exc_info=True)
+                data = None
+            if not data:
+                filelog.error("Error: failed to read the file data at %i bytes", position)
+                self.cancel_sending(chunk_id)
+                return
+            position += len(data)
+            sent += 1
+            chunk_state[5] = sent
+            chunk_state[7] = position
+            has_more = position<filesize
+            chunk_options = {}
+            if digest:
+                digest.update(data)
+                if not has_more:
+                    chunk_options["sha1"] = digest.hexdigest()
+            mmap_data = self.mmap_write_data(data)
+            if mmap_data:
+                chunk_options["mmap"] = mmap_data
+                cdata = ""
+            else:
+                cdata = self.compressed_wrapper("file-data", data)
+            if chunk_options:
+                self.send("send-file-chunk", chunk_id, sent, cdata, has_more, chunk_options)
+            else:
+                self.send("send-file-chunk", chunk_id, sent, cdata, has_more)
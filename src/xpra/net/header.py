@@ -10,18 +10,23 @@ FLAGS_BENCODE   = 0x0       #assume bencode if not other flag is set
 FLAGS_RENCODE   = 0x1
 FLAGS_CIPHER    = 0x2
 FLAGS_YAML      = 0x4
+#compressed using the zlib stream of the connection:
+FLAGS_ZLIB_STREAM = 0x8
 
 #compression flags are carried in the "level" field,
 #the low bits contain the compression level, the high bits the compression algo:
 ZLIB_FLAG       = 0x0       #assume zlib if no other compression flag is set
 LZ4_FLAG        = 0x10
 LZO_FLAG        = 0x20
+ZSTD_FLAG       = 0x40
+#zstd compressed using the dictionary shared by both ends:
+ZSTD_DICT_FLAG  = 0x80
 FLAGS_NOHEADER  = 0x40
 
 
 _header_unpack_struct = struct.Struct('!cBBBL')
-def unpack_header(buf):
-    return _header_unpack_struct.unpack_from(buf)
+def unpack_header(buf, offset=0):
+    return _header_unpack_struct.unpack_from(buf, offset)
 
 #'P' + protocol-flags + compression_level + packet_index + data_size
 _header_pack_struct = struct.Struct('!BBBBL')
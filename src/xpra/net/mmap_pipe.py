@@ -5,6 +5,8 @@
 
 import os
 import ctypes
+from collections import deque
+from threading import Lock
 from xpra.util import roundup
 from xpra.os_util import memoryview_to_bytes, WIN32, POSIX
 from xpra.simple_stats import to_std_unit
@@ -279,3 +281,142 @@ def mmap_write(mmap_area, mmap_size, data):
             mmap_data_end.value = 8+l2
     log("sending damage with mmap: %s", data)
     return data, mmap_free_size
+
+
+#ring buffer mode:
+#each chunk of data is preceded by an 8 byte header:
+#the length of the chunk (including the header) and its state
+RING_HEADER_SIZE = 8
+RING_CHUNK_FREE = 0
+RING_CHUNK_USED = 1
+
+def mmap_ring_read(mmap_area, offset, length):
+    """
+        Returns the data written by 'MmapRing.write' without copying it,
+        the caller must release the chunk using 'mmap_ring_free' once it is done with it.
+    """
+    arraytype = ctypes.c_char * length
+    return arraytype.from_buffer(mmap_area, offset)
+
+def mmap_ring_free(mmap_area, *descr_data):
+    """
+        Releases the ring buffer chunks once the consumer is done with them,
+        this can be done in any order.
+    """
+    for offset, _ in descr_data:
+        int_from_buffer(mmap_area, offset-RING_HEADER_SIZE+4).value = RING_CHUNK_FREE
+
+
+class MmapRing(object):
+    """
+        Allocates contiguous chunks of the mmap area as a ring buffer,
+        so that we can have many frames (or other data) in flight at the same time.
+        The producer (the server) sets the state of each chunk to 'used' when it writes it,
+        the consumer (the client) sets it back to 'free' when it is done with the data.
+        The chunks can be released in any order, but the space is only reclaimed
+        once all the chunks before it have been freed.
+        The allocation indexes are only ever updated on the producer side,
+        so the two processes do not need to synchronize.
+    """
+
+    def __init__(self, mmap_area, mmap_size, start=8):
+        self.mmap_area = mmap_area
+        #keep the chunks aligned:
+        self.mmap_size = mmap_size - mmap_size%RING_HEADER_SIZE
+        self.start = roundup(start, RING_HEADER_SIZE)
+        self.lock = Lock()
+        #chunks allocated, oldest first: (position, size, padding)
+        self.chunks = deque()
+        self.head = self.start
+        self.tail = self.start
+        self.used = 0
+
+    def __repr__(self):
+        return "MmapRing(%i)" % self.mmap_size
+
+    def get_info(self):
+        return {
+                "size"      : self.mmap_size,
+                "used"      : self.used,
+                "head"      : self.head,
+                "tail"      : self.tail,
+                "chunks"    : len(self.chunks),
+                }
+
+    def get_free_size(self):
+        return self.mmap_size-self.start-self.used
+
+    def reclaim(self):
+        """ move the tail past the chunks that have been freed by the consumer """
+        chunks = self.chunks
+        while chunks:
+            pos, size, padding = chunks[0]
+            if not padding and int_from_buffer(self.mmap_area, pos+4).value!=RING_CHUNK_FREE:
+                break
+            chunks.popleft()
+            self.used -= size
+        if chunks:
+            self.tail = chunks[0][0]
+        else:
+            #empty: start again from the beginning
+            self.head = self.tail = self.start
+            self.used = 0
+
+    def allocate(self, size):
+        """ returns the position of a contiguous chunk of 'size' bytes, or -1 """
+        #must be called with the lock held
+        self.reclaim()
+        head, tail = self.head, self.tail
+        if not self.chunks or head>tail:
+            #[-----T+++++++++H------]
+            #the space after the head is available, then the space before the tail
+            if self.mmap_size-head<size:
+                if tail-self.start<size:
+                    return -1
+                #wrap around, marking the end of the area as padding:
+                padding = self.mmap_size-head
+                if padding>0:
+                    self.chunks.append((head, padding, True))
+                    self.used += padding
+                head = self.start
+        elif tail-head<size:
+            #[+++++H---------T++++++]
+            #we have wrapped around already, only the space up to the tail is available
+            return -1
+        self.chunks.append((head, size, False))
+        self.used += size
+        self.head = head+size
+        int_from_buffer(self.mmap_area, head).value = size
+        int_from_buffer(self.mmap_area, head+4).value = RING_CHUNK_USED
+        return head
+
+    def write(self, data, quiet=False):
+        """
+            Writes 'data' to a new chunk of the ring buffer,
+            returns the mmap chunk used (or None if it failed)
+            and the mmap area's free memory.
+            Callers which can deal with a full area
+            can use 'quiet' to avoid the warnings.
+        """
+        warn = log.warn
+        if quiet:
+            warn = log
+        l = len(data)
+        size = roundup(l+RING_HEADER_SIZE, RING_HEADER_SIZE)
+        if size>self.mmap_size-self.start:
+            warn("Warning: mmap area is too small!")
+            warn(" we need to store %s bytes but the mmap area is limited to %i", l, self.mmap_size-self.start-RING_HEADER_SIZE)
+            return None, self.get_free_size()-size
+        with self.lock:
+            pos = self.allocate(size)
+            free = self.get_free_size()
+        if pos<0:
+            warn("Warning: mmap area is full!")
+            warn(" we need to store %s bytes but only have %s free space left", l, free)
+            return None, free-size
+        #the chunk is ours until the consumer frees it,
+        #so we can copy the data without holding the lock:
+        offset = pos+RING_HEADER_SIZE
+        self.mmap_area[offset:offset+l] = memoryview_to_bytes(data)
+        log("mmap ring: %i bytes written at %i", l, offset)
+        return [(offset, l)], free
@@ -18,7 +18,7 @@ from xpra.log import Logger
 log = Logger("network", "protocol")
 cryptolog = Logger("network", "crypto")
 
-from xpra.os_util import PYTHON3, Queue, memoryview_to_bytes, strtobytes
+from xpra.os_util import PYTHON3, Queue, memoryview_to_bytes, strtobytes, monotonic_time
 from xpra.util import repr_ellipsized, csv, envint, envbool
 from xpra.make_thread import make_thread, start_thread
 from xpra.net.common import ConnectionClosedException          #@UndefinedVariable (pydev false positive)
@@ -26,9 +26,11 @@ from xpra.net.bytestreams import ABORT
 from xpra.net import compression
 from xpra.net import packet_encoding
 from xpra.net.compression import get_compression_caps, decompress, sanity_checks as compression_sanity_checks,\
-        InvalidCompressionException, Compressed, LevelCompressed, Compressible, LargeStructure
+        InvalidCompressionException, Compressed, LevelCompressed, Compressible, LargeStructure, \
+        AdaptiveCompressor, StreamCompressor, StreamDecompressor, ADAPTIVE_COMPRESSION, STREAM_COMPRESSION
 from xpra.net.packet_encoding import get_packet_encoding_caps, decode, sanity_checks as packet_encoding_sanity_checks, InvalidPacketEncodingException
-from xpra.net.header import unpack_header, pack_header, FLAGS_CIPHER, FLAGS_NOHEADER
+from xpra.net.header import unpack_header, pack_header, FLAGS_CIPHER, FLAGS_NOHEADER, FLAGS_ZLIB_STREAM
+from xpra.net.read_buffer import ReadBuffer, COPY_SIZE
 from xpra.net.crypto import get_crypto_caps, get_encryptor, get_decryptor, pad, INITIAL_PADDING
 
 
@@ -104,6 +106,8 @@ class Protocol(object):
         self._read_queue_put = self.read_queue_put
         # Invariant: if .source is None, then _source_has_more == False
         self._get_packet_cb = get_packet_cb
+        #when set, the packets are passed to this callback without being parsed:
+        self._raw_packet_cb = None
         #counters:
         self.input_stats = {}
         self.input_packetcount = 0
@@ -123,6 +127,10 @@ class Protocol(object):
         self._encoder = self.noencode
         self.compressor = "none"
         self._compress = compression.nocompress
+        self._adaptive_compressor = None
+        self.stream_compression = False
+        self._stream_compressor = None
+        self._stream_decompressor = None
         self.compression_level = 0
         self.cipher_in = None
         self.cipher_in_name = None
@@ -134,6 +142,10 @@ class Protocol(object):
         self.cipher_out_padding = INITIAL_PADDING
         self._write_lock = Lock()
         self._write_thread = None
+        #vectored writes let us send the header and payload chunks
+        #in a single call without joining or slicing the buffers:
+        can_writev = getattr(conn, "can_writev", None)
+        self._writev = bool(can_writev and can_writev())
         self._read_thread = make_thread(self._read_thread_loop, "read", daemon=True)
         self._read_parser_thread = None         #started when needed
         self._write_format_thread = None        #started when needed
@@ -142,7 +154,7 @@ class Protocol(object):
     STATE_FIELDS = ("max_packet_size", "large_packets", "send_aliases", "receive_aliases",
                     "cipher_in", "cipher_in_name", "cipher_in_block_size", "cipher_in_padding",
                     "cipher_out", "cipher_out_name", "cipher_out_block_size", "cipher_out_padding",
-                    "compression_level", "encoder", "compressor")
+                    "compression_level", "encoder", "compressor", "stream_compression")
     def save_state(self):
         state = {}
         for x in Protocol.STATE_FIELDS:
@@ -157,6 +169,7 @@ class Protocol(object):
         #special handling for compressor / encoder which are named objects:
         self.enable_compressor(self.compressor)
         self.enable_encoder(self.encoder)
+        self.enable_stream_compression(self.stream_compression)
 
     def wait_for_io_threads_exit(self, timeout=None):
         for t in (self._read_thread, self._write_thread):
@@ -173,6 +186,44 @@ class Protocol(object):
     def set_packet_source(self, get_packet_cb):
         self._get_packet_cb = get_packet_cb
 
+    def set_raw_packet_callback(self, raw_packet_cb):
+        """
+            From now on, the packets received are not decrypted, decompressed or decoded,
+            the raw payloads are passed to:
+            raw_packet_cb(protocol, protocol_flags, compression_level, packet_index, data)
+            Used by the proxy for forwarding packets to another connection with 'write_raw_packet'.
+        """
+        assert not self.cipher_in, "cannot use raw packets with encryption"
+        self._raw_packet_cb = raw_packet_cb
+
+    def write_raw_packet(self, protocol_flags, compression_level, packet_index, data):
+        """ sends a packet received from another connection as-is """
+        assert not self.cipher_out, "cannot send raw packets with encryption"
+        items = [(pack_header(protocol_flags, compression_level, packet_index, len(data)), None, None), (data, None, None)]
+        with self._write_lock:
+            if self._closed:
+                return
+            if self._write_thread is None:
+                self.start_write_thread()
+            self._write_queue.put(items)
+            if packet_index==0:
+                self.output_packetcount += 1
+
+    def decode_raw_packet(self, protocol_flags, compression_level, data):
+        """
+            Decodes a packet received via the raw packet callback,
+            returns None if this cannot be done without the stream decompression context.
+        """
+        if protocol_flags & FLAGS_ZLIB_STREAM:
+            return None
+        if compression_level>0:
+            data = decompress(data, compression_level)
+        packet = decode(memoryview_to_bytes(data), protocol_flags)
+        packet_type = packet[0]
+        if self.receive_aliases and type(packet_type)==int and packet_type in self.receive_aliases:
+            packet[0] = self.receive_aliases.get(packet_type)
+        return packet
+
 
     def set_cipher_in(self, ciphername, iv, password, key_salt, iterations, padding):
         if self.cipher_in_name!=ciphername:
@@ -214,6 +265,7 @@ class Protocol(object):
                                                    },
                         },
             "output" : {
+                        "vectored"              : self._writev,
                         "packet-join-size"      : PACKET_JOIN_SIZE,
                         "large-packet-size"     : LARGE_PACKET_SIZE,
                         "inline-size"           : INLINE_SIZE,
@@ -229,6 +281,15 @@ class Protocol(object):
         c = self._compress
         if c:
             info["compressor"] = compression.get_compressor_name(self._compress)
+        sc = self._stream_compressor
+        if sc:
+            info["compression-stream"] = {
+                "packets"   : sc.packets,
+                "level"     : sc.level,
+                }
+        ac = self._adaptive_compressor
+        if ac:
+            info["adaptive-compression"] = ac.get_info()
         e = self._encoder
         if e:
             if self._encoder==self.noencode:
@@ -245,6 +306,7 @@ class Protocol(object):
             except:
                 log.error("error collecting connection information on %s", self._conn, exc_info=True)
         info["has_more"] = self._source_has_more.is_set()
+        info["raw"] = self._raw_packet_cb is not None
         for t in (self._write_thread, self._read_thread, self._read_parser_thread, self._write_format_thread):
             if t:
                 info.setdefault("thread", {})[t.name] = t.is_alive()
@@ -349,6 +411,10 @@ class Protocol(object):
                 #for plain/text packets (ie: gibberish response)
                 log("sending %s bytes without header", payload_size)
                 items.append((data, scb, ecb))
+            elif self._writev:
+                #no need to join, the header and data are written together:
+                items.append((pack_header(proto_flags, level, index, payload_size), scb, None))
+                items.append((data, None, ecb))
             elif actual_size<PACKET_JOIN_SIZE:
                 if type(data) not in JOIN_TYPES:
                     data = memoryview_to_bytes(data)
@@ -435,7 +501,16 @@ class Protocol(object):
         log("enable_compressor_from_caps(..) options=%s", opts)
         for c in opts:      #ie: [zlib, lz4, lzo]
             if caps.boolget(c):
+                if c=="zstd" and compression.zstd_dictionary_id and caps.intget("zstd.dictionary")==compression.zstd_dictionary_id:
+                    #both ends have the same dictionary:
+                    c = "zstd-dictionary"
                 self.enable_compressor(c)
+                #we can use any of the compressors supported by both ends:
+                compressors = [x for x in opts if caps.boolget(x)]
+                if ADAPTIVE_COMPRESSION:
+                    self._adaptive_compressor = AdaptiveCompressor(compressors, c)
+                    log("enable_compressor_from_caps(..) using %s", self._adaptive_compressor)
+                self.enable_stream_compression(STREAM_COMPRESSION and "zlib" in compressors and caps.boolget("zlib.stream"))
                 return
         log.warn("compression disabled: no matching compressor found")
         self.enable_compressor("none")
@@ -443,9 +518,21 @@ class Protocol(object):
     def enable_compressor(self, compressor):
         self._compress = compression.get_compressor(compressor)
         self.compressor = compressor
+        #selecting a compressor explicitly disables adaptive compression:
+        self._adaptive_compressor = None
         log("enable_compressor(%s): %s", compressor, self._compress)
 
 
+    def enable_stream_compression(self, enabled):
+        """ zlib compression will use the connection's stream context """
+        self.stream_compression = enabled
+        if enabled:
+            self._stream_compressor = StreamCompressor()
+        else:
+            self._stream_compressor = None
+        log("enable_stream_compression(%s)", enabled)
+
+
     def noencode(self, data):
         #just send data as a string for clients that don't understand xpra packet format:
         if PYTHON3:
@@ -460,13 +547,15 @@ class Protocol(object):
         return b(": ".join(str(x) for x in data)+"\n"), FLAGS_NOHEADER
 
 
-    def encode(self, packet_in):
+    def encode(self, packet_in, stream=True):
         """
         Given a packet (tuple or list of items), converts it for the wire.
         This method returns all the binary packets to send, as an array of:
         (index, compression_level and compression flags, binary_data)
         The index, if positive indicates the item to populate in the packet
         whose index is zero.
+        The stream compression context can only be used from the format thread,
+        as the packets must be sent in the order they were compressed.
         ie: ["blah", [large binary data], "hello", 200]
         may get converted to:
         [
@@ -521,8 +610,8 @@ class Protocol(object):
             elif ti in (str, bytes) and level>0 and l>LARGE_PACKET_SIZE:
                 log.warn("found a large uncompressed item in packet '%s' at position %s: %s bytes", packet[0], i, len(item))
                 #add new binary packet with large item:
-                cl, cdata = self._compress(item, level)
-                packets.append((0, i, cl, cdata))
+                flags, cl, cdata = self.compress_packet(packet[0], item, level, stream)
+                packets.append((flags, i, cl, cdata))
                 #replace this item with an empty string placeholder:
                 packet[i] = ''
             elif ti not in (str, bytes):
@@ -548,12 +637,33 @@ class Protocol(object):
                      len(main_packet), packet_in[0], [type(x) for x in packet[1:]], [len(str(x)) for x in packet[1:]], repr_ellipsized(packet))
         #compress, but don't bother for small packets:
         if level>0 and len(main_packet)>min_comp_size:
-            cl, cdata = self._compress(main_packet, level)
-            packets.append((proto_flags, 0, cl, cdata))
+            flags, cl, cdata = self.compress_packet(packet_type, main_packet, level, stream)
+            packets.append((proto_flags | flags, 0, cl, cdata))
         else:
             packets.append((proto_flags, 0, 0, main_packet))
         return packets
 
+    def compress_packet(self, packet_type, data, level, stream=True):
+        """ returns the protocol flags, compression level flags and compressed data """
+        ac = self._adaptive_compressor
+        if ac:
+            compressor = ac.select(packet_type)
+            if compressor is None:
+                return (0, )+compression.nocompress(data, level)
+        else:
+            compressor = self._compress
+        flags = 0
+        start = monotonic_time()
+        sc = self._stream_compressor
+        if stream and sc and compressor==compression.zcompress:
+            flags = FLAGS_ZLIB_STREAM
+            cl, cdata = sc.compress(data, level)
+        else:
+            cl, cdata = compressor(data, level)
+        if ac:
+            ac.record(packet_type, len(data), len(cdata), monotonic_time()-start)
+        return flags, cl, cdata
+
     def set_compression_level(self, level):
         #this may be used next time encode() is called
         assert level>=0 and level<=10, "invalid compression level: %s (must be between 0 and 10" % level
@@ -588,16 +698,13 @@ class Protocol(object):
             log("write thread: empty marker, exiting")
             self.close()
             return False
+        if self._writev:
+            return self._write_vectored(items)
         for buf, start_cb, end_cb in items:
             con = self._conn
             if not con:
                 return False
-            if start_cb:
-                try:
-                    start_cb(con.output_bytecount)
-                except:
-                    if not self._closed:
-                        log.error("Error on write start callback %s", start_cb, exc_info=True)
+            self._call_write_cb("start", start_cb)
             while buf and not self._closed:
                 written = con.write(buf)
                 #example test code, for sending small chunks very slowly:
@@ -607,14 +714,54 @@ class Protocol(object):
                 if written:
                     buf = buf[written:]
                     self.output_raw_packetcount += 1
-            if end_cb:
-                try:
-                    end_cb(self._conn.output_bytecount)
-                except:
-                    if not self._closed:
-                        log.error("Error on write end callback %s", end_cb, exc_info=True)
+            self._call_write_cb("end", end_cb)
         return True
 
+    def _write_vectored(self, items):
+        """
+            Writes all the buffers of a packet using vectored writes,
+            partial writes advance the memoryview offsets rather than
+            copying what remains of the buffers.
+        """
+        con = self._conn
+        if not con:
+            return False
+        views = [memoryview(buf) for buf, _, _ in items]
+        count = len(views)
+        if count==0:
+            return True
+        index = 0
+        def advance(written):
+            #consume all the buffers that have been fully written
+            #and fire their callbacks:
+            i = index
+            while i<count and len(views[i])<=written:
+                written -= len(views[i])
+                self._call_write_cb("end", items[i][2])
+                i += 1
+                if i<count:
+                    self._call_write_cb("start", items[i][1])
+            if i<count and written>0:
+                views[i] = views[i][written:]
+            return i
+        self._call_write_cb("start", items[0][1])
+        index = advance(0)
+        while index<count and not self._closed:
+            written = con.writev(views[index:])
+            if written:
+                index = advance(written)
+                self.output_raw_packetcount += 1
+        return True
+
+    def _call_write_cb(self, name, cb):
+        if not cb:
+            return
+        try:
+            cb(self._conn.output_bytecount)
+        except:
+            if not self._closed:
+                log.error("Error on write %s callback %s", name, cb, exc_info=True)
+
     def _read_thread_loop(self):
         self._io_thread_loop("read", self._read)
     def _read(self):
@@ -650,12 +797,12 @@ class Protocol(object):
 
 
     def invalid(self, msg, data):
-        self.idle_add(self._process_packet_cb, self, [Protocol.INVALID, msg, data])
+        self.idle_add(self._process_packet_cb, self, [Protocol.INVALID, msg, memoryview_to_bytes(data)])
         # Then hang up:
         self.timeout_add(1000, self._connection_lost, msg)
 
     def gibberish(self, msg, data):
-        self.idle_add(self._process_packet_cb, self, [Protocol.GIBBERISH, msg, data])
+        self.idle_add(self._process_packet_cb, self, [Protocol.GIBBERISH, msg, memoryview_to_bytes(data)])
         # Then hang up:
         self.timeout_add(1000, self._connection_lost, msg)
 
@@ -699,16 +846,18 @@ class Protocol(object):
     def do_read_parse_thread_loop(self):
         """
             Process the individual network packets placed in _read_queue.
-            Concatenate the raw packet data, then try to parse it.
-            Extract the individual packets from the potentially large buffer,
-            saving the rest of the buffer for later, and optionally decompress this data
+            Accumulate the raw packet data in a ReadBuffer (without concatenating it),
+            then try to parse it.
+            Extract the individual packets from the buffer, the payloads which span
+            multiple reads are copied only once into a buffer allocated from the size
+            found in the packet header, and optionally decompress this data
             and re-construct the one python-object-packet from potentially multiple packets (see packet_index).
             The 8 bytes packet header gives us information on the packet index, packet size and compression.
             The actual processing of the packet is done via the callback process_packet_cb,
             this will be called from this parsing thread so any calls that need to be made
             from the UI thread will need to use a callback (usually via 'idle_add')
         """
-        read_buffer = None
+        read_buffer = ReadBuffer()
         payload_size = -1
         padding_size = 0
         packet_index = 0
@@ -721,35 +870,63 @@ class Protocol(object):
                 log("parse thread: empty marker, exiting")
                 self.idle_add(self.close)
                 return
-            if read_buffer:
-                read_buffer = read_buffer + buf
+            if payload_size<0 and read_buffer.size==0:
+                pos = 0
             else:
-                read_buffer = buf
-            bl = len(read_buffer)
+                read_buffer.add(buf)
+                buf = None
             while not self._closed:
                 packet = None
-                bl = len(read_buffer)
-                if bl<=0:
-                    break
-                if payload_size<0:
-                    if read_buffer[0] not in ("P", ord("P")):
-                        self._invalid_header(read_buffer, "invalid packet header byte %s" % read_buffer[0])
+                payload = None
+                if buf is None and payload_size<0:
+                    buf, pos = read_buffer.detach()
+                if buf is not None:
+                    #fast path: the packets which are fully contained in a single chunk
+                    #are parsed from it directly, without going through the read buffer
+                    if len(buf)-pos>=8:
+                        magic, protocol_flags, compression_level, packet_index, data_size = unpack_header(buf, pos)
+                        start = pos+8
+                        end = start+data_size
+                        if magic==b"P" and end<=len(buf) and 0<data_size<=self.max_packet_size and \
+                            data_size<=self.abs_max_packet_size and not protocol_flags & FLAGS_CIPHER:
+                            padding_size = 0
+                            payload_size = data_size
+                            if data_size<COPY_SIZE:
+                                payload = buf[start:end]
+                            else:
+                                payload = memoryview(buf)[start:end]
+                            pos = end
+                    if payload is None:
+                        if pos>=len(buf):
+                            buf = None
+                            break
+                        #incomplete or unusual packet, let the read buffer deal with it:
+                        read_buffer.add(buf)
+                        read_buffer.consume(pos)
+                        buf = None
+                if payload is None and payload_size<0:
+                    bl = len(read_buffer)
+                    if bl<=0:
+                        break
+                    header = read_buffer.peek(8)
+                    first_byte = header[:1]
+                    if first_byte!=b"P":
+                        self._invalid_header(read_buffer.peek(), "invalid packet header byte %s" % first_byte)
                         return
                     if bl<8:
                         break   #packet still too small
                     #packet format: struct.pack('cBBBL', ...) - 8 bytes
-                    _, protocol_flags, compression_level, packet_index, data_size = unpack_header(read_buffer[:8])
+                    _, protocol_flags, compression_level, packet_index, data_size = unpack_header(header)
 
                     #sanity check size (will often fail if not an xpra client):
                     if data_size>self.abs_max_packet_size:
-                        self._invalid_header(read_buffer, "invalid size in packet header: %s" % data_size)
+                        self._invalid_header(read_buffer.peek(), "invalid size in packet header: %s" % data_size)
                         return
 
-                    bl = len(read_buffer)-8
                     if protocol_flags & FLAGS_CIPHER:
                         if self.cipher_in_block_size==0 or not self.cipher_in_name:
                             cryptolog.warn("received cipher block but we don't have a cipher to decrypt it with, not an xpra client?")
-                            self._invalid_header(read_buffer, "invalid encryption packet flag (no cipher configured)")
+                            self._invalid_header(read_buffer.peek(), "invalid encryption packet flag (no cipher configured)")
                             return
                         padding_size = self.cipher_in_block_size - (data_size % self.cipher_in_block_size)
                         payload_size = data_size + padding_size
@@ -758,7 +935,7 @@ class Protocol(object):
                         padding_size = 0
                         payload_size = data_size
                     assert payload_size>0, "invalid payload size: %i" % payload_size
-                    read_buffer = read_buffer[8:]
+                    read_buffer.consume(8)
 
                     if payload_size>self.max_packet_size:
                         #this packet is seemingly too big, but check again from the main UI thread
@@ -772,24 +949,30 @@ class Protocol(object):
                                               (size_to_check, self.max_packet_size)
                                 self.invalid(msg, packet_header)
                             return False
-                        self.timeout_add(1000, check_packet_size, payload_size, read_buffer[:32])
-
-                if bl<payload_size:
-                    # incomplete packet, wait for the rest to arrive
-                    break
-
-                #chop this packet from the buffer:
-                if len(read_buffer)==payload_size:
-                    raw_string = read_buffer
-                    read_buffer = ''
-                else:
-                    raw_string = read_buffer[:payload_size]
-                    read_buffer = read_buffer[payload_size:]
+                        self.timeout_add(1000, check_packet_size, payload_size, read_buffer.peek(32))
+
+                if payload is None:
+                    #extract this packet from the buffer:
+                    payload = read_buffer.read(payload_size)
+                    if payload is None:
+                        # incomplete packet, wait for the rest to arrive
+                        break
+                #large payloads are memoryviews, and we only convert them to bytes
+                #where the decryption or the decoders need it:
+                data = payload
+                payload = None
+                raw_packet_cb = self._raw_packet_cb
+                if raw_packet_cb:
+                    payload_size = -1
+                    if packet_index==0:
+                        self.input_packetcount += 1
+                    raw_packet_cb(self, protocol_flags, compression_level, packet_index, data)
+                    packet_index = 0
+                    continue
                 #decrypt if needed:
-                data = raw_string
                 if self.cipher_in and protocol_flags & FLAGS_CIPHER:
                     cryptolog("received %i %s encrypted bytes with %s padding", payload_size, self.cipher_in_name, padding_size)
-                    data = self.cipher_in.decrypt(raw_string)
+                    data = self.cipher_in.decrypt(memoryview_to_bytes(data))
                     if padding_size > 0:
                         def debug_str(s):
                             try:
@@ -811,7 +994,12 @@ class Protocol(object):
                 #uncompress if needed:
                 if compression_level>0:
                     try:
-                        data = decompress(data, compression_level)
+                        if protocol_flags & FLAGS_ZLIB_STREAM:
+                            if not self._stream_decompressor:
+                                self._stream_decompressor = StreamDecompressor()
+                            data = self._stream_decompressor.decompress(data)
+                        else:
+                            data = decompress(data, compression_level)
                     except InvalidCompressionException as e:
                         self.invalid("invalid compression: %s" % e, data)
                         return
@@ -834,8 +1022,9 @@ class Protocol(object):
                 if self._closed:
                     return
                 if packet_index>0:
-                    #raw packet, store it and continue:
-                    raw_packets[packet_index] = data
+                    #raw packet, store it and continue
+                    #(the packet handlers expect bytes):
+                    raw_packets[packet_index] = memoryview_to_bytes(data)
                     payload_size = -1
                     packet_index = 0
                     if len(raw_packets)>=4:
@@ -844,7 +1033,7 @@ class Protocol(object):
                     continue
                 #final packet (packet_index==0), decode it:
                 try:
-                    packet = decode(data, protocol_flags)
+                    packet = decode(memoryview_to_bytes(data), protocol_flags)
                 except InvalidPacketEncodingException as e:
                     self.invalid("invalid packet encoding: %s" % e, data)
                     return
@@ -915,7 +1104,8 @@ class Protocol(object):
                     self.timeout_add(100, wait_for_queue, timeout-1)
             else:
                 log("flush_then_close: queue is now empty, sending the last packet and closing")
-                chunks = self.encode(last_packet)
+                #the format thread may still be using the compression stream:
+                chunks = self.encode(last_packet, stream=False)
                 def close_and_release():
                     log("flush_then_close: wait_for_packet_sent() close_and_release()")
                     self.close()
@@ -1020,6 +1210,7 @@ class Protocol(object):
         self._read_parser_thread = None
         self._write_format_thread = None
         self._process_packet_cb = None
+        self._raw_packet_cb = None
 
     def terminate_queue_threads(self):
         log("terminate_queue_threads()")
@@ -0,0 +1,143 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from collections import deque
+
+from xpra.util import envint
+from xpra.os_util import memoryview_to_bytes
+
+#payloads smaller than this are copied out of the chunk,
+#which is cheaper than creating a memoryview for them:
+COPY_SIZE = envint("XPRA_READ_BUFFER_COPY_SIZE", 4096)
+
+
+class ReadBuffer(object):
+    """
+        Accumulates the data received from the network without concatenating it.
+        The chunks read are kept as they are, with the offset of the data
+        not consumed yet in the first one, and the consumer
+        extracts the packet headers and payloads from them:
+        * a small payload which is fully contained in a single chunk
+          is returned as bytes
+        * a larger payload which is fully contained in a single chunk
+          is returned as a memoryview of that chunk (no copy)
+        * a payload spanning multiple chunks is copied once
+          into a buffer preallocated from the size found in the packet header
+    """
+
+    def __init__(self):
+        self.chunks = deque()
+        self.offset = 0
+        self.size = 0
+        self.payload = None
+        self.payload_offset = 0
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "ReadBuffer(%i bytes in %i chunks)" % (self.size, len(self.chunks))
+
+    def add(self, buf):
+        if buf:
+            self.chunks.append(buf)
+            self.size += len(buf)
+
+    def peek(self, n=-1):
+        """ returns (a copy of) the first n bytes available, or all of them """
+        if n<0 or n>self.size:
+            n = self.size
+        offset = self.offset
+        if self.chunks:
+            chunk = self.chunks[0]
+            if len(chunk)>=offset+n:
+                return memoryview_to_bytes(chunk[offset:offset+n])
+        parts = []
+        for chunk in self.chunks:
+            if n<=0:
+                break
+            part = chunk[offset:offset+n]
+            parts.append(memoryview_to_bytes(part))
+            n -= len(part)
+            offset = 0
+        return b"".join(parts)
+
+    def read(self, n):
+        """
+            Returns the next n bytes,
+            or None if we don't have enough data yet.
+        """
+        if self.payload is None:
+            if self.size<n:
+                return None
+            chunk = self.chunks[0]
+            offset = self.offset
+            end = offset+n
+            cl = len(chunk)
+            if cl>=end:
+                #fast path: contained in the first chunk
+                if end==cl:
+                    self.chunks.popleft()
+                    self.offset = 0
+                else:
+                    self.offset = end
+                self.size -= n
+                if offset==0 and end==cl:
+                    return chunk
+                if n<COPY_SIZE:
+                    return memoryview_to_bytes(chunk[offset:end])
+                return memoryview(chunk)[offset:end]
+            #allocate the buffer for the whole payload:
+            self.payload = bytearray(n)
+            self.payload_offset = 0
+        #copy what we have into the payload buffer:
+        payload = self.payload
+        view = memoryview(payload)
+        offset = self.payload_offset
+        needed = len(payload)-offset
+        while needed>0 and self.chunks:
+            chunk = self.chunks[0]
+            start = self.offset
+            l = min(needed, len(chunk)-start)
+            view[offset:offset+l] = memoryview(chunk)[start:start+l]
+            offset += l
+            needed -= l
+            self.consume(l)
+        self.payload_offset = offset
+        if needed>0:
+            return None
+        self.payload = None
+        self.payload_offset = 0
+        return view
+
+    def consume(self, n):
+        self.size -= n
+        offset = self.offset+n
+        chunks = self.chunks
+        while chunks:
+            l = len(chunks[0])
+            if l>offset:
+                break
+            chunks.popleft()
+            offset -= l
+        self.offset = offset
+
+    def detach(self):
+        """
+            If all the data left is in a single chunk,
+            removes it from the buffer and returns it
+            with the offset of the data not consumed yet.
+        """
+        if len(self.chunks)!=1 or self.payload is not None:
+            return None, 0
+        chunk = self.chunks.popleft()
+        offset = self.offset
+        self.offset = 0
+        self.size = 0
+        return chunk, offset
+
+    def get_pending(self):
+        """ the number of bytes received but not returned yet """
+        return self.size+self.payload_offset
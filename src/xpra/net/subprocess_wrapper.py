@@ -15,6 +15,7 @@ from xpra.util import repr_ellipsized, envint, envbool
 from xpra.net.bytestreams import TwoFileConnection
 from xpra.net.common import ConnectionClosedException
 from xpra.net.protocol import Protocol
+from xpra.net.mmap_pipe import MmapRing, mmap_ring_read, mmap_ring_free, init_client_mmap, init_server_mmap
 from xpra.os_util import Queue, setbinarymode, SIGNAMES, bytestostr, WIN32, POSIX
 from xpra.child_reaper import getChildReaper
 from xpra.log import Logger
@@ -28,6 +29,7 @@ log = Logger("util")
 #and one for the class
 #they talk to each other through stdin / stdout,
 #using the protocol for encoding the data
+#the data of large packets can also be exchanged using a shared memory area
 
 
 DEBUG_WRAPPER = envbool("XPRA_WRAPPER_DEBUG", False)
@@ -37,6 +39,12 @@ HEXLIFY_PACKETS = envbool("XPRA_HEXLIFY_PACKETS", False)
 WIN32_SHOWWINDOW = envbool("XPRA_WIN32_SHOWWINDOW", False)
 #this used to cause problems with py3k / gi bindings?
 HANDLE_SIGINT = envbool("XPRA_WRAPPER_SIGINT", True)
+#share memory with the subprocess for the packets listed in 'mmap_packets':
+WRAPPER_MMAP = envbool("XPRA_WRAPPER_MMAP", POSIX)
+#size of the shared memory area, for both directions:
+WRAPPER_MMAP_SIZE = envint("XPRA_WRAPPER_MMAP_SIZE", 2*1024*1024)
+#the environment variable used for passing the mmap filename to the subprocess:
+MMAP_FILENAME_ENV = "XPRA_WRAPPER_MMAP_FILENAME"
 
 FAULT_RATE = envint("XPRA_WRAPPER_FAULT_INJECTION_RATE")
 if FAULT_RATE>0:
@@ -67,6 +75,76 @@ def setup_fastencoder_nocompression(protocol):
     protocol.enable_compressor("none")
 
 
+class mmap_channel(object):
+    """
+    A shared memory area which carries the data of large packets,
+    so only a small packet pointing to the data goes through the pipe:
+    the data is not serialized and it does not go through the kernel pipe buffers.
+    The area is split in two ring buffers, one for each direction.
+    The first argument of the packet is the data, the packet type gets a "-mmap" suffix.
+    """
+    def __init__(self, mmap_area, mmap_size, caller):
+        self.mmap_area = mmap_area
+        self.mmap_size = mmap_size
+        half = mmap_size//2
+        if caller:
+            self.ring = MmapRing(mmap_area, half)
+            self.read_range = (half, mmap_size)
+        else:
+            self.ring = MmapRing(mmap_area, mmap_size, half)
+            self.read_range = (8, half)
+        #the caller creates the area, so it must wait for the callee to open it:
+        self.enabled = not caller
+        self.sent = 0
+        self.received = 0
+        self.fallback = 0
+
+    def __repr__(self):
+        return "mmap_channel(%i)" % self.mmap_size
+
+    def get_info(self):
+        return {
+                "enabled"   : self.enabled,
+                "sent"      : self.sent,
+                "received"  : self.received,
+                "fallback"  : self.fallback,
+                "ring"      : self.ring.get_info(),
+                }
+
+    def encode(self, packet):
+        """ moves the data to the shared memory area, if we can """
+        data = packet[1]
+        if not self.enabled or not isinstance(data, (bytes, bytearray, memoryview)):
+            return packet
+        mmap_data, _ = self.ring.write(data, True)
+        if not mmap_data:
+            #the area is full, send it in the packet
+            #(this is expected, so we only count it):
+            self.fallback += 1
+            return packet
+        self.sent += 1
+        return ("%s-mmap" % packet[0], mmap_data) + tuple(packet[2:])
+
+    def decode(self, packet):
+        """ returns the original packet, or None if the mmap data is invalid """
+        packet_type = bytestostr(packet[0])[:-len("-mmap")]
+        mmap_data = packet[1]
+        start, end = self.read_range
+        if not all(start<=offset and offset+length<=end for offset, length in mmap_data):
+            log.warn("Warning: invalid mmap data %s for '%s' packet", mmap_data, packet_type)
+            return None
+        data = b"".join(mmap_ring_read(self.mmap_area, offset, length).raw for offset, length in mmap_data)
+        mmap_ring_free(self.mmap_area, *mmap_data)
+        self.received += 1
+        return [packet_type, data] + list(packet[2:])
+
+    def close(self):
+        try:
+            self.mmap_area.close()
+        except Exception as e:
+            log("failed to close %s: %s", self, e)
+
+
 class subprocess_callee(object):
     """
     This is the callee side, wrapping the gobject we want to interact with.
@@ -82,6 +160,9 @@ class subprocess_callee(object):
         self.output_filename = output_filename
         self.method_whitelist = method_whitelist
         self.large_packets = []
+        #the packets which can use the shared memory area:
+        self.mmap_packets = []
+        self.mmap = None
         #the gobject instance which is wrapped:
         self.wrapped_object = wrapped_object
         self.send_queue = Queue()
@@ -119,6 +200,7 @@ class subprocess_callee(object):
     def start(self):
         self.protocol = self.make_protocol()
         self.protocol.start()
+        self.init_mmap()
         try:
             self.run()
             return 0
@@ -170,6 +252,18 @@ class subprocess_callee(object):
         return protocol
 
 
+    def init_mmap(self):
+        """ opens the shared memory area created by the caller, if there is one """
+        mmap_filename = os.environ.get(MMAP_FILENAME_ENV)
+        if not mmap_filename:
+            return
+        mmap_area, mmap_size = init_server_mmap(mmap_filename)
+        log("init_mmap() %s: %s", mmap_filename, mmap_size)
+        if mmap_area:
+            self.mmap = mmap_channel(mmap_area, mmap_size, False)
+            #tell the caller it can use it too:
+            self.send("mmap-enabled")
+
     def run(self):
         self.mainloop.run()
 
@@ -191,6 +285,10 @@ class subprocess_callee(object):
         if p:
             self.protocol = None
             p.close()
+        m = self.mmap
+        if m:
+            self.mmap = None
+            m.close()
         self.do_stop()
 
     def do_stop(self):
@@ -220,6 +318,8 @@ class subprocess_callee(object):
 
 
     def send(self, *args):
+        if self.mmap and args[0] in self.mmap_packets:
+            args = self.mmap.encode(args)
         if HEXLIFY_PACKETS:
             args = args[:1]+[binascii.hexlify(str(x)[:32]) for x in args[1:]]
         log("send: adding '%s' message (%s items already in queue)", args[0], self.send_queue.qsize())
@@ -238,6 +338,11 @@ class subprocess_callee(object):
 
     def process_packet(self, proto, packet):
         command = bytestostr(packet[0])
+        if command.endswith("-mmap") and self.mmap:
+            packet = self.mmap.decode(packet)
+            if not packet:
+                return
+            command = bytestostr(packet[0])
         if command==Protocol.CONNECTION_LOST:
             log("connection-lost: %s, calling stop", packet[1:])
             self.net_stop()
@@ -329,6 +434,12 @@ class subprocess_caller(object):
         self.send_queue = Queue()
         self.signal_callbacks = {}
         self.large_packets = []
+        #create a shared memory area for the subprocess:
+        self.use_mmap = False
+        #the packets which can use it:
+        self.mmap_packets = []
+        self.mmap = None
+        self.mmap_temp_file = None
         #hook a default packet handlers:
         self.connect(Protocol.CONNECTION_LOST, self.connection_lost)
         self.connect(Protocol.GIBBERISH, self.gibberish)
@@ -350,6 +461,8 @@ class subprocess_caller(object):
 
     def start(self):
         self.start = self.fail_start
+        if self.use_mmap and WRAPPER_MMAP:
+            self.init_mmap()
         self.process = self.exec_subprocess()
         self.protocol = self.make_protocol()
         self.protocol.start()
@@ -357,6 +470,30 @@ class subprocess_caller(object):
     def fail_start(self):
         raise Exception("this wrapper has already been started")
 
+    def init_mmap(self):
+        success, _, mmap_area, mmap_size, temp_file, _ = init_client_mmap(size=WRAPPER_MMAP_SIZE)
+        log("init_mmap() success=%s, size=%s, file=%s", success, mmap_size, temp_file)
+        if success and temp_file:
+            self.mmap = mmap_channel(mmap_area, mmap_size, True)
+            self.mmap_temp_file = temp_file
+
+    def close_mmap_file(self):
+        #the temporary file is deleted when we close it,
+        #the memory remains accessible to the processes which have mapped it:
+        temp_file = self.mmap_temp_file
+        if temp_file:
+            self.mmap_temp_file = None
+            try:
+                temp_file.close()
+            except Exception as e:
+                log.warn("Warning: failed to close the mmap file: %s", e)
+
+    def mmap_enabled(self):
+        log("mmap_enabled() %s", self.mmap)
+        self.close_mmap_file()
+        if self.mmap:
+            self.mmap.enabled = True
+
     def abort_test(self, action):
         p = self.process
         if p is None or p.poll():
@@ -383,6 +520,8 @@ class subprocess_caller(object):
     def get_env(self):
         env = exec_env()
         env["XPRA_LOG_PREFIX"] = "%s " % self.description
+        if self.mmap_temp_file:
+            env[MMAP_FILENAME_ENV] = self.mmap_temp_file.name
         return env
 
     def cleanup(self):
@@ -391,6 +530,11 @@ class subprocess_caller(object):
     def stop(self):
         self.stop_process()
         self.stop_protocol()
+        self.close_mmap_file()
+        m = self.mmap
+        if m:
+            self.mmap = None
+            m.close()
 
     def stop_process(self):
         log("%s.stop_process() sending stop request to %s", self, self.description)
@@ -431,6 +575,8 @@ class subprocess_caller(object):
         return (item, None, None, self.send_queue.qsize()>0)
 
     def send(self, *packet_data):
+        if self.mmap and packet_data[0] in self.mmap_packets:
+            packet_data = self.mmap.encode(packet_data)
         self.send_queue.put(packet_data)
         p = self.protocol
         if p:
@@ -441,6 +587,14 @@ class subprocess_caller(object):
         if DEBUG_WRAPPER:
             log("process_packet(%s, %s)", proto, [str(x)[:32] for x in packet])
         signal_name = bytestostr(packet[0])
+        if signal_name=="mmap-enabled":
+            self.mmap_enabled()
+            return
+        if signal_name.endswith("-mmap") and self.mmap:
+            packet = self.mmap.decode(packet)
+            if not packet:
+                return
+            signal_name = packet[0]
         self._fire_callback(signal_name, packet[1:])
         INJECT_FAULT(proto)
 
@@ -244,3 +244,7 @@ class WebSocketConnection(SocketConnection):
         self.ws_handler.send_frames([memoryview_to_bytes(buf)])
         self.output_bytecount += len(buf)
         return len(buf)
+
+    def can_writev(self):
+        #the data must be wrapped in websocket frames:
+        return False
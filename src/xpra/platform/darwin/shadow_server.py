@@ -46,6 +46,9 @@ def patch_picture_encode():
 class OSXRootWindowModel(RootWindowModel):
 
     def get_image(self, x, y, width, height, logger=None):
+        image = self.get_frame_image(x, y, width, height)
+        if image:
+            return image
         rect = (x, y, width, height)
         return get_CG_imagewrapper(rect)
 
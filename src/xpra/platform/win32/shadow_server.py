@@ -244,6 +244,9 @@ class Win32RootWindowModel(RootWindowModel):
         return w, h
 
     def get_image(self, x, y, width, height, logger=None):
+        image = self.get_frame_image(x, y, width, height)
+        if image:
+            return image
         if not self.capture:
             self.capture = init_capture(self.pixel_depth)
         try:
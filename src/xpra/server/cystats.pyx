@@ -10,8 +10,11 @@
 import time
 from xpra.monotonic_time cimport monotonic_time
 
+from libc.stdlib cimport malloc, free, qsort
+
 cdef extern from "math.h":
     double log(double x)
+    double csqrt "sqrt" (double x)
 
 from math import sqrt
 def logp(double x):
@@ -187,10 +190,243 @@ def queue_inspect(metric, time_values, float target=1.0, float div=1.0, smoothin
     """
         Given an historical list of values and a current value,
         figure out if things are getting better or worse.
+        'time_values' can be a TimeSeries or a list of (event_time, value).
     """
     #inspect a queue size history: figure out if things are better or worse than before
     if len(time_values)==0:
         return  metric, {}, 1.0, 0.0
-    avg, recent = calculate_time_weighted_average(list(time_values))
+    if isinstance(time_values, TimeSeries):
+        avg, recent = time_values.time_weighted_average()
+    else:
+        avg, recent = calculate_time_weighted_average(list(time_values))
     weight_multiplier = sqrt(max(avg, recent) / div / target)
     return  calculate_for_target(metric, target, avg, recent, aim=0.25, div=div, slope=1.0, smoothing=smoothing, weight_multiplier=weight_multiplier)
+
+
+cdef int cmp_double(const void *a, const void *b) nogil:
+    cdef double v1 = (<double*> a)[0]
+    cdef double v2 = (<double*> b)[0]
+    return (v1>v2)-(v1<v2)
+
+
+cdef class TimeSeries:
+    """
+        A fixed size ring buffer of numeric records, stored as C doubles.
+        This is a replacement for the deques of tuples we use for statistics:
+        records are appended as tuples and read back as tuples of floats,
+        but the aggregates are calculated without creating any python objects.
+        One of the fields is the event time, another is the 'value' we aggregate.
+        The sum and sum of squares of the values are updated
+        as records are added and evicted.
+    """
+    cdef double *records
+    cdef readonly unsigned int maxlen
+    cdef readonly unsigned int fields
+    cdef readonly unsigned int time_index
+    cdef readonly unsigned int value_index
+    cdef unsigned int start
+    cdef unsigned int count
+    cdef double total
+    cdef double total_sq
+
+    def __cinit__(self, unsigned int maxlen, unsigned int fields=2, time_index=0, value_index=None):
+        assert maxlen>0 and fields>0
+        if value_index is None:
+            value_index = fields-1
+        assert time_index<fields and value_index<fields
+        self.maxlen = maxlen
+        self.fields = fields
+        self.time_index = time_index
+        self.value_index = value_index
+        self.records = <double*> malloc(maxlen*fields*sizeof(double))
+        assert self.records!=NULL, "failed to allocate time series memory"
+        self.clear()
+
+    def __dealloc__(self):
+        if self.records!=NULL:
+            free(self.records)
+            self.records = NULL
+
+    def __repr__(self):
+        return "TimeSeries(%i/%i)" % (self.count, self.maxlen)
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+
+    cdef inline double *get_record(self, unsigned int i):
+        #the oldest record is at index 0:
+        return self.records + ((self.start+i) % self.maxlen)*self.fields
+
+    cdef void recalculate_totals(self):
+        cdef unsigned int i
+        cdef double v
+        self.total = 0
+        self.total_sq = 0
+        for i in range(self.count):
+            v = self.get_record(i)[self.value_index]
+            self.total += v
+            self.total_sq += v*v
+
+    def append(self, record):
+        assert len(record)==self.fields, "expected %i fields but got %i" % (self.fields, len(record))
+        cdef double *r
+        cdef double v
+        cdef unsigned int i
+        if self.count==self.maxlen:
+            #evict the oldest record:
+            r = self.get_record(0)
+            v = r[self.value_index]
+            self.total -= v
+            self.total_sq -= v*v
+            self.start = (self.start+1) % self.maxlen
+            self.count -= 1
+            if self.start==0:
+                #every 'maxlen' evictions, start again from scratch
+                #so rounding errors don't accumulate:
+                self.recalculate_totals()
+        r = self.get_record(self.count)
+        for i in range(self.fields):
+            r[i] = record[i]
+        v = r[self.value_index]
+        self.total += v
+        self.total_sq += v*v
+        self.count += 1
+
+    cdef record_tuple(self, unsigned int i):
+        cdef double *r = self.get_record(i)
+        return tuple(r[j] for j in range(self.fields))
+
+    def __getitem__(self, int i):
+        if i<0:
+            i += self.count
+        if i<0 or i>=<int> self.count:
+            raise IndexError("time series index out of range")
+        return self.record_tuple(i)
+
+    def __iter__(self):
+        #iterate over a copy, so the series can be modified by other threads:
+        return iter([self.record_tuple(i) for i in range(self.count)])
+
+    def values(self, double multiplier=1.0):
+        return [self.get_record(i)[self.value_index]*multiplier for i in range(self.count)]
+
+    def get_sum(self):
+        return self.total
+
+    def get_mean(self):
+        if self.count==0:
+            return 0.0
+        return self.total/self.count
+
+    def get_std(self):
+        if self.count==0:
+            return 0.0
+        cdef double mean = self.total/self.count
+        return csqrt(max(0.0, self.total_sq/self.count-mean*mean))
+
+    def get_min(self):
+        assert self.count>0
+        cdef double v = self.get_record(0)[self.value_index]
+        cdef unsigned int i
+        for i in range(1, self.count):
+            v = min(v, self.get_record(i)[self.value_index])
+        return v
+
+    def get_max(self):
+        assert self.count>0
+        cdef double v = self.get_record(0)[self.value_index]
+        cdef unsigned int i
+        for i in range(1, self.count):
+            v = max(v, self.get_record(i)[self.value_index])
+        return v
+
+    def time_weighted_average(self):
+        """
+            Same as calculate_time_weighted_average,
+            using the time and value fields of the records.
+        """
+        assert self.count>0
+        cdef double now = monotonic_time()
+        cdef double tv = 0.0, tw = 0.0, rv = 0.0, rw = 0.0
+        cdef double value, delta, w
+        cdef double *r
+        cdef unsigned int i
+        for i in range(self.count):
+            r = self.get_record(i)
+            value = r[self.value_index]
+            delta = now-r[self.time_index]
+            w = 1.0/(1.0+delta)
+            tv += value*w
+            tw += w
+            w = 1.0/(0.1+delta**2)
+            rv += value*w
+            rw += w
+        return tv / tw, rv / rw
+
+    def timesize_weighted_average(self, unsigned int size_index, double sizeunit=1.0):
+        """
+            Same as calculate_timesize_weighted_average,
+            the 'value' field of the records is the elapsed time.
+        """
+        assert self.count>0 and size_index<self.fields
+        cdef double size_total = 0
+        cdef unsigned int i
+        for i in range(self.count):
+            size_total += self.get_record(i)[size_index]
+        cdef double size_avg = size_total/self.count
+        cdef double now = monotonic_time()
+        cdef double tv = 0.0, tw = 0.0, rv = 0.0, rw = 0.0
+        cdef double size, size_ps, elapsed_time, pw, w, delta
+        cdef double *r
+        for i in range(self.count):
+            r = self.get_record(i)
+            elapsed_time = r[self.value_index]
+            if elapsed_time<=0:
+                continue        #invalid record
+            size = r[size_index]
+            delta = now-r[self.time_index]
+            pw = clogp(size/size_avg)
+            size_ps = max(1, size*sizeunit/elapsed_time)
+            w = pw/(1.0+delta)
+            tv += w*size_ps
+            tw += w
+            w = pw/(0.1+delta**2)
+            rv += w*size_ps
+            rw += w
+        return float(tv / tw), float(rv / rw)
+
+    def get_list_stats(self, double multiplier=1.0, show_percentile=[5, 8, 9]):
+        """
+            Same as simple_stats.get_list_stats for the values multiplied by 'multiplier',
+            the average is calculated from the running total.
+        """
+        cdef unsigned int n = self.count
+        if n==0:
+            return {}
+        cdef double *r = self.get_record(n-1)
+        lstats = {
+                  "cur"     : int(r[self.value_index]*multiplier),
+                  "min"     : int(self.get_min()*multiplier),
+                  "max"     : int(self.get_max()*multiplier),
+                  "avg"     : int(self.total*multiplier/n),
+                  }
+        if not show_percentile:
+            return lstats
+        cdef double *sorted_values = <double*> malloc(n*sizeof(double))
+        assert sorted_values!=NULL
+        cdef unsigned int i
+        try:
+            for i in range(n):
+                sorted_values[i] = self.get_record(i)[self.value_index]*multiplier
+            qsort(sorted_values, n, sizeof(double), &cmp_double)
+            for i in show_percentile:
+                lstats["%ip" % (i*10)] = int(sorted_values[n*i//10])
+        finally:
+            free(sorted_values)
+        return lstats
@@ -0,0 +1,200 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from time import sleep
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("encoding")
+
+from xpra.os_util import Queue, monotonic_time
+from xpra.util import envint, envbool
+from xpra.make_thread import start_thread
+
+NOYIELD = not envbool("XPRA_YIELD", False)
+#number of encoding threads for each client connection:
+ENCODE_THREADS = max(1, envint("XPRA_ENCODE_THREADS", 1))
+#use a single pool of encoding threads for all the clients:
+SHARED_ENCODE_POOL = envbool("XPRA_SHARED_ENCODE_POOL", False)
+SHARED_ENCODE_THREADS = max(1, envint("XPRA_SHARED_ENCODE_THREADS", 4))
+
+
+class EncodeWorker(object):
+    """
+        A thread which calls the functions queued for the windows assigned to it,
+        in the order they were queued.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queue = Queue()
+        self.items = 0
+        self.busy_time = 0
+        self.start_time = monotonic_time()
+        self.keys = set()
+        #the number of items queued for each key:
+        self.pending = {}
+        self.lock = Lock()
+        self.thread = start_thread(self.run, name, daemon=True)
+
+    def __repr__(self):
+        return "EncodeWorker(%s)" % self.name
+
+    def qsize(self, key=None):
+        if key is not None:
+            return self.pending.get(key, 0)
+        return self.queue.qsize()
+
+    def add(self, key, is_closed, fn_and_args):
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0)+1
+        self.queue.put((key, is_closed, fn_and_args))
+
+    def done(self, key):
+        with self.lock:
+            n = self.pending.get(key, 0)-1
+            if n>0:
+                self.pending[key] = n
+            else:
+                self.pending.pop(key, None)
+
+    def get_info(self):
+        elapsed = max(0.001, monotonic_time()-self.start_time)
+        return {
+                "queue"     : {"size" : self.queue.qsize()},
+                "items"     : self.items,
+                "windows"   : len(self.keys),
+                "busy"      : int(1000*self.busy_time),
+                "load"      : int(100*self.busy_time/elapsed),
+                }
+
+    def run(self):
+        """
+            Must run until we hit the end of queue marker,
+            to ensure all the queued items get called.
+        """
+        while True:
+            item = self.queue.get(True)
+            if item is None:
+                log("%s found end of queue marker", self)
+                return
+            key, is_closed, fn_and_args = item
+            #some function calls are optional and can be skipped when closing:
+            #(but some are not, like encoder clean functions)
+            optional_when_closing = fn_and_args[0]
+            if optional_when_closing and is_closed():
+                self.done(key)
+                continue
+            start = monotonic_time()
+            try:
+                fn_and_args[1](*fn_and_args[2:])
+            except Exception as e:
+                if is_closed():
+                    log("ignoring encoding error in %s as source is already closed:", fn_and_args[1])
+                    log(" %s", e)
+                else:
+                    log.error("Error during encoding:", exc_info=True)
+            self.done(key)
+            self.busy_time += monotonic_time()-start
+            self.items += 1
+            NOYIELD or sleep(0)
+
+    def stop(self):
+        self.queue.put(None)
+
+
+class EncodePool(object):
+    """
+        Distributes the encoding work across a number of threads.
+        Each key (usually a window) is assigned to a single worker
+        so that its work items are processed in order,
+        while independent windows can be encoded concurrently.
+        The keys must be assigned before queuing work for them,
+        the work queued after a key has been released is dropped.
+    """
+
+    def __init__(self, name="encode", size=1):
+        assert size>0
+        self.name = name
+        self.lock = Lock()
+        self.assignments = {}
+        if size==1:
+            self.workers = [EncodeWorker(name)]
+        else:
+            self.workers = [EncodeWorker("%s-%i" % (name, i)) for i in range(size)]
+
+    def __repr__(self):
+        return "EncodePool(%s: %i workers)" % (self.name, len(self.workers))
+
+    def assign(self, key):
+        w = self.assignments.get(key)
+        if w:
+            return w
+        with self.lock:
+            w = self.assignments.get(key)
+            if not w:
+                #pick the worker with the least windows assigned to it,
+                #and the smallest backlog:
+                w = min(self.workers, key=lambda x : (len(x.keys), x.qsize()))
+                w.keys.add(key)
+                self.assignments[key] = w
+                log("%s assigned %s to %s", self, key, w)
+            return w
+
+    def release(self, key):
+        """ the key will not be used again (ie: window removed) """
+        with self.lock:
+            w = self.assignments.pop(key, None)
+            if w:
+                w.keys.discard(key)
+
+    def queue(self, key, is_closed, fn_and_args):
+        w = self.assignments.get(key)
+        if not w:
+            log("%s: %s is not assigned, dropping %s", self, key, fn_and_args[1])
+            return
+        w.add(key, is_closed, fn_and_args)
+
+    def qsize(self, key=None):
+        """ the number of items queued for this key, or for all of them """
+        if key is not None:
+            w = self.assignments.get(key)
+            if not w:
+                return 0
+            return w.qsize(key)
+        return sum(w.qsize() for w in self.workers)
+
+    def get_info(self):
+        info = {
+                "threads"   : len(self.workers),
+                "queue"     : {"size" : self.qsize()},
+                }
+        for i, w in enumerate(self.workers):
+            info.setdefault("worker", {})[i] = w.get_info()
+        return info
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+
+
+#the pool shared by all the clients, if enabled:
+shared_pool = None
+lock = Lock()
+
+def get_shared_pool():
+    global shared_pool
+    if shared_pool:
+        return shared_pool
+    with lock:
+        if not shared_pool:
+            shared_pool = EncodePool("encode-shared", SHARED_ENCODE_THREADS)
+    return shared_pool
+
+def get_encode_pool():
+    """ returns the pool to use for a new client connection, and whether it is shared """
+    if SHARED_ENCODE_POOL:
+        return get_shared_pool(), True
+    return EncodePool("encode", ENCODE_THREADS), False
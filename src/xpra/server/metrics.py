@@ -0,0 +1,214 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+"""
+    A minimal metrics registry, exported in the Prometheus text format.
+    Counters and histograms are updated directly from the hot paths,
+    gauges can be refreshed just before the metrics are collected.
+    The updates are not locked: we may lose an increment under contention,
+    which is acceptable for monitoring data and much cheaper than a lock.
+"""
+
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("network", "stats")
+
+from xpra.util import envbool
+
+#the "/metrics" HTTP endpoint is not authenticated, so it must be enabled explicitly:
+METRICS = envbool("XPRA_METRICS", False)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def escape_label(v):
+    return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (k, escape_label(v)) for k,v in labels)
+
+def format_value(v):
+    if v==float("inf"):
+        return "+Inf"
+    return repr(float(v))
+
+
+class CounterValue(object):
+    __slots__ = ("value", )
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        #for counters which are maintained elsewhere (ie: connection byte counts)
+        self.value = value
+
+    def get_samples(self):
+        return [("", (), self.value)]
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramValue(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, b in enumerate(self.buckets):
+            if value<=b:
+                self.counts[i] += 1
+                break
+
+    def get_samples(self):
+        samples = []
+        total = 0
+        for b, c in zip(self.buckets, self.counts):
+            total += c
+            samples.append(("_bucket", (("le", format_value(b)), ), total))
+        samples.append(("_bucket", (("le", "+Inf"), ), self.count))
+        samples.append(("_sum", (), self.sum))
+        samples.append(("_count", (), self.count))
+        return samples
+
+
+class Metric(object):
+    """
+        A named metric, with an optional list of label names.
+        Without labels, the metric can be updated directly,
+        otherwise use 'labels(..)' to get the value for a set of labels.
+    """
+    mtype = "untyped"
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+        if not self.labelnames:
+            self.value = self.new_value()
+            self.values[()] = self.value
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, self.name)
+
+    def new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *labelvalues):
+        v = self.values.get(labelvalues)
+        if v is None:
+            assert len(labelvalues)==len(self.labelnames), "%s expects labels %s but got %s" % (self, self.labelnames, labelvalues)
+            with self.lock:
+                v = self.values.setdefault(labelvalues, self.new_value())
+        return v
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def collect(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.doc),
+            "# TYPE %s %s" % (self.name, self.mtype),
+            ]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labelvalues, v in items:
+            labels = tuple(zip(self.labelnames, labelvalues))
+            for suffix, extra_labels, value in v.get_samples():
+                lines.append("%s%s%s %s" % (self.name, suffix, format_labels(labels+extra_labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    mtype = "counter"
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.value.inc(amount)
+
+
+class Gauge(Metric):
+    mtype = "gauge"
+
+    def new_value(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        self.value.inc(amount)
+
+    def dec(self, amount=1):
+        self.value.dec(amount)
+
+    def set(self, value):
+        self.value.set(value)
+
+
+class Histogram(Metric):
+    mtype = "histogram"
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, doc, labelnames)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.value.observe(value)
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def get_metric(self, mclass, name, doc, *args, **kwargs):
+        """ returns the existing metric with this name, or creates it """
+        with self.lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = mclass(name, doc, *args, **kwargs)
+                self.metrics[name] = m
+        assert isinstance(m, mclass), "metric %s is already registered as a %s" % (name, type(m))
+        return m
+
+    def generate(self):
+        lines = []
+        for name in sorted(self.metrics.keys()):
+            lines += self.metrics[name].collect()
+        return "\n".join(lines)+"\n"
+
+
+registry = MetricsRegistry()
+
+def counter(name, doc, labelnames=()):
+    return registry.get_metric(Counter, name, doc, labelnames)
+
+def gauge(name, doc, labelnames=()):
+    return registry.get_metric(Gauge, name, doc, labelnames)
+
+def histogram(name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.get_metric(Histogram, name, doc, labelnames, buckets=buckets)
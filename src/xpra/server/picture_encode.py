@@ -235,7 +235,7 @@ def rgb_reformat(image, rgb_formats, supports_transparency):
     return True
 
 
-def mmap_send(mmap, mmap_size, image, rgb_formats, supports_transparency):
+def mmap_send(mmap, mmap_size, image, rgb_formats, supports_transparency, mmap_ring=None, mmap_lock=None):
     if mmap_write is None:
         warn_encoding_once("mmap_write missing", "cannot use mmap!")
         return None
@@ -247,7 +247,15 @@ def mmap_send(mmap, mmap_size, image, rgb_formats, supports_transparency):
     start = monotonic_time()
     data = image.get_pixels()
     assert data, "failed to get pixels from %s" % image
-    mmap_data, mmap_free_size = mmap_write(mmap, mmap_size, data)
+    if mmap_ring:
+        mmap_data, mmap_free_size = mmap_ring.write(data)
+    elif mmap_lock:
+        #the mmap area pointers are shared by all the windows,
+        #which may be encoded from different threads:
+        with mmap_lock:
+            mmap_data, mmap_free_size = mmap_write(mmap, mmap_size, data)
+    else:
+        mmap_data, mmap_free_size = mmap_write(mmap, mmap_size, data)
     elapsed = monotonic_time()-start+0.000000001 #make sure never zero!
     log("%s MBytes/s - %s bytes written to mmap in %.1f ms", int(len(data)/elapsed/1024/1024), len(data), 1000*elapsed)
     if mmap_data is None:
@@ -0,0 +1,193 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from multiprocessing import Array, Condition, cpu_count
+
+from xpra.log import Logger
+log = Logger("proxy", "encoding")
+
+from xpra.os_util import monotonic_time
+from xpra.util import envint
+
+
+def get_default_threads():
+    try:
+        return max(1, cpu_count()-1)
+    except NotImplementedError:
+        return 2
+
+#maximum number of frames being re-encoded at the same time by all the proxy instances,
+#0 disables the pool:
+PROXY_ENCODE_THREADS = envint("XPRA_PROXY_ENCODE_THREADS", get_default_threads())
+#maximum number of video encoder contexts for all the proxy instances:
+PROXY_ENCODER_CONTEXTS = envint("XPRA_PROXY_ENCODER_CONTEXTS", 32)
+MAX_SESSIONS = envint("XPRA_PROXY_ENCODER_SESSIONS", 256)
+
+#the values we keep for each session:
+IN_USE, PID, TICKET, ACTIVE, CONTEXTS, FRAMES, WAIT_TIME, MAX_WAIT_TIME = range(8)
+FIELDS = 8
+
+
+class ProxyEncoderPool(object):
+    """
+        Schedules the video re-encoding work of all the proxy instance processes,
+        so that they never use more than 'threads' CPUs or 'max_contexts' encoder contexts between them.
+        The state lives in shared memory, so this object must be created
+        by the proxy server before it starts the proxy instances.
+        A session waiting for an encoding slot is given a ticket,
+        and free slots are handed out in ticket order:
+        as each session has a single encode thread, this is a round-robin between the busy sessions.
+        Only the proxy server adds and removes sessions, so the slots of the instances
+        that terminate abnormally are always reclaimed.
+    """
+
+    def __init__(self, threads, max_contexts, max_sessions=MAX_SESSIONS):
+        self.threads = threads
+        self.max_contexts = max_contexts
+        self.max_sessions = max_sessions
+        self.condition = Condition()
+        #the last ticket issued, followed by the values for each session:
+        self.state = Array("l", 1+max_sessions*FIELDS, lock=False)
+
+    def __repr__(self):
+        return "ProxyEncoderPool(%i threads, %i contexts)" % (self.threads, self.max_contexts)
+
+    def _get(self, index, field):
+        return self.state[1+index*FIELDS+field]
+
+    def _set(self, index, field, value):
+        self.state[1+index*FIELDS+field] = value
+
+    def _sessions(self):
+        return [i for i in range(self.max_sessions) if self._get(i, IN_USE)]
+
+    def _total(self, field):
+        return sum(self._get(i, field) for i in self._sessions())
+
+    def get_info(self):
+        with self.condition:
+            sessions = self._sessions()
+            sinfo = {}
+            for i in sessions:
+                frames = self._get(i, FRAMES)
+                sinfo[i] = {
+                            "pid"       : self._get(i, PID),
+                            "waiting"   : self._get(i, TICKET)>0,
+                            "active"    : self._get(i, ACTIVE)>0,
+                            "contexts"  : self._get(i, CONTEXTS),
+                            "frames"    : frames,
+                            "wait"      : {
+                                           "avg"    : self._get(i, WAIT_TIME)//max(1, frames),
+                                           "max"    : self._get(i, MAX_WAIT_TIME),
+                                           },
+                            }
+            return {
+                    "threads"       : self.threads,
+                    "active"        : self._total(ACTIVE),
+                    "queue"         : {"size" : len([i for i in sessions if self._get(i, TICKET)>0])},
+                    "contexts"      : {
+                                       ""       : self._total(CONTEXTS),
+                                       "max"    : self.max_contexts,
+                                       },
+                    "frames"        : self._total(FRAMES),
+                    "sessions"      : len(sessions),
+                    "session"       : sinfo,
+                    }
+
+    #methods used by the proxy server:
+    def add_session(self):
+        """ returns the index of a free session slot, or None if they are all used """
+        with self.condition:
+            for i in range(self.max_sessions):
+                if not self._get(i, IN_USE):
+                    for field in range(FIELDS):
+                        self._set(i, field, 0)
+                    self._set(i, IN_USE, 1)
+                    return i
+        return None
+
+    def set_session_pid(self, index, pid):
+        with self.condition:
+            self._set(index, PID, pid)
+
+    def remove_session(self, index):
+        """ frees the slot, releasing any encoding slot or encoder context it may still hold """
+        with self.condition:
+            for field in range(FIELDS):
+                self._set(index, field, 0)
+            self.condition.notify_all()
+
+    def get_session(self, index):
+        return ProxyEncoderSession(self, index)
+
+    #methods used by the proxy instances:
+    def _can_start(self, index):
+        if self._total(ACTIVE)>=self.threads:
+            return False
+        ticket = self._get(index, TICKET)
+        return not [i for i in self._sessions() if 0<self._get(i, TICKET)<ticket]
+
+    def acquire(self, index):
+        start = monotonic_time()
+        with self.condition:
+            self.state[0] += 1
+            self._set(index, TICKET, self.state[0])
+            while not self._can_start(index):
+                #the timeout is only a safety net:
+                self.condition.wait(1)
+            self._set(index, TICKET, 0)
+            self._set(index, ACTIVE, 1)
+            wait = int(1000*(monotonic_time()-start))
+            self._set(index, WAIT_TIME, self._get(index, WAIT_TIME)+wait)
+            self._set(index, MAX_WAIT_TIME, max(wait, self._get(index, MAX_WAIT_TIME)))
+
+    def release(self, index):
+        with self.condition:
+            if not self._get(index, IN_USE):
+                return
+            self._set(index, ACTIVE, 0)
+            self._set(index, FRAMES, self._get(index, FRAMES)+1)
+            self.condition.notify_all()
+
+    def add_context(self, index):
+        """ returns False if we already have too many encoder contexts """
+        with self.condition:
+            if self._total(CONTEXTS)>=self.max_contexts:
+                return False
+            self._set(index, CONTEXTS, self._get(index, CONTEXTS)+1)
+            return True
+
+    def remove_context(self, index):
+        with self.condition:
+            self._set(index, CONTEXTS, max(0, self._get(index, CONTEXTS)-1))
+
+
+class ProxyEncoderSession(object):
+    """ the handle on the pool used by a proxy instance """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def __repr__(self):
+        return "ProxyEncoderSession(%i)" % self.index
+
+    def get_info(self):
+        #only show our own session:
+        info = self.pool.get_info()
+        info["session"] = info.get("session", {}).get(self.index, {})
+        return info
+
+    def acquire(self):
+        self.pool.acquire(self.index)
+
+    def release(self):
+        self.pool.release(self.index)
+
+    def add_context(self):
+        return self.pool.add_context(self.index)
+
+    def remove_context(self):
+        self.pool.remove_context(self.index)
@@ -17,13 +17,13 @@ enclog = Logger("encoding")
 
 from xpra.server.server_core import get_server_info, get_thread_info
 from xpra.scripts.server import deadly_signal
-from xpra.net import compression
+from xpra.net import compression, packet_encoding
 from xpra.net.compression import Compressed, compressed_wrapper
 from xpra.net.protocol import Protocol, get_network_caps
 from xpra.codecs.loader import load_codecs, get_codec
 from xpra.codecs.image_wrapper import ImageWrapper
 from xpra.codecs.video_helper import getVideoHelper, PREFERRED_ENCODER_ORDER
-from xpra.os_util import Queue, SIGNAMES, strtobytes, memoryview_to_bytes, getuid, getgid, monotonic_time, get_username_for_uid, setuidgid
+from xpra.os_util import Queue, SIGNAMES, strtobytes, bytestostr, memoryview_to_bytes, getuid, getgid, monotonic_time, get_username_for_uid, setuidgid
 from xpra.util import flatten_dict, typedict, updict, repr_ellipsized, xor, std, envint, envbool, csv, \
     LOGIN_TIMEOUT, CONTROL_COMMAND_ERROR, AUTHENTICATION_ERROR, CLIENT_EXIT_TIMEOUT, SERVER_SHUTDOWN
 from xpra.version_util import XPRA_VERSION
@@ -45,10 +45,109 @@ except:
 PROXY_QUEUE_SIZE = envint("XPRA_PROXY_QUEUE_SIZE", 10)
 #for testing only: passthrough as RGB:
 PASSTHROUGH = envbool("XPRA_PROXY_PASSTHROUGH", False)
+#forward the packets without decoding them when no re-encoding is needed:
+RAW_PASSTHROUGH = envbool("XPRA_PROXY_RAW_PASSTHROUGH", True)
+#the packets we still need to handle in raw passthrough mode are all small:
+RAW_PEEK_SIZE = envint("XPRA_PROXY_RAW_PEEK_SIZE", 1024)
+RAW_PEEK_PACKETS = ("hello", "disconnect", "challenge")
+#the packet type is found at the start of the encoded packet (ie: "l5:hello" with bencode):
+RAW_PEEK_NAMES = tuple(strtobytes(x) for x in RAW_PEEK_PACKETS)
+RAW_PEEK_HEADER = 16
+#marker used in the packet queues for packets forwarded as-is:
+RAW_PACKET = "raw-packet"
 MAX_CONCURRENT_CONNECTIONS = 20
 VIDEO_TIMEOUT = 5                  #destroy video encoder after N seconds of idle state
 
 
+def sanitize_session_options(options):
+    d = {}
+    def number(k, v):
+        return parse_number(int, k, v)
+    OPTION_WHITELIST = {"compression_level" : number,
+                        "lz4"               : parse_bool,
+                        "lzo"               : parse_bool,
+                        "zlib"              : parse_bool,
+                        "rencode"           : parse_bool,
+                        "bencode"           : parse_bool,
+                        "yaml"              : parse_bool}
+    for k,v in options.items():
+        parser = OPTION_WHITELIST.get(k)
+        if parser:
+            log("trying to add %s=%s using %s", k, v, parser)
+            try:
+                d[k] = parser(k, v)
+            except Exception as e:
+                log.warn("failed to parse value %s for %s using %s: %s", v, k, parser, e)
+    return d
+
+def filter_caps(caps, prefixes, restrict=RAW_PASSTHROUGH):
+    #removes caps that the proxy overrides / does not use:
+    #(not very pythonic!)
+    pcaps = {}
+    removed = []
+    for k in caps.keys():
+        sk = bytestostr(k)
+        skip = len([e for e in prefixes if sk.startswith(e)])
+        if skip==0:
+            pcaps[sk] = caps[k]
+        else:
+            removed.append(k)
+    log("filtered out %s matching %s", removed, prefixes)
+    #replace the network caps with the proxy's own:
+    pcaps.update(flatten_dict(get_network_caps()))
+    if restrict:
+        #so we can forward the packets as-is:
+        restrict_network_caps(pcaps, typedict(caps))
+    #then add the proxy info:
+    updict(pcaps, "proxy", get_server_info(), flatten_dicts=True)
+    pcaps["proxy"] = True
+    pcaps["proxy.hostname"] = socket.gethostname()
+    return pcaps
+
+def filter_client_caps(caps, session_options, restrict=RAW_PASSTHROUGH):
+    fc = filter_caps(caps, ("cipher", "challenge", "digest", "aliases", "compression", "lz4", "lz0", "zlib"), restrict)
+    #update with options provided via config if any:
+    fc.update(sanitize_session_options(session_options))
+    return fc
+
+def restrict_network_caps(pcaps, peer_caps):
+    """
+        Only advertise the packet encoders and compressors that the other end also supports,
+        so that the packets can be forwarded without re-encoding them.
+        Stream compression cannot be used since the proxy also sends its own packets.
+    """
+    for x in packet_encoding.ALL_ENCODERS:
+        if pcaps.get(x) and not peer_caps.boolget(x, x=="bencode"):
+            pcaps[x] = False
+    for x in compression.ALL_COMPRESSORS:
+        if pcaps.get(x) and not peer_caps.boolget(x):
+            pcaps[x] = False
+    if "zstd.dictionary" in pcaps and pcaps["zstd.dictionary"]!=peer_caps.intget("zstd.dictionary"):
+        del pcaps["zstd.dictionary"]
+    pcaps["encoders"] = [x for x in pcaps.get("encoders", []) if pcaps.get(x, x=="bencode")]
+    pcaps["compressors"] = [x for x in pcaps.get("compressors", []) if pcaps.get(x)]
+    pcaps["zlib.stream"] = False
+
+def get_challenge_response(password, salt, digest):
+    """
+        Handles the server's authentication challenge on behalf of the client,
+        returns the challenge response and the client salt.
+    """
+    from xpra.net.crypto import get_salt, get_digest_module
+    client_salt = get_salt(len(salt))
+    salt = xor(salt, client_salt)
+    digestmod = get_digest_module(digest)
+    if not digestmod:
+        raise Exception("digest mode '%s' not supported" % std(digest))
+    if not password:
+        raise Exception("authentication requested by the server, but no password available for this session")
+    import hmac
+    password = strtobytes(password)
+    salt = memoryview_to_bytes(salt)
+    challenge_response = hmac.HMAC(password, salt, digestmod=digestmod).hexdigest()
+    return challenge_response, client_salt
+
+
 def set_blocking(conn):
     #Note: importing set_socket_timeout from xpra.net.bytestreams
     #fails in mysterious ways, so we duplicate the code here instead
@@ -64,7 +163,7 @@ class ProxyInstanceProcess(Process):
 
     def __init__(self, uid, gid, env_options, session_options, socket_dir,
                  video_encoder_modules, csc_modules,
-                 client_conn, client_state, cipher, encryption_key, server_conn, caps, message_queue):
+                 client_conn, client_state, cipher, encryption_key, server_conn, caps, message_queue, encoder_session=None):
         Process.__init__(self, name=str(client_conn))
         self.uid = uid
         self.gid = gid
@@ -79,10 +178,12 @@ class ProxyInstanceProcess(Process):
         self.encryption_key = encryption_key
         self.server_conn = server_conn
         self.caps = caps
+        #our handle on the proxy server's ProxyEncoderPool, if any:
+        self.encoder_session = encoder_session
         log("ProxyProcess%s", (uid, gid, env_options, session_options, socket_dir,
                                video_encoder_modules, csc_modules,
                                client_conn, repr_ellipsized(str(client_state)), cipher, encryption_key, server_conn,
-                               "%s: %s.." % (type(caps), repr_ellipsized(str(caps))), message_queue))
+                               "%s: %s.." % (type(caps), repr_ellipsized(str(caps))), message_queue, encoder_session))
         self.client_protocol = None
         self.server_protocol = None
         self.exit = False
@@ -96,6 +197,7 @@ class ProxyInstanceProcess(Process):
         self.video_encoder_types = None
         self.video_helper = None
         self.lost_windows = None
+        self.raw_passthrough = False
         #for handling the local unix domain socket:
         self.control_socket_cleanup = None
         self.control_socket = None
@@ -373,11 +475,17 @@ class ProxyInstanceProcess(Process):
         sinfo = {}
         sinfo.update(get_server_info())
         sinfo.update(get_thread_info(proto))
-        return {
-            "proxy" : {
+        pinfo = {
                 "version"    : XPRA_VERSION,
+                "raw-passthrough" : self.raw_passthrough,
                 ""           : sinfo,
-                },
+                }
+        if self.encode_queue:
+            pinfo["encode-queue"] = {"size" : self.encode_queue.qsize()}
+        if self.encoder_session:
+            pinfo["encoder-pool"] = self.encoder_session.get_info()
+        return {
+            "proxy" : pinfo,
             "window" : self.get_window_info(),
             }
 
@@ -391,31 +499,8 @@ class ProxyInstanceProcess(Process):
         self.queue_server_packet(("hello", hello))
 
 
-    def sanitize_session_options(self, options):
-        d = {}
-        def number(k, v):
-            return parse_number(int, k, v)
-        OPTION_WHITELIST = {"compression_level" : number,
-                            "lz4"               : parse_bool,
-                            "lzo"               : parse_bool,
-                            "zlib"              : parse_bool,
-                            "rencode"           : parse_bool,
-                            "bencode"           : parse_bool,
-                            "yaml"              : parse_bool}
-        for k,v in options.items():
-            parser = OPTION_WHITELIST.get(k)
-            if parser:
-                log("trying to add %s=%s using %s", k, v, parser)
-                try:
-                    d[k] = parser(k, v)
-                except Exception as e:
-                    log.warn("failed to parse value %s for %s using %s: %s", v, k, parser, e)
-        return d
-
     def filter_client_caps(self, caps):
-        fc = self.filter_caps(caps, ("cipher", "challenge", "digest", "aliases", "compression", "lz4", "lz0", "zlib"))
-        #update with options provided via config if any:
-        fc.update(self.sanitize_session_options(self.session_options))
+        fc = filter_client_caps(caps, self.session_options)
         #add video proxies if any:
         fc["encoding.proxy.video"] = len(self.video_encoding_defs)>0
         if self.video_encoding_defs:
@@ -424,27 +509,63 @@ class ProxyInstanceProcess(Process):
 
     def filter_server_caps(self, caps):
         self.server_protocol.enable_encoder_from_caps(caps)
-        return self.filter_caps(caps, ("aliases", ))
-
-    def filter_caps(self, caps, prefixes):
-        #removes caps that the proxy overrides / does not use:
-        #(not very pythonic!)
-        pcaps = {}
-        removed = []
-        for k in caps.keys():
-            skip = len([e for e in prefixes if k.startswith(e)])
-            if skip==0:
-                pcaps[k] = caps[k]
-            else:
-                removed.append(k)
-        log("filtered out %s matching %s", removed, prefixes)
-        #replace the network caps with the proxy's own:
-        pcaps.update(flatten_dict(get_network_caps()))
-        #then add the proxy info:
-        updict(pcaps, "proxy", get_server_info(), flatten_dicts=True)
-        pcaps["proxy"] = True
-        pcaps["proxy.hostname"] = socket.gethostname()
-        return pcaps
+        return filter_caps(caps, ("aliases", ))
+
+    def can_raw_passthrough(self, server_caps):
+        """ only when the proxy has nothing to re-encode or re-encrypt """
+        def no(reason):
+            log("raw passthrough disabled: %s", reason)
+            return False
+        if not RAW_PASSTHROUGH:
+            return no("XPRA_PROXY_RAW_PASSTHROUGH is not set")
+        if PASSTHROUGH:
+            return no("the rgb passthrough test mode is enabled")
+        if self.cipher or server_caps.strget("cipher"):
+            return no("encryption is enabled")
+        for proto in (self.client_protocol, self.server_protocol):
+            if proto.cipher_in or proto.cipher_out:
+                return no("%s is encrypted" % proto)
+        if self.video_encoding_defs:
+            return no("the proxy may need to encode video")
+        return True
+
+    def enable_raw_passthrough(self):
+        log.info("forwarding packets without re-encoding them")
+        self.raw_passthrough = True
+        self.client_protocol.set_raw_packet_callback(self.process_raw_client_packet)
+        self.server_protocol.set_raw_packet_callback(self.process_raw_server_packet)
+
+    def peek_raw_packet(self, proto, protocol_flags, compression_level, packet_index, data, process_packet):
+        """
+            Decodes the small packets to find the ones the proxy must handle itself,
+            returns True if the packet has been processed.
+            Those packets are too small to be compressed, and we only decode
+            the ones that have one of the packet types we want in their first few bytes.
+        """
+        if packet_index>0 or compression_level>0 or len(data)>RAW_PEEK_SIZE:
+            return False
+        head = memoryview_to_bytes(data[:RAW_PEEK_HEADER])
+        if not any(name in head for name in RAW_PEEK_NAMES):
+            return False
+        try:
+            packet = proto.decode_raw_packet(protocol_flags, compression_level, data)
+        except Exception as e:
+            log("failed to decode raw packet: %s", e)
+            return False
+        if not packet or bytestostr(packet[0]) not in RAW_PEEK_PACKETS:
+            return False
+        process_packet(proto, packet)
+        return True
+
+    def process_raw_client_packet(self, proto, protocol_flags, compression_level, packet_index, data):
+        if not self.peek_raw_packet(proto, protocol_flags, compression_level, packet_index, data, self.process_client_packet):
+            self.server_packets.put((RAW_PACKET, protocol_flags, compression_level, packet_index, data))
+            self.server_protocol.source_has_more()
+
+    def process_raw_server_packet(self, proto, protocol_flags, compression_level, packet_index, data):
+        if not self.peek_raw_packet(proto, protocol_flags, compression_level, packet_index, data, self.process_server_packet):
+            self.client_packets.put((RAW_PACKET, protocol_flags, compression_level, packet_index, data))
+            self.client_protocol.source_has_more()
 
 
     def run_queue(self):
@@ -511,6 +632,9 @@ class ProxyInstanceProcess(Process):
     def get_client_packet(self):
         #server wants a packet
         p = self.client_packets.get()
+        if p[0]==RAW_PACKET:
+            self.client_protocol.write_raw_packet(*p[1:])
+            return None, None, None, self.client_packets.qsize()>0
         log("sending to client: %s", p[0])
         return p, None, None, self.client_packets.qsize()>0
 
@@ -545,6 +669,9 @@ class ProxyInstanceProcess(Process):
     def get_server_packet(self):
         #server wants a packet
         p = self.server_packets.get()
+        if p[0]==RAW_PACKET:
+            self.server_protocol.write_raw_packet(*p[1:])
+            return None, None, None, self.server_packets.qsize()>0
         log("sending to server: %s", p[0])
         return p, None, None, self.server_packets.qsize()>0
 
@@ -596,6 +723,11 @@ class ProxyInstanceProcess(Process):
             self.client_protocol.max_packet_size = max(self.client_protocol.max_packet_size, file_max_packet_size)
             self.server_protocol.max_packet_size = max(self.server_protocol.max_packet_size, file_max_packet_size)
             packet = ("hello", caps)
+            if self.can_raw_passthrough(c):
+                #the packets that follow are queued after this hello:
+                self.queue_client_packet(packet)
+                self.enable_raw_passthrough()
+                return
         elif packet_type=="info-response":
             #adds proxy info:
             #note: this is only seen by the client application
@@ -638,25 +770,15 @@ class ProxyInstanceProcess(Process):
             if packet[3]:
                 packet[3] = Compressed("file-chunk-data", packet[3])
         elif packet_type=="challenge":
-            from xpra.net.crypto import get_salt, get_digest_module
             #client may have already responded to the challenge,
             #so we have to handle authentication from this end
             salt = packet[1]
             digest = packet[3]
-            client_salt = get_salt(len(salt))
-            salt = xor_str(salt, client_salt)
-            digestmod = get_digest_module(digest)
-            if not digestmod:
-                self.stop("digest mode '%s' not supported", std(digest))
-                return
-            password = self.session_options.get("password")
-            if not password:
-                self.stop("authentication requested by the server, but no password available for this session")
+            try:
+                challenge_response, client_salt = get_challenge_response(self.session_options.get("password"), salt, digest)
+            except Exception as e:
+                self.stop(str(e))
                 return
-            import hmac
-            password = strtobytes(password)
-            salt = memoryview_to_bytes(salt)
-            challenge_response = hmac.HMAC(password, salt, digestmod=digestmod).hexdigest()
             log.info("sending %s challenge response", digest)
             self.send_hello(challenge_response, client_salt)
             return
@@ -678,10 +800,20 @@ class ProxyInstanceProcess(Process):
                     if ve:
                         del self.video_encoders[wid]
                         del self.video_encoders_last_used_time[wid]
-                        ve.clean()
+                        self.clean_video_encoder(ve)
                 elif packet_type=="draw":
-                    #modify the packet with the video encoder:
-                    if self.process_draw(packet):
+                    #modify the packet with the video encoder,
+                    #waiting for our turn if the encoding is shared with other sessions:
+                    session = self.encoder_session
+                    if session and self.uses_video_encoder(packet):
+                        session.acquire()
+                        try:
+                            send = self.process_draw(packet)
+                        finally:
+                            session.release()
+                    else:
+                        send = self.process_draw(packet)
+                    if send:
                         #then send it as normal:
                         self.queue_client_packet(packet)
                 elif packet_type=="check-video-timeout":
@@ -694,7 +826,7 @@ class ProxyInstanceProcess(Process):
                         enclog("timing out the video encoder context for window %s", wid)
                         #timeout is confirmed, we are in the encoding thread,
                         #so it is now safe to clean it up:
-                        ve.clean()
+                        self.clean_video_encoder(ve)
                         del self.video_encoders[wid]
                         del self.video_encoders_last_used_time[wid]
                 else:
@@ -702,6 +834,21 @@ class ProxyInstanceProcess(Process):
             except:
                 enclog.warn("error encoding packet", exc_info=True)
 
+    def clean_video_encoder(self, ve):
+        ve.clean()
+        if self.encoder_session:
+            self.encoder_session.remove_context()
+
+    def uses_video_encoder(self, packet):
+        """ the draw packets which process_draw will re-encode rather than pass through """
+        encoding, client_options = packet[6], packet[10]
+        if encoding in ("mmap", "scroll") or not self.video_encoder_types or not client_options:
+            return False
+        proxy_video = client_options.get("proxy", False)
+        if PASSTHROUGH and (encoding in ("rgb32", "rgb24") or proxy_video):
+            return False
+        return bool(proxy_video)
+
 
     def process_draw(self, packet):
         wid, x, y, width, height, encoding, pixels, _, rowstride, client_options = packet[1:11]
@@ -766,11 +913,16 @@ class ProxyInstanceProcess(Process):
             #and scrap it if not (ie: when window is resized)
             if ve.get_width()!=width or ve.get_height()!=height:
                 enclog("closing existing video encoder %s because dimensions have changed from %sx%s to %sx%s", ve, ve.get_width(), ve.get_height(), width, height)
-                ve.clean()
+                self.clean_video_encoder(ve)
+                #we may not create a new one, so forget this one now:
+                del self.video_encoders[wid]
+                del self.video_encoders_last_used_time[wid]
                 ve = None
             elif ve.get_encoding()!=encoding:
                 enclog("closing existing video encoder %s because encoding has changed from %s to %s", ve.get_encoding(), encoding)
-                ve.clean()
+                self.clean_video_encoder(ve)
+                del self.video_encoders[wid]
+                del self.video_encoders_last_used_time[wid]
                 ve = None
         #scaling and depth are proxy-encoder attributes:
         scaling = client_options.get("scaling", (1, 1))
@@ -789,6 +941,9 @@ class ProxyInstanceProcess(Process):
         if not ve:
             #make a new video encoder:
             spec = self._find_video_encoder(encoding, rgb_format)
+            if spec and self.encoder_session and not self.encoder_session.add_context():
+                enclog("too many video encoder contexts in use, not using %s for window %s", spec, wid)
+                spec = None
             if spec is None:
                 #no video encoder!
                 enc_pillow = get_codec("enc_pillow")
@@ -801,17 +956,22 @@ class ProxyInstanceProcess(Process):
                 return send_updated(coding, compressed_data, client_options)
 
             enclog("creating new video encoder %s for window %s", spec, wid)
-            ve = spec.make_instance()
-            #dst_formats is specified with first frame only:
-            dst_formats = client_options.get("dst_formats")
-            if dst_formats is not None:
-                #save it in case we timeout the video encoder,
-                #so we can instantiate it again, even from a frame no>1
-                self.video_encoders_dst_formats = dst_formats
-            else:
-                assert self.video_encoders_dst_formats, "BUG: dst_formats not specified for proxy and we don't have it either"
-                dst_formats = self.video_encoders_dst_formats
-            ve.init_context(width, height, rgb_format, dst_formats, encoding, quality, speed, scaling, {})
+            try:
+                ve = spec.make_instance()
+                #dst_formats is specified with first frame only:
+                dst_formats = client_options.get("dst_formats")
+                if dst_formats is not None:
+                    #save it in case we timeout the video encoder,
+                    #so we can instantiate it again, even from a frame no>1
+                    self.video_encoders_dst_formats = dst_formats
+                else:
+                    assert self.video_encoders_dst_formats, "BUG: dst_formats not specified for proxy and we don't have it either"
+                    dst_formats = self.video_encoders_dst_formats
+                ve.init_context(width, height, rgb_format, dst_formats, encoding, quality, speed, scaling, {})
+            except:
+                if self.encoder_session:
+                    self.encoder_session.remove_context()
+                raise
             self.video_encoders[wid] = ve
             self.video_encoders_last_used_time[wid] = monotonic_time()      #just to make sure this is always set
         #actual video compression:
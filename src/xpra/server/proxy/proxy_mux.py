@@ -0,0 +1,581 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import errno
+import socket
+import signal
+import select
+from threading import Lock
+from multiprocessing import Process, Pipe
+from multiprocessing.reduction import send_handle, recv_handle
+
+from xpra.log import Logger
+log = Logger("proxy")
+
+from xpra.net import compression, packet_encoding
+from xpra.net.header import unpack_header, pack_header, FLAGS_CIPHER, FLAGS_ZLIB_STREAM
+from xpra.net.bytestreams import SocketConnection
+from xpra.os_util import monotonic_time, setuidgid, getuid, getgid, bytestostr, SIGNAMES
+from xpra.util import typedict, envint, repr_ellipsized, AtomicInteger, \
+    LOGIN_TIMEOUT, PROTOCOL_ERROR, AUTHENTICATION_ERROR, SERVER_SHUTDOWN
+from xpra.server.proxy.proxy_instance_process import filter_caps, filter_client_caps, get_challenge_response, RAW_PEEK_SIZE
+
+
+#number of worker processes for each user, 0 disables the multiplexing engine:
+PROXY_MUX_WORKERS = envint("XPRA_PROXY_MUX_WORKERS", 0)
+#maximum number of sessions for each worker:
+MAX_MUX_SESSIONS = max(1, envint("XPRA_PROXY_MUX_SESSIONS", 100))
+#stop reading from one end when this much data is waiting to be sent to the other:
+MAX_BUFFERED = envint("XPRA_PROXY_MUX_BUFFER_SIZE", 4*1024*1024)
+HELLO_TIMEOUT = envint("XPRA_PROXY_MUX_HELLO_TIMEOUT", 20)
+CLOSE_TIMEOUT = 5
+READ_SIZE = 65536
+MAX_PACKET_SIZE = 256*1024*1024
+VIDEO_ENCODINGS = ("h264", "h265", "vp8", "vp9", "mpeg4")
+
+
+def can_multiplex(conn):
+    """ only plain sockets can be handed over to a worker process and used for non-blocking I/O """
+    return type(conn)==SocketConnection and type(conn._socket)==socket.socket
+
+def needs_video_proxy(video_encoders, caps):
+    """ sessions that may use the proxy's video encoders need a dedicated process """
+    if not [x for x in video_encoders if x and x!="none"]:
+        return False
+    return any(x in VIDEO_ENCODINGS for x in caps.strlistget("encodings"))
+
+def encode_packet(packet, encoder):
+    """
+        The packets generated by the proxy itself are never compressed,
+        so they cannot interfere with any stream compression context.
+    """
+    data, flags = packet_encoding.get_encoder(encoder)(packet)
+    return pack_header(flags, 0, 0, len(data))+data
+
+def decompress_packet(protocol_flags, compression_level, data):
+    if protocol_flags & FLAGS_CIPHER:
+        raise Exception("encrypted packets are not supported")
+    if protocol_flags & FLAGS_ZLIB_STREAM:
+        raise Exception("stream compression is not supported")
+    if compression_level>0:
+        data = compression.decompress(data, compression_level)
+    return data
+
+def decode_packet(protocol_flags, compression_level, data):
+    return packet_encoding.decode(decompress_packet(protocol_flags, compression_level, data), protocol_flags)
+
+def get_encoder(caps):
+    #same logic as Protocol.enable_encoder_from_caps:
+    for e in packet_encoding.get_enabled_encoders(order=packet_encoding.PERFORMANCE_ORDER):
+        if caps.boolget(e, e=="bencode"):
+            return e
+    return packet_encoding.get_enabled_encoders()[0]
+
+
+class MuxEndpoint(object):
+    """ one of the two sockets of a session, with the data waiting to be written to it """
+
+    def __init__(self, name, sock):
+        self.name = name
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.encoder = packet_encoding.get_enabled_encoders()[0]
+        self.read_buffer = bytearray()
+        self.write_buffers = []
+        self.write_size = 0
+        #bytes left to forward for the current packet:
+        self.remaining = 0
+        #raw chunks of the packet being decoded:
+        self.raw_chunks = {}
+        self.closed = False
+
+    def __repr__(self):
+        return "MuxEndpoint(%s)" % self.name
+
+    def write(self, data):
+        if data and not self.closed:
+            self.write_buffers.append(data)
+            self.write_size += len(data)
+
+    def flush(self):
+        """ writes as much as we can without blocking """
+        while self.write_buffers:
+            buf = self.write_buffers[0]
+            try:
+                sent = self.sock.send(buf)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            self.write_size -= sent
+            if sent<len(buf):
+                self.write_buffers[0] = buf[sent:]
+                return
+            self.write_buffers.pop(0)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.write_buffers = []
+            self.write_size = 0
+            try:
+                self.sock.close()
+            except:
+                pass
+
+
+class MuxSession(object):
+    """
+        The state of a proxied session:
+        the proxy sends the hello to the server and handles its response,
+        from then on the packets are forwarded as-is in both directions.
+    """
+
+    def __init__(self, sid, display, client_sock, server_sock, caps, client_encoder, session_options):
+        self.sid = sid
+        self.display = display
+        self.client = MuxEndpoint("client", client_sock)
+        if client_encoder in packet_encoding.get_enabled_encoders():
+            self.client.encoder = client_encoder
+        self.server = MuxEndpoint("server", server_sock)
+        self.caps = typedict(caps)
+        self.session_options = session_options
+        self.start_time = monotonic_time()
+        self.close_time = 0
+        self.raw = False
+        self.closing = False
+
+    def __repr__(self):
+        return "MuxSession(%s: %s)" % (self.sid, self.display)
+
+    def get_info(self):
+        return {
+                "display"   : self.display,
+                "raw"       : self.raw,
+                "closing"   : self.closing,
+                "buffered"  : {
+                               "client" : self.client.write_size,
+                               "server" : self.server.write_size,
+                               },
+                }
+
+    def endpoints(self):
+        return self.client, self.server
+
+    def peer(self, endpoint):
+        if endpoint is self.client:
+            return self.server
+        return self.client
+
+    def wants_read(self, endpoint):
+        if self.closing or endpoint.closed:
+            return False
+        if not self.raw and endpoint is self.client:
+            #the client waits for the server's hello,
+            #anything else it sends must not reach the server before that:
+            return False
+        return self.peer(endpoint).write_size<MAX_BUFFERED
+
+    def start(self):
+        hello = filter_client_caps(self.caps, self.session_options, True)
+        hello["encoding.proxy.video"] = False
+        self.send_hello(hello)
+
+    def send_hello(self, hello):
+        self.server.write(encode_packet(("hello", hello), self.server.encoder))
+
+    def check_timeout(self, now):
+        if self.closing:
+            if now-self.close_time>CLOSE_TIMEOUT or not (self.client.write_size or self.server.write_size):
+                return True
+        elif not self.raw and now-self.start_time>HELLO_TIMEOUT:
+            log.warn("Warning: timeout waiting for the server's hello on %s", self)
+            self.disconnect(LOGIN_TIMEOUT)
+        return False
+
+    def disconnect(self, reason, *extra):
+        """ tells both ends we are closing the connection, then stops reading """
+        if self.closing:
+            return
+        log("%s.disconnect(%s, %s)", self, reason, extra)
+        packet = ["disconnect", reason]+list(extra)
+        for endpoint in self.endpoints():
+            #only insert a packet between two forwarded packets:
+            if self.peer(endpoint).remaining==0:
+                endpoint.write(encode_packet(packet, endpoint.encoder))
+        self.set_closing()
+
+    def set_closing(self):
+        self.closing = True
+        self.close_time = monotonic_time()
+
+    def close(self):
+        for endpoint in self.endpoints():
+            endpoint.close()
+
+    def process_data(self, endpoint, data):
+        buf = endpoint.read_buffer
+        buf += data
+        if self.raw:
+            self.forward(endpoint, buf)
+            return
+        if endpoint is self.client:
+            #forwarded once we have the server's hello
+            return
+        #handshake: decode the server's packets until we get its hello
+        while not self.raw and not self.closing and len(buf)>=8:
+            _, protocol_flags, compression_level, packet_index, data_size = unpack_header(bytes(buf[:8]))
+            if buf[0]!=ord("P") or data_size>MAX_PACKET_SIZE:
+                self.disconnect(PROTOCOL_ERROR, "invalid packet header")
+                return
+            if len(buf)<8+data_size:
+                return
+            payload = bytes(buf[8:8+data_size])
+            del buf[:8+data_size]
+            try:
+                if packet_index>0:
+                    endpoint.raw_chunks[packet_index] = decompress_packet(protocol_flags, compression_level, payload)
+                    continue
+                packet = decode_packet(protocol_flags, compression_level, payload)
+            except Exception as e:
+                log("failed to decode packet", exc_info=True)
+                self.disconnect(PROTOCOL_ERROR, "failed to decode packet: %s" % e)
+                return
+            for index, raw_data in endpoint.raw_chunks.items():
+                packet[index] = raw_data
+            endpoint.raw_chunks = {}
+            self.process_server_packet(packet)
+        if self.raw and buf:
+            #packets which followed the server's hello:
+            self.forward(endpoint, buf)
+
+    def process_server_packet(self, packet):
+        packet_type = bytestostr(packet[0])
+        log("%s.process_server_packet: %s", self, packet_type)
+        if packet_type=="hello":
+            c = typedict(packet[1])
+            if c.strget("cipher"):
+                self.disconnect(PROTOCOL_ERROR, "encryption is not supported by this proxy")
+                return
+            self.server.encoder = get_encoder(c)
+            #we never re-encode packets, so the caps are always restricted:
+            caps = filter_caps(c, ("aliases", ), True)
+            self.client.write(encode_packet(("hello", caps), self.client.encoder))
+            self.raw = True
+            log("%s: forwarding packets", self)
+            if self.client.read_buffer:
+                self.forward(self.client, self.client.read_buffer)
+        elif packet_type=="challenge":
+            salt = packet[1]
+            digest = packet[3]
+            try:
+                challenge_response, client_salt = get_challenge_response(self.session_options.get("password"), salt, digest)
+            except Exception as e:
+                self.disconnect(AUTHENTICATION_ERROR, str(e))
+                return
+            log.info("sending %s challenge response", digest)
+            hello = filter_client_caps(self.caps, self.session_options, True)
+            hello["encoding.proxy.video"] = False
+            hello.update({
+                          "challenge_response"      : challenge_response,
+                          "challenge_client_salt"   : client_salt,
+                          })
+            self.send_hello(hello)
+        elif packet_type=="disconnect":
+            log.info("%s: disconnect from server: %s", self, repr_ellipsized(str(packet[1:])))
+            self.client.write(encode_packet(packet, self.client.encoder))
+            self.set_closing()
+        else:
+            log.warn("Warning: unexpected '%s' packet from the server before its hello", packet_type)
+
+    def forward(self, endpoint, buf):
+        """
+            Forwards complete packets and streams the payload of large packets,
+            only the small packets are buffered so we can look for 'disconnect'.
+        """
+        dst = self.peer(endpoint)
+        while buf:
+            if endpoint.remaining>0:
+                n = min(endpoint.remaining, len(buf))
+                dst.write(bytes(buf[:n]))
+                del buf[:n]
+                endpoint.remaining -= n
+                continue
+            if len(buf)<8:
+                return
+            _, protocol_flags, compression_level, packet_index, data_size = unpack_header(bytes(buf[:8]))
+            if buf[0]!=ord("P") or data_size>MAX_PACKET_SIZE or protocol_flags & FLAGS_CIPHER:
+                log.warn("Warning: invalid packet header from %s", endpoint.name)
+                self.disconnect(PROTOCOL_ERROR, "invalid packet header")
+                return
+            if packet_index>0 or data_size>RAW_PEEK_SIZE:
+                dst.write(bytes(buf[:8]))
+                del buf[:8]
+                endpoint.remaining = data_size
+                continue
+            if len(buf)<8+data_size:
+                return
+            data = bytes(buf[:8+data_size])
+            del buf[:8+data_size]
+            packet_type = self.peek_packet_type(protocol_flags, compression_level, data[8:])
+            if packet_type=="hello":
+                log.warn("Warning: invalid hello packet received from the %s after the handshake (dropped)", endpoint.name)
+                continue
+            dst.write(data)
+            if packet_type=="disconnect":
+                log.info("%s: disconnect from %s", self, endpoint.name)
+                self.set_closing()
+                return
+
+    def peek_packet_type(self, protocol_flags, compression_level, data):
+        if protocol_flags & FLAGS_ZLIB_STREAM:
+            return None
+        try:
+            return bytestostr(decode_packet(protocol_flags, compression_level, data)[0])
+        except Exception as e:
+            log("failed to decode packet: %s", e)
+            return None
+
+
+class ProxyMuxProcess(Process):
+    """
+        A worker process forwarding the packets of many sessions
+        using non-blocking sockets and a single poll loop.
+    """
+
+    def __init__(self, uid, gid, conn):
+        Process.__init__(self, name="proxy-mux")
+        self.uid = uid
+        self.gid = gid
+        self.conn = conn
+        self.exit = False
+        self.poller = None
+        self.sessions = {}
+        self.endpoints = {}
+
+    def run(self):
+        log("ProxyMuxProcess.run() pid=%s, uid=%s, gid=%s", os.getpid(), getuid(), getgid())
+        try:
+            import setproctitle
+            setproctitle.setproctitle("Xpra Proxy Worker")
+        except ImportError as e:
+            log("setproctitle not installed: %s", e)
+        setuidgid(self.uid, self.gid)
+        signal.signal(signal.SIGTERM, self.signal_quit)
+        signal.signal(signal.SIGINT, self.signal_quit)
+        log.info("new proxy worker started with pid %s", os.getpid())
+        self.poller = select.poll()
+        self.poller.register(self.conn.fileno(), select.POLLIN)
+        try:
+            self.run_loop()
+        finally:
+            for session in list(self.sessions.values()):
+                session.close()
+            log.info("proxy worker %s stopped", os.getpid())
+
+    def signal_quit(self, signum, frame):
+        log.info("proxy worker pid %s got signal %s, exiting", os.getpid(), SIGNAMES.get(signum, signum))
+        self.stop()
+
+    def stop(self):
+        self.exit = True
+        for session in self.sessions.values():
+            session.disconnect(SERVER_SHUTDOWN)
+
+    def run_loop(self):
+        conn_fd = self.conn.fileno()
+        while not (self.exit and not self.sessions):
+            self.update_poller()
+            try:
+                events = self.poller.poll(1000)
+            except select.error as e:
+                if e.args[0]==errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd==conn_fd:
+                    if not self.process_message():
+                        return
+                    continue
+                v = self.endpoints.get(fd)
+                if v:
+                    self.process_event(v[0], v[1], event)
+            now = monotonic_time()
+            for session in list(self.sessions.values()):
+                if session.check_timeout(now):
+                    self.remove_session(session)
+
+    def update_poller(self):
+        for session in self.sessions.values():
+            for endpoint in session.endpoints():
+                if endpoint.closed:
+                    continue
+                flags = 0
+                if session.wants_read(endpoint):
+                    flags |= select.POLLIN
+                if endpoint.write_buffers:
+                    flags |= select.POLLOUT
+                self.poller.register(endpoint.fd, flags)
+
+    def process_event(self, session, endpoint, event):
+        try:
+            if event & select.POLLOUT:
+                endpoint.flush()
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                data = endpoint.sock.recv(READ_SIZE)
+                if not data:
+                    log.info("%s: %s connection closed", session, endpoint.name)
+                    endpoint.close()
+                    session.disconnect("%s connection lost" % endpoint.name)
+                    return
+                session.process_data(endpoint, data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            log("%s: socket error on %s", session, endpoint.name, exc_info=True)
+            endpoint.close()
+            session.disconnect("%s connection error" % endpoint.name)
+        except Exception as e:
+            #only this session is affected:
+            log.error("Error processing %s data for %s", endpoint.name, session, exc_info=True)
+            session.disconnect(PROTOCOL_ERROR, str(e))
+        if endpoint.closed:
+            self.unregister(endpoint)
+
+    def unregister(self, endpoint):
+        if self.endpoints.pop(endpoint.fd, None):
+            try:
+                self.poller.unregister(endpoint.fd)
+            except (KeyError, ValueError):
+                pass
+
+    def process_message(self):
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            log("proxy server connection closed")
+            self.stop()
+            self.poller.unregister(self.conn.fileno())
+            return bool(self.sessions)
+        log("process_message: %s", repr_ellipsized(str(message)))
+        mtype = message[0]
+        if mtype=="session":
+            sid, display, caps, client_encoder, session_options, client_family, server_family = message[1:8]
+            socks = []
+            for family in (client_family, server_family):
+                fd = recv_handle(self.conn)
+                socks.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+                os.close(fd)
+            for sock in socks:
+                sock.setblocking(0)
+            session = MuxSession(sid, display, socks[0], socks[1], caps, client_encoder, session_options)
+            self.add_session(session)
+        elif mtype=="stop-display":
+            display = message[1]
+            for session in self.sessions.values():
+                if session.display==display:
+                    session.disconnect(SERVER_SHUTDOWN)
+        elif mtype=="stop":
+            self.stop()
+        else:
+            log.error("Error: unexpected proxy server message: %s", mtype)
+        return True
+
+    def add_session(self, session):
+        log.info("proxying session %s for display %s", session.sid, session.display)
+        self.sessions[session.sid] = session
+        for endpoint in session.endpoints():
+            self.endpoints[endpoint.fd] = (session, endpoint)
+        session.start()
+        if self.exit:
+            session.disconnect(SERVER_SHUTDOWN)
+
+    def remove_session(self, session):
+        log("remove_session(%s)", session)
+        for endpoint in session.endpoints():
+            self.unregister(endpoint)
+        session.close()
+        del self.sessions[session.sid]
+        try:
+            self.conn.send(("ended", session.sid))
+        except Exception as e:
+            log("failed to notify the proxy server: %s", e)
+
+
+class ProxyMuxWorker(object):
+    """ the proxy server's handle on a worker process """
+
+    counter = AtomicInteger()
+
+    def __init__(self, uid, gid):
+        self.uid = uid
+        self.gid = gid
+        self.conn, child_conn = Pipe()
+        self.process = ProxyMuxProcess(uid, gid, child_conn)
+        self.child_conn = child_conn
+        self.sessions = {}
+        self.lock = Lock()
+
+    def __repr__(self):
+        return "ProxyMuxWorker(%s)" % self.process.pid
+
+    def start(self):
+        self.process.start()
+        #only the worker uses this end of the pipe:
+        self.child_conn.close()
+        self.child_conn = None
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def get_info(self):
+        self.update()
+        return {
+                "pid"       : self.process.pid,
+                "live"      : self.is_alive(),
+                "sessions"  : len(self.sessions),
+                "displays"  : list(set(self.sessions.values())),
+                }
+
+    def update(self):
+        """ process the notifications from the worker, returns False once the worker has gone """
+        with self.lock:
+            try:
+                while self.conn.poll():
+                    message = self.conn.recv()
+                    if message[0]=="ended":
+                        self.sessions.pop(message[1], None)
+            except (EOFError, IOError):
+                self.sessions = {}
+                return False
+        return True
+
+    def add_session(self, display, client_conn, server_conn, caps, client_state, session_options):
+        with self.lock:
+            sid = ProxyMuxWorker.counter.increase()
+            csock = client_conn._socket
+            ssock = server_conn._socket
+            self.conn.send(("session", sid, display, dict(caps), client_state.get("encoder"), dict(session_options),
+                            csock.family, ssock.family))
+            send_handle(self.conn, csock.fileno(), self.process.pid)
+            send_handle(self.conn, ssock.fileno(), self.process.pid)
+            self.sessions[sid] = display
+        return sid
+
+    def has_display(self, display):
+        self.update()
+        return display in self.sessions.values()
+
+    def stop_display(self, display):
+        with self.lock:
+            self.conn.send(("stop-display", display))
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.conn.send(("stop", ))
+            except Exception as e:
+                log("failed to send stop message to %s: %s", self, e)
@@ -6,6 +6,7 @@
 
 import os
 import sys
+from threading import Lock
 
 from xpra.gtk_common.gobject_compat import import_glib, import_gobject
 glib = import_glib()
@@ -23,6 +24,8 @@ authlog = Logger("proxy", "auth")
 from xpra.util import LOGIN_TIMEOUT, AUTHENTICATION_ERROR, SESSION_NOT_FOUND, SERVER_ERROR, repr_ellipsized, print_nested_dict, csv, typedict
 from xpra.os_util import get_username_for_uid, get_groups, get_home_for_uid, WIN32, POSIX
 from xpra.server.proxy.proxy_instance_process import ProxyInstanceProcess
+from xpra.server.proxy.proxy_mux import ProxyMuxWorker, can_multiplex, needs_video_proxy, PROXY_MUX_WORKERS, MAX_MUX_SESSIONS
+from xpra.server.proxy.proxy_encoder_pool import ProxyEncoderPool, PROXY_ENCODE_THREADS, PROXY_ENCODER_CONTEXTS
 from xpra.server.server_core import ServerCore
 from xpra.server.control_command import ArgsControlCommand, ControlError
 from xpra.child_reaper import getChildReaper
@@ -60,6 +63,14 @@ class ProxyServer(ServerCore):
         #the display they're on and the message queue we can
         # use to communicate with them
         self.processes = {}
+        #the video re-encoding work of all the proxy processes is scheduled by this pool:
+        self.encoder_pool = None
+        #the pool session index of each process:
+        self.encoder_sessions = {}
+        #the worker processes which multiplex sessions,
+        #for each (uid, gid) pair:
+        self.mux_workers = {}
+        self.mux_lock = Lock()
         #connections used exclusively for requests:
         self._requests = set()
         self.idle_add = glib.idle_add
@@ -74,6 +85,10 @@ class ProxyServer(ServerCore):
         self.video_encoders = opts.proxy_video_encoders
         self.csc_modules = opts.csc_modules
         self._start_sessions = opts.proxy_start_sessions
+        if PROXY_ENCODE_THREADS>0 and [x for x in self.video_encoders if x and x!="none"]:
+            #must be created before we start any proxy instance processes:
+            self.encoder_pool = ProxyEncoderPool(PROXY_ENCODE_THREADS, PROXY_ENCODER_CONTEXTS)
+            log("using %s", self.encoder_pool)
         ServerCore.init(self, opts)
         #ensure we cache the platform info before intercepting SIGCHLD
         #as this will cause a fork and SIGCHLD to be emitted:
@@ -119,6 +134,11 @@ class ProxyServer(ServerCore):
                 log.info(" forwarding the 'stop' request")
                 mq.put("stop")
                 return "stopped proxy process with pid %s" % pid
+        for worker in self.get_all_mux_workers():
+            if worker.has_display(display):
+                log.info("stop command: found worker %s for display %s", worker, display)
+                worker.stop_display(display)
+                return "stopped proxy sessions for display %s" % display
         raise ControlError("no proxy found for display %s" % display)
 
 
@@ -132,6 +152,13 @@ class ProxyServer(ServerCore):
             disp,mq = v
             log("stop_all_proxies() stopping process %s for display %s", process, disp)
             mq.put("stop")
+        with self.mux_lock:
+            workers = self.get_all_mux_workers()
+            self.mux_workers = {}
+        for worker in workers:
+            if worker.is_alive():
+                log("stop_all_proxies() stopping %s", worker)
+                worker.stop()
         log("stop_all_proxies() done")
 
     def cleanup(self):
@@ -322,6 +349,13 @@ class ProxyServer(ServerCore):
         log("start_proxy(..) client connection=%s", client_conn)
         log("start_proxy(..) client state=%s", client_state)
 
+        #sessions which don't need a dedicated process can be handed to a worker:
+        worker = None
+        if PROXY_MUX_WORKERS>0 and not cipher and can_multiplex(client_conn) and can_multiplex(server_conn) \
+            and not needs_video_proxy(self.video_encoders, c):
+            worker = self.get_mux_worker(uid, gid)
+        log("start_proxy(..) mux worker=%s", worker)
+
         #this may block, so run it in a thread:
         def do_start_proxy():
             log("do_start_proxy()")
@@ -332,13 +366,39 @@ class ProxyServer(ServerCore):
                     log.error("Error: some network IO threads have failed to terminate")
                     return
                 client_conn.set_active(True)
-                process = ProxyInstanceProcess(uid, gid, env_options, session_options, self._socket_dir,
-                                               self.video_encoders, self.csc_modules,
-                                               client_conn, client_state, cipher, encryption_key, server_conn, c, message_queue)
-                log("starting %s from pid=%s", process, os.getpid())
-                self.processes[process] = (display, message_queue)
-                process.start()
+                if worker:
+                    sid = worker.add_session(display, client_conn, server_conn, c, client_state, session_options)
+                    log("added session %i for display %s to %s", sid, display, worker)
+                    return
+                encoder_session = None
+                pool = self.encoder_pool
+                if pool:
+                    index = pool.add_session()
+                    if index is None:
+                        log.warn("Warning: too many proxy sessions for the encoder pool")
+                    else:
+                        encoder_session = pool.get_session(index)
+                process = None
+                try:
+                    process = ProxyInstanceProcess(uid, gid, env_options, session_options, self._socket_dir,
+                                                   self.video_encoders, self.csc_modules,
+                                                   client_conn, client_state, cipher, encryption_key, server_conn, c, message_queue,
+                                                   encoder_session)
+                    log("starting %s from pid=%s", process, os.getpid())
+                    self.processes[process] = (display, message_queue)
+                    if encoder_session:
+                        self.encoder_sessions[process] = encoder_session.index
+                    process.start()
+                except:
+                    if process is not None:
+                        self.processes.pop(process, None)
+                    #free the encoder pool slot, unless reap has already done it:
+                    if encoder_session and (process is None or self.encoder_sessions.pop(process, None) is not None):
+                        pool.remove_session(encoder_session.index)
+                    raise
                 log("process started")
+                if encoder_session:
+                    pool.set_session_pid(encoder_session.index, process.pid)
                 popen = process._popen
                 assert popen
                 #when this process dies, run reap to update our list of proxy processes:
@@ -446,6 +506,43 @@ class ProxyServer(ServerCore):
         #exec_command(["C:\\Windows\notepad.exe"])
         return "tcp/localhost:%i" % port, proc
 
+    def get_all_mux_workers(self):
+        workers = []
+        for l in self.mux_workers.values():
+            workers += l
+        return workers
+
+    def get_mux_worker(self, uid, gid):
+        """
+            Returns the worker process that should handle a new session for this user,
+            starting a new one if we have not reached PROXY_MUX_WORKERS yet,
+            or None if they are all full.
+        """
+        with self.mux_lock:
+            workers = [w for w in self.mux_workers.get((uid, gid), []) if w.is_alive()]
+            self.mux_workers[(uid, gid)] = workers
+            for w in workers:
+                w.update()
+            if len(workers)<PROXY_MUX_WORKERS:
+                worker = ProxyMuxWorker(uid, gid)
+                worker.start()
+                log("started %s for uid=%i, gid=%i", worker, uid, gid)
+                popen = worker.process._popen
+                assert popen
+                self.child_reaper.add_process(popen, "xpra-proxy-mux-%i" % uid, "xpra-proxy-mux", True, True, self.reap)
+                #the worker blocks if we don't read its notifications:
+                glib.io_add_watch(worker.conn.fileno(), glib.IO_IN | glib.IO_HUP | glib.IO_ERR, self.mux_worker_notification, worker)
+                workers.append(worker)
+                return worker
+            available = [w for w in workers if len(w.sessions)<MAX_MUX_SESSIONS]
+            if not available:
+                return None
+            return sorted(available, key=lambda w : len(w.sessions))[0]
+
+    def mux_worker_notification(self, fd, cb_condition, worker):
+        #keep watching until the worker closes its end of the pipe:
+        return worker.update()
+
     def reap(self, *args):
         log("reap%s", args)
         dead = []
@@ -456,6 +553,13 @@ class ProxyServer(ServerCore):
         log("reap%s dead processes: %s", args, dead or None)
         for p in dead:
             del self.processes[p]
+            #free its encoder pool slot, and anything it may have been holding:
+            index = self.encoder_sessions.pop(p, None)
+            if index is not None and self.encoder_pool:
+                self.encoder_pool.remove_session(index)
+        with self.mux_lock:
+            for k, workers in list(self.mux_workers.items()):
+                self.mux_workers[k] = [w for w in workers if w.is_alive()]
 
 
     def get_info(self, proto, *args):
@@ -481,4 +585,9 @@ class ProxyServer(ServerCore):
                                    }
                         i += 1
                     info["proxies"] = len(self.processes)
+                    if self.encoder_pool:
+                        info["encoder-pool"] = self.encoder_pool.get_info()
+                    workers = self.get_all_mux_workers()
+                    if workers:
+                        info["mux"] = dict((j, w.get_info()) for j, w in enumerate(workers))
         return info
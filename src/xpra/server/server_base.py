@@ -38,7 +38,7 @@ from xpra.server.server_core import ServerCore, get_thread_info
 from xpra.server.control_command import ArgsControlCommand, ControlError
 from xpra.simple_stats import to_std_unit
 from xpra.child_reaper import getChildReaper
-from xpra.os_util import BytesIOClass, thread, livefds, load_binary_file, pollwait, monotonic_time, bytestostr, OSX, POSIX, PYTHON3
+from xpra.os_util import BytesIOClass, thread, livefds, pollwait, monotonic_time, bytestostr, OSX, POSIX, PYTHON3
 from xpra.util import typedict, flatten_dict, updict, envbool, envint, log_screen_sizes, engs, repr_ellipsized, csv, iround, \
     SERVER_EXIT, SERVER_ERROR, SERVER_SHUTDOWN, DETACH_REQUEST, NEW_CLIENT, DONE, IDLE_TIMEOUT, SESSION_BUSY
 from xpra.net.bytestreams import set_socket_timeout
@@ -50,6 +50,7 @@ from xpra.scripts.main import sound_option, parse_env
 from xpra.codecs.loader import PREFERED_ENCODING_ORDER, PROBLEMATIC_ENCODINGS, load_codecs, codec_versions, get_codec
 from xpra.codecs.video_helper import getVideoHelper, ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
 from xpra.net.file_transfer import FileTransferAttributes
+from xpra.server import metrics
 if PYTHON3:
     unicode = str           #@ReservedAssignment
 
@@ -60,6 +61,8 @@ MAX_CONCURRENT_CONNECTIONS = 20
 SAVE_PRINT_JOBS = os.environ.get("XPRA_SAVE_PRINT_JOBS", None)
 CLIENT_CAN_SHUTDOWN = envbool("XPRA_CLIENT_CAN_SHUTDOWN", True)
 TERMINATE_DELAY = envint("XPRA_TERMINATE_DELAY", 1000)/1000.0
+#how long to wait before refreshing the iconified and off-screen windows of a new client:
+INITIAL_DEFER_DELAY = envint("XPRA_INITIAL_DEFER_DELAY", 1000)
 
 
 class ServerBase(ServerCore):
@@ -719,6 +722,7 @@ class ServerBase(ServerCore):
             "ping":                                 self._process_ping,
             "ping_echo":                            self._process_ping_echo,
             "set-cursors":                          self._process_set_cursors,
+            "reset-cursor-cache":                   self._process_reset_cursor_cache,
             "set-notify":                           self._process_set_notify,
             "set-bell":                             self._process_set_bell,
             "logging":                              self._process_logging,
@@ -1402,6 +1406,43 @@ class ServerBase(ServerCore):
     def send_initial_cursors(self, ss, sharing=False):
         pass
 
+    def send_initial_damage(self, ss, windows):
+        """
+            Refreshes the windows we have just sent to a new client,
+            'windows' is a list of (wid, window, x, y, w, h).
+            The focused window goes first, then the other visible windows,
+            the iconified and off-screen windows are only refreshed after INITIAL_DEFER_DELAY.
+            The refresh bypasses the batching heuristics (see WindowSource.damage),
+            so the windows are queued for encoding straight away, in this order.
+        """
+        root_w, root_h = self.get_root_window_size()
+        focused = self.get_focus()
+        now, later = [], []
+        for wid, window, x, y, w, h in windows:
+            if w<=0 or h<=0:
+                continue
+            iconic = "iconic" in window.get_property_names() and window.get_property("iconic")
+            offscreen = x+w<=0 or y+h<=0 or x>=root_w or y>=root_h
+            if iconic or offscreen:
+                later.append((wid, window, w, h))
+            elif wid==focused:
+                now.insert(0, (wid, window, w, h))
+            else:
+                now.append((wid, window, w, h))
+        windowlog("send_initial_damage(%s, ..) now=%s, later=%s", ss, [x[0] for x in now], [x[0] for x in later])
+        def damage_all(windows):
+            if ss.is_closed():
+                return False
+            for wid, window, w, h in windows:
+                if self._id_to_window.get(wid)!=window:
+                    #window is gone
+                    continue
+                ss.damage(wid, window, 0, 0, w, h, {"initial" : True, "delay" : 0})
+            return False
+        damage_all(now)
+        if later:
+            self.timeout_add(INITIAL_DEFER_DELAY, damage_all, later)
+
 
     def sanity_checks(self, proto, c):
         server_uuid = c.strget("server_uuid")
@@ -1682,9 +1723,8 @@ class ServerBase(ServerCore):
             filelog("os.stat(%s)", actual_filename, exc_info=True)
         if not os.path.exists(actual_filename):
             raise ControlError("file '%s' does not exist" % filename)
-        data = load_binary_file(actual_filename)
         #verify size:
-        file_size = len(data)
+        file_size = os.path.getsize(actual_filename)
         file_size_MB = file_size//1024//1024
         if file_size_MB>self.file_transfer.file_size_limit:
             raise ControlError("file '%s' is too large: %iMB (limit is %iMB)" % (filename, file_size_MB, self.file_transfer.file_size_limit))
@@ -1698,7 +1738,8 @@ class ServerBase(ServerCore):
                 log.warn("Warning: cannot %s '%s'", command_type, filename)
                 log.warn(" client %s file size limit is %iMB (file is %iMB)", ss, ss.file_size_limit, file_size_MB)
             else:
-                ss.send_file(filename, "", data, file_size, *send_file_args)
+                #the data is read from disk as it is sent:
+                ss.send_file(actual_filename, "", None, file_size, *send_file_args)
         return "%s of '%s' to %s initiated" % (command_type, filename, client_uuids)
 
 
@@ -2182,7 +2223,7 @@ class ServerBase(ServerCore):
         return i
 
     def get_encoding_info(self):
-        return  {
+        info = {
              ""                     : self.encodings,
              "core"                 : self.core_encodings,
              "allowed"              : self.allowed_encodings,
@@ -2192,6 +2233,11 @@ class ServerBase(ServerCore):
              "with_quality"         : [x for x in self.core_encodings if x in ("jpeg", "h264", "vp8", "vp9")],
              "with_lossless_mode"   : self.lossless_mode_encodings,
              }
+        from xpra.codecs.encoding_cache import get_encoding_cache
+        cache = get_encoding_cache()
+        if cache:
+            info["cache"] = cache.get_info()
+        return info
 
     def get_keyboard_info(self):
         start = monotonic_time()
@@ -2296,6 +2342,45 @@ class ServerBase(ServerCore):
         info["clients"] = len(self._server_sources)
         return info
 
+    def update_metrics(self):
+        ServerCore.update_metrics(self)
+        sources = list(self._server_sources.values())
+        metrics.gauge("xpra_clients", "Number of clients connected").set(len(sources))
+        metrics.gauge("xpra_windows", "Number of windows").set(len(self._id_to_window))
+        #per client values, labelled with the client's connection number:
+        client_metrics = (
+            metrics.counter("xpra_client_received_bytes_total", "Bytes received from the client", ("client", )),
+            metrics.counter("xpra_client_sent_bytes_total", "Bytes sent to the client", ("client", )),
+            metrics.counter("xpra_client_received_packets_total", "Packets received from the client", ("client", )),
+            metrics.counter("xpra_client_sent_packets_total", "Packets sent to the client", ("client", )),
+            metrics.gauge("xpra_client_min_latency_seconds", "Lowest latency measured for the client", ("client", )),
+            metrics.gauge("xpra_client_avg_latency_seconds", "Average latency of the client", ("client", )),
+            )
+        window_metrics = (
+            metrics.gauge("xpra_window_batch_delay_seconds", "Damage batching delay", ("client", "wid")),
+            metrics.gauge("xpra_window_quality", "Current encoding quality", ("client", "wid")),
+            metrics.gauge("xpra_window_speed", "Current encoding speed", ("client", "wid")),
+            )
+        #start again so we don't keep the disconnected clients and the closed windows:
+        for m in client_metrics+window_metrics:
+            m.clear()
+        for ss in sources:
+            client = str(ss.counter)
+            proto = ss.protocol
+            conn = proto and proto._conn
+            if conn:
+                values = [conn.input_bytecount, conn.output_bytecount, proto.input_packetcount, proto.output_packetcount]
+            else:
+                values = [0, 0, 0, 0]
+            stats = ss.statistics
+            values += [stats.min_client_latency or 0, stats.avg_client_latency]
+            for m, v in zip(client_metrics, values):
+                m.labels(client).set(v)
+            for wid, ws in list(ss.window_sources.items()):
+                values = [ws.batch_config.delay/1000.0, ws._current_quality, ws._current_speed]
+                for m, v in zip(window_metrics, values):
+                    m.labels(client, str(wid)).set(v)
+
     def get_http_scripts(self):
         scripts = ServerCore.get_http_scripts(self)
         scripts["/audio.mp3"] = self.http_audio_mp3_request
@@ -2683,6 +2768,11 @@ class ServerBase(ServerCore):
         if ss:
             ss.send_cursors = bool(packet[1])
 
+    def _process_reset_cursor_cache(self, proto, packet):
+        ss = self._server_sources.get(proto)
+        if ss:
+            ss.reset_cursor_cache()
+
     def _process_set_bell(self, proto, packet):
         assert self.bell, "cannot toggle send_bell: the feature is disabled"
         ss = self._server_sources.get(proto)
@@ -40,6 +40,7 @@ from xpra.server.background_worker import stop_worker, get_worker
 from xpra.make_thread import start_thread
 from xpra.scripts.fdproxy import XpraProxy
 from xpra.server.control_command import ControlError, HelloCommand, HelpCommand, DebugControl
+from xpra.server import metrics
 from xpra.util import csv, merge_dicts, typedict, notypedict, flatten_dict, parse_simple_dict, repr_ellipsized, dump_all_frames, nonl, envint, envbool, \
         SERVER_SHUTDOWN, SERVER_UPGRADE, LOGIN_TIMEOUT, DONE, PROTOCOL_ERROR, SERVER_ERROR, VERSION_ERROR, CLIENT_REQUEST, SERVER_EXIT
 
@@ -761,10 +762,13 @@ class ServerCore(object):
 
 
     def get_http_scripts(self):
-        return {
+        scripts = {
             "/Status"       : self.http_status_request,
             "/Info"         : self.http_info_request,
             }
+        if metrics.METRICS:
+            scripts["/metrics"] = self.http_metrics_request
+        return scripts
 
     def start_websockify(self, conn, req_info, frominfo):
         wslog("start_websockify(%s, %s, %s) www dir=%s", conn, req_info, frominfo, self._www_dir)
@@ -814,6 +818,16 @@ class ServerCore(object):
             "uuid"              : self.uuid,
             }
 
+    def http_metrics_request(self, handler):
+        self.update_metrics()
+        return self.send_http_response(handler, metrics.registry.generate(), metrics.CONTENT_TYPE)
+
+    def update_metrics(self):
+        """ updates the gauges just before the metrics are exported """
+        metrics.gauge("xpra_server_info", "Server information", ("mode", "version")).labels(self.get_server_mode(), XPRA_VERSION).set(1)
+        metrics.gauge("xpra_uptime_seconds", "Time since the server was started").set(monotonic_time()-self.start_time)
+        metrics.gauge("xpra_connections", "Number of connections, including the ones not authenticated yet").set(len(self._potential_protocols))
+
     def http_status_request(self, handler):
         return self.send_http_response(handler, "ready")
 
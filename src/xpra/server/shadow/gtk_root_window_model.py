@@ -20,6 +20,9 @@ class GTKRootWindowModel(RootWindowModel):
         return "GTKRootWindowModel(%s)" % self.window
 
     def get_image(self, x, y, width, height, logger=None):
+        image = self.get_frame_image(x, y, width, height)
+        if image:
+            return image
         v = get_rgb_rawdata(self.window, x, y, width, height, logger=logger)
         if v is None:
             return None
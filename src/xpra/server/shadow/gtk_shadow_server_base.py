@@ -81,6 +81,7 @@ class GTKShadowServerBase(ShadowServerBase, GTKServerBase):
         mouselog("poll_pointer_position() wid=%i, position=%s", wid, (x, y))
         if self.last_pointer_position!=(x, y):
             self.last_pointer_position = (x, y)
+            self.reset_refresh_delay()
             for ss in self._server_sources.values():
                 ss.update_mouse(wid, x, y, x, y)
         return True
@@ -20,12 +20,13 @@ class RootWindowModel(object):
         self.property_names = ["title", "class-instance", "client-machine", "window-type", "size-hints", "icon", "shadow"]
         self.dynamic_property_names = []
         self.internal_property_names = []
+        self.frame = None
 
     def get_info(self):
         return {}
 
     def cleanup(self):
-        pass
+        self.set_frame(None)
 
     def suspend(self):
         pass
@@ -60,6 +61,34 @@ class RootWindowModel(object):
     def get_image(self, x, y, width, height):
         raise NotImplementedError()
 
+    def set_frame(self, image):
+        """
+            The shadow server gives us the screen capture it used for detecting the changes,
+            the damage it generates is then encoded from this frame rather than from a new capture.
+        """
+        frame = self.frame
+        self.frame = image
+        if frame and frame is not image:
+            frame.free()
+
+    def get_frame_image(self, x, y, width, height):
+        """ returns the area from the last frame, or None if we don't have it """
+        frame = self.frame
+        if not frame:
+            return None
+        fx, fy = frame.get_x(), frame.get_y()
+        if x<fx or y<fy or x+width>fx+frame.get_width() or y+height>fy+frame.get_height():
+            return None
+        if x==fx and y==fy and width==frame.get_width() and height==frame.get_height():
+            #hand it over, the caller will free it:
+            self.frame = None
+            return frame
+        image = frame.get_sub_image(x-fx, y-fy, width, height)
+        #the sub-image must not reference the pixels of the frame,
+        #as those are freed or overwritten by the next capture:
+        image.restride(width*image.get_bytesperpixel())
+        return image
+
     def get_property_names(self):
         return self.property_names
 
@@ -12,9 +12,19 @@ log = Logger("shadow")
 from xpra.net.compression import Compressed
 from xpra.server.window.batch_config import DamageBatchConfig
 from xpra.server.shadow.root_window_model import RootWindowModel
-from xpra.util import envint, DONE
+from xpra.util import envint, envbool, DONE
 
 REFRESH_DELAY = envint("XPRA_SHADOW_REFRESH_DELAY", 50)
+MAX_REFRESH_DELAY = envint("XPRA_SHADOW_MAX_REFRESH_DELAY", 250)
+TILE_DETECTION = envbool("XPRA_SHADOW_TILE_DETECTION", True)
+TILE_SIZE = envint("XPRA_SHADOW_TILE_SIZE", 64)
+
+TileChangeDetector = None
+if TILE_DETECTION:
+    try:
+        from xpra.server.shadow.tile_damage import TileChangeDetector
+    except ImportError as e:
+        log("tile change detection is not available: %s", e)
 
 
 class ShadowServerBase(object):
@@ -26,7 +36,12 @@ class ShadowServerBase(object):
         self.pulseaudio = False
         self.sharing = False
         self.refresh_delay = REFRESH_DELAY
+        self.current_refresh_delay = REFRESH_DELAY
+        self.idle_refreshes = 0
         self.timer = None
+        self.tile_detector = None
+        if TileChangeDetector:
+            self.tile_detector = TileChangeDetector(TILE_SIZE)
         DamageBatchConfig.ALWAYS = True             #always batch
         DamageBatchConfig.MIN_DELAY = 50            #never lower than 50ms
 
@@ -56,9 +71,18 @@ class ShadowServerBase(object):
         return {"shadow" : True}
 
     def get_info(self, proto=None):
+        info = {
+                "refresh-delay" : {
+                                   ""           : self.refresh_delay,
+                                   "current"    : self.current_refresh_delay,
+                                   "max"        : MAX_REFRESH_DELAY,
+                                   },
+                }
+        if self.tile_detector:
+            info["tile-detection"] = self.tile_detector.get_info()
         if self.root_window_model:
-            return {"root-window" : self.root_window_model.get_info()}
-        return {}
+            info["root-window"] = self.root_window_model.get_info()
+        return info
 
 
     def get_window_position(self, window):
@@ -84,7 +108,14 @@ class ShadowServerBase(object):
 
     def start_refresh(self):
         self.mapped = True
-        self.timer = self.timeout_add(self.refresh_delay, self.refresh)
+        self.idle_refreshes = 0
+        if self.tile_detector:
+            self.tile_detector.reset()
+        self.schedule_refresh(self.refresh_delay)
+
+    def schedule_refresh(self, delay):
+        self.current_refresh_delay = delay
+        self.timer = self.timeout_add(delay, self.refresh_timer)
 
     def set_refresh_delay(self, v):
         assert v>0 and v<10000
@@ -95,6 +126,13 @@ class ShadowServerBase(object):
                 self.timer = None
             self.start_refresh()
 
+    def reset_refresh_delay(self):
+        #something is likely to change on screen soon (ie: pointer movement),
+        #so go back to polling at the normal rate:
+        if self.timer and self.current_refresh_delay>self.refresh_delay:
+            self.source_remove(self.timer)
+            self.schedule_refresh(self.refresh_delay)
+
 
     def stop_refresh(self):
         log("stop_refresh() mapped=%s, timer=%s", self.mapped, self.timer)
@@ -102,15 +140,68 @@ class ShadowServerBase(object):
         if self.timer:
             self.source_remove(self.timer)
             self.timer = None
+        if self.root_window_model:
+            self.root_window_model.set_frame(None)
+
+    def refresh_timer(self):
+        if not self.refresh():
+            self.timer = None
+            return False
+        #back off when the screen is idle:
+        td = self.tile_detector
+        if td and td.hashes is not None and self.idle_refreshes>0:
+            delay = min(max(self.refresh_delay, MAX_REFRESH_DELAY), self.current_refresh_delay*2)
+        else:
+            delay = self.refresh_delay
+        if delay==self.current_refresh_delay:
+            return True
+        log("refresh_timer() idle refreshes=%i, new delay=%i", self.idle_refreshes, delay)
+        self.schedule_refresh(delay)
+        return False
 
     def refresh(self):
         if not self.mapped:
             self.timer = None
             return False
         w, h = self.root.get_size()
-        self._damage(self.root_window_model, 0, 0, w, h)
+        rects = self.detect_changes(w, h)
+        if rects:
+            self.idle_refreshes = 0
+            for x, y, rw, rh in rects:
+                self._damage(self.root_window_model, x, y, rw, rh)
+        else:
+            self.idle_refreshes += 1
         return True
 
+    def detect_changes(self, w, h):
+        """
+            Returns the list of areas that have changed since the last refresh,
+            or the whole screen if we can't tell.
+        """
+        td = self.tile_detector
+        if not td:
+            return [(0, 0, w, h)]
+        rwm = self.root_window_model
+        #drop the previous frame so we capture a new one:
+        rwm.set_frame(None)
+        image = rwm.get_image(0, 0, w, h)
+        if not image:
+            td.reset()
+            return [(0, 0, w, h)]
+        try:
+            rects = td.update(image)
+        except Exception as e:
+            log("detect_changes(%i, %i)", w, h, exc_info=True)
+            log.warn("Warning: tile change detection failed:")
+            log.warn(" %s", e)
+            log.warn(" using full screen updates")
+            self.tile_detector = None
+            image.free()
+            return [(0, 0, w, h)]
+        #the damage will be encoded from this frame instead of capturing the screen again:
+        rwm.set_frame(image)
+        return rects
+
     ############################################################################
 
     def sanity_checks(self, proto, c):
@@ -0,0 +1,102 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.log import Logger
+log = Logger("shadow")
+
+from xpra.server.window.tile_hash import hash_tiles     #@UnresolvedImport
+
+
+class TileChangeDetector(object):
+    """
+        Compares the checksums of fixed-size tiles of successive frames
+        and returns the rectangles covering the tiles that have changed.
+    """
+
+    def __init__(self, tile_size=64):
+        assert tile_size>0
+        self.tile_size = tile_size
+        self.frames = 0
+        self.idle_frames = 0
+        self.changed_tiles = 0
+        self.total_tiles = 0
+        self.reset()
+
+    def __repr__(self):
+        return "TileChangeDetector(%i)" % self.tile_size
+
+    def reset(self):
+        self.geometry = None
+        self.hashes = None
+
+    def get_info(self):
+        return {
+                "tile-size"     : self.tile_size,
+                "frames"        : self.frames,
+                "idle-frames"   : self.idle_frames,
+                "changed-tiles" : self.changed_tiles,
+                "total-tiles"   : self.total_tiles,
+                }
+
+    def update(self, image):
+        """
+            Returns the list of rectangles that have changed since the previous frame.
+            The whole image is returned for the first frame,
+            or when the dimensions or pixel format have changed.
+        """
+        x, y = image.get_x(), image.get_y()
+        w, h = image.get_width(), image.get_height()
+        bpp = image.get_bytesperpixel()
+        ts = self.tile_size
+        hashes = hash_tiles(image.get_pixels(), w, h, image.get_rowstride(), bpp, ts)
+        geometry = (x, y, w, h, bpp, image.get_pixel_format())
+        old_hashes = self.hashes
+        self.hashes = hashes
+        self.frames += 1
+        self.total_tiles += len(hashes)
+        if geometry!=self.geometry or old_hashes is None:
+            self.geometry = geometry
+            self.changed_tiles += len(hashes)
+            return [(x, y, w, h)]
+        cols = (w+ts-1)//ts
+        rows = (h+ts-1)//ts
+        #find the runs of changed tiles on each row of tiles,
+        #and merge them with the previous row when they span the same columns:
+        rects = []
+        pending = {}
+        for row in range(rows):
+            runs = []
+            col = 0
+            row_hashes = hashes[row*cols:(row+1)*cols]
+            old_row_hashes = old_hashes[row*cols:(row+1)*cols]
+            while col<cols:
+                if row_hashes[col]==old_row_hashes[col]:
+                    col += 1
+                    continue
+                start = col
+                while col<cols and row_hashes[col]!=old_row_hashes[col]:
+                    col += 1
+                runs.append((start, col))
+            merged = {}
+            for run in runs:
+                self.changed_tiles += run[1]-run[0]
+                r = pending.pop(run, None)
+                if r:
+                    r[3] += 1
+                else:
+                    r = [run[0], row, run[1]-run[0], 1]
+                merged[run] = r
+            rects += pending.values()
+            pending = merged
+        rects += pending.values()
+        if not rects:
+            self.idle_frames += 1
+            return []
+        changes = []
+        for col, row, ncols, nrows in sorted(rects, key=lambda r : (r[1], r[0])):
+            rx, ry = col*ts, row*ts
+            changes.append((x+rx, y+ry, min(ncols*ts, w-rx), min(nrows*ts, h-ry)))
+        log("update(%s) changes=%s", image, changes)
+        return changes
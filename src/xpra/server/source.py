@@ -7,8 +7,10 @@
 # later version. See the file COPYING for details.
 
 import os
+import struct
+import hashlib
 from collections import deque
-from threading import Event
+from threading import Event, Lock
 from math import sqrt
 from time import sleep
 
@@ -41,10 +43,12 @@ from xpra.codecs.video_helper import getVideoHelper
 from xpra.codecs.codec_constants import video_spec
 from xpra.net import compression
 from xpra.net.compression import compressed_wrapper, Compressed, Compressible
+from xpra.codecs.tile_cache import TileCache
+from xpra.server import metrics
 from xpra.net.file_transfer import FileTransferHandler
-from xpra.make_thread import start_thread
-from xpra.os_util import platform_name, Queue, get_machine_id, get_user_uuid, monotonic_time, BytesIOClass, WIN32
+from xpra.os_util import platform_name, get_machine_id, get_user_uuid, monotonic_time, BytesIOClass, WIN32, memoryview_to_bytes
 from xpra.server.background_worker import add_work_item
+from xpra.server.encode_pool import get_encode_pool
 from xpra.util import csv, std, typedict, updict, flatten_dict, notypedict, get_screen_info, envint, envbool, AtomicInteger, \
                     CLIENT_PING_TIMEOUT, WORKSPACE_UNSET, DEFAULT_METADATA_SUPPORTED
 def no_legacy_names(v):
@@ -55,7 +59,6 @@ except:
     LEGACY_CODEC_NAMES, NEW_CODEC_NAMES = {}, {}
     new_to_legacy = no_legacy_names
 
-NOYIELD = not envbool("XPRA_YIELD", False)
 MAX_CLIPBOARD_LIMIT = envint("XPRA_CLIPBOARD_LIMIT", 30)
 MAX_CLIPBOARD_LIMIT_DURATION = envint("XPRA_CLIPBOARD_LIMIT_DURATION", 3)
 ADD_LOCAL_PRINTERS = envbool("XPRA_ADD_LOCAL_PRINTERS", False)
@@ -66,9 +69,19 @@ PRINTER_LOCATION_STRING = os.environ.get("XPRA_PRINTER_LOCATION_STRING", "via xp
 PROPERTIES_DEBUG = [x.strip() for x in os.environ.get("XPRA_WINDOW_PROPERTIES_DEBUG", "").split(",")]
 
 MIN_PIXEL_RECALCULATE = envint("XPRA_MIN_PIXEL_RECALCULATE", 2000)
+CURSOR_CACHE_SIZE = envint("XPRA_CURSOR_CACHE_SIZE", 64)
+MMAP_RING = envbool("XPRA_MMAP_RING", True)
 
 counter = AtomicInteger()
 
+CLIENT_DECODE_TIME = metrics.histogram("xpra_client_decode_seconds", "Time the clients spent decoding screen updates")
+
+#the png cursors we have already encoded, shared by all the clients:
+encoded_cursors = TileCache(CURSOR_CACHE_SIZE)
+
+def get_cursor_key(w, h, pixels):
+    return hashlib.sha1(struct.pack("@II", w, h)+memoryview_to_bytes(pixels)).hexdigest()[:16]
+
 
 def make_window_metadata(window, propname, get_transient_for=None, get_window_id=None):
     def raw():
@@ -219,8 +232,8 @@ class ServerSource(FileTransferHandler):
     See 'next_packet'.
 
     The UI thread calls damage(), which goes into WindowSource and eventually (batching may be involved)
-    adds the damage pixels ready for processing to the encode_work_queue,
-    items are picked off by the separate 'encode' thread (see 'encode_loop')
+    adds the damage pixels ready for processing to the encode_pool,
+    items are picked off by the separate 'encode' threads (see 'EncodeWorker')
     and added to the damage_packet_queue.
     """
 
@@ -291,6 +304,9 @@ class ServerSource(FileTransferHandler):
         self.mmap_filename = mmap_filename
         self.mmap = None
         self.mmap_size = 0
+        self.mmap_ring = None
+        #serializes the writes to the mmap area when not using the ring buffer:
+        self.mmap_lock = Lock()
         self.mmap_client_token = None                   #the token we write that the client may check
         self.mmap_client_token_index = 512
         self.mmap_client_token_bytes = 0
@@ -332,9 +348,13 @@ class ServerSource(FileTransferHandler):
         self.connection_time = monotonic_time()
 
         # the queues of damage requests we work through:
-        self.encode_work_queue = Queue()            #holds functions to call to compress data (pixels, clipboard)
-                                                    #items placed in this queue are picked off by the "encode" thread,
+        self.encode_pool, self.encode_pool_shared = get_encode_pool()
+                                                    #holds functions to call to compress data (pixels, clipboard)
+                                                    #items placed in this pool are picked off by the "encode" threads,
+                                                    #(all the items for the same window are processed by the same thread)
                                                     #the functions should add the packets they generate to the 'packet_queue'
+        #for the work which is not specific to a window:
+        self.encode_pool.assign(self.encode_key(0))
         self.packet_queue = deque()                 #holds actual packets ready for sending (already encoded)
                                                     #these packets are picked off by the "protocol" via 'next_packet()'
                                                     #format: packet, wid, pixels, start_send_cb, end_send_cb
@@ -354,7 +374,6 @@ class ServerSource(FileTransferHandler):
 
         # ready for processing:
         protocol.set_packet_source(self.next_packet)
-        self.encode_thread = start_thread(self.encode_loop, "encode")
         #dbus:
         if self.dbus_control:
             from xpra.server.dbus.dbus_common import dbus_exception_wrap
@@ -404,6 +423,7 @@ class ServerSource(FileTransferHandler):
         self.info_namespace = False
         self.send_cursors = False
         self.cursor_encodings = []
+        self.cursor_cache = None
         self.send_bell = False
         self.send_notifications = False
         self.send_windows = True
@@ -466,18 +486,25 @@ class ServerSource(FileTransferHandler):
         log("%s.close()", self)
         FileTransferHandler.cleanup(self)
         self.close_event.set()
+        wids = list(self.window_sources.keys())
         for window_source in self.window_sources.values():
             window_source.cleanup()
         self.window_sources = {}
         #it is now safe to add the end of queue marker:
         #(all window sources will have stopped queuing data)
-        self.encode_work_queue.put(None)
+        if self.encode_pool_shared:
+            #other clients are still using the pool:
+            for wid in wids+[0]:
+                self.encode_pool.release(self.encode_key(wid))
+        else:
+            self.encode_pool.stop()
         #this should be a noop since we inherit an initialized helper:
         self.video_helper.cleanup()
         mmap = self.mmap
         if mmap:
             self.mmap = None
             self.mmap_size = 0
+            self.mmap_ring = None
             mmap.close()
         self.stop_sending_sound()
         self.stop_receiving_sound()
@@ -724,6 +751,10 @@ class ServerSource(FileTransferHandler):
         self.info_namespace = c.boolget("info-namespace")
         self.send_cursors = self.send_windows and c.boolget("cursors")
         self.cursor_encodings = c.strlistget("encodings.cursor")
+        cursor_cache_size = min(CURSOR_CACHE_SIZE, c.intget("cursor.cache", 0))
+        if cursor_cache_size>0:
+            #mirrors the client's cache, see TileCache:
+            self.cursor_cache = TileCache(cursor_cache_size)
         self.send_bell = c.boolget("bell")
         self.send_notifications = c.boolget("notifications")
         self.randr_notify = c.boolget("randr_notify")
@@ -872,7 +903,7 @@ class ServerSource(FileTransferHandler):
                 stripped_k = k[len("encoding."):]
                 if stripped_k in ("transparency",
                                   "rgb_zlib", "rgb_lz4", "rgb_lzo",
-                                  "video_scaling"):
+                                  "video_scaling", "video_stripes"):
                     v = c.boolget(k)
                 elif stripped_k in ("initial_quality", "initial_speed",
                                     "min-quality", "quality",
@@ -956,9 +987,16 @@ class ServerSource(FileTransferHandler):
                             #use the expected default for older versions:
                             self.mmap_client_token_index = DEFAULT_TOKEN_INDEX
                         write_mmap_token(self.mmap, self.mmap_client_token, self.mmap_client_token_index, self.mmap_client_token_bytes)
+                        if MMAP_RING and c.boolget("mmap.ring"):
+                            from xpra.net.mmap_pipe import MmapRing
+                            #the client has written its token at the end of the area,
+                            #and so have we: keep it out of the ring buffer
+                            self.mmap_ring = MmapRing(self.mmap, self.mmap_client_token_index)
 
         if self.mmap_size>0:
             mmaplog.info(" mmap is enabled using %sB area in %s", std_unit(self.mmap_size, unit=1024), mmap_filename)
+            if self.mmap_ring:
+                mmaplog.info(" using a ring buffer")
         else:
             others = [x for x in self.core_encodings if x in self.server_core_encodings and x!=self.encoding]
             if self.encoding=="auto":
@@ -1465,6 +1503,7 @@ class ServerSource(FileTransferHandler):
         if self.wants_features:
             capabilities.update({
                          "mmap_enabled"         : self.mmap_size>0,
+                         "mmap.ring"            : self.mmap_ring is not None,
                          "auto_refresh_delay"   : self.auto_refresh_delay,
                          })
         if self.mmap_client_token:
@@ -1544,6 +1583,8 @@ class ServerSource(FileTransferHandler):
         einfo.update(self.default_encoding_options)
         einfo.update(self.encoding_options)
         info.setdefault("encoding", {}).update(einfo)
+        if self.cursor_cache is not None:
+            info["cursor-cache"] = self.cursor_cache.get_info()
         if self.window_frame_sizes:
             info.setdefault("window", {}).update({"frame-sizes" : self.window_frame_sizes})
         if self.window_filters:
@@ -1562,6 +1603,8 @@ class ServerSource(FileTransferHandler):
             "size"          : self.mmap_size,
             "filename"      : self.mmap_filename or "",
             }
+        if self.mmap_ring:
+            info["mmap"]["ring"] = self.mmap_ring.get_info()
         info.update(self.get_features_info())
         info.update(self.get_screen_info())
         return info
@@ -1628,11 +1671,12 @@ class ServerSource(FileTransferHandler):
         if len(pqpixels)>0:
             pqpi["current"] = pqpixels[-1]
         info = {"damage"    : {
-                               "compression_queue"      : {"size" : {"current" : self.encode_work_queue.qsize()}},
+                               "compression_queue"      : {"size" : {"current" : self.encode_pool.qsize()}},
                                "packet_queue"           : {"size" : {"current" : len(self.packet_queue)}},
                                "packet_queue_pixels"    : pqpi,
                                },
                 "batch"     : self.global_batch_config.get_info(),
+                "encode"    : self.get_encode_pool_info(),
                 }
         info.update(self.statistics.get_info())
 
@@ -1717,7 +1761,7 @@ class ServerSource(FileTransferHandler):
                     self.send_clipboard_enabled(msg)
                 return
         #call compress_clibboard via the work queue:
-        self.encode_work_queue.put((True, self.compress_clipboard, packet))
+        self.call_in_encode_thread(True, self.compress_clipboard, packet)
 
     def compress_clipboard(self, packet):
         #Note: this runs in the 'encode' thread!
@@ -1738,6 +1782,16 @@ class ServerSource(FileTransferHandler):
             self.send("pointer-ungrab", wid)
 
 
+    def mmap_write_data(self, data):
+        #bulk data can use the mmap ring buffer too:
+        if not self.mmap_ring:
+            return None
+        mmap_data, mmap_free_size = self.mmap_ring.write(data)
+        if mmap_data:
+            self.statistics.mmap_bytes_sent += len(data)
+            self.statistics.mmap_free_size = mmap_free_size
+        return mmap_data
+
     def compressed_wrapper(self, datatype, data, min_saving=128):
         if self.zlib or self.lz4 or self.lzo:
             cw = compressed_wrapper(datatype, data, zlib=self.zlib, lz4=self.lz4, lzo=self.lzo, can_inline=False)
@@ -1748,6 +1802,15 @@ class ServerSource(FileTransferHandler):
         #we can't compress, so at least avoid warnings in the protocol layer:
         return Compressed(datatype, data, can_inline=True)
 
+    def reset_cursor_cache(self):
+        """ the client is missing a cursor from its cache and has cleared it """
+        cursorlog("reset_cursor_cache() cursor_cache=%s", self.cursor_cache)
+        if self.cursor_cache is not None:
+            self.cursor_cache.clear()
+        #send the current cursor again, with its pixels:
+        self.last_cursor_sent = None
+        self.send_cursor()
+
     def send_cursor(self):
         if not self.send_cursors or self.suspended or not self.hello_sent:
             return
@@ -1764,18 +1827,24 @@ class ServerSource(FileTransferHandler):
                 w, h, _xhot, _yhot, serial, pixels, name = cursor_data[2:9]
                 #compress pixels if needed:
                 encoding = None
+                cache_key = None
                 if pixels is not None:
                     #convert bytearray to string:
-                    cpixels = str(pixels)
+                    cpixels = memoryview_to_bytes(pixels)
+                    key = get_cursor_key(w, h, cpixels)
+                    cc = self.cursor_cache
+                    if cc is not None and len(cursor_sizes)==2:
+                        if key in cc:
+                            #the client already has it, just send the key:
+                            cc.get(key)
+                            cursorlog("do_send_cursor(..) %sx%s cursor name=%s, serial=%i found in cache", w, h, name, serial)
+                            args = ["cache"] + list(cursor_data[:7]) + [key, name] + list(cursor_sizes)
+                            self.send("cursor", *args)
+                            return
+                        cc.add(key)
+                        cache_key = key
                     if "png" in self.cursor_encodings:
-                        from xpra.codecs.loader import get_codec
-                        PIL = get_codec("PIL")
-                        assert PIL
-                        img = PIL.Image.frombytes("RGBA", (w, h), cpixels, "raw", "BGRA", w*4, 1)
-                        buf = BytesIOClass()
-                        img.save(buf, "PNG")
-                        cpixels = Compressed("png cursor", buf.getvalue(), can_inline=True)
-                        buf.close()
+                        cpixels = self.get_png_cursor(key, w, h, cpixels)
                         encoding = "png"
                     elif len(cpixels)>=256 and ("raw" in self.cursor_encodings or not self.cursor_encodings):
                         cpixels = self.compressed_wrapper("cursor", pixels)
@@ -1786,6 +1855,9 @@ class ServerSource(FileTransferHandler):
                 args = list(cursor_data[:9]) + list(cursor_sizes)
                 if self.cursor_encodings and encoding:
                     args = [encoding] + args
+                if cache_key:
+                    #tell the client to store it in its cache:
+                    args.append(cache_key)
             else:
                 cursorlog("do_send_cursor(..) sending empty cursor with delay=%s", delay)
                 args = [""]
@@ -1798,6 +1870,23 @@ class ServerSource(FileTransferHandler):
             self.timeout_add(delay, do_send_cursor)
 
 
+    def get_png_cursor(self, key, w, h, pixels):
+        try:
+            return encoded_cursors.get(key)
+        except KeyError:
+            pass
+        from xpra.codecs.loader import get_codec
+        PIL = get_codec("PIL")
+        assert PIL
+        img = PIL.Image.frombytes("RGBA", (w, h), pixels, "raw", "BGRA", w*4, 1)
+        buf = BytesIOClass()
+        img.save(buf, "PNG")
+        cpixels = Compressed("png cursor", buf.getvalue(), can_inline=True)
+        buf.close()
+        encoded_cursors.add(key, cpixels)
+        return cpixels
+
+
     def bell(self, wid, device, percent, pitch, duration, bell_class, bell_id, bell_name):
         if not self.send_bell or self.suspended or not self.hello_sent:
             return
@@ -2143,6 +2232,7 @@ class ServerSource(FileTransferHandler):
         if ws:
             del self.window_sources[wid]
             ws.cleanup()
+            self.encode_pool.release(self.encode_key(wid))
         try:
             del self.calculate_window_pixels[wid]
         except:
@@ -2212,7 +2302,13 @@ class ServerSource(FileTransferHandler):
         ws = self.window_sources.get(wid)
         if ws is None:
             batch_config = self.make_batch_config(wid, window)
-            ws = WindowVideoSource(self.queue_size, self.call_in_encode_thread, self.queue_packet, self.compressed_wrapper,
+            key = self.encode_key(wid)
+            self.encode_pool.assign(key)
+            def queue_size():
+                return self.encode_pool.qsize(key)
+            def call_in_encode_thread(*fn_and_args):
+                self.queue_encode(key, fn_and_args)
+            ws = WindowVideoSource(queue_size, call_in_encode_thread, self.queue_packet, self.compressed_wrapper,
                               self.statistics,
                               wid, window, batch_config, self.auto_refresh_delay,
                               self.av_sync, self.av_sync_delay,
@@ -2221,7 +2317,7 @@ class ServerSource(FileTransferHandler):
                               self.encoding, self.encodings, self.core_encodings, self.window_icon_encodings, self.encoding_options, self.icons_encoding_options,
                               self.rgb_formats,
                               self.default_encoding_options,
-                              self.mmap, self.mmap_size)
+                              self.mmap, self.mmap_size, self.mmap_ring, self.mmap_lock)
             self.window_sources[wid] = ws
         return ws
 
@@ -2253,6 +2349,7 @@ class ServerSource(FileTransferHandler):
             return
         if decode_time>0:
             self.statistics.client_decode_time.append((wid, monotonic_time(), width*height, decode_time))
+            CLIENT_DECODE_TIME.observe(decode_time/1000.0/1000.0)
         ws = self.window_sources.get(wid)
         if ws:
             ws.damage_packet_acked(damage_packet_sequence, width, height, decode_time, message)
@@ -2261,16 +2358,32 @@ class ServerSource(FileTransferHandler):
 #
 # Methods used by WindowSource:
 #
+    def encode_key(self, wid):
+        #the shared pool is used by all the clients,
+        #so the key must also identify this source:
+        return (self.counter, wid)
+
+    def get_encode_pool_info(self):
+        info = self.encode_pool.get_info()
+        info["shared"] = self.encode_pool_shared
+        return info
+
     def queue_size(self):
-        return self.encode_work_queue.qsize()
+        return self.encode_pool.qsize()
 
     def call_in_encode_thread(self, *fn_and_args):
         """
-            This is used by WindowSource to queue damage processing to be done in the 'encode' thread.
+            This is used to queue work which is not specific to a window (ie: clipboard compression)
+        """
+        self.queue_encode(self.encode_key(0), fn_and_args)
+
+    def queue_encode(self, key, fn_and_args):
+        """
+            This is used by WindowSource to queue damage processing to be done in the 'encode' threads.
             The 'encode_and_send_cb' will then add the resulting packet to the 'packet_queue' via 'queue_packet'.
         """
-        self.statistics.compression_work_qsizes.append((monotonic_time(), self.encode_work_queue.qsize()))
-        self.encode_work_queue.put(fn_and_args)
+        self.statistics.compression_work_qsizes.append((monotonic_time(), self.encode_pool.qsize(key)))
+        self.encode_pool.queue(key, self.is_closed, fn_and_args)
 
     def queue_packet(self, packet, wid=0, pixels=0, start_send_cb=None, end_send_cb=None):
         """
@@ -2286,31 +2399,3 @@ class ServerSource(FileTransferHandler):
         if p:
             p.source_has_more()
 
-#
-# The damage packet thread loop:
-#
-    def encode_loop(self):
-        """
-            This runs in a separate thread and calls all the function callbacks
-            which are added to the 'encode_work_queue'.
-            Must run until we hit the end of queue marker,
-            to ensure all the queued items get called.
-        """
-        while True:
-            fn_and_args = self.encode_work_queue.get(True)
-            if fn_and_args is None:
-                return              #empty marker
-            #some function calls are optional and can be skipped when closing:
-            #(but some are not, like encoder clean functions)
-            optional_when_closing = fn_and_args[0]
-            if optional_when_closing and self.is_closed():
-                continue
-            try:
-                fn_and_args[1](*fn_and_args[2:])
-            except Exception as e:
-                if self.is_closed():
-                    log("ignoring encoding error in %s as source is already closed:", fn_and_args[0])
-                    log(" %s", e)
-                else:
-                    log.error("Error during encoding:", exc_info=True)
-            NOYIELD or sleep(0)
@@ -12,12 +12,15 @@ from collections import deque
 from xpra.log import Logger
 log = Logger("stats")
 
-from xpra.server.cystats import logp, calculate_time_weighted_average, calculate_for_target, queue_inspect  #@UnresolvedImport
+from xpra.server.cystats import logp, calculate_time_weighted_average, calculate_for_target, queue_inspect, TimeSeries  #@UnresolvedImport
 from xpra.simple_stats import get_list_stats
 from xpra.os_util import monotonic_time
+from xpra.server import metrics
 
 NRECS = 500
 
+CLIENT_LATENCY = metrics.histogram("xpra_client_latency_seconds", "Time for screen updates to reach the client, excluding decoding")
+
 
 class GlobalPerformanceStatistics(object):
     """
@@ -35,9 +38,9 @@ class GlobalPerformanceStatistics(object):
         self.mmap_bytes_sent = 0
         self.mmap_free_size = 0                             #how much of the mmap space is left (may be negative if we failed to write the last chunk)
         # queue statistics:
-        self.compression_work_qsizes = deque(maxlen=NRECS)  #size of the compression_work_queue before we add a new record to it
+        self.compression_work_qsizes = TimeSeries(NRECS)    #size of the compression_work_queue before we add a new record to it
                                                             #(event_time, size)
-        self.packet_qsizes = deque(maxlen=NRECS)            #size of the packet_queue before we add a new packet to it
+        self.packet_qsizes = TimeSeries(NRECS)              #size of the packet_queue before we add a new packet to it
                                                             #(event_time, size)
         self.damage_packet_qpixels = deque(maxlen=NRECS)    #number of pixels waiting in the packet_queue for a specific window,
                                                             #before we add a new packet to it
@@ -48,9 +51,9 @@ class GlobalPerformanceStatistics(object):
                                                             #(wid, event_time, no of pixels, decoding_time*1000*1000)
         self.client_latency = deque(maxlen=NRECS)           #how long it took for a packet to get to the client and get the echo back.
                                                             #(wid, event_time, no of pixels, client_latency)
-        self.client_ping_latency = deque(maxlen=NRECS)      #time it took to get a ping_echo back from the client:
+        self.client_ping_latency = TimeSeries(NRECS)        #time it took to get a ping_echo back from the client:
                                                             #(event_time, elapsed_time_in_seconds)
-        self.server_ping_latency = deque(maxlen=NRECS)      #time it took for the client to get a ping_echo back from us:
+        self.server_ping_latency = TimeSeries(NRECS)        #time it took for the client to get a ping_echo back from us:
                                                             #(event_time, elapsed_time_in_seconds)
         self.client_load = None
         self.damage_events_count = 0
@@ -78,6 +81,7 @@ class GlobalPerformanceStatistics(object):
         if self.min_client_latency is None or self.min_client_latency>send_latency:
             self.min_client_latency = send_latency
         self.client_latency.append((wid, monotonic_time(), pixels, send_latency))
+        CLIENT_LATENCY.observe(send_latency)
 
     def get_damage_pixels(self, wid):
         """ returns the list of (event_time, pixelcount) for the given window id """
@@ -90,14 +94,12 @@ class GlobalPerformanceStatistics(object):
             self.avg_client_latency, self.recent_client_latency = calculate_time_weighted_average(data)
         #client ping latency: from ping packets
         if len(self.client_ping_latency)>0:
-            data = list(self.client_ping_latency)
-            self.min_client_ping_latency = min([x for _,x in data])
-            self.avg_client_ping_latency, self.recent_client_ping_latency = calculate_time_weighted_average(data)
+            self.min_client_ping_latency = self.client_ping_latency.get_min()
+            self.avg_client_ping_latency, self.recent_client_ping_latency = self.client_ping_latency.time_weighted_average()
         #server ping latency: from ping packets
         if len(self.server_ping_latency)>0:
-            data = list(self.server_ping_latency)
-            self.min_server_ping_latency = min([x for _,x in data])
-            self.avg_server_ping_latency, self.recent_server_ping_latency = calculate_time_weighted_average(data)
+            self.min_server_ping_latency = self.server_ping_latency.get_min()
+            self.avg_server_ping_latency, self.recent_server_ping_latency = self.server_ping_latency.time_weighted_average()
 
     def get_factors(self, target_latency, pixel_count):
         factors = []
@@ -139,10 +141,10 @@ class GlobalPerformanceStatistics(object):
                                        },
                 "latency"           : get_list_stats(latencies),
                 "server"            : {
-                                       "ping_latency"   : get_list_stats(1000.0*x for _, x in list(self.server_ping_latency)),
+                                       "ping_latency"   : self.server_ping_latency.get_list_stats(1000),
                                        },
                 "client"            : {
-                                       "ping_latency"   : get_list_stats(1000.0*x for _, x in list(self.client_ping_latency)),
+                                       "ping_latency"   : self.client_ping_latency.get_list_stats(1000),
                                        },
                 }
         if self.min_client_latency is not None:
@@ -151,16 +153,14 @@ class GlobalPerformanceStatistics(object):
 
 
     def get_info(self):
-        cwqsizes = [x for _,x in list(self.compression_work_qsizes)]
-        pqsizes = [x for _,x in list(self.packet_qsizes)]
         info = {"damage" : {
                             "events"        : self.damage_events_count,
                             "packets_sent"  : self.packet_count,
                             "data_queue"    : {
-                                               "size"   : get_list_stats(cwqsizes),
+                                               "size"   : self.compression_work_qsizes.get_list_stats(),
                                                },
                             "packet_queue"  : {
-                                               "size"   : get_list_stats(pqsizes),
+                                               "size"   : self.packet_qsizes.get_list_stats(),
                                                },
                             },
                 "encoding" : {"decode_errors"   : self.decode_errors},
@@ -0,0 +1,456 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Replays a damage trace recorded with XPRA_DAMAGE_TRACE
+# through WindowVideoSource (or WindowSource) without an X11 server
+# and reports the encoding statistics.
+# ie:
+# python ./xpra/server/window/damage_replay.py --latency=50 --bandwidth=10 ~/damage-1234-1.trace
+
+import sys
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("window", "damage")
+
+from xpra.util import typedict, csv
+from xpra.os_util import monotonic_time, bytestostr
+from xpra.simple_stats import std_unit
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.net import compression
+from xpra.server.window.damage_trace import read_damage_trace
+
+#we pretend the client can decode all of these:
+CLIENT_CSC_MODES = ["YUV420P", "YUV422P", "YUV444P", "BGRX", "XRGB", "GBRP"]
+
+
+class ReplayWindow(object):
+    """
+        A window model which paints the pixels found in the damage trace,
+        or a generated pattern if the trace does not include pixels.
+    """
+
+    def __init__(self, properties):
+        self.properties = {}
+        for k,v in properties.items():
+            if isinstance(v, (list, tuple)):
+                v = [bytestostr(x) for x in v]
+            else:
+                v = bytestostr(v)
+            self.properties[bytestostr(k)] = v
+        self.width = 0
+        self.height = 0
+        self.rowstride = 0
+        self.framebuffer = bytearray()
+        self.pixel_format = "BGRX"
+        self.frame = 0
+
+    def __repr__(self):
+        return "ReplayWindow(%ix%i)" % (self.width, self.height)
+
+    def is_managed(self):
+        return True
+
+    def is_tray(self):
+        return False
+
+    def is_OR(self):
+        return False
+
+    def is_shadow(self):
+        return False
+
+    def has_alpha(self):
+        return False
+
+    def uses_XShm(self):
+        return False
+
+    def get_default_window_icon(self):
+        return None
+
+    def acknowledge_changes(self):
+        pass
+
+    def get_property_names(self):
+        return list(self.properties.keys())
+
+    def get_dynamic_property_names(self):
+        return []
+
+    def get_internal_property_names(self):
+        return []
+
+    def get_property(self, prop):
+        return self.properties.get(prop)
+
+    def get(self, name, default_value=None):
+        return self.properties.get(name, default_value)
+
+    def connect(self, *args):
+        return 0
+
+    def managed_connect(self, *args):
+        return 0
+
+    def disconnect(self, *args):
+        pass
+
+
+    def get_dimensions(self):
+        return self.width, self.height
+
+    def resize(self, w, h):
+        old, old_rowstride, old_height = self.framebuffer, self.rowstride, self.height
+        self.width, self.height = w, h
+        self.rowstride = w*4
+        self.framebuffer = bytearray(self.rowstride*h)
+        l = min(old_rowstride, self.rowstride)
+        for y in range(min(old_height, h)):
+            self.framebuffer[y*self.rowstride:y*self.rowstride+l] = old[y*old_rowstride:y*old_rowstride+l]
+
+    def clip(self, x, y, w, h):
+        x = max(0, min(x, self.width))
+        y = max(0, min(y, self.height))
+        return x, y, max(0, min(w, self.width-x)), max(0, min(h, self.height-y))
+
+    def paint(self, x, y, w, h, pixel_format, depth, rowstride, bpp, pixels):
+        """ copy the pixels recorded into the framebuffer """
+        if bpp!=4:
+            log("ignoring %s pixels with %i bytes per pixel", pixel_format, bpp)
+            return
+        self.pixel_format = pixel_format
+        cx, cy, cw, ch = self.clip(x, y, w, h)
+        l = cw*4
+        for i in range(ch):
+            src = (cy-y+i)*rowstride + (cx-x)*4
+            dst = (cy+i)*self.rowstride + cx*4
+            self.framebuffer[dst:dst+l] = pixels[src:src+l]
+
+    def fill(self, x, y, w, h):
+        """ generate some new contents for this area """
+        self.frame += 1
+        x, y, w, h = self.clip(x, y, w, h)
+        l = w*4
+        pattern = bytearray((self.frame+i*7) & 0xff for i in range(l+256))
+        for i in range(h):
+            offset = (y+i) & 0xff
+            dst = (y+i)*self.rowstride + x*4
+            self.framebuffer[dst:dst+l] = pattern[offset:offset+l]
+
+    def get_image(self, x, y, w, h, logger=None):
+        x, y, w, h = self.clip(x, y, w, h)
+        if w==0 or h==0:
+            return None
+        l = w*4
+        pixels = bytearray(l*h)
+        for i in range(h):
+            src = (y+i)*self.rowstride + x*4
+            pixels[i*l:(i+1)*l] = self.framebuffer[src:src+l]
+        return ImageWrapper(x, y, w, h, bytes(pixels), self.pixel_format, 24, l, 4)
+
+
+class ReplayStatistics(object):
+    """
+        Plays the part of the client connection:
+        receives the draw packets, simulates the network link
+        and sends back the damage acks.
+    """
+
+    def __init__(self, timeout_add, latency=20, bandwidth=0, decode_speed=100):
+        self.timeout_add = timeout_add
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.decode_speed = decode_speed
+        self.lock = Lock()
+        self.window_source = None
+        self.closed = False
+        self.link_free_at = 0
+        self.bytes_sent = 0
+        self.pending = {}
+        self.damage_events = 0
+        self.packets = 0
+        self.pixels = 0
+        self.encodings = {}
+        self.encode_times = []
+        self.damage_latency = []
+        self.batch_delays = []
+        self.client_latency = []
+        self.batch_delay_samples = []
+
+    def is_closed(self):
+        return self.closed
+
+    def timed_call(self, fn, *args):
+        start = monotonic_time()
+        try:
+            fn(*args)
+        finally:
+            self.encode_times.append(1000.0*(monotonic_time()-start))
+
+    def record_damage_packet(self, sequence, damage_time, process_damage_time):
+        now = monotonic_time()
+        self.pending[sequence] = damage_time
+        if damage_time>0:
+            self.damage_latency.append(1000.0*(now-damage_time))
+            self.batch_delays.append(1000.0*(process_damage_time-damage_time))
+
+    def queue_packet(self, packet, wid=0, pixels=0, start_send_cb=None, end_send_cb=None):
+        #this runs in the encode thread
+        if packet[0]!="draw":
+            return
+        w, h, coding, data, sequence = packet[4:9]
+        size = len(data)
+        now = monotonic_time()
+        with self.lock:
+            self.packets += 1
+            self.pixels += w*h
+            totals = self.encodings.setdefault(bytestostr(coding), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += w*h
+            totals[2] += size
+            start_bytes = self.bytes_sent
+            self.bytes_sent += size
+            end_bytes = self.bytes_sent
+            #simulate the time it takes to send the packet:
+            send_start = max(now, self.link_free_at)
+            send_end = send_start
+            if self.bandwidth>0:
+                send_end += size*8.0/(self.bandwidth*1000*1000)
+            self.link_free_at = send_end
+        if start_send_cb:
+            start_send_cb(start_bytes)
+        def packet_sent():
+            if end_send_cb:
+                end_send_cb(end_bytes)
+            self.timeout_add(self.latency, self.ack, sequence, w, h)
+        self.timeout_add(int(1000*(send_end-now)), packet_sent)
+
+    def ack(self, sequence, w, h):
+        damage_time = self.pending.pop(sequence, 0)
+        if damage_time>0:
+            self.client_latency.append(1000.0*(monotonic_time()-damage_time))
+        decode_time = w*h//max(1, self.decode_speed)
+        ws = self.window_source
+        if ws:
+            ws.damage_packet_acked(sequence, w, h, decode_time, "")
+        return False
+
+
+class ReplayMixin(object):
+    """ records the damage latency of each draw packet """
+
+    replay_statistics = None
+
+    def queue_damage_packet(self, packet, damage_time=0, process_damage_time=0):
+        rs = self.replay_statistics
+        if rs:
+            rs.record_damage_packet(packet[8], damage_time, process_damage_time)
+        super(ReplayMixin, self).queue_damage_packet(packet, damage_time, process_damage_time)
+
+
+def format_stats(values, unit="ms"):
+    if not values:
+        return "none"
+    svalues = sorted(values)
+    def pct(p):
+        return svalues[min(len(svalues)-1, len(svalues)*p//100)]
+    return "min=%.1f%s, avg=%.1f%s, 50p=%.1f%s, 90p=%.1f%s, 99p=%.1f%s, max=%.1f%s" % (
+        svalues[0], unit, sum(svalues)/len(svalues), unit, pct(50), unit, pct(90), unit, pct(99), unit, svalues[-1], unit)
+
+
+def replay(filename, options):
+    from xpra.gtk_common.gobject_compat import import_glib
+    from xpra.codecs.loader import load_codecs, get_codec, PREFERED_ENCODING_ORDER
+    from xpra.codecs.video_helper import getVideoHelper, ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+    from xpra.server.source_stats import GlobalPerformanceStatistics
+    from xpra.server.window.batch_config import DamageBatchConfig
+    from xpra.server.window.window_source import WindowSource
+    from xpra.server.window.window_video_source import WindowVideoSource
+    from xpra.server.encode_pool import EncodePool
+
+    wid, properties, records = read_damage_trace(filename)
+    if not records:
+        print("no damage records found in '%s'" % filename)
+        return 1
+    has_pixels = any(r[0]=="pixels" for r in records)
+
+    glib = import_glib()
+    WindowSource.staticinit(glib.idle_add, glib.timeout_add, glib.source_remove)
+
+    #find the encodings available, as the server does:
+    load_codecs(decoders=False)
+    vh = getVideoHelper()
+    if options.video:
+        vh.set_modules(video_encoders=ALL_VIDEO_ENCODER_OPTIONS, csc_modules=ALL_CSC_MODULE_OPTIONS)
+        vh.init()
+    core_encodings = ["rgb24", "rgb32"]
+    if options.video:
+        core_encodings += list(vh.get_encodings())
+    enc_pillow = get_codec("enc_pillow")
+    if enc_pillow:
+        core_encodings += [x for x in enc_pillow.get_encodings() if x not in core_encodings]
+    encodings = []
+    for x in core_encodings:
+        e = {"rgb32" : "rgb", "rgb24" : "rgb"}.get(x, x)
+        if e not in encodings:
+            encodings.append(e)
+    encoding = options.encoding
+    if not encoding:
+        encoding = [x for x in PREFERED_ENCODING_ORDER if x in encodings][0]
+    elif encoding not in encodings:
+        print("invalid encoding '%s', options: %s" % (encoding, csv(encodings)))
+        return 1
+
+    encoding_options = typedict({
+                                 "rgb_zlib"         : True,
+                                 "rgb_lz4"          : compression.use_lz4,
+                                 "flush"            : True,
+                                 "scrolling"        : True,
+                                 "video_scaling"    : True,
+                                 "full_csc_modes"   : dict((e, CLIENT_CSC_MODES) for e in vh.get_encodings()),
+                                 })
+    default_encoding_options = typedict()
+    if options.quality>0:
+        default_encoding_options["quality"] = options.quality
+    if options.speed>0:
+        default_encoding_options["speed"] = options.speed
+
+    stats = ReplayStatistics(glib.timeout_add, options.latency, options.bandwidth, options.decode_speed)
+    pool = EncodePool("replay", options.threads)
+    pool.assign(wid)
+    def queue_size():
+        return pool.qsize()
+    def call_in_encode_thread(*fn_and_args):
+        #time each work item:
+        pool.queue(wid, stats.is_closed, (fn_and_args[0], stats.timed_call) + fn_and_args[1:])
+    def compressed_wrapper(datatype, data, min_saving=128):
+        cw = compression.compressed_wrapper(datatype, data, zlib=True, lz4=compression.use_lz4, can_inline=False)
+        if len(cw)+min_saving<=len(data):
+            return cw
+        return compression.Compressed(datatype, data, can_inline=True)
+
+    if options.video:
+        class ReplayWindowSource(ReplayMixin, WindowVideoSource):
+            pass
+    else:
+        class ReplayWindowSource(ReplayMixin, WindowSource):     #@DuplicatedSignature
+            pass
+    global_statistics = GlobalPerformanceStatistics()
+    window = ReplayWindow(properties)
+    ws = ReplayWindowSource(queue_size, call_in_encode_thread, stats.queue_packet, compressed_wrapper,
+                            global_statistics,
+                            wid, window, DamageBatchConfig(), options.auto_refresh_delay,
+                            False, 0,
+                            vh,
+                            core_encodings, encodings,
+                            encoding, encodings, core_encodings, ["png"], encoding_options, typedict(),
+                            ["RGB", "RGBA", "RGBX"],
+                            default_encoding_options,
+                            None, 0)
+    ws.replay_statistics = stats
+    stats.window_source = ws
+
+    print("replaying %i records from window %i %s" % (len(records), wid, csv("%s=%s" % (k, v) for k,v in window.properties.items())))
+    print(" using %s with encoding '%s', trace %s pixel data" % (type(ws).__bases__[1].__name__, encoding, ["without", "with"][has_pixels]))
+
+    loop = glib.MainLoop()
+    state = {"index" : 0}
+    start = monotonic_time()
+
+    def play():
+        index = state["index"]
+        elapsed = int(1000*1000*(monotonic_time()-start)*options.rate)
+        while index<len(records) and records[index][1]<=elapsed:
+            record = records[index]
+            index += 1
+            rtype = record[0]
+            if rtype=="size":
+                window.resize(*record[2:4])
+            elif rtype=="pixels":
+                window.paint(*record[2:])
+            elif rtype=="damage":
+                x, y, w, h = record[2:6]
+                if not has_pixels:
+                    window.fill(x, y, w, h)
+                stats.damage_events += 1
+                global_statistics.damage_last_events.append((wid, monotonic_time(), w*h))
+                ws.damage(x, y, w, h, {})
+        state["index"] = index
+        if index<len(records):
+            delay = (records[index][1]-elapsed)/1000.0/options.rate
+            glib.timeout_add(max(0, int(delay)), play)
+        else:
+            glib.timeout_add(100, wait_for_completion, monotonic_time())
+        return False
+
+    def recalculate():
+        #same as ServerSource.recalculate_delays:
+        global_statistics.update_averages()
+        ws.statistics.update_averages()
+        ws.calculate_batch_delay(True, False, False)
+        ws.reconfigure()
+        stats.batch_delay_samples.append(ws.batch_config.delay)
+        return not stats.closed
+
+    def wait_for_completion(end):
+        busy = pool.qsize()>0 or ws._damage_delayed or stats.pending
+        if busy and monotonic_time()-end<options.timeout:
+            return True
+        if busy:
+            print("timeout waiting for the replay to complete")
+        stats.closed = True
+        loop.quit()
+        return False
+
+    glib.timeout_add(1000, recalculate)
+    glib.idle_add(play)
+    try:
+        loop.run()
+    finally:
+        stats.closed = True
+        ws.cleanup()
+        pool.stop()
+    elapsed = monotonic_time()-start
+
+    trace_duration = records[-1][1]/1000.0/1000.0
+    print("")
+    print("replayed %.1f seconds of damage events in %.1f seconds" % (trace_duration, elapsed))
+    print("%i damage events, %i packets, %sPixels, %sB" % (stats.damage_events, stats.packets, std_unit(stats.pixels), std_unit(stats.bytes_sent, unit=1024)))
+    for coding, (count, pixels, size) in sorted(stats.encodings.items()):
+        print(" %-10s: %6i packets, %8sPixels, %8sB, %5.1f bits per pixel" % (coding, count, std_unit(pixels), std_unit(size, unit=1024), 8.0*size/max(1, pixels)))
+    print("encode thread time : total=%.1fs, %s" % (sum(stats.encode_times)/1000.0, format_stats(stats.encode_times)))
+    print("damage latency     : %s" % format_stats(stats.damage_latency))
+    print("client latency     : %s" % format_stats(stats.client_latency))
+    print("actual batch delay : %s" % format_stats(stats.batch_delays))
+    print("batch delay        : %s" % format_stats(stats.batch_delay_samples))
+    return 0
+
+
+def main(argv):
+    from optparse import OptionParser
+    from xpra.platform import program_context
+    parser = OptionParser(usage="%prog [options] DAMAGE_TRACE_FILE")
+    parser.add_option("--encoding", default="", help="the encoding to use (default: the server's default encoding)")
+    parser.add_option("--no-video", dest="video", action="store_false", default=True, help="use WindowSource without video encoders")
+    parser.add_option("--quality", type="int", default=0, help="fixed encoding quality")
+    parser.add_option("--speed", type="int", default=0, help="fixed encoding speed")
+    parser.add_option("--threads", type="int", default=1, help="number of encoding threads")
+    parser.add_option("--rate", type="float", default=1.0, help="replay speed multiplier")
+    parser.add_option("--latency", type="int", default=20, help="simulated network latency in milliseconds")
+    parser.add_option("--bandwidth", type="float", default=0, help="simulated bandwidth in Mbps (0 for unlimited)")
+    parser.add_option("--decode-speed", dest="decode_speed", type="int", default=100, help="simulated client decoding speed in MPixels/s")
+    parser.add_option("--auto-refresh-delay", dest="auto_refresh_delay", type="int", default=150, help="auto-refresh delay in milliseconds")
+    parser.add_option("--timeout", type="int", default=10, help="how long to wait for the encoding to complete, in seconds")
+    options, args = parser.parse_args(argv[1:])
+    if len(args)!=1:
+        parser.print_usage()
+        return 1
+    with program_context("Damage Replay", "Damage Replay"):
+        return replay(args[0], options)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
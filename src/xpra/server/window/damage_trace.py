@@ -0,0 +1,158 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import gzip
+import struct
+
+from xpra.log import Logger
+log = Logger("window", "damage")
+
+from xpra.util import envbool
+from xpra.os_util import monotonic_time, memoryview_to_bytes, strtobytes, bytestostr
+from xpra.net.bencode import bencode, bdecode
+
+
+#directory where the damage traces are saved (disabled when empty):
+DAMAGE_TRACE = os.environ.get("XPRA_DAMAGE_TRACE", "")
+#also save the pixels captured for each screen update:
+DAMAGE_TRACE_PIXELS = envbool("XPRA_DAMAGE_TRACE_PIXELS", False)
+
+TRACE_MAGIC = "xpra-damage-trace"
+TRACE_VERSION = 1
+TRACE_PROPERTIES = ("title", "class-instance", "window-type")
+
+#each record is a bencoded list, prefixed with its length:
+# ["damage", time, x, y, w, h]
+# ["size", time, w, h]
+# ["pixels", time, x, y, w, h, pixel_format, depth, rowstride, bytesperpixel, data]
+#all times are in microseconds, relative to the start of the trace
+RECORD_HEADER = "!I"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+
+class DamageTraceRecorder(object):
+    """
+        Records the damage events of a window to a compressed file,
+        so the workload can be replayed later (see damage_replay).
+        This is only called from the UI thread.
+    """
+
+    def __init__(self, filename, wid, properties={}, pixels=False):
+        self.filename = filename
+        self.pixels = pixels
+        self.start = monotonic_time()
+        self.dimensions = 0, 0
+        self.records = 0
+        self.file = gzip.open(filename, "wb")
+        self.write_record(TRACE_MAGIC, TRACE_VERSION, wid, properties)
+        log("recording damage trace for window %i to '%s'", wid, filename)
+
+    def __repr__(self):
+        return "DamageTraceRecorder(%s)" % self.filename
+
+    def get_info(self):
+        return {
+                "file"      : self.filename,
+                "pixels"    : self.pixels,
+                "records"   : self.records,
+                }
+
+    def get_time(self):
+        return int(1000*1000*(monotonic_time()-self.start))
+
+    def write_record(self, *record):
+        f = self.file
+        if not f:
+            return
+        data = bencode(record)
+        try:
+            f.write(struct.pack(RECORD_HEADER, len(data)))
+            f.write(data)
+            self.records += 1
+        except Exception as e:
+            log.error("Error writing damage trace '%s':", self.filename)
+            log.error(" %s", e)
+            self.close()
+
+    def record_damage(self, x, y, w, h, ww, wh):
+        if self.dimensions!=(ww, wh):
+            self.dimensions = ww, wh
+            self.write_record("size", self.get_time(), ww, wh)
+        self.write_record("damage", self.get_time(), x, y, w, h)
+
+    def record_image(self, image):
+        if not self.pixels or image.get_planes()!=0:
+            return
+        pixels = memoryview_to_bytes(image.get_pixels())
+        self.write_record("pixels", self.get_time(),
+                          image.get_x(), image.get_y(), image.get_width(), image.get_height(),
+                          image.get_pixel_format(), image.get_depth(), image.get_rowstride(), image.get_bytesperpixel(),
+                          pixels)
+
+    def close(self):
+        f = self.file
+        if f:
+            self.file = None
+            log("closing %s after %i records", self, self.records)
+            f.close()
+
+
+def new_damage_trace_recorder(wid, window):
+    """ returns a recorder for this window if damage traces are enabled """
+    if not DAMAGE_TRACE:
+        return None
+    properties = {}
+    for prop in TRACE_PROPERTIES:
+        #these properties are only informational:
+        try:
+            v = window.get_property(prop)
+            if isinstance(v, (list, tuple)):
+                properties[prop] = [strtobytes(x) for x in v]
+            elif v is not None:
+                properties[prop] = strtobytes(v)
+        except Exception as e:
+            log("cannot record window property %s: %s", prop, e)
+    filename = os.path.join(os.path.expanduser(DAMAGE_TRACE), "damage-%i-%i.trace" % (os.getpid(), wid))
+    try:
+        return DamageTraceRecorder(filename, wid, properties, DAMAGE_TRACE_PIXELS)
+    except Exception as e:
+        log.error("Error: cannot record damage trace to '%s':", filename)
+        log.error(" %s", e)
+        return None
+
+
+def read_damage_trace(filename):
+    """
+        Returns the window id, its properties and the list of records
+        found in the damage trace file.
+    """
+    records = []
+    with gzip.open(filename, "rb") as f:
+        def read_record():
+            header = f.read(RECORD_HEADER_SIZE)
+            if len(header)<RECORD_HEADER_SIZE:
+                return None
+            size = struct.unpack(RECORD_HEADER, header)[0]
+            data = f.read(size)
+            if len(data)<size:
+                log.warn("Warning: damage trace '%s' is truncated", filename)
+                return None
+            return bdecode(data)[0]
+        header = read_record()
+        if not header or bytestostr(header[0])!=TRACE_MAGIC:
+            raise ValueError("'%s' is not a damage trace file" % filename)
+        if header[1]!=TRACE_VERSION:
+            raise ValueError("unsupported damage trace version %s" % header[1])
+        wid, properties = header[2:4]
+        while True:
+            record = read_record()
+            if record is None:
+                break
+            record[0] = bytestostr(record[0])
+            if record[0]=="pixels":
+                record[6] = bytestostr(record[6])
+            records.append(record)
+    return wid, properties, records
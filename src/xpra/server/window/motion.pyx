@@ -23,7 +23,7 @@ from xpra.server.window.region import rectangle
 cdef int DEBUG = envbool("XPRA_SCROLL_DEBUG", False)
 
 
-from libc.stdint cimport uint8_t, uint16_t, int16_t, uint64_t, uintptr_t
+from libc.stdint cimport uint8_t, uint16_t, int16_t, uint32_t, uint64_t, uintptr_t
 
 cdef extern from "stdlib.h":
     void* malloc(size_t __size)
@@ -32,9 +32,20 @@ cdef extern from "string.h":
     void free(void * ptr) nogil
     void *memset(void * ptr, int value, size_t num) nogil
     void *memcpy(void * destination, void * source, size_t num) nogil
+    int memcmp(const void *s1, const void *s2, size_t n) nogil
 
 
 DEF MIN_LINE_COUNT = 5
+#changed columns separated by fewer unchanged columns than this are merged:
+DEF MIN_SPAN_GAP = 8
+#narrower areas are just repainted:
+DEF MIN_SCROLL_WIDTH = 16
+#number of lines used to find horizontal scrolling candidates:
+DEF HSCROLL_SAMPLES = 16
+#the ScrollDetector keeps a checksum for each block of pixels of this width:
+DEF BLOCK_WIDTH = 32
+#exposed for the unit tests:
+SCROLL_BLOCK_WIDTH = BLOCK_WIDTH
 
 DEF MAXINT64 = 2**63
 DEF MAXUINT64 = 2**64
@@ -55,6 +66,9 @@ cdef dd(uint16_t *d, uint16_t l):
 
 assert sizeof(uint64_t)==64//8, "uint64_t is not 64-bit: %i!" % sizeof(uint64_t)
 
+#used for the column checksums:
+cdef uint64_t COLUMN_PRIME = 0x100000001b3
+
 
 cdef class ScrollData:
 
@@ -131,10 +145,11 @@ cdef class ScrollData:
         #checksum each line of the pixel array:
         cdef uint8_t *buf = NULL
         cdef Py_ssize_t buf_len = 0
-        cdef Py_ssize_t min_buf_len = rowstride*height
+        cdef size_t row_len = width*bpp
+        #the last line does not need the rowstride padding:
+        cdef Py_ssize_t min_buf_len = rowstride*(height-1)+row_len
         assert object_as_buffer(pixels, <const void**> &buf, &buf_len)==0
         assert buf_len>=0 and buf_len>=min_buf_len, "buffer length=%i is too small for %ix%i" % (buf_len, rowstride, height)
-        cdef size_t row_len = width*bpp
         assert row_len<=rowstride, "invalid row length: %ix%i=%i but rowstride is %i" % (width, bpp, width*bpp, rowstride)
         cdef uint64_t *a2 = self.a2
         cdef unsigned long long seed = 0
@@ -382,3 +397,403 @@ cdef class ScrollData:
         if ptr:
             self.a2 = NULL
             free(ptr)
+
+
+cdef class ScrollDetector:
+    """
+        Keeps the checksums of the last image so we can find the areas that have changed,
+        and detect vertical or horizontal scrolling in each of them separately.
+        (ie: the content pane of a browser scrolls, but not its toolbars and sidebars)
+        We don't keep a copy of the pixels:
+        each line is split into blocks of BLOCK_WIDTH pixels and we keep the checksum of each block,
+        we also keep a checksum of each column to find the exact edges of the areas that have changed.
+        The scrolling is detected using the whole blocks contained in those areas,
+        what remains at the edges is repainted.
+    """
+
+    cdef object __weakref__
+    cdef uint64_t *checksums        #block checksums of the reference image
+    cdef uint64_t *new_checksums    #block checksums of the latest image
+    cdef uint64_t *col_checksums    #column checksums of the reference image
+    cdef uint64_t *new_col_checksums
+    cdef uint8_t *valid             #for each line: does the client have the reference pixels?
+    cdef uint16_t x
+    cdef uint16_t y
+    cdef uint16_t width
+    cdef uint16_t height
+    cdef uint16_t nblocks
+    cdef uint8_t bpp
+
+    def __repr__(self):
+        return "ScrollDetector(%ix%i at %i,%i)" % (self.width, self.height, self.x, self.y)
+
+    def update(self, pixels, uint16_t x, uint16_t y, uint16_t width, uint16_t height, unsigned int rowstride, uint8_t bpp=4, uint16_t max_distance=1000):
+        """
+            Compares the new image with the reference image (if we have one)
+            and returns the scrolled areas and the areas that need to be repainted,
+            as two lists of rectangles relative to the image:
+            [(x, y, w, h, xdelta, ydelta), ..], [(x, y, w, h), ..]
+            The areas that have not changed are not included.
+            The new image then becomes the reference image.
+        """
+        assert width>0 and height>0, "invalid dimensions: %ix%i" % (width, height)
+        cdef uint8_t *buf = NULL
+        cdef Py_ssize_t buf_len = 0
+        cdef size_t row_len = width*bpp
+        assert row_len<=rowstride, "invalid row length: %ix%i=%i but rowstride is %i" % (width, bpp, row_len, rowstride)
+        assert object_as_buffer(pixels, <const void**> &buf, &buf_len)==0
+        assert buf_len>=<Py_ssize_t> (rowstride*(height-1)+row_len), "buffer length=%i is too small for %ix%i" % (buf_len, rowstride, height)
+        cdef uint8_t reference = self.checksums!=NULL and self.x==x and self.y==y and self.width==width and self.height==height and self.bpp==bpp
+        cdef size_t csize
+        if not reference:
+            log("%s: new reference image %ix%i at %i,%i", self, width, height, x, y)
+            self.free()
+            self.x = x
+            self.y = y
+            self.width = width
+            self.height = height
+            self.bpp = bpp
+            self.nblocks = (width+BLOCK_WIDTH-1)//BLOCK_WIDTH
+            csize = self.nblocks*height*sizeof(uint64_t)
+            self.checksums = <uint64_t*> memalign(csize)
+            self.new_checksums = <uint64_t*> memalign(csize)
+            self.col_checksums = <uint64_t*> memalign(width*sizeof(uint64_t))
+            self.new_col_checksums = <uint64_t*> memalign(width*sizeof(uint64_t))
+            self.valid = <uint8_t*> memalign(height)
+            assert self.checksums!=NULL and self.new_checksums!=NULL and self.col_checksums!=NULL and self.new_col_checksums!=NULL and self.valid!=NULL, "checksum memory allocation failed"
+        with nogil:
+            self.checksum(buf, rowstride)
+        result = None
+        if reference:
+            result = self.detect(buf, rowstride, max_distance)
+        #the new image becomes the reference:
+        cdef uint64_t *tmp = self.checksums
+        self.checksums = self.new_checksums
+        self.new_checksums = tmp
+        tmp = self.col_checksums
+        self.col_checksums = self.new_col_checksums
+        self.new_col_checksums = tmp
+        memset(self.valid, 1, height)
+        return result
+
+    cdef void checksum(self, uint8_t *buf, unsigned int rowstride) nogil:
+        """ populates new_checksums and new_col_checksums """
+        cdef uint16_t width = self.width
+        cdef uint16_t nblocks = self.nblocks
+        cdef uint8_t bpp = self.bpp
+        cdef uint64_t *cols = self.new_col_checksums
+        cdef uint64_t *blocks
+        cdef uint8_t *row
+        cdef uint16_t i, b, c, bx
+        cdef uint8_t k
+        memset(cols, 0, width*sizeof(uint64_t))
+        for i in range(self.height):
+            row = buf+i*rowstride
+            blocks = self.new_checksums+i*nblocks
+            for b in range(nblocks):
+                bx = b*BLOCK_WIDTH
+                blocks[b] = <uint64_t> xxh64(row+bx*bpp, min(BLOCK_WIDTH, width-bx)*bpp, 0)
+            if bpp==4:
+                for c in range(width):
+                    cols[c] = (cols[c] ^ (<uint32_t*> row)[c]) * COLUMN_PRIME
+            else:
+                for c in range(width):
+                    for k in range(bpp):
+                        cols[c] = (cols[c] ^ row[c*bpp+k]) * COLUMN_PRIME
+
+    cdef inline uint16_t block_end(self, uint16_t b) nogil:
+        return min((b+1)*BLOCK_WIDTH, self.width)
+
+    cdef detect(self, uint8_t *buf, unsigned int rowstride, uint16_t max_distance):
+        cdef uint16_t width = self.width
+        cdef uint16_t height = self.height
+        cdef uint16_t nblocks = self.nblocks
+        cdef uint8_t *changed_cols = <uint8_t*> malloc(width)
+        cdef uint8_t *changed_rows = <uint8_t*> malloc(height)
+        cdef uint8_t *changed_blocks = <uint8_t*> malloc(nblocks)
+        assert changed_cols!=NULL and changed_rows!=NULL and changed_blocks!=NULL, "change map memory allocation failed"
+        cdef uint64_t *old_blocks
+        cdef uint64_t *new_blocks
+        cdef uint16_t i, b, c, bx, bend, nchanged = 0
+        cdef uint8_t found
+        scrolls = []
+        paints = []
+        try:
+            with nogil:
+                memset(changed_blocks, 0, nblocks)
+                for i in range(height):
+                    if not self.valid[i]:
+                        changed_rows[i] = 2
+                        continue
+                    old_blocks = self.checksums+i*nblocks
+                    new_blocks = self.new_checksums+i*nblocks
+                    if memcmp(old_blocks, new_blocks, nblocks*sizeof(uint64_t))==0:
+                        changed_rows[i] = 0
+                        continue
+                    changed_rows[i] = 1
+                    if nchanged==nblocks:
+                        #all the blocks have changed already
+                        continue
+                    for b in range(nblocks):
+                        if not changed_blocks[b] and old_blocks[b]!=new_blocks[b]:
+                            changed_blocks[b] = 1
+                            nchanged += 1
+                for c in range(width):
+                    changed_cols[c] = self.col_checksums[c]!=self.new_col_checksums[c]
+                #the column checksums are only used for finding the edges,
+                #make sure that we never miss a block that has changed:
+                for b in range(nblocks):
+                    if not changed_blocks[b]:
+                        continue
+                    bx = b*BLOCK_WIDTH
+                    bend = self.block_end(b)
+                    found = 0
+                    for c in range(bx, bend):
+                        if changed_cols[c]:
+                            found = 1
+                            break
+                    if not found:
+                        memset(changed_cols+bx, 1, bend-bx)
+            #lines we don't have a valid reference for must be repainted:
+            for start, count in self.get_runs(changed_rows, height, 2):
+                paints.append((0, start, width, count))
+            #find the areas that have changed:
+            for cx1, cx2 in self.get_spans(changed_cols, width):
+                self.detect_span(buf, rowstride, changed_rows, cx1, cx2, max_distance, scrolls, paints)
+        finally:
+            free(changed_cols)
+            free(changed_rows)
+            free(changed_blocks)
+        if DEBUG:
+            log("%s.detect: scrolls=%s, paints=%s", self, scrolls, paints)
+        return scrolls, paints
+
+    cdef get_runs(self, uint8_t *values, uint16_t size, uint8_t value):
+        """ returns the runs of consecutive items matching the value, as (start, count) """
+        runs = []
+        cdef uint16_t i, start = 0, count = 0
+        for i in range(size):
+            if values[i]==value:
+                if count==0:
+                    start = i
+                count += 1
+            elif count>0:
+                runs.append((start, count))
+                count = 0
+        if count>0:
+            runs.append((start, count))
+        return runs
+
+    cdef get_spans(self, uint8_t *changed_cols, uint16_t width):
+        """ returns the spans of changed columns, merging the ones separated by small gaps """
+        spans = []
+        for start, count in self.get_runs(changed_cols, width, 1):
+            if spans and start-spans[len(spans)-1][1]<MIN_SPAN_GAP:
+                spans[len(spans)-1][1] = start+count
+            else:
+                spans.append([start, start+count])
+        return spans
+
+    cdef detect_span(self, uint8_t *buf, unsigned int rowstride, uint8_t *changed_rows, uint16_t cx1, uint16_t cx2, uint16_t max_distance, scrolls, paints):
+        cdef uint16_t nblocks = self.nblocks
+        #the blocks covering this span:
+        cdef uint16_t b1 = cx1//BLOCK_WIDTH
+        cdef uint16_t b2 = (cx2+BLOCK_WIDTH-1)//BLOCK_WIDTH
+        cdef size_t span_size = (b2-b1)*sizeof(uint64_t)
+        cdef uint16_t i, ry1 = 0, ry2 = 0
+        #find the lines that have changed within this span:
+        cdef uint8_t found = 0
+        for i in range(self.height):
+            if changed_rows[i]==1 and memcmp(self.checksums+i*nblocks+b1, self.new_checksums+i*nblocks+b1, span_size)!=0:
+                if not found:
+                    ry1 = i
+                    found = 1
+                ry2 = i+1
+        if not found:
+            return
+        cdef uint16_t h = ry2-ry1
+        #the blocks fully contained in this span:
+        cdef uint16_t fb1 = (cx1+BLOCK_WIDTH-1)//BLOCK_WIDTH
+        cdef uint16_t fb2 = cx2//BLOCK_WIDTH
+        if cx2==self.width:
+            fb2 = nblocks
+        cdef uint16_t sx1, sx2
+        if h>MIN_LINE_COUNT and fb2>fb1:
+            sx1 = fb1*BLOCK_WIDTH
+            sx2 = self.block_end(fb2-1)
+            if sx2-sx1>=MIN_SCROLL_WIDTH and (self.detect_vertical(fb1, fb2, ry1, h, max_distance, scrolls, paints) or \
+                                             self.detect_horizontal(buf, rowstride, fb1, fb2, ry1, h, max_distance, scrolls, paints)):
+                #repaint the edges that are not covered by whole blocks:
+                if sx1>cx1:
+                    paints.append((cx1, ry1, sx1-cx1, h))
+                if cx2>sx2:
+                    paints.append((sx2, ry1, cx2-sx2, h))
+                return
+        paints.append((cx1, ry1, cx2-cx1, h))
+
+    cdef int detect_vertical(self, uint16_t b1, uint16_t b2, uint16_t y, uint16_t h, uint16_t max_distance, scrolls, paints):
+        cdef uint16_t nblocks = self.nblocks
+        cdef uint16_t x = b1*BLOCK_WIDTH
+        cdef uint16_t w = self.block_end(b2-1)-x
+        cdef size_t span_size = (b2-b1)*sizeof(uint64_t)
+        cdef ScrollData sd = ScrollData(0, 0, w, h)
+        sd.a1 = <uint64_t*> memalign(h*sizeof(uint64_t))
+        sd.a2 = <uint64_t*> memalign(h*sizeof(uint64_t))
+        assert sd.a1!=NULL and sd.a2!=NULL, "checksum memory allocation failed"
+        cdef uint16_t i
+        with nogil:
+            for i in range(h):
+                if self.valid[y+i]:
+                    sd.a1[i] = <uint64_t> xxh64(self.checksums+(y+i)*nblocks+b1, span_size, 0)
+                    sd.a2[i] = <uint64_t> xxh64(self.new_checksums+(y+i)*nblocks+b1, span_size, 0)
+                else:
+                    #never matches:
+                    sd.a1[i] = 1
+                    sd.a2[i] = 0
+        sd.calculate(max_distance)
+        distance, hits = sd.get_best_match()
+        if distance==0 or hits<=MIN_LINE_COUNT:
+            return 0
+        scroll_values = sd.get_scroll_values()
+        if not scroll_values:
+            return 0
+        raw_scroll, non_scroll = scroll_values
+        for scroll, line_defs in raw_scroll.items():
+            if scroll==0:
+                #unchanged lines
+                continue
+            for line, count in line_defs.items():
+                scrolls.append((x, y+line, w, count, 0, scroll))
+        for line, count in non_scroll.items():
+            paints.append((x, y+line, w, count))
+        return 1
+
+    cdef int detect_horizontal(self, uint8_t *buf, unsigned int rowstride, uint16_t b1, uint16_t b2, uint16_t y, uint16_t h, uint16_t max_distance, scrolls, paints):
+        """
+            We don't have the pixels of the reference image,
+            so we look for the pixels of its blocks at a different position in the new image.
+        """
+        cdef uint8_t bpp = self.bpp
+        cdef uint16_t nblocks = self.nblocks
+        cdef int x1 = b1*BLOCK_WIDTH
+        cdef int x2 = self.block_end(b2-1)
+        cdef uint16_t max_dx = min(max_distance, (x2-x1)//2)
+        cdef uint16_t samples = min(h, HSCROLL_SAMPLES)
+        #use the block in the middle of the span to find the candidates:
+        cdef uint16_t bm = (b1+b2-1)//2
+        cdef int mx1 = bm*BLOCK_WIDTH
+        cdef int mx2 = self.block_end(bm)
+        cdef size_t mlen = (mx2-mx1)*bpp
+        cdef int dx, sdx, best_dx = 0
+        cdef uint16_t best_hits = 0
+        cdef uint16_t i, row, matches
+        cdef uint8_t j
+        #try all the distances on a few sample lines:
+        with nogil:
+            for dx in range(1, max_dx+1):
+                for j in range(2):
+                    #moved right, or moved left:
+                    sdx = dx if j==0 else -dx
+                    if mx1+sdx<x1 or mx2+sdx>x2:
+                        continue
+                    matches = 0
+                    for i in range(samples):
+                        row = y+i*h//samples
+                        if self.valid[row] and xxh64(buf+row*rowstride+(mx1+sdx)*bpp, mlen, 0)==self.checksums[row*nblocks+bm]:
+                            matches += 1
+                    if matches>best_hits:
+                        best_hits = matches
+                        best_dx = sdx
+        if best_hits*2<samples:
+            return 0
+        #the blocks that remain within the span once moved:
+        cdef uint16_t eb1 = b1, eb2 = b2
+        while eb1<eb2 and <int> (eb1*BLOCK_WIDTH)+best_dx<x1:
+            eb1 += 1
+        while eb2>eb1 and <int> self.block_end(eb2-1)+best_dx>x2:
+            eb2 -= 1
+        if eb1>=eb2:
+            return 0
+        cdef int sx1 = eb1*BLOCK_WIDTH
+        cdef int sx2 = self.block_end(eb2-1)
+        cdef uint8_t *line_state = <uint8_t*> malloc(h)
+        assert line_state!=NULL, "state map memory allocation failed"
+        cdef uint64_t *old_blocks
+        cdef uint16_t b, bx
+        try:
+            #verify all the lines:
+            with nogil:
+                for i in range(h):
+                    row = y+i
+                    old_blocks = self.checksums+row*nblocks
+                    if not self.valid[row]:
+                        line_state[i] = 0
+                    elif memcmp(old_blocks+b1, self.new_checksums+row*nblocks+b1, (b2-b1)*sizeof(uint64_t))==0:
+                        #unchanged
+                        line_state[i] = 2
+                    else:
+                        line_state[i] = 1
+                        for b in range(eb1, eb2):
+                            bx = b*BLOCK_WIDTH
+                            if xxh64(buf+row*rowstride+(bx+best_dx)*bpp, (self.block_end(b)-bx)*bpp, 0)!=old_blocks[b]:
+                                line_state[i] = 0
+                                break
+            matched = self.get_runs(line_state, h, 1)
+            if sum(count for _, count in matched)<=MIN_LINE_COUNT:
+                return 0
+            for line, count in matched:
+                scrolls.append((sx1, y+line, sx2-sx1, count, best_dx, 0))
+                #the columns exposed on either side:
+                if sx1+best_dx>x1:
+                    paints.append((x1, y+line, sx1+best_dx-x1, count))
+                if x2>sx2+best_dx:
+                    paints.append((sx2+best_dx, y+line, x2-sx2-best_dx, count))
+            for line, count in self.get_runs(line_state, h, 0):
+                paints.append((x1, y+line, x2-x1, count))
+        finally:
+            free(line_state)
+        return 1
+
+    def invalidate(self, int x, int y, int w, int h):
+        """ the client's pixels no longer match the reference image for this area """
+        if self.checksums==NULL:
+            return
+        rect = rectangle(self.x, self.y, self.width, self.height)
+        inter = rect.intersection(x, y, w, h)
+        if not inter:
+            return
+        cdef int i
+        for i in range(inter.y-rect.y, inter.y-rect.y+inter.height):
+            self.valid[i] = 0
+        cdef uint16_t nvalid = 0
+        for i in range(self.height):
+            nvalid += self.valid[i]
+        log("invalidated %i lines from intersection of scroll area %s and rectangle %s, remains %i", inter.height, rect, (x, y, w, h), nvalid)
+        #if more than half has already been invalidated, drop it completely:
+        if nvalid<=self.height//2:
+            self.free()
+
+    def __dealloc__(self):
+        self.free()
+
+    def free(self):
+        cdef void* ptr = <void*> self.checksums
+        if ptr:
+            self.checksums = NULL
+            free(ptr)
+        ptr = <void*> self.new_checksums
+        if ptr:
+            self.new_checksums = NULL
+            free(ptr)
+        ptr = <void*> self.col_checksums
+        if ptr:
+            self.col_checksums = NULL
+            free(ptr)
+        ptr = <void*> self.new_col_checksums
+        if ptr:
+            self.new_col_checksums = NULL
+            free(ptr)
+        ptr = <void*> self.valid
+        if ptr:
+            self.valid = NULL
+            free(ptr)
@@ -1,6 +1,6 @@
 # coding=utf8
 # This file is part of Xpra.
-# Copyright (C) 2013-2016 Antoine Martin <antoine@devloop.org.uk>
+# Copyright (C) 2013-2017 Antoine Martin <antoine@devloop.org.uk>
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
@@ -9,6 +9,9 @@
 
 #cython: auto_pickle=False, boundscheck=False, wraparound=False, overflowcheck=False, cdivision=True, unraisable_tracebacks=True, always_allow_keywords=False
 
+from libc.limits cimport INT_MIN, INT_MAX
+
+
 #what I want is a real macro!
 cdef inline int MIN(int a, int b):
     if a<=b:
@@ -209,3 +212,382 @@ def merge_all(rectangles):
         if y2>ry2:
             ry2 = y2
     return rectangle(rx, ry, rx2-rx, ry2-ry)
+
+
+# banded regions:
+# a region is stored as a list of horizontal bands sorted by y,
+# each band is a tuple: (y1, y2, spans)
+# where spans is a tuple of sorted x coordinates: (x1, x2, x1, x2, ..)
+# (the same representation as pixman / X11 regions)
+# bands never overlap, spans never overlap or touch,
+# and vertically adjacent bands with the same spans are always coalesced,
+# so the representation of a given area is unique.
+
+DEF UNION = 0
+DEF INTERSECTION = 1
+DEF SUBSTRACT = 2
+
+cdef tuple NO_SPANS = ()
+
+cdef inline int span_op(const int op, const int a, const int b):
+    if op==UNION:
+        return a or b
+    elif op==INTERSECTION:
+        return a and b
+    return a and not b
+
+cdef tuple spans_op(tuple a, tuple b, const int op):
+    """ combine two tuples of spans by walking their edges in order """
+    cdef int la = len(a)
+    cdef int lb = len(b)
+    cdef int i = 0, j = 0
+    cdef int x, ax, bx
+    cdef int ina = 0, inb = 0, inside = 0, v
+    cdef list out = []
+    while i<la or j<lb:
+        if op!=UNION and i>=la:
+            #nothing left in 'a', so nothing more can be added:
+            break
+        ax = a[i] if i<la else INT_MAX
+        bx = b[j] if j<lb else INT_MAX
+        x = MIN(ax, bx)
+        if ax==x:
+            ina = not ina
+            i += 1
+        if bx==x:
+            inb = not inb
+            j += 1
+        v = span_op(op, ina, inb)
+        if v!=inside:
+            out.append(x)
+            inside = v
+    return tuple(out)
+
+cdef inline void append_band(list bands, const int y1, const int y2, tuple spans):
+    """ adds a band at the bottom, coalescing it with the previous one if we can """
+    cdef tuple last
+    cdef int n = len(bands)
+    if n>0:
+        last = bands[n-1]
+        if last[1]==y1 and last[2]==spans:
+            bands[n-1] = (last[0], y2, spans)
+            return
+    bands.append((y1, y2, spans))
+
+cdef list bands_op(list a, list b, const int op):
+    """ combine two lists of bands, slicing them vertically wherever either one changes """
+    cdef list out = []
+    cdef int la = len(a)
+    cdef int lb = len(b)
+    cdef int i = 0, j = 0
+    cdef int y = INT_MIN
+    cdef int ay1, ay2, by1, by2, top, bottom
+    cdef tuple band, sa, sb, spans
+    while True:
+        #skip the bands we have already processed:
+        while i<la and (<tuple> a[i])[1]<=y:
+            i += 1
+        while j<lb and (<tuple> b[j])[1]<=y:
+            j += 1
+        if i>=la and (op!=UNION or j>=lb):
+            break
+        if i<la:
+            band = a[i]
+            ay1, ay2, sa = band
+        else:
+            ay1, ay2, sa = INT_MAX, INT_MAX, NO_SPANS
+        if j<lb:
+            band = b[j]
+            by1, by2, sb = band
+        else:
+            by1, by2, sb = INT_MAX, INT_MAX, NO_SPANS
+        top = MAX(y, MIN(ay1, by1))
+        bottom = INT_MAX
+        if ay1<=top:
+            bottom = MIN(bottom, ay2)
+        else:
+            #'a' starts further down:
+            bottom = MIN(bottom, ay1)
+            sa = NO_SPANS
+        if by1<=top:
+            bottom = MIN(bottom, by2)
+        else:
+            bottom = MIN(bottom, by1)
+            sb = NO_SPANS
+        spans = spans_op(sa, sb, op)
+        if spans:
+            append_band(out, top, bottom, spans)
+        y = bottom
+    return out
+
+cdef int find_band_end(list bands, const int y):
+    """ index of the first band which ends at or after y """
+    cdef int lo = 0
+    cdef int hi = len(bands)
+    cdef int mid
+    while lo<hi:
+        mid = (lo+hi)//2
+        if (<tuple> bands[mid])[1]<y:
+            lo = mid+1
+        else:
+            hi = mid
+    return lo
+
+cdef int find_band_start(list bands, const int y):
+    """ index of the first band which starts after y """
+    cdef int lo = 0
+    cdef int hi = len(bands)
+    cdef int mid
+    while lo<hi:
+        mid = (lo+hi)//2
+        if (<tuple> bands[mid])[0]<=y:
+            lo = mid+1
+        else:
+            hi = mid
+    return lo
+
+cdef int spans_contain(tuple spans, const int x1, const int x2):
+    """ is the segment x1 to x2 fully contained in one of the spans """
+    cdef int lo = 0
+    cdef int hi = len(spans)//2
+    cdef int mid
+    #find the last span starting at or before x1:
+    while lo<hi:
+        mid = (lo+hi)//2
+        if spans[mid*2]<=x1:
+            lo = mid+1
+        else:
+            hi = mid
+    if lo==0:
+        return False
+    return spans[lo*2-1]>=x2
+
+cdef int spans_intersect(tuple spans, const int x1, const int x2):
+    cdef int k
+    for k in range(0, len(spans), 2):
+        if spans[k]>=x2:
+            return False
+        if spans[k+1]>x1:
+            return True
+    return False
+
+
+cdef class banded_region:
+    """
+        A set of non-overlapping rectangles stored as horizontal bands.
+        Adding or removing a rectangle only modifies the bands it covers,
+        which are located using a binary search.
+    """
+
+    cdef list bands
+
+    def __init__(self, rects=None):
+        self.bands = []
+        if isinstance(rects, banded_region):
+            self.bands = list((<banded_region> rects).bands)
+        elif rects:
+            self.add_rectangles(rects)
+
+    def __len__(self):
+        """ the number of rectangles in this region """
+        return len(self.merge_bands())
+
+    def __iter__(self):
+        return iter(self.get_rectangles())
+
+    def __richcmp__(self, object other, const int op):
+        if type(other)!=banded_region:
+            raise Exception("cannot compare banded_region and %s" % type(other))
+        cdef banded_region o = other
+        if op==2:
+            return self.bands==o.bands
+        elif op==3:
+            return self.bands!=o.bands
+        raise Exception("invalid richcmp operator for banded_region: %s" % op)
+
+    def __repr__(self):
+        return "banded_region(%s)" % self.get_rectangles()
+
+    def get_bands(self):
+        return list(self.bands)
+
+    def clone(self):
+        return banded_region(self)
+
+
+    cdef void rect_op(self, const int x, const int y, const int w, const int h, const int op):
+        if w<=0 or h<=0:
+            return
+        #only the bands touching the rectangle can be modified:
+        cdef int i = find_band_end(self.bands, y)
+        cdef int j = find_band_start(self.bands, y+h)
+        cdef int k
+        cdef tuple band
+        if op==UNION:
+            #fast path for rectangles we already have:
+            for k in range(i, j):
+                band = self.bands[k]
+                if band[0]<=y and band[1]>=y+h:
+                    if spans_contain(band[2], x, x+w):
+                        return
+                    break
+        self.bands[i:j] = bands_op(self.bands[i:j], [(y, y+h, (x, x+w))], op)
+
+    def add(self, const int x, const int y, const int w, const int h):
+        self.rect_op(x, y, w, h, UNION)
+
+    def add_rect(self, rectangle rect):
+        self.rect_op(rect.x, rect.y, rect.width, rect.height, UNION)
+
+    def add_rectangles(self, rects):
+        """ add a list of rectangles, or of (x, y, w, h) tuples """
+        cdef rectangle r
+        cdef int x, y, w, h
+        for v in rects:
+            if type(v)==rectangle:
+                r = v
+                self.rect_op(r.x, r.y, r.width, r.height, UNION)
+            else:
+                x, y, w, h = v
+                self.rect_op(x, y, w, h, UNION)
+
+    def add_region(self, banded_region region):
+        self.bands = bands_op(self.bands, region.bands, UNION)
+
+    def remove(self, const int x, const int y, const int w, const int h):
+        self.rect_op(x, y, w, h, SUBSTRACT)
+
+    def remove_rect(self, rectangle rect):
+        self.rect_op(rect.x, rect.y, rect.width, rect.height, SUBSTRACT)
+
+    def remove_region(self, banded_region region):
+        self.bands = bands_op(self.bands, region.bands, SUBSTRACT)
+
+
+    cdef banded_region new_region(self, list bands):
+        cdef banded_region r = banded_region()
+        r.bands = bands
+        return r
+
+    def union(self, banded_region region):
+        return self.new_region(bands_op(self.bands, region.bands, UNION))
+
+    def intersection(self, banded_region region):
+        return self.new_region(bands_op(self.bands, region.bands, INTERSECTION))
+
+    def substract(self, banded_region region):
+        return self.new_region(bands_op(self.bands, region.bands, SUBSTRACT))
+
+    def intersection_rect(self, rectangle rect):
+        if rect.width<=0 or rect.height<=0:
+            return banded_region()
+        cdef int i = find_band_end(self.bands, rect.y)
+        cdef int j = find_band_start(self.bands, rect.y+rect.height)
+        rect_band = [(rect.y, rect.y+rect.height, (rect.x, rect.x+rect.width))]
+        return self.new_region(bands_op(self.bands[i:j], rect_band, INTERSECTION))
+
+    def substract_rect(self, rectangle rect):
+        cdef banded_region r = self.clone()
+        r.rect_op(rect.x, rect.y, rect.width, rect.height, SUBSTRACT)
+        return r
+
+
+    def contains(self, const int x, const int y, const int w, const int h):
+        """ is the given area fully covered by this region """
+        if w<=0 or h<=0:
+            return True
+        cdef int n = len(self.bands)
+        cdef int i = find_band_end(self.bands, y+1)
+        cdef int ny = y
+        cdef tuple band
+        while ny<y+h:
+            if i>=n:
+                return False
+            band = self.bands[i]
+            if band[0]>ny or not spans_contain(band[2], x, x+w):
+                return False
+            ny = band[1]
+            i += 1
+        return True
+
+    def contains_rect(self, rectangle rect):
+        return self.contains(rect.x, rect.y, rect.width, rect.height)
+
+    def intersects(self, const int x, const int y, const int w, const int h):
+        if w<=0 or h<=0:
+            return False
+        cdef int n = len(self.bands)
+        cdef int i = find_band_end(self.bands, y+1)
+        cdef tuple band
+        while i<n:
+            band = self.bands[i]
+            if band[0]>=y+h:
+                break
+            if spans_intersect(band[2], x, x+w):
+                return True
+            i += 1
+        return False
+
+    def intersects_rect(self, rectangle rect):
+        return self.intersects(rect.x, rect.y, rect.width, rect.height)
+
+
+    def get_extents(self):
+        """ the smallest rectangle containing the whole region, or None if empty """
+        if not self.bands:
+            return None
+        cdef int x1 = INT_MAX
+        cdef int x2 = INT_MIN
+        cdef tuple band, spans
+        for band in self.bands:
+            spans = band[2]
+            x1 = MIN(x1, spans[0])
+            x2 = MAX(x2, spans[len(spans)-1])
+        cdef int y1 = (<tuple> self.bands[0])[0]
+        cdef int y2 = (<tuple> self.bands[len(self.bands)-1])[1]
+        return rectangle(x1, y1, x2-x1, y2-y1)
+
+    def get_area(self):
+        cdef long area = 0
+        cdef int k
+        cdef tuple band, spans
+        for band in self.bands:
+            spans = band[2]
+            for k in range(0, len(spans), 2):
+                area += (band[1]-band[0]) * (spans[k+1]-spans[k])
+        return area
+
+    cdef list merge_bands(self):
+        """
+            Returns the region as a list of [x1, y1, x2, y2] areas,
+            the spans found at the same position in consecutive bands
+            are merged together so we don't split rectangles vertically.
+        """
+        cdef list areas = []
+        cdef dict current = {}
+        cdef dict below
+        cdef int k, y1, y2
+        cdef int prev_y2 = INT_MIN
+        cdef tuple spans
+        cdef list area
+        for y1, y2, spans in self.bands:
+            below = {}
+            for k in range(0, len(spans), 2):
+                key = spans[k], spans[k+1]
+                area = None
+                if prev_y2==y1:
+                    area = current.get(key)
+                if area is None:
+                    area = [spans[k], y1, spans[k+1], y2]
+                    areas.append(area)
+                else:
+                    area[3] = y2
+                below[key] = area
+            current = below
+            prev_y2 = y2
+        return areas
+
+    def get_rectangles(self):
+        """ the region as a list of non-overlapping rectangles, sorted by y then x """
+        cdef list area
+        return [rectangle(area[0], area[1], area[2]-area[0], area[3]-area[1]) for area in self.merge_bands()]
@@ -0,0 +1,60 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+#!python
+#cython: auto_pickle=False, boundscheck=False, wraparound=False, cdivision=True
+
+from xpra.buffers.membuf cimport memalign, object_as_buffer, xxh64
+
+from libc.stdint cimport uint8_t, uint64_t
+
+cdef extern from "string.h":
+    void free(void * ptr) nogil
+
+
+#keep the values positive so they can be sent as regular integers:
+DEF HASH_MASK = 0x7fffffffffffffff
+
+
+def hash_tiles(pixels, unsigned int width, unsigned int height, unsigned int rowstride, unsigned int bpp, unsigned int tile_size):
+    """
+        Splits the pixel buffer into square tiles of 'tile_size' pixels
+        (the tiles on the right and bottom edges may be smaller)
+        and returns the xxhash checksum of each tile, in row-major order.
+        The dimensions of the tile are used as seed,
+        so tiles of different sizes never share the same checksum.
+    """
+    assert width>0 and height>0, "invalid dimensions: %ix%i" % (width, height)
+    assert tile_size>0, "invalid tile size: %i" % tile_size
+    cdef uint8_t *buf = NULL
+    cdef Py_ssize_t buf_len = 0
+    assert object_as_buffer(pixels, <const void**> &buf, &buf_len)==0, "cannot get buffer from %s" % type(pixels)
+    cdef size_t row_len = width*bpp
+    assert row_len<=rowstride, "invalid row length: %ix%i=%i but rowstride is %i" % (width, bpp, row_len, rowstride)
+    assert buf_len>=<Py_ssize_t> (rowstride*(height-1)+row_len), "buffer length=%i is too small for %ix%i with rowstride=%i" % (buf_len, width, height, rowstride)
+    cdef unsigned int cols = (width+tile_size-1)//tile_size
+    cdef unsigned int rows = (height+tile_size-1)//tile_size
+    cdef uint64_t *hashes = <uint64_t*> memalign(cols*rows*sizeof(uint64_t))
+    assert hashes!=NULL, "checksum memory allocation failed"
+    cdef unsigned int col, row, y, tw, th
+    cdef uint64_t *row_hashes
+    cdef uint8_t *line
+    try:
+        with nogil:
+            for row in range(rows):
+                th = min(tile_size, height-row*tile_size)
+                row_hashes = hashes+row*cols
+                for col in range(cols):
+                    tw = min(tile_size, width-col*tile_size)
+                    row_hashes[col] = (tw<<16) | th
+                #chain the checksums of each line segment:
+                for y in range(th):
+                    line = buf + (row*tile_size+y)*rowstride
+                    for col in range(cols):
+                        tw = min(tile_size, width-col*tile_size)
+                        row_hashes[col] = <uint64_t> xxh64(line+col*tile_size*bpp, tw*bpp, row_hashes[col])
+        return [hashes[i] & HASH_MASK for i in range(cols*rows)]
+    finally:
+        free(hashes)
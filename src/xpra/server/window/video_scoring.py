@@ -41,9 +41,13 @@ def get_quality_score(csc_format, csc_spec, encoder_spec, scaling, target_qualit
             qscore *= 2.0
     return int(qscore)
 
-def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=100, min_speed=0):
+def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=100, min_speed=0, stripes=1):
     #score based on speed:
     speed = encoder_spec.speed
+    if stripes>1:
+        #the stripes are encoded in parallel,
+        #but with diminishing returns as we add more of them:
+        speed += (100-speed)*(1.0-1.0/stripes)/2.0
     if csc_spec:
         #when subsampling, add the speed gains to the video encoder
         #which now has less work to do:
@@ -55,7 +59,7 @@ def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=10
             for div_x, div_y in (y, u, v):
                 mult += (div_x+div_y)/2.0/3.0
         #average and add 0.25 for the extra cost of doing the csc step:
-        speed = (encoder_spec.speed * mult + csc_spec.speed) / 2.25
+        speed = (speed * mult + csc_spec.speed) / 2.25
 
     #the lower the current speed
     #the more we need a fast encoder/csc to cancel it out:
@@ -74,7 +78,7 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
                        target_quality, min_quality,
                        target_speed, min_speed,
                        current_csce, current_ve,
-                       client_score_delta):
+                       client_score_delta, stripes=1):
     """
         Given an optional csc step (csc_format and csc_spec), and
         and a required encoding step (encoder_spec and width/height),
@@ -85,13 +89,15 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
         Note: we know the current pipeline settings, so the "switching
         cost" will be lower for pipelines that share components with the
         current one.
+        When 'stripes' is more than one, the dimensions are those of each stripe,
+        and the stripes are encoded in parallel using separate pipelines.
 
         Can be called from any thread.
     """
     def clamp(v):
         return max(0, min(100, v))
     qscore = clamp(get_quality_score(enc_in_format, csc_spec, encoder_spec, scaling, target_quality, min_quality))
-    sscore = clamp(get_speed_score(enc_in_format, csc_spec, encoder_spec, scaling, target_speed, min_speed))
+    sscore = clamp(get_speed_score(enc_in_format, csc_spec, encoder_spec, scaling, target_speed, min_speed, stripes))
 
     #how well the codec deals with larger screen sizes:
     sizescore = 100
@@ -162,14 +168,17 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
        current_ve.get_src_format()!=enc_in_format or \
        current_ve.get_width()!=enc_width or current_ve.get_height()!=enc_height:
         #account for new encoder setup cost:
-        ee_score = 100 - encoder_spec.setup_cost
+        ee_score = 100 - min(100, encoder_spec.setup_cost*(stripes+1)//2)
         ee_score += encoder_spec.score_boost
     #edge resistance score: average of csc and encoder score:
     er_score = (ecsc_score + ee_score) / 2.0
+    if stripes>1:
+        #independent streams compress less well and use more packets:
+        runtime_score *= (100.0-2*stripes)/100.0
     score = int((qscore+sscore+er_score+sizescore+client_score_delta)*runtime_score/100.0/4.0)
-    scorelog("get_score(%-7s, %-24r, %-24r, %5i, %5i) quality: %2i, speed: %2i, setup: %2i runtime: %2i scaling: %s / %s, encoder dimensions=%sx%s, sizescore=%3i, client score delta=%3i, score=%2i",
+    scorelog("get_score(%-7s, %-24r, %-24r, %5i, %5i) quality: %2i, speed: %2i, setup: %2i runtime: %2i scaling: %s / %s, encoder dimensions=%sx%s, sizescore=%3i, client score delta=%3i, stripes=%i, score=%2i",
              enc_in_format, csc_spec, encoder_spec, width, height,
-             qscore, sscore, er_score, runtime_score, scaling, encoder_scaling, enc_width, enc_height, sizescore, client_score_delta, score)
+             qscore, sscore, er_score, runtime_score, scaling, encoder_scaling, enc_width, enc_height, sizescore, client_score_delta, stripes, score)
     return score, scaling, csc_scaling, csc_width, csc_height, csc_spec, enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec
 
 def get_encoder_dimensions(csc_spec, encoder_spec, width, height, scaling=(1,1)):
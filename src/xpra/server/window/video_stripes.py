@@ -0,0 +1,170 @@
+# This file is part of Xpra.
+# Copyright (C) 2017 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("video", "encoding")
+
+from xpra.os_util import Queue, monotonic_time
+from xpra.util import envint
+from xpra.server.encode_pool import EncodePool
+
+#maximum number of stripes for a single window (0 or 1 disables striping):
+MAX_STRIPES = envint("XPRA_VIDEO_STRIPES", 0)
+STRIPE_THREADS = max(1, envint("XPRA_VIDEO_STRIPE_THREADS", 4))
+MIN_STRIPE_HEIGHT = max(16, envint("XPRA_VIDEO_MIN_STRIPE_HEIGHT", 256))
+#smaller windows are always encoded using a single pipeline:
+MIN_STRIPE_PIXELS = envint("XPRA_VIDEO_MIN_STRIPE_PIXELS", 2560*1440)
+
+
+#the threads used for encoding the stripes, shared by all the windows:
+stripe_pool = None
+lock = Lock()
+
+def get_stripe_pool():
+    global stripe_pool
+    if stripe_pool:
+        return stripe_pool
+    with lock:
+        if not stripe_pool:
+            stripe_pool = EncodePool("video-stripe", STRIPE_THREADS)
+    return stripe_pool
+
+
+def get_stripe_counts(width, height, max_stripes=MAX_STRIPES):
+    """ the number of stripes worth evaluating for a video area of this size """
+    if max_stripes<2 or width*height<MIN_STRIPE_PIXELS:
+        return []
+    return [n for n in range(2, max_stripes+1) if height//n>=MIN_STRIPE_HEIGHT]
+
+
+class VideoStripe(object):
+    """
+        A horizontal stripe of the video area,
+        encoded as an independent video stream with its own csc and encoder.
+    """
+
+    def __init__(self, index, y, height, csce, ve):
+        self.index = index
+        self.y = y
+        self.height = height
+        self.csce = csce
+        self.ve = ve
+
+    def __repr__(self):
+        return "VideoStripe(%i: %i+%i)" % (self.index, self.y, self.height)
+
+    def get_info(self):
+        info = {
+                "y"         : self.y,
+                "height"    : self.height,
+                "encoder"   : self.ve.get_type(),
+                }
+        if self.csce:
+            info["csc"] = self.csce.get_type()
+        return info
+
+    def clean(self):
+        csce = self.csce
+        if csce:
+            self.csce = None
+            csce.clean()
+        ve = self.ve
+        if ve:
+            self.ve = None
+            ve.clean()
+
+
+class StripedPipeline(object):
+    """
+        A list of stripes of the same size covering the video area,
+        encoded in parallel using the threads from the stripe pool.
+        Only one frame is ever encoded at a time,
+        so each stripe's encoder is only used by one thread at a time.
+    """
+
+    def __init__(self, width, height, src_format, stripe_width, stripes):
+        assert stripes
+        self.width = width
+        self.height = height
+        self.src_format = src_format
+        #the stripes may not cover all the columns:
+        self.stripe_width = stripe_width
+        self.stripes = stripes
+        self.closed = False
+        self.frames = 0
+        self.encode_time = 0
+
+    def __repr__(self):
+        return "StripedPipeline(%ix%i: %i stripes)" % (self.width, self.height, len(self.stripes))
+
+    def get_info(self):
+        info = {
+                "width"     : self.width,
+                "height"    : self.height,
+                "format"    : self.src_format,
+                "stripe-width" : self.stripe_width,
+                "frames"    : self.frames,
+                }
+        if self.frames>0:
+            info["encode-time"] = int(1000*self.encode_time/self.frames)
+        for stripe in self.stripes:
+            info.setdefault("stripe", {})[stripe.index] = stripe.get_info()
+        return info
+
+    def get_covered_height(self):
+        """ the stripes may not cover all the rows """
+        return sum(stripe.height for stripe in self.stripes)
+
+    def matches(self, width, height, src_format):
+        return not self.closed and self.width==width and self.height==height and self.src_format==src_format
+
+    def is_closed(self):
+        return self.closed
+
+    def encode(self, encode_stripe, image, *args):
+        """
+            Calls 'encode_stripe(stripe, image, *args)' for all the stripes in parallel,
+            and returns the results in stripe order.
+            An exception raised in any of the stripes is re-raised here.
+        """
+        pool = get_stripe_pool()
+        results = Queue()
+        def run(stripe):
+            try:
+                results.put((stripe.index, True, encode_stripe(stripe, image, *args)))
+            except Exception as e:
+                log("%s failed on %s", encode_stripe, stripe, exc_info=True)
+                results.put((stripe.index, False, e))
+        start = monotonic_time()
+        for stripe in self.stripes:
+            key = (id(self), stripe.index)
+            pool.assign(key)
+            pool.queue(key, self.is_closed, (False, run, stripe))
+        values = {}
+        error = None
+        for _ in range(len(self.stripes)):
+            #we must wait for all the stripes,
+            #even if one fails, since the image is shared:
+            index, ok, v = results.get()
+            if ok:
+                values[index] = v
+            else:
+                error = v
+        if error:
+            raise error
+        self.frames += 1
+        self.encode_time += monotonic_time()-start
+        return [values[stripe.index] for stripe in self.stripes]
+
+    def clean(self):
+        self.closed = True
+        pool = stripe_pool
+        for stripe in self.stripes:
+            stripe.clean()
+            if pool:
+                pool.release((id(self), stripe.index))
+        self.stripes = []
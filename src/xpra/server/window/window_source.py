@@ -36,6 +36,19 @@ DELTA = envbool("XPRA_DELTA", True)
 MIN_DELTA_SIZE = envint("XPRA_MIN_DELTA_SIZE", 1024)
 MAX_DELTA_SIZE = envint("XPRA_MAX_DELTA_SIZE", 32768)
 MAX_DELTA_HITS = envint("XPRA_MAX_DELTA_HITS", 20)
+DELTA_SPANS = envbool("XPRA_DELTA_SPANS", True)
+#sending spans is cheap, so we can use delta for much larger regions:
+MAX_DELTA_SPANS_SIZE = envint("XPRA_MAX_DELTA_SPANS_SIZE", 1024*1024)
+#maximum size of the spans, as a percentage of the size of the pixels:
+MAX_DELTA_SPANS_RATIO = envint("XPRA_MAX_DELTA_SPANS_RATIO", 25)
+#how many frames of the same size we keep as delta references:
+MAX_DELTA_REFS = max(1, envint("XPRA_MAX_DELTA_REFS", 3))
+DELTA_SPANS_ENCODINGS = ("rgb24", "rgb32")
+TILE_CACHE = envbool("XPRA_TILE_CACHE", True)
+TILE_SIZE = envint("XPRA_TILE_SIZE", 64)
+MIN_TILE_REGION_SIZE = envint("XPRA_MIN_TILE_REGION_SIZE", 128*128)
+MAX_TILE_CACHE_SIZE = envint("XPRA_MAX_TILE_CACHE_SIZE", 4096)
+MAX_TILE_RUNS = envint("XPRA_MAX_TILE_RUNS", 16)
 MIN_WINDOW_REGION_SIZE = envint("XPRA_MIN_WINDOW_REGION_SIZE", 1024)
 MAX_SOFT_EXPIRED = envint("XPRA_MAX_SOFT_EXPIRED", 5)
 
@@ -58,15 +71,38 @@ HARDCODED_ENCODING = os.environ.get("XPRA_HARDCODED_ENCODING")
 from xpra.os_util import StringIOClass, memoryview_to_bytes
 from xpra.server.window.window_stats import WindowPerformanceStatistics
 from xpra.server.window.batch_config import DamageBatchConfig
+from xpra.server.window.damage_trace import new_damage_trace_recorder
+from xpra.server.window.tile_hash import hash_tiles     #@UnresolvedImport
 from xpra.simple_stats import get_list_stats
 from xpra.server.window.batch_delay_calculator import calculate_batch_delay, get_target_speed, get_target_quality
 from xpra.server.cystats import time_weighted_average   #@UnresolvedImport
-from xpra.server.window.region import rectangle, add_rectangle, remove_rectangle, merge_all   #@UnresolvedImport
-from xpra.codecs.xor.cyxor import xor_str           #@UnresolvedImport
+from xpra.server.window.region import rectangle, banded_region, add_rectangle, remove_rectangle  #@UnresolvedImport
+from xpra.codecs.xor.cyxor import xor_str, delta_spans    #@UnresolvedImport
+from xpra.codecs.image_wrapper import ImageWrapper
 from xpra.server.picture_encode import rgb_encode, mmap_send, argb_swap
 from xpra.codecs.loader import PREFERED_ENCODING_ORDER, get_codec
 from xpra.codecs.codec_constants import LOSSY_PIXEL_FORMATS
+from xpra.codecs.tile_cache import TileCache
+from xpra.codecs.encoding_cache import get_encoding_cache, get_cache_key
 from xpra.net import compression
+from xpra.net.compression import LargeStructure
+from xpra.server import metrics
+
+#only lossless encodings can populate the client's tile cache:
+TILE_ENCODINGS = ("png", "rgb24", "rgb32")
+
+ENCODED_FRAMES = metrics.counter("xpra_encoded_frames_total", "Number of screen updates encoded", ("encoding", ))
+ENCODED_PIXELS = metrics.counter("xpra_encoded_pixels_total", "Number of pixels encoded", ("encoding", ))
+ENCODED_BYTES = metrics.counter("xpra_encoded_bytes_total", "Size of the encoded screen updates", ("encoding", ))
+ENCODE_TIME = metrics.histogram("xpra_encode_seconds", "Time spent encoding screen updates", ("encoding", ))
+DAMAGE_IN_LATENCY = metrics.histogram("xpra_damage_in_latency_seconds", "Time from the damage event to the screen update being queued")
+DAMAGE_OUT_LATENCY = metrics.histogram("xpra_damage_out_latency_seconds", "Time from the damage event to the screen update being sent")
+
+def record_encoding_metrics(coding, pixels, size, elapsed):
+    ENCODED_FRAMES.labels(coding).inc()
+    ENCODED_PIXELS.labels(coding).inc(pixels)
+    ENCODED_BYTES.labels(coding).inc(size)
+    ENCODE_TIME.labels(coding).observe(elapsed)
 
 
 class WindowSource(object):
@@ -97,10 +133,12 @@ class WindowSource(object):
                     encoding, encodings, core_encodings, window_icon_encodings, encoding_options, icons_encoding_options,
                     rgb_formats,
                     default_encoding_options,
-                    mmap, mmap_size):
+                    mmap, mmap_size, mmap_ring=None, mmap_lock=None):
         # mmap:
         self._mmap = mmap
         self._mmap_size = mmap_size
+        self._mmap_ring = mmap_ring
+        self._mmap_lock = mmap_lock
 
         self.init_vars()
 
@@ -112,6 +150,7 @@ class WindowSource(object):
         self.compressed_wrapper = compressed_wrapper    #callback utility for making compressed wrappers
         self.wid = wid
         self.window = window                            #only to be used from the UI thread!
+        self.damage_trace = new_damage_trace_recorder(wid, window)
         self.global_statistics = statistics             #shared/global statistics from ServerSource
         self.statistics = WindowPerformanceStatistics()
         self.av_sync = av_sync
@@ -148,6 +187,13 @@ class WindowSource(object):
             if self.supports_delta:
                 self.delta_buckets = min(25, encoding_options.intget("delta_buckets", 1))
                 self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+                #the client can apply spans and store frames in a different bucket:
+                self.supports_delta_spans = DELTA_SPANS and encoding_options.boolget("delta_spans")
+        if not window.is_tray() and TILE_CACHE:
+            #(the client may cache more tiles than we keep track of, which is harmless)
+            tile_cache_size = min(MAX_TILE_CACHE_SIZE, encoding_options.intget("tile_cache", 0))
+            if tile_cache_size>0:
+                self.tile_cache = TileCache(tile_cache_size)
         self.batch_config = batch_config
         #auto-refresh:
         self.auto_refresh_delay = auto_refresh_delay
@@ -263,8 +309,12 @@ class WindowSource(object):
         self.supports_transparency = False
         self.full_frames_only = False
         self.supports_delta = []
+        self.supports_delta_spans = False
         self.delta_buckets = 0
         self.delta_pixel_data = []
+        self.tile_cache = None
+        self.tile_cache_reset = False
+        self.tile_pixel_format = None
         self.suspended = False
         self.strict = STRICT_MODE
         #
@@ -318,6 +368,10 @@ class WindowSource(object):
 
     def cleanup(self):
         self.cancel_damage()
+        dt = self.damage_trace
+        if dt:
+            self.damage_trace = None
+            dt.close()
         self.statistics.reset()
         log("encoding_totals for wid=%s with primary encoding=%s : %s", self.wid, self.encoding, self.statistics.encoding_totals)
         self.init_vars()
@@ -388,9 +442,11 @@ class WindowSource(object):
                 "full-frames-only"      : self.full_frames_only,
                 "supports-transparency" : self.supports_transparency,
                 "delta"                 : {""               : self.supports_delta,
+                                           "spans"          : self.supports_delta_spans,
                                            "buckets"        : self.delta_buckets,
                                            "bucket"         : buckets_info,
                                            },
+                "tile-cache"            : self.get_tile_cache_info(),
                 "property"              : self.get_property_info(),
                 "batch"                 : self.batch_config.get_info(),
                 "soft-timeout"          : {
@@ -408,6 +464,9 @@ class WindowSource(object):
         ma = self.mapped_at
         if ma:
             info["mapped-at"] = ma
+        dt = self.damage_trace
+        if dt:
+            info["damage-trace"] = dt.get_info()
         now = monotonic_time()
         cutoff = now-5
         lde = [x for x in list(self.statistics.last_damage_events) if x[0]>=cutoff]
@@ -456,6 +515,17 @@ class WindowSource(object):
                 "quality"               : self._fixed_quality,
                 }
 
+    def get_tile_cache_info(self):
+        tc = self.tile_cache
+        if tc is None:
+            return {"" : False}
+        info = tc.get_info()
+        info.update({
+                ""          : True,
+                "tile-size" : TILE_SIZE,
+                })
+        return info
+
 
     def go_idle(self):
         self.lock_batch_delay(500)
@@ -583,27 +653,41 @@ class WindowSource(object):
         use_png = has_png and (SAVE_WINDOW_ICONS or w>max_w or h>max_h or (not has_premult) or (pixel_format!="BGRA"))
         iconlog("compress_and_send_window_icon: %sx%s, sending as png=%s", w, h, use_png)
         if use_png:
-            img = PIL.Image.frombuffer("RGBA", (w,h), pixel_data, "raw", pixel_format, 0, 1)
             icon_w, icon_h = self.window_icon_size
-            if w>icon_w or h>icon_h:
-                #scale the icon down to the size the client wants
-                if float(w)/icon_w>=float(h)/icon_h:
-                    h = min(max_h, h*icon_w//w)
-                    w = icon_w
-                else:
-                    w = min(max_w, w*icon_h//h)
-                    h = icon_h
-                iconlog("scaling window icon down to %sx%s", w, h)
-                img = img.resize((w,h), PIL.Image.ANTIALIAS)
-            output = StringIOClass()
-            img.save(output, 'PNG')
-            compressed_data = output.getvalue()
-            output.close()
+            #the same icons are sent again and again (reconnections, new windows, other clients):
+            cache = None
+            if not SAVE_WINDOW_ICONS:
+                cache = get_encoding_cache()
+            cached = None
+            if cache:
+                cache_key = get_cache_key(pixel_data, "window-icon", pixel_format, w, h, icon_w, icon_h, max_w, max_h)
+                cached = cache.get(cache_key)
+            if cached:
+                w, h, compressed_data = cached
+                iconlog("using cached png window icon")
+            else:
+                img = PIL.Image.frombuffer("RGBA", (w,h), pixel_data, "raw", pixel_format, 0, 1)
+                if w>icon_w or h>icon_h:
+                    #scale the icon down to the size the client wants
+                    if float(w)/icon_w>=float(h)/icon_h:
+                        h = min(max_h, h*icon_w//w)
+                        w = icon_w
+                    else:
+                        w = min(max_w, w*icon_h//h)
+                        h = icon_h
+                    iconlog("scaling window icon down to %sx%s", w, h)
+                    img = img.resize((w,h), PIL.Image.ANTIALIAS)
+                output = StringIOClass()
+                img.save(output, 'PNG')
+                compressed_data = output.getvalue()
+                output.close()
+                if cache:
+                    cache.add(cache_key, (w, h, compressed_data), len(compressed_data))
+                if SAVE_WINDOW_ICONS:
+                    filename = "server-window-%i-icon-%i.png" % (self.wid, int(time.time()))
+                    img.save(filename, 'PNG')
+                    iconlog("server window icon saved to %s", filename)
             wrapper = compression.Compressed("png", compressed_data)
-            if SAVE_WINDOW_ICONS:
-                filename = "server-window-%i-icon-%i.png" % (self.wid, int(time.time()))
-                img.save(filename, 'PNG')
-                iconlog("server window icon saved to %s", filename)
         elif ("premult_argb32" in self.window_icon_encodings) and pixel_format=="BGRA":
             wrapper = self.compressed_wrapper("premult_argb32", str(pixel_data))
         else:
@@ -1084,6 +1168,8 @@ class WindowSource(object):
             self.statistics.last_resized = now
             self.window_dimensions = ww, wh
             self.encode_queue_max_size = max(2, min(30, MAX_SYNC_BUFFER_SIZE/(ww*wh*4)))
+        if self.damage_trace and "auto_refresh" not in options:
+            self.damage_trace.record_damage(x, y, w, h, ww, wh)
         if self.full_frames_only:
             x, y, w, h = 0, 0, ww, wh
 
@@ -1091,9 +1177,7 @@ class WindowSource(object):
         if delayed:
             #use existing delayed region:
             if not self.full_frames_only:
-                regions = delayed[1]
-                region = rectangle(x, y, w, h)
-                add_rectangle(regions, region)
+                delayed[1].add(x, y, w, h)
             #merge/override options
             if options is not None:
                 override = options.get("override_options", False)
@@ -1121,11 +1205,15 @@ class WindowSource(object):
                 self.batch_config.delay = int(self.batch_config.min_delay * max(eratio, pratio))
 
         delay = options.get("delay", self.batch_config.delay)
-        if now-self.statistics.last_resized<0.250:
+        #the initial refresh of a new client's windows is sent as quickly as possible,
+        #even though all the windows have just been "resized" and are queued together:
+        #(see ServerBase.send_initial_damage)
+        initial = options.get("initial", False)
+        if now-self.statistics.last_resized<0.250 and not initial:
             #recently resized, batch more
             delay = max(50, delay+25)
         qsize = self.queue_size()
-        if qsize>4:
+        if qsize>4 and not initial:
             #the queue is getting big, try to slow down progressively:
             delay = max(10, min(self.batch_config.min_delay, delay)) * (qsize/4.0)
         delay = max(delay, options.get("min_delay", 0))
@@ -1159,7 +1247,8 @@ class WindowSource(object):
             return
 
         #create a new delayed region:
-        regions = [rectangle(x, y, w, h)]
+        regions = banded_region()
+        regions.add(x, y, w, h)
         self._damage_delayed_expired = False
         actual_encoding = options.get("encoding", self.encoding)
         self._damage_delayed = now, regions, actual_encoding, options or {}
@@ -1346,12 +1435,15 @@ class WindowSource(object):
             assert actual_encoding is not None
             self.process_damage_region(damage_time, 0, 0, ww, wh, actual_encoding, options)
 
+        #regions can be a banded_region or a list of rectangles,
+        #either way we work on a copy without any overlapping areas:
+        region = banded_region(regions)
         if exclude_region is None:
             if self.full_frames_only:
                 send_full_window_update()
                 return
 
-            if len(regions)>self.max_small_regions:
+            if len(region)>self.max_small_regions:
                 #too many regions!
                 send_full_window_update()
                 return
@@ -1360,10 +1452,10 @@ class WindowSource(object):
                 send_full_window_update()
                 return
 
-        regions = list(set(regions))
+        regions = region.get_rectangles()
         if MERGE_REGIONS:
             bytes_threshold = ww*wh*self.max_bytes_percent/100
-            pixel_count = sum(rect.width*rect.height for rect in regions)
+            pixel_count = region.get_area()
             bytes_cost = pixel_count+self.small_packet_cost*len(regions)
             log("send_delayed_regions: bytes_cost=%s, bytes_threshold=%s, pixel_count=%s", bytes_cost, bytes_threshold, pixel_count)
             if bytes_cost>=bytes_threshold:
@@ -1374,11 +1466,11 @@ class WindowSource(object):
                 #make regions out of the rest of the window area:
                 non_exclude = rectangle(0, 0, ww, wh).substract_rect(exclude_region)
                 #and keep those that have damage areas in them:
-                regions = [x for x in non_exclude if len([y for y in regions if x.intersects_rect(y)])>0]
+                regions = [x for x in non_exclude if region.intersects_rect(x)]
                 #TODO: should verify that is still better than what we had before..
             elif len(regions)>1:
                 #try to merge all the regions to see if we save anything:
-                merged = merge_all(regions)
+                merged = region.get_extents()
                 #remove the exclude region if needed:
                 if exclude_region:
                     merged_rects = merged.substract_rect(exclude_region)
@@ -1411,11 +1503,9 @@ class WindowSource(object):
         #we're processing a number of regions separately,
         #start by removing the exclude region if there is one:
         if exclude_region:
-            e_regions = []
-            for r in regions:
-                for v in r.substract_rect(exclude_region):
-                    e_regions.append(v)
-            regions = e_regions
+            region = banded_region(regions)
+            region.remove_rect(exclude_region)
+            regions = region.get_rectangles()
             log("send_delayed_regions: remaining regions for exclude=%s : %s", exclude_region, len(regions))
         #then figure out which encoding will get used,
         #and shortcut out if this needs to be a full window update:
@@ -1484,6 +1574,8 @@ class WindowSource(object):
         if self.is_cancelled(sequence):
             image.free()
             return
+        if self.damage_trace:
+            self.damage_trace.record_image(image)
         self.pixel_format = image.get_pixel_format()
         self.image_depth = image.get_depth()
 
@@ -1524,7 +1616,7 @@ class WindowSource(object):
         x, y, w, h = packet[2:6]
         client_options = packet[10]     #info about this packet from the encoder
         actual_quality = client_options.get("quality", 0)
-        if encoding.startswith("png") or encoding.startswith("rgb"):
+        if encoding.startswith("png") or encoding.startswith("rgb") or encoding=="tiles":
             actual_quality = 100
         #jpeg uses colour subsampling by default, otherwise check the csc format value:
         lossy_csc = encoding=="jpeg" or client_options.get("csc") in LOSSY_PIXEL_FORMATS
@@ -1721,11 +1813,13 @@ class WindowSource(object):
                 if damage_time>0:
                     damage_out_latency = now-process_damage_time
                     self.statistics.damage_out_latency.append((now, width*height, actual_batch_delay, damage_out_latency))
+                    DAMAGE_OUT_LATENCY.observe(damage_out_latency)
                     self.statistics.damage_send_speed.append((now, bytecount-start_bytecount, now-start_send_time))
         if damage_time>0:
             now = monotonic_time()
             damage_in_latency = now-process_damage_time
             self.statistics.damage_in_latency.append((now, width*height, actual_batch_delay, damage_in_latency))
+            DAMAGE_IN_LATENCY.observe(damage_in_latency)
         self.queue_packet(packet, self.wid, width*height, start_send, damage_packet_sent)
 
     def damage_packet_acked(self, damage_packet_sequence, width, height, decode_time, message):
@@ -1775,10 +1869,60 @@ class WindowSource(object):
         self.global_statistics.decode_errors += 1
         #something failed client-side, so we can't rely on the delta being available
         self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        self.reset_tile_cache()
         if self.window:
             self.timeout_add(250, self.full_quality_refresh)
 
 
+    def find_delta_reference(self, w, h, pixel_format, coding, dpixels):
+        """
+            Finds the stored frame which is the closest to the new pixels,
+            returns the bucket, its sequence number, hit count
+            and the spans which differ from it (None if there are too many changes).
+        """
+        dlen = len(dpixels)
+        max_size = dlen*MAX_DELTA_SPANS_RATIO//100
+        bucket, delta, hits, spans = -1, -1, 0, None
+        for i, dr in enumerate(list(self.delta_pixel_data)):
+            if dr is None:
+                continue
+            lw, lh, lpixel_format, lcoding, lsequence, buflen, ldata, lhits, _ = dr
+            if lw!=w or lh!=h or lpixel_format!=pixel_format or lcoding!=coding or buflen!=dlen:
+                continue
+            if MAX_DELTA_HITS>0 and lhits>=MAX_DELTA_HITS:
+                deltalog("delta: too many hits for bucket %s: %s, clearing it", i, lhits)
+                self.delta_pixel_data[i] = None
+                continue
+            s = delta_spans(dpixels, ldata, max_size)
+            if s is not None and len(s)==0:
+                #identical: xoring gives us a buffer of zeroes which compresses very well
+                return i, lsequence, lhits, None
+            if s is not None:
+                bucket, delta, hits, spans = i, lsequence, lhits, s
+                max_size = len(s)-1
+            elif bucket<0:
+                #not worth sending spans, but we can still xor with it:
+                bucket, delta, hits = i, lsequence, lhits
+        deltalog("find_delta_reference%s=%s", (w, h, pixel_format, coding), (bucket, delta, hits, len(spans or "")))
+        return bucket, delta, hits, spans
+
+    def get_delta_store_bucket(self, w, h, pixel_format, coding):
+        """
+            We keep up to MAX_DELTA_REFS frames for each region size,
+            so deltas can use older frames as reference.
+            Returns the least recently used of those frames when we have enough of them,
+            otherwise an empty bucket or the least recently used bucket.
+        """
+        lpd = self.delta_pixel_data
+        same = [i for i,dr in enumerate(lpd) if dr and dr[0]==w and dr[1]==h and dr[2]==pixel_format and dr[3]==coding]
+        if len(same)<MAX_DELTA_REFS:
+            if None in lpd:
+                return lpd.index(None)
+            candidates = range(len(lpd))
+        else:
+            candidates = same
+        return min(candidates, key=lambda i : lpd[i][-1])
+
     def make_data_packet(self, damage_time, process_damage_time, image, coding, sequence, options, flush):
         """
             Picture encoding - non-UI thread.
@@ -1803,7 +1947,15 @@ class WindowSource(object):
         psize = isize*4
         log("make_data_packet: image=%s, damage data: %s", image, (self.wid, x, y, w, h, coding))
         start = monotonic_time()
+        tiles = None
+        if self.tile_cache is not None and coding in TILE_ENCODINGS and isize>=MIN_TILE_REGION_SIZE and not self._mmap:
+            tiles = self.get_tiles(image)
+            if tiles:
+                packet = self.make_tile_packets(damage_time, process_damage_time, image, coding, tiles, options, flush)
+                if packet:
+                    return packet
         delta, store, bucket, hits = -1, -1, -1, 0
+        spans = None
         pixel_format = image.get_pixel_format()
         #use delta pre-compression for this encoding if:
         #* client must support delta (at least one bucket)
@@ -1811,7 +1963,11 @@ class WindowSource(object):
         #* size is worth xoring (too small is pointless, too big is too expensive)
         #* the pixel format is supported by the client
         # (if we have to rgb_reformat the buffer, it really complicates things)
-        if self.delta_buckets>0 and (coding in self.supports_delta) and self.min_delta_size<isize<self.max_delta_size and \
+        max_delta_size = self.max_delta_size
+        if max_delta_size>0 and self.supports_delta_spans and coding in DELTA_SPANS_ENCODINGS:
+            #spans are cheap to send, so we can use them for larger regions:
+            max_delta_size = max(max_delta_size, MAX_DELTA_SPANS_SIZE)
+        if self.delta_buckets>0 and (coding in self.supports_delta) and self.min_delta_size<isize<max_delta_size and \
             pixel_format in self.rgb_formats:
             #this may save space (and lower the cost of xoring):
             image.may_restride()
@@ -1823,27 +1979,40 @@ class WindowSource(object):
             dlen = len(dpixels)
             store = sequence
             deltalog("delta available for %s and %i %s pixels on wid=%i", coding, isize, pixel_format, self.wid)
-            for i, dr in enumerate(list(self.delta_pixel_data)):
-                if dr is None:
-                    continue
-                lw, lh, lpixel_format, lcoding, lsequence, buflen, ldata, hits, _ = dr
-                if lw==w and lh==h and lpixel_format==pixel_format and lcoding==coding and buflen==dlen:
-                    bucket = i
-                    if MAX_DELTA_HITS>0 and hits<MAX_DELTA_HITS:
-                        deltalog("delta: using matching bucket %s: %sx%s (%s, %i bytes, sequence=%i, hit count=%s)", i, lw, lh, lpixel_format, dlen, lsequence, hits)
-                        #xor with this matching delta bucket:
-                        delta = lsequence
-                        xored = xor_str(dpixels, ldata)
-                        image.set_pixels(xored)
-                        dr[-1] = monotonic_time()            #update last used time
-                        hits += 1
-                        dr[-2] = hits               #update hit count
+            if self.supports_delta_spans and coding in DELTA_SPANS_ENCODINGS:
+                bucket, delta, hits, spans = self.find_delta_reference(w, h, pixel_format, coding, dpixels)
+                if bucket>=0:
+                    dr = self.delta_pixel_data[bucket]
+                    dr[-1] = monotonic_time()            #update last used time
+                    hits += 1
+                    dr[-2] = hits               #update hit count
+                    if spans is not None:
+                        deltalog("delta: sending %i bytes of spans against bucket %i (sequence=%i)", len(spans), bucket, delta)
+                        image = ImageWrapper(x, y, w, h, spans, pixel_format, image.get_depth(), image.get_rowstride(), image.get_bytesperpixel())
                     else:
-                        deltalog("delta: too many hits for bucket %s: %s, clearing it", bucket, hits)
-                        hits = 0
-                        self.delta_pixel_data[i] = None
-                        delta = -1
-                    break
+                        image.set_pixels(xor_str(dpixels, dr[6]))
+            else:
+                for i, dr in enumerate(list(self.delta_pixel_data)):
+                    if dr is None:
+                        continue
+                    lw, lh, lpixel_format, lcoding, lsequence, buflen, ldata, hits, _ = dr
+                    if lw==w and lh==h and lpixel_format==pixel_format and lcoding==coding and buflen==dlen:
+                        bucket = i
+                        if MAX_DELTA_HITS>0 and hits<MAX_DELTA_HITS:
+                            deltalog("delta: using matching bucket %s: %sx%s (%s, %i bytes, sequence=%i, hit count=%s)", i, lw, lh, lpixel_format, dlen, lsequence, hits)
+                            #xor with this matching delta bucket:
+                            delta = lsequence
+                            xored = xor_str(dpixels, ldata)
+                            image.set_pixels(xored)
+                            dr[-1] = monotonic_time()            #update last used time
+                            hits += 1
+                            dr[-2] = hits               #update hit count
+                        else:
+                            deltalog("delta: too many hits for bucket %s: %s, clearing it", bucket, hits)
+                            hits = 0
+                            self.delta_pixel_data[i] = None
+                            delta = -1
+                        break
 
         #by default, don't set rowstride (the container format will take care of providing it):
         encoder = self._encoders.get(coding)
@@ -1864,10 +2033,14 @@ class WindowSource(object):
         if coding!="mmap" and (self.is_cancelled(sequence) or self.suspended):
             log("make_data_packet: dropping data packet for window %s with sequence=%s", self.wid, sequence)
             return  None
+        if tiles:
+            self.store_tiles(tiles, coding, client_options)
         #tell client about delta/store for this pixmap:
         if delta>=0:
             client_options["delta"] = delta
             client_options["bucket"] = bucket
+            if spans is not None:
+                client_options["delta_spans"] = True
         csize = len(data)
         if store>0:
             if delta>0 and csize>=psize*40//100:
@@ -1879,23 +2052,32 @@ class WindowSource(object):
                 #(add a new client capability and send it a zero store value)
             else:
                 #find the bucket to use:
-                if bucket<0:
-                    lpd = self.delta_pixel_data
-                    try:
-                        bucket = lpd.index(None)
-                        deltalog("delta: found empty bucket %i", bucket)
-                    except ValueError:
-                        #find a bucket which has not been used recently
-                        t = 0
-                        bucket = 0
-                        for i,dr in enumerate(lpd):
-                            if dr and (t==0 or dr[-1]<t):
-                                t = dr[-1]
-                                bucket = i
-                        deltalog("delta: using oldest bucket %i", bucket)
-                self.delta_pixel_data[bucket] = [w, h, pixel_format, coding, store, len(dpixels), dpixels, hits, monotonic_time()]
+                if self.supports_delta_spans:
+                    #keep the reference frame, so we can have more than one for each region size:
+                    store_bucket = self.get_delta_store_bucket(w, h, pixel_format, coding)
+                else:
+                    if bucket<0:
+                        lpd = self.delta_pixel_data
+                        try:
+                            bucket = lpd.index(None)
+                            deltalog("delta: found empty bucket %i", bucket)
+                        except ValueError:
+                            #find a bucket which has not been used recently
+                            t = 0
+                            bucket = 0
+                            for i,dr in enumerate(lpd):
+                                if dr and (t==0 or dr[-1]<t):
+                                    t = dr[-1]
+                                    bucket = i
+                            deltalog("delta: using oldest bucket %i", bucket)
+                    store_bucket = bucket
+                self.delta_pixel_data[store_bucket] = [w, h, pixel_format, coding, store, len(dpixels), dpixels, hits, monotonic_time()]
                 client_options["store"] = store
-                client_options["bucket"] = bucket
+                if delta>=0 and store_bucket!=bucket:
+                    #"bucket" is the delta reference:
+                    client_options["store_bucket"] = store_bucket
+                else:
+                    client_options["bucket"] = store_bucket
                 #record number of frames and pixels:
                 totals = self.statistics.encoding_totals.setdefault("delta", [0, 0])
                 totals[0] = totals[0] + 1
@@ -1920,8 +2102,145 @@ class WindowSource(object):
         compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %6s with ratio %5.1f%%  (%5iKB to %5iKB), sequence %5i, client_options=%s",
                  (end-start)*1000.0, outw, outh, x, y, self.wid, coding, 100.0*csize/psize, psize/1024, csize/1024, self._damage_packet_sequence, client_options)
         self.statistics.encoding_stats.append((end, coding, w*h, bpp, len(data), end-start))
+        record_encoding_metrics(coding, w*h, len(data), end-start)
         return self.make_draw_packet(x, y, outw, outh, coding, data, outstride, client_options, options)
 
+    def reset_tile_cache(self):
+        tc = self.tile_cache
+        if tc is not None and len(tc)>0:
+            tc.clear()
+            #tell the client to clear its cache with the next tiles it stores:
+            self.tile_cache_reset = True
+
+    def get_tiles(self, image):
+        """
+            Returns the checksums of the tiles of this image,
+            or None if the image cannot be split into tiles.
+        """
+        if image.get_planes()!=0:
+            return None
+        pixel_format = image.get_pixel_format()
+        if pixel_format!=self.tile_pixel_format:
+            #the cached tiles use a different pixel format:
+            self.reset_tile_cache()
+            self.tile_pixel_format = pixel_format
+        pixels = image.get_pixels()
+        if not pixels:
+            return None
+        return hash_tiles(pixels, image.get_width(), image.get_height(), image.get_rowstride(), image.get_bytesperpixel(), TILE_SIZE)
+
+    def store_tiles(self, tiles, coding, client_options):
+        """
+            Tells the client to add the tiles of this screen update to its cache,
+            if they were encoded without any loss.
+        """
+        if coding not in TILE_ENCODINGS or client_options.get("scaled_size"):
+            return
+        tc = self.tile_cache
+        for tile in tiles:
+            tc.add(tile)
+        client_options["tile-store"] = tiles
+        client_options["tile-size"] = TILE_SIZE
+        if self.tile_cache_reset:
+            self.tile_cache_reset = False
+            client_options["tile-reset"] = True
+
+    def make_tile_packets(self, damage_time, process_damage_time, image, coding, tiles, options, flush):
+        """
+            Sends the tiles that the client already has in its cache as a 'tiles' packet,
+            and encodes the rows of tiles it does not have separately.
+            Returns the last packet, or None if the image should be encoded as a whole.
+        """
+        tc = self.tile_cache
+        x, y, w, h = image.get_geometry()[:4]
+        cols = (w+TILE_SIZE-1)//TILE_SIZE
+        rows = len(tiles)//cols
+        cached = []
+        #rows of tiles we have to send, as [row_start, row_end, col_start, col_end]
+        #(rows with the exact same columns are merged together):
+        runs = []
+        prev_runs = {}
+        for row in range(rows):
+            row_runs = {}
+            col = 0
+            while col<cols:
+                tile = tiles[row*cols+col]
+                if tile in tc:
+                    cached.append((col*TILE_SIZE, row*TILE_SIZE, tile))
+                    col += 1
+                    continue
+                start_col = col
+                while col<cols and tiles[row*cols+col] not in tc:
+                    col += 1
+                run = prev_runs.get((start_col, col))
+                if run:
+                    run[1] = row+1
+                else:
+                    run = [row, row+1, start_col, col]
+                    runs.append(run)
+                row_runs[(start_col, col)] = run
+            prev_runs = row_runs
+        if not cached:
+            return None
+        if len(runs)>MAX_TILE_RUNS:
+            #avoid fragmentation, which is too costly
+            deltalog("tile cache: too many rows of tiles to send (%i), sending just one image instead", len(runs))
+            return None
+        encoder = self._encoders.get(coding)
+        if encoder is None:
+            return None
+        start = monotonic_time()
+        #the client will lookup the tiles in the same order:
+        for _, _, tile in cached:
+            tc.get(tile)
+        count = len(runs)
+        def get_client_options(remaining):
+            client_options = {}
+            if self.supports_flush:
+                if remaining>0:
+                    client_options["flush"] = remaining
+                elif flush not in (None, 0):
+                    client_options["flush"] = flush
+            return client_options
+        packets = [self.make_draw_packet(x, y, w, h, "tiles", LargeStructure("tiles", cached), 0, get_client_options(count), options)]
+        compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %6s with %i cached tiles, %i rows of tiles to send",
+                 (monotonic_time()-start)*1000.0, w, h, x, y, self.wid, "tiles", len(cached), count)
+        for row_start, row_end, col_start, col_end in runs:
+            substart = monotonic_time()
+            sx, sy = col_start*TILE_SIZE, row_start*TILE_SIZE
+            sw, sh = min(w, col_end*TILE_SIZE)-sx, min(h, row_end*TILE_SIZE)-sy
+            sub = image.get_sub_image(sx, sy, sw, sh)
+            ret = encoder(coding, sub, options)
+            if not ret:
+                #cancelled? we still have to send the packets we have,
+                #since the client must update its cache like we did:
+                client_options = packets[-1][10]
+                client_options.pop("flush", None)
+                client_options.update(get_client_options(0))
+                break
+            scoding, data, client_options, outw, outh, outstride, bpp = ret
+            count -= 1
+            client_options.update(get_client_options(count))
+            sub_tiles = []
+            for row in range(row_start, row_end):
+                sub_tiles += tiles[row*cols+col_start:row*cols+col_end]
+            self.store_tiles(sub_tiles, scoding, client_options)
+            packets.append(self.make_draw_packet(sub.get_x(), sub.get_y(), outw, outh, scoding, data, outstride, client_options, options))
+            end = monotonic_time()
+            psize = sw*sh*4
+            csize = len(data)
+            compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %6s with ratio %5.1f%%  (%5iKB to %5iKB), sequence %5i, client_options=%s",
+                 (end-substart)*1000.0, sw, sh, sx, sy, self.wid, scoding, 100.0*csize/psize, psize/1024, csize/1024, self._damage_packet_sequence, client_options)
+            self.statistics.encoding_stats.append((end, scoding, sw*sh, bpp, csize, end-substart))
+            record_encoding_metrics(scoding, sw*sh, csize, end-substart)
+        for packet in packets[:-1]:
+            self.queue_damage_packet(packet, damage_time, process_damage_time)
+        if len(packets)>1 and self.refresh_regions:
+            #the cached tiles are lossless too:
+            self.remove_refresh_region(rectangle(x, y, w, h))
+        #the caller queues the last packet:
+        return packets[-1]
+
     def make_draw_packet(self, x, y, outw, outh, coding, data, outstride, client_options={}, options={}):
         packet = ("draw", self.wid, x, y, outw, outh, coding, data, self._damage_packet_sequence, outstride, client_options)
         self.global_statistics.packet_count += 1
@@ -1963,7 +2282,7 @@ class WindowSource(object):
 
     def mmap_encode(self, coding, image, options):
         assert self._mmap and self._mmap_size>0
-        v = mmap_send(self._mmap, self._mmap_size, image, self.rgb_formats, self.supports_transparency)
+        v = mmap_send(self._mmap, self._mmap_size, image, self.rgb_formats, self.supports_transparency, self._mmap_ring, self._mmap_lock)
         if v is None:
             return None
         mmap_info, mmap_free_size, written = v
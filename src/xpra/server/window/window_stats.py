@@ -18,13 +18,12 @@ from xpra.log import Logger
 log = Logger("stats")
 
 from collections import deque
-from xpra.simple_stats import get_list_stats, get_weighted_list_stats
+from xpra.simple_stats import get_weighted_list_stats
 from xpra.os_util import monotonic_time
 from xpra.util import engs, csv, envint
 from xpra.server.cystats import (logp,      #@UnresolvedImport
-    calculate_time_weighted_average,        #@UnresolvedImport
-    calculate_timesize_weighted_average,    #@UnresolvedImport
-    calculate_for_average)                  #@UnresolvedImport
+    calculate_for_average,                  #@UnresolvedImport
+    TimeSeries)                             #@UnresolvedImport
 
 
 TARGET_LATENCY_TOLERANCE = envint("XPRA_TARGET_LATENCY_TOLERANCE", 20)/1000.0
@@ -43,15 +42,15 @@ class WindowPerformanceStatistics(object):
     DEFAULT_TARGET_LATENCY = 0.1
 
     def reset(self):
-        self.client_decode_time = deque(maxlen=NRECS)       #records how long it took the client to decode frames:
+        self.client_decode_time = TimeSeries(NRECS, 3)      #records how long it took the client to decode frames:
                                                             #(ack_time, no of pixels, decoding_time*1000*1000)
         self.encoding_stats = deque(maxlen=NRECS)           #encoding: (time, coding, pixels, bpp, compressed_size, encoding_time)
         # statistics:
-        self.damage_in_latency = deque(maxlen=NRECS)        #records how long it took for a damage request to be sent
+        self.damage_in_latency = TimeSeries(NRECS, 4)       #records how long it took for a damage request to be sent
                                                             #last NRECS: (sent_time, no of pixels, actual batch delay, damage_latency)
-        self.damage_out_latency = deque(maxlen=NRECS)       #records how long it took for a damage request to be processed
+        self.damage_out_latency = TimeSeries(NRECS, 4)      #records how long it took for a damage request to be processed
                                                             #last NRECS: (processed_time, no of pixels, actual batch delay, damage_latency)
-        self.damage_send_speed = deque(maxlen=NRECS)        #how long it took to send damage packets (this is not a sustained speed)
+        self.damage_send_speed = TimeSeries(NRECS, 3)       #how long it took to send damage packets (this is not a sustained speed)
                                                             #last NRECS: (sent_time, no_of_pixels, elapsed_time)
         self.damage_ack_pending = {}                        #records when damage packets are sent
                                                             #so we can calculate the "client_latency" when the client sends
@@ -82,19 +81,17 @@ class WindowPerformanceStatistics(object):
     def update_averages(self):
         #damage "in" latency: (the time it takes for damage requests to be processed only)
         if len(self.damage_in_latency)>0:
-            data = [(when, latency) for when, _, _, latency in list(self.damage_in_latency)]
-            self.avg_damage_in_latency, self.recent_damage_in_latency =  calculate_time_weighted_average(data)
+            self.avg_damage_in_latency, self.recent_damage_in_latency =  self.damage_in_latency.time_weighted_average()
         #damage "out" latency: (the time it takes for damage requests to be processed and sent out)
         if len(self.damage_out_latency)>0:
-            data = [(when, latency) for when, _, _, latency in list(self.damage_out_latency)]
-            self.avg_damage_out_latency, self.recent_damage_out_latency = calculate_time_weighted_average(data)
+            self.avg_damage_out_latency, self.recent_damage_out_latency = self.damage_out_latency.time_weighted_average()
         #client decode speed:
         if len(self.client_decode_time)>0:
             #the elapsed time recorded is in microseconds, so multiply by 1000*1000 to get the real value:
-            self.avg_decode_speed, self.recent_decode_speed = calculate_timesize_weighted_average(list(self.client_decode_time), sizeunit=1000*1000)
+            self.avg_decode_speed, self.recent_decode_speed = self.client_decode_time.timesize_weighted_average(1, sizeunit=1000*1000)
         #network send speed:
         if len(self.damage_send_speed)>0:
-            self.avg_send_speed, self.recent_send_speed = calculate_timesize_weighted_average(list(self.damage_send_speed))
+            self.avg_send_speed, self.recent_send_speed = self.damage_send_speed.timesize_weighted_average(1)
         all_l = [0.1,
                  self.avg_damage_in_latency, self.recent_damage_in_latency,
                  self.avg_damage_out_latency, self.recent_damage_out_latency]
@@ -190,10 +187,8 @@ class WindowPerformanceStatistics(object):
                 add_compression_stats(enc_stats, encoding)
 
         dinfo = info.setdefault("damage", {})
-        latencies = [x*1000 for _, _, _, x in list(self.damage_in_latency)]
-        dinfo["in_latency"]  = get_list_stats(latencies, show_percentile=[9])
-        latencies = [x*1000 for _, _, _, x in list(self.damage_out_latency)]
-        dinfo["out_latency"] = get_list_stats(latencies, show_percentile=[9])
+        dinfo["in_latency"]  = self.damage_in_latency.get_list_stats(1000, show_percentile=[9])
+        dinfo["out_latency"] = self.damage_out_latency.get_list_stats(1000, show_percentile=[9])
         #per encoding totals:
         if self.encoding_totals:
             tf = info.setdefault("total_frames", {})
@@ -212,7 +207,7 @@ class WindowPerformanceStatistics(object):
             """
         decoding_latency = 0.010
         if len(self.client_decode_time)>0:
-            decoding_latency, _ = calculate_timesize_weighted_average(list(self.client_decode_time))
+            decoding_latency, _ = self.client_decode_time.timesize_weighted_average(1)
             decoding_latency /= 1000.0
         min_latency = max(abs_min, min_client_latency or abs_min)*1.2
         avg_latency = max(min_latency, avg_client_latency or abs_min)
@@ -13,10 +13,11 @@ from math import sqrt
 from xpra.net.compression import Compressed, LargeStructure
 from xpra.codecs.codec_constants import TransientCodecException, RGB_FORMATS, PIXEL_SUBSAMPLING
 from xpra.server.window.window_source import WindowSource, STRICT_MODE, AUTO_REFRESH_SPEED, AUTO_REFRESH_QUALITY
-from xpra.server.window.region import merge_all          #@UnresolvedImport
-from xpra.server.window.motion import ScrollData                    #@UnresolvedImport
+from xpra.server.window.region import banded_region      #@UnresolvedImport
+from xpra.server.window.motion import ScrollDetector                #@UnresolvedImport
 from xpra.server.window.video_subregion import VideoSubregion, VIDEO_SUBREGION
 from xpra.server.window.video_scoring import get_pipeline_score
+from xpra.server.window.video_stripes import StripedPipeline, VideoStripe, get_stripe_counts, MAX_STRIPES
 from xpra.codecs.loader import PREFERED_ENCODING_ORDER, EDGE_ENCODING_ORDER
 from xpra.util import parse_scaling_value, engs, envint, envbool, csv, roundup, print_nested_dict
 from xpra.os_util import monotonic_time
@@ -73,6 +74,7 @@ class WindowVideoSource(WindowSource):
         self.supports_scrolling = self.scroll_encoding and self.encoding_options.boolget("scrolling") and not STRICT_MODE
         self.supports_video_scaling = self.encoding_options.boolget("video_scaling", False)
         self.supports_video_b_frames = self.encoding_options.strlistget("video_b_frames", [])
+        self.supports_video_stripes = MAX_STRIPES>1 and self.encoding_options.boolget("video_stripes", False)
 
     def init_encoders(self):
         WindowSource.init_encoders(self)
@@ -94,6 +96,7 @@ class WindowVideoSource(WindowSource):
         #those two instances should only ever be modified or accessed from the encode thread:
         self._csc_encoder = None
         self._video_encoder = None
+        self._video_stripes = None
         self._last_pipeline_check = 0
 
     def __repr__(self):
@@ -118,6 +121,9 @@ class WindowVideoSource(WindowSource):
         self.last_pipeline_time = 0
 
         self.supports_video_scaling = False
+        self.supports_video_stripes = False
+        #the number of stripes chosen by the pipeline scoring, 0 when not striping:
+        self.video_stripes = 0
 
         self.full_csc_modes = {}                            #for 0.12 onwards: per encoding lists
         self.video_encodings = []
@@ -164,6 +170,7 @@ class WindowVideoSource(WindowSource):
     def get_client_info(self):
         info = {
                 "supports_video_scaling"    : self.supports_video_scaling,
+                "supports_video_stripes"    : self.supports_video_stripes,
                 }
         for enc, csc_modes in (self.full_csc_modes or {}).items():
             info["csc_modes.%s" % enc] = csc_modes
@@ -196,6 +203,9 @@ class WindowVideoSource(WindowSource):
                 log.error("Error collecting codec information from %s", x, exc_info=True)
         addcinfo("csc", self._csc_encoder)
         addcinfo("encoder", self._video_encoder)
+        sp = self._video_stripes
+        if sp:
+            info["stripes"] = sp.get_info()
         info.setdefault("encodings", {}).update({
                                                  "non-video"    : self.non_video_encodings,
                                                  "video"        : self.common_video_encodings,
@@ -272,14 +282,18 @@ class WindowVideoSource(WindowSource):
         """ Calls clean() from the encode thread """
         csce = self._csc_encoder
         ve = self._video_encoder
-        if csce or ve:
+        sp = self._video_stripes
+        if csce or ve or sp:
             self._csc_encoder = None
             self._video_encoder = None
+            self._video_stripes = None
             def clean():
                 if csce:
                     csce.clean()
                 if ve:
                     ve.clean()
+                if sp:
+                    sp.clean()
             self.call_in_encode_thread(False, clean)
 
     def parse_csc_modes(self, full_csc_modes):
@@ -633,16 +647,17 @@ class WindowVideoSource(WindowSource):
         assert not self.full_frames_only
 
         actual_vr = None
-        if vr in regions:
-            #found the video region the easy way: exact match in list
+        region = banded_region(regions)
+        if region.contains_rect(vr):
+            #found the video region the easy way: all of it is damaged
             actual_vr = vr
         else:
             #find how many pixels are within the region (roughly):
-            #find all unique regions that intersect with it:
-            inter = [x for x in (vr.intersection_rect(r) for r in regions) if x is not None]
+            #find the area of the regions that intersect with it:
+            inter = region.intersection_rect(vr)
             if len(inter)>0:
                 #merge all regions into one:
-                in_region = merge_all(inter)
+                in_region = inter.get_extents()
                 pixels_in_region = vr.width*vr.height
                 pixels_intersect = in_region.width*in_region.height
                 if pixels_intersect>=pixels_in_region*40/100:
@@ -653,7 +668,7 @@ class WindowVideoSource(WindowSource):
             #still no luck?
             if actual_vr is None:
                 #try to find one that has the same dimensions:
-                same_d = [r for r in regions if r.width==vr.width and r.height==vr.height]
+                same_d = [r for r in region if r.width==vr.width and r.height==vr.height]
                 if len(same_d)==1:
                     #probably right..
                     actual_vr = same_d[0]
@@ -664,7 +679,7 @@ class WindowVideoSource(WindowSource):
                         actual_vr = same_c[0]
 
         if actual_vr is None:
-            sublog("send_delayed_regions: video region %s not found in: %s", vr, regions)
+            sublog("send_delayed_regions: video region %s not found in: %s", vr, region)
         else:
             #found the video region:
             #sanity check in case the window got resized since:
@@ -678,20 +693,18 @@ class WindowVideoSource(WindowSource):
             self.process_damage_region(damage_time, actual_vr.x, actual_vr.y, actual_vr.width, actual_vr.height, coding, video_options, 0)
 
             #now substract this region from the rest:
-            trimmed = []
-            for r in regions:
-                trimmed += r.substract_rect(actual_vr)
+            trimmed = region.substract_rect(actual_vr)
             if not trimmed:
                 sublog("send_delayed_regions: nothing left after removing video region %s", actual_vr)
                 return
-            sublog("send_delayed_regions: substracted %s from %s gives us %s", actual_vr, regions, trimmed)
-            regions = trimmed
+            sublog("send_delayed_regions: substracted %s from %s gives us %s", actual_vr, region, trimmed)
+            region = trimmed
 
         #merge existing damage delayed region if there is one:
         #(this codepath can fire from a video region refresh callback)
         dr = self._damage_delayed
         if dr:
-            regions = dr[1] + regions
+            region.add_region(dr[1])
             damage_time = min(damage_time, dr[0])
             self._damage_delayed = None
             self.cancel_expire_timer()
@@ -706,10 +719,10 @@ class WindowVideoSource(WindowSource):
             delay = max(self.batch_config.delay*4, 50)
             delay = min(delay, self.video_subregion.non_max_wait-elapsed)
         if delay<=25:
-            send_nonvideo(regions=regions, encoding=None, exclude_region=actual_vr)
+            send_nonvideo(regions=region, encoding=None, exclude_region=actual_vr)
         else:
-            self._damage_delayed = damage_time, regions, coding, options or {}
-            sublog("send_delayed_regions: delaying non video regions %s some more by %ims", regions, delay)
+            self._damage_delayed = damage_time, region, coding, options or {}
+            sublog("send_delayed_regions: delaying non video regions %s some more by %ims", region, delay)
             self.expire_timer = self.timeout_add(int(delay), self.expire_delayed_region, delay)
 
     def must_encode_full_frame(self, encoding):
@@ -749,6 +762,8 @@ class WindowVideoSource(WindowSource):
         if self.is_cancelled(sequence):
             image.free()
             return
+        if self.damage_trace:
+            self.damage_trace.record_image(image)
         self.pixel_format = image.get_pixel_format()
         self.image_depth = image.get_depth()
         #image may have been clipped to the new window size during resize:
@@ -1022,12 +1037,33 @@ class WindowVideoSource(WindowSource):
         elif type(ve)!=encoder_spec.codec_class:
             scorelog("check_pipeline_score(%s) found a better video encoder class than %s: %s", force_reload, type(ve), scores[0])
             clean = True
+        stripes = 0
+        if self.supports_video_stripes:
+            stripes = self.get_best_stripes(eval_encodings, w, h, scores[0][0])
+        if stripes!=self.video_stripes:
+            scorelog("check_pipeline_score(%s) changing the number of video stripes from %i to %i", force_reload, self.video_stripes, stripes)
+            self.video_stripes = stripes
+            clean = True
         if clean:
             self.video_context_clean()
         self._last_pipeline_check = monotonic_time()
 
+    def get_best_stripes(self, encodings, width, height, best_score):
+        """
+            Returns the number of stripes we should split this video area into,
+            or 0 if encoding it with a single pipeline scores higher.
 
-    def get_video_pipeline_options(self, encodings, width, height, src_format, force_refresh=False):
+            Can be called from any thread.
+        """
+        stripes = 0
+        for n in get_stripe_counts(width, height):
+            scores = self.get_video_pipeline_options(encodings, width, height//n, self.pixel_format, stripes=n)
+            if scores and scores[0][0]>best_score:
+                stripes, best_score = n, scores[0][0]
+        return stripes
+
+
+    def get_video_pipeline_options(self, encodings, width, height, src_format, force_refresh=False, stripes=1):
         """
             Given a picture format (width, height and src pixel format),
             we find all the pipeline options that will allow us to compress
@@ -1039,10 +1075,12 @@ class WindowVideoSource(WindowSource):
             score (best solution comes first).
             Because this function is expensive to call, we cache the results.
             This allows it to run more often from the timer thread.
+            When 'stripes' is more than one, we score pipelines for each of the
+            stripes (the dimensions given), and the results are not cached.
 
             Can be called from any thread.
         """
-        if not force_refresh and (monotonic_time()-self.last_pipeline_time<1) and self.last_pipeline_params and self.last_pipeline_params==(encodings, width, height, src_format):
+        if stripes==1 and not force_refresh and (monotonic_time()-self.last_pipeline_time<1) and self.last_pipeline_params and self.last_pipeline_params==(encodings, width, height, src_format):
             #keep existing scores
             scorelog("get_video_pipeline_options%s using cached values from %ims ago", (encodings, width, height, src_format, force_refresh), 1000.0*(monotonic_time()-self.last_pipeline_time))
             return self.last_pipeline_scores
@@ -1070,6 +1108,13 @@ class WindowVideoSource(WindowSource):
                 target_q = int(sqrt(target_q/100.0)*100)
                 scorelog("raising quality for video encoding of non-video region")
         scorelog("get_video_pipeline_options%s speed: %s (min %s), quality: %s (min %s)", (encodings, width, height, src_format), target_s, min_s, target_q, min_q)
+        #the current pipeline, so we can take the setup cost into account:
+        csce, ve = self._csc_encoder, self._video_encoder
+        if stripes>1:
+            csce, ve = None, None
+            sp = self._video_stripes
+            if sp and len(sp.stripes)==stripes:
+                csce, ve = sp.stripes[0].csce, sp.stripes[0].ve
         scores = []
         for encoding in encodings:
             #these are the CSC modes the client can handle for this encoding:
@@ -1100,7 +1145,7 @@ class WindowVideoSource(WindowSource):
                     client_score_delta = self.encoding_options.get("%s.score-delta" % encoding, 0)
                     score_data = get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
                                                     target_q, min_q, target_s, min_s,
-                                                    self._csc_encoder, self._video_encoder, client_score_delta)
+                                                    csce, ve, client_score_delta, stripes)
                     if score_data:
                         scores.append(score_data)
             if not FORCE_CSC or src_format==FORCE_CSC_MODE:
@@ -1117,7 +1162,9 @@ class WindowVideoSource(WindowSource):
                         for csc_spec in l:
                             add_scores("via %s (%s)" % (out_csc, actual_csc), csc_spec, out_csc)
         s = sorted(scores, key=lambda x : -x[0])
-        scorelog("get_video_pipeline_options%s scores=%s", (encodings, width, height, src_format), s)
+        scorelog("get_video_pipeline_options%s scores=%s", (encodings, width, height, src_format, stripes), s)
+        if stripes>1:
+            return s
         self.last_pipeline_params = (encodings, width, height, src_format)
         self.last_pipeline_scores = s
         self.last_pipeline_time = monotonic_time()
@@ -1354,8 +1401,6 @@ class WindowVideoSource(WindowSource):
     def setup_pipeline_option(self, width, height, src_format,
                       _score, scaling, _csc_scaling, csc_width, csc_height, csc_spec,
                       enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec):
-        speed = self._current_speed
-        quality = self._current_quality
         min_w = 1
         min_h = 1
         max_w = 16384
@@ -1368,18 +1413,7 @@ class WindowVideoSource(WindowSource):
             min_h = max(min_h, csc_spec.min_h)
             max_w = min(max_w, csc_spec.max_w)
             max_h = min(max_h, csc_spec.max_h)
-            #csc speed is not very important compared to encoding speed,
-            #so make sure it never degrades quality
-            csc_speed = min(speed, 100-quality/2.0)
-            csc_start = monotonic_time()
-            csce = csc_spec.make_instance()
-            csce.init_context(csc_width, csc_height, src_format,
-                                   enc_width, enc_height, enc_in_format, csc_speed)
-            csc_end = monotonic_time()
-            csclog("setup_pipeline: csc=%s, info=%s, setup took %.2fms",
-                  csce, csce.get_info(), (csc_end-csc_start)*1000.0)
         else:
-            csce = None
             #use the encoder's mask directly since that's all we have to worry about!
             width_mask = encoder_spec.width_mask
             height_mask = encoder_spec.height_mask
@@ -1391,14 +1425,10 @@ class WindowVideoSource(WindowSource):
             if encoder_scaling!=(1,1) and not encoder_spec.can_scale:
                 videolog("scaling is now enabled, so skipping %s", encoder_spec)
                 return False
+        options = self.get_video_encoder_options(encoder_spec.encoding, width, height)
+        csce, ve = self.make_pipeline(src_format, csc_width, csc_height, csc_spec,
+                                      enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec, options)
         self._csc_encoder = csce
-        enc_start = monotonic_time()
-        #FIXME: filter dst_formats to only contain formats the encoder knows about?
-        dst_formats = self.full_csc_modes.get(encoder_spec.encoding)
-        ve = encoder_spec.make_instance()
-        options = self.encoding_options.copy()
-        options.update(self.get_video_encoder_options(encoder_spec.encoding, width, height))
-        ve.init_context(enc_width, enc_height, enc_in_format, dst_formats, encoder_spec.encoding, quality, speed, encoder_scaling, options)
         #record new actual limits:
         self.actual_scaling = scaling
         self.width_mask = width_mask
@@ -1407,14 +1437,50 @@ class WindowVideoSource(WindowSource):
         self.min_h = min_h
         self.max_w = max_w
         self.max_h = max_h
-        enc_end = monotonic_time()
         self.start_video_frame = 0
         self._video_encoder = ve
-        videolog("setup_pipeline: csc=%s, video encoder=%s, info: %s, setup took %.2fms",
-                csce, ve, ve.get_info(), (enc_end-enc_start)*1000.0)
         scalinglog("setup_pipeline: scaling=%s, encoder_scaling=%s", scaling, encoder_scaling)
         return  True
 
+    def make_pipeline(self, src_format, csc_width, csc_height, csc_spec,
+                      enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec, encoder_options):
+        """
+            Creates the csc step (if needed) and the video encoder,
+            returns them as a tuple: (csc_encoder, video_encoder)
+
+            Runs in the 'encode' thread.
+        """
+        speed = self._current_speed
+        quality = self._current_quality
+        csce = None
+        if csc_spec:
+            #csc speed is not very important compared to encoding speed,
+            #so make sure it never degrades quality
+            csc_speed = min(speed, 100-quality/2.0)
+            csc_start = monotonic_time()
+            csce = csc_spec.make_instance()
+            csce.init_context(csc_width, csc_height, src_format,
+                                   enc_width, enc_height, enc_in_format, csc_speed)
+            csc_end = monotonic_time()
+            csclog("setup_pipeline: csc=%s, info=%s, setup took %.2fms",
+                  csce, csce.get_info(), (csc_end-csc_start)*1000.0)
+        try:
+            enc_start = monotonic_time()
+            #FIXME: filter dst_formats to only contain formats the encoder knows about?
+            dst_formats = self.full_csc_modes.get(encoder_spec.encoding)
+            ve = encoder_spec.make_instance()
+            options = self.encoding_options.copy()
+            options.update(encoder_options)
+            ve.init_context(enc_width, enc_height, enc_in_format, dst_formats, encoder_spec.encoding, quality, speed, encoder_scaling, options)
+            enc_end = monotonic_time()
+        except:
+            if csce:
+                csce.clean()
+            raise
+        videolog("setup_pipeline: csc=%s, video encoder=%s, info: %s, setup took %.2fms",
+                csce, ve, ve.get_info(), (enc_end-enc_start)*1000.0)
+        return csce, ve
+
     def get_video_encoder_options(self, encoding, width, height):
         #tweaks for "real" video:
         if self.matches_video_subregion(width, height) and self.subregion_is_video() and (monotonic_time()-self.last_scroll_time)>5:
@@ -1441,7 +1507,12 @@ class WindowVideoSource(WindowSource):
         return packet
 
 
-    def encode_scrolling(self, scroll_data, image, options={}):
+    def encode_scrolling(self, scroll_values, image, options={}):
+        """
+            Sends the scrolled areas as a single "scroll" packet,
+            followed by the areas that need to be repainted.
+            scroll_values are rectangles relative to the image, see ScrollDetector.update
+        """
         start = monotonic_time()
         try:
             del options["av-sync"]
@@ -1451,31 +1522,26 @@ class WindowVideoSource(WindowSource):
         ww, wh = self.window_dimensions
         scrolllog("encode_scrolling(%s, %s) window-dimensions=%s", image, options, (ww, wh))
         x, y, w, h = image.get_geometry()[:4]
-        if x+y>ww or y+h>wh:
+        if x+w>ww or y+h>wh:
             #window may have been resized
-            raw_scroll, non_scroll = {}, {0 : h}
+            raw_scroll, non_scroll = [], [(0, 0, w, h)]
         else:
-            raw_scroll, non_scroll = scroll_data.get_scroll_values()
-            assert raw_scroll, "failed to detect scroll values"
+            raw_scroll, non_scroll = scroll_values
         if len(raw_scroll)>=20 or len(non_scroll)>20:
             #avoid fragmentation, which is too costly
             #(too many packets, too many loops through the encoder code)
             scrolllog("too many items: %i scrolls, %i non-scrolls - sending just one image instead", len(raw_scroll), len(non_scroll))
-            raw_scroll = {}
-            non_scroll = {0 : h}
+            raw_scroll = []
+            non_scroll = [(0, 0, w, h)]
         scrolllog(" will send scroll data=%s, non-scroll=%s", raw_scroll, non_scroll)
         flush = len(non_scroll)
         #convert to a screen rectangle list for the client:
         scrolls = []
-        for scroll, line_defs in raw_scroll.items():
-            if scroll==0:
-                continue
-            for line, count in line_defs.items():
-                assert y+line+scroll>=0, "cannot scroll rectangle by %i lines from %i+%i" % (scroll, y, line)
-                assert y+line+scroll<=wh, "cannot scroll rectangle %i high by %i lines from %i+%i (window height is %i)" % (count, scroll, y, line, wh)
-                scrolls.append((x, y+line, w, count, 0, scroll))
-        #send the scrolls if we have any
-        #(zero change scrolls have been removed - so maybe there are none)
+        for sx, sy, sw, sh, xdelta, ydelta in raw_scroll:
+            assert x+sx+xdelta>=0 and y+sy+ydelta>=0, "cannot scroll rectangle %s by %i,%i" % ((x+sx, y+sy, sw, sh), xdelta, ydelta)
+            assert x+sx+sw+xdelta<=ww and y+sy+sh+ydelta<=wh, "cannot scroll rectangle %s by %i,%i (window size is %ix%i)" % ((x+sx, y+sy, sw, sh), xdelta, ydelta, ww, wh)
+            scrolls.append((x+sx, y+sy, sw, sh, xdelta, ydelta))
+        #send the scrolls if we have any:
         if len(scrolls)>0:
             client_options = options.copy()
             try:
@@ -1502,9 +1568,9 @@ class WindowVideoSource(WindowSource):
             client_options = options.copy()
             if encoding:
                 encode_fn = self._encoders[encoding]
-                for sy, sh in non_scroll.items():
+                for sx, sy, sw, sh in non_scroll:
                     substart = monotonic_time()
-                    sub = image.get_sub_image(0, sy, w, sh)
+                    sub = image.get_sub_image(sx, sy, sw, sh)
                     ret = encode_fn(encoding, sub, options)
                     if not ret:
                         #cancelled?
@@ -1524,10 +1590,10 @@ class WindowVideoSource(WindowSource):
                     #    log.info("saved scroll y=%i h=%i to %s", sy, sh, filename)
                     packet = self.make_draw_packet(sub.get_x(), sub.get_y(), outw, outh, coding, data, outstride, client_options, options)
                     self.queue_damage_packet(packet)
-                    psize = w*sh*4
+                    psize = sw*sh*4
                     csize = len(data)
                     compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %6s with ratio %5.1f%%  (%5iKB to %5iKB), sequence %5i, client_options=%s",
-                         (monotonic_time()-substart)*1000.0, w, sh, 0, sy, self.wid, coding, 100.0*csize/psize, psize/1024, csize/1024, self._damage_packet_sequence, client_options)
+                         (monotonic_time()-substart)*1000.0, sw, sh, sx, sy, self.wid, coding, 100.0*csize/psize, psize/1024, csize/1024, self._damage_packet_sequence, client_options)
                 scrolllog("non-scroll encoding using %s (quality=%i, speed=%i) took %ims for %i rectangles", encoding, self._current_quality, self._current_speed, (monotonic_time()-nsstart)*1000, len(non_scroll))
             else:
                 #we can't send the non-scroll areas, ouch!
@@ -1620,7 +1686,7 @@ class WindowVideoSource(WindowSource):
                 try:
                     start = monotonic_time()
                     if not scroll_data:
-                        scroll_data = ScrollData()
+                        scroll_data = ScrollDetector()
                         self.scroll_data = scroll_data
                         scrolllog("new scroll data: %s", scroll_data)
                     if not image.is_thread_safe():
@@ -1633,18 +1699,20 @@ class WindowVideoSource(WindowSource):
                         newstride = roundup(image.get_width()*image.get_bytesperpixel(), 4)
                         image.restride(newstride)
                     bpp = image.get_bytesperpixel()
-                    scroll_data.update(image.get_pixels(), x, y, w, h, image.get_rowstride(), bpp)
                     max_distance = min(1000, (100-SCROLL_MIN_PERCENT)*h//100)
-                    scroll_data.calculate(max_distance)
+                    scroll_values = scroll_data.update(image.get_pixels(), x, y, w, h, image.get_rowstride(), bpp, max_distance)
                     #marker telling us not to invalidate the scroll data from here on:
                     options["scroll"] = True
-                    scroll, count = scroll_data.get_best_match()
-                    end = monotonic_time()
-                    match_pct = int(100*count/h)
-                    scrolllog("best scroll guess took %ims, matches %i%% of %i lines: %s", (end-start)*1000, match_pct, h, scroll)
-                    #if enough scrolling is detected, use scroll encoding for this frame:
-                    if match_pct>=SCROLL_MIN_PERCENT:
-                        return self.encode_scrolling(scroll_data, image, options)
+                    if scroll_values:
+                        scrolls, paints = scroll_values
+                        scrolled = sum(sw*sh for _, _, sw, sh, _, _ in scrolls)
+                        changed = scrolled + sum(pw*ph for _, _, pw, ph in paints)
+                        end = monotonic_time()
+                        match_pct = 100*scrolled//max(1, changed)
+                        scrolllog("scroll detection took %ims, %i scrolls matching %i%% of the %i pixels changed", (end-start)*1000, len(scrolls), match_pct, changed)
+                        #if enough scrolling is detected (or nothing changed), use scroll encoding for this frame:
+                        if changed==0 or (scrolls and match_pct>=SCROLL_MIN_PERCENT):
+                            return self.encode_scrolling(scroll_values, image, options)
                 except Exception:
                     scrolllog.error("Error during scrolling detection")
                     scrolllog.error(" with image=%s, options=%s", image, options, exc_info=True)
@@ -1662,6 +1730,8 @@ class WindowVideoSource(WindowSource):
         vh = self.video_helper
         if vh is None:
             return None         #shortcut when closing down
+        if self.video_stripes>1 and self.encode_stripes(encoding, image, options):
+            return None
         if not self.check_pipeline(encoding, w, h, src_format):
             if self.is_cancelled():
                 return None
@@ -1764,6 +1834,151 @@ class WindowVideoSource(WindowSource):
                             ve.get_type(), actual_encoding, enc_width, enc_height, len(data or ""), (enc_width*enc_height/(end-start+0.000001)/1024.0/1024.0), client_options)
         return actual_encoding, Compressed(actual_encoding, data), client_options, width, height, 0, 24
 
+    def setup_stripes(self, encoding, width, height, src_format, n):
+        """
+            Creates a pipeline for each of the 'n' stripes,
+            using the best option that works for all of them.
+
+            Runs in the 'encode' thread.
+        """
+        if encoding=="auto":
+            encodings = self.common_video_encodings
+        else:
+            encodings = [encoding]
+        scores = self.get_video_pipeline_options(encodings, width, height//n, src_format, stripes=n)
+        for option in scores:
+            _, _, _, csc_width, csc_height, csc_spec, enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec = option
+            if not csc_spec and encoder_scaling!=(1, 1) and not encoder_spec.can_scale:
+                continue
+            if csc_spec:
+                stripe_width, stripe_height = csc_width, csc_height
+            else:
+                stripe_width, stripe_height = enc_width, enc_height
+            if stripe_width<=0 or stripe_height<=0:
+                continue
+            #b-frames would require flushing each stripe separately:
+            options = self.get_video_encoder_options(encoder_spec.encoding, width, height)
+            options["b-frames"] = 0
+            stripes = []
+            try:
+                for i in range(n):
+                    csce, ve = self.make_pipeline(src_format, csc_width, csc_height, csc_spec,
+                                                  enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec, options)
+                    stripes.append(VideoStripe(i, i*stripe_height, stripe_height, csce, ve))
+            except TransientCodecException as e:
+                videolog.warn("setup_stripes failed for %s: %s", option, e)
+            except:
+                videolog.warn("setup_stripes failed for %s", option, exc_info=True)
+            else:
+                sp = StripedPipeline(width, height, src_format, stripe_width, stripes)
+                videolog("setup_stripes%s=%s", (encoding, width, height, src_format, n), sp)
+                return sp
+            for stripe in stripes:
+                stripe.clean()
+        return None
+
+    def encode_stripes(self, encoding, image, options):
+        """
+            Splits the image into horizontal stripes which are encoded in parallel,
+            each one as a separate video stream that the client paints at its offset.
+            The areas not covered by the stripes are sent using the edge encoding.
+            Returns False if the image could not be encoded this way.
+
+            Runs in the 'encode' thread.
+        """
+        x, y, w, h = image.get_geometry()[:4]
+        src_format = image.get_pixel_format()
+        sp = self._video_stripes
+        if not sp or not sp.matches(w, h, src_format):
+            if sp:
+                self._video_stripes = None
+                sp.clean()
+            sp = self.setup_stripes(encoding, w, h, src_format, self.video_stripes)
+            if not sp:
+                #we'll try again after the next pipeline scoring:
+                self.video_stripes = 0
+                return False
+            self._video_stripes = sp
+        quality = max(0, min(100, self._current_quality))
+        speed = max(0, min(100, self._current_speed))
+        start = monotonic_time()
+        try:
+            results = sp.encode(self.encode_stripe, image, sp.stripe_width, quality, speed, options)
+        except Exception as e:
+            if self.is_cancelled():
+                return True
+            videolog.error("Error: failed to encode %i video stripes", len(sp.stripes))
+            videolog.error(" %s", e)
+            self._video_stripes = None
+            self.video_stripes = 0
+            sp.clean()
+            return False
+        #the edges that the stripes do not cover:
+        edges = []
+        ew = sp.stripe_width
+        eh = sp.get_covered_height()
+        edge_encoding = self.edge_encoding or self.get_video_fallback_encoding(FAST_ORDER)
+        if edge_encoding:
+            if ew<w:
+                edges.append(image.get_sub_image(ew, 0, w-ew, h))
+            if eh<h:
+                edges.append(image.get_sub_image(0, eh, ew, h-eh))
+        flush = len(results)+len(edges)
+        for stripe, ret in zip(sp.stripes, results):
+            coding, data, client_options = ret
+            flush -= 1
+            if self.supports_flush and flush>0:
+                client_options["flush"] = flush
+            packet = self.make_draw_packet(x, y+stripe.y, ew, stripe.height, coding, Compressed(coding, data), 0, client_options, options)
+            self.queue_damage_packet(packet)
+        for sub in edges:
+            ret = self._encoders[edge_encoding](edge_encoding, sub, options)
+            flush -= 1
+            if not ret:
+                continue
+            coding, data, client_options, outw, outh, outstride, _ = ret
+            if self.supports_flush and flush>0:
+                client_options["flush"] = flush
+            packet = self.make_draw_packet(sub.get_x(), sub.get_y(), outw, outh, coding, data, outstride, client_options, options)
+            self.queue_damage_packet(packet)
+        videolog("encode_stripes: %i stripes and %i edges for %ix%i took %ims", len(results), len(edges), w, h, 1000*(monotonic_time()-start))
+        return True
+
+    def encode_stripe(self, stripe, image, width, quality, speed, options):
+        """
+            Encodes a single stripe of the image using its own csc and video encoder,
+            returns the encoding, the compressed data and the client options.
+
+            Runs in one of the stripe threads.
+        """
+        sub = image.get_sub_image(0, stripe.y, width, stripe.height)
+        csce = stripe.csce
+        if csce:
+            csc_image = csce.convert_image(sub)
+            if not csc_image:
+                raise Exception("conversion of %s to %s failed" % (sub, csce.get_dst_format()))
+            csc = csce.get_dst_format()
+        else:
+            csc_image = sub
+            csc = sub.get_pixel_format()
+        ve = stripe.ve
+        try:
+            ret = ve.compress_image(csc_image, quality, speed, options.copy())
+        finally:
+            if csc_image is not sub:
+                self.free_image_wrapper(csc_image)
+            if sub is not image:
+                sub.free()
+        if ret is None:
+            raise Exception("%s video compression failed" % ve.get_type())
+        data, client_options = ret
+        client_options["stripe"] = stripe.index
+        client_options["csc"] = self.csc_equiv(csc)
+        #tell the client about scaling (unless the video encoder has already done so):
+        if csce and "scaled_size" not in client_options and (csce.get_dst_width()!=width or csce.get_dst_height()!=stripe.height):
+            client_options["scaled_size"] = csce.get_dst_width(), csce.get_dst_height()
+        return ve.get_encoding(), data, client_options
+
     def cancel_video_encoder_flush(self):
         self.cancel_video_encoder_flush_timer()
         self.b_frame_flush_data = None
@@ -111,6 +111,7 @@ class sound_record(sound_subprocess):
         sound_pipeline = SoundSource(*pipeline_args)
         sound_subprocess.__init__(self, sound_pipeline, [], ["new-stream", "new-buffer"])
         self.large_packets = ["new-buffer"]
+        self.mmap_packets = ["new-buffer"]
 
 class sound_play(sound_subprocess):
     """ wraps SoundSink as a subprocess """
@@ -224,6 +225,8 @@ class sound_subprocess_wrapper(subprocess_caller):
     """
     def __init__(self, description):
         subprocess_caller.__init__(self, description)
+        #the sound buffers are exchanged using shared memory:
+        self.use_mmap = True
         self.state = "stopped"
         self.codec = "unknown"
         self.codec_description = ""
@@ -280,7 +283,11 @@ class sound_subprocess_wrapper(subprocess_caller):
 
 
     def get_info(self):
-        return self.info
+        info = self.info.copy()
+        m = self.mmap
+        if m:
+            info["mmap"] = m.get_info()
+        return info
 
     def info_update(self, wrapper, info):
         log("info_update: %s", info)
@@ -319,6 +326,7 @@ class sink_subprocess_wrapper(sound_subprocess_wrapper):
     def __init__(self, plugin, codec, volume, element_options):
         sound_subprocess_wrapper.__init__(self, "sound output")
         self.large_packets = ["add_data"]
+        self.mmap_packets = ["add_data"]
         self.codec = codec
         self.command = get_sound_command()+["_sound_play", "-", "-", plugin or "", format_element_options(element_options), codec, "", str(volume)]
         _add_debug_args(self.command)
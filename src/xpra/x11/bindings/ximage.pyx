@@ -7,8 +7,9 @@
 #cython: auto_pickle=False
 
 import errno as pyerrno
+from threading import Lock
 from libc.stdint cimport uint64_t, uintptr_t
-from xpra.buffers.membuf cimport memory_as_pybuffer, object_as_buffer
+from xpra.buffers.membuf cimport memalign, memory_as_pybuffer, object_as_buffer
 from xpra.monotonic_time cimport monotonic_time
 
 from xpra.log import Logger
@@ -17,6 +18,13 @@ log = Logger("x11", "bindings", "ximage")
 xshmdebug = Logger("x11", "bindings", "ximage", "xshm", "verbose")
 ximagedebug = Logger("x11", "bindings", "ximage", "verbose")
 
+from xpra.util import envint
+
+#number of free pixel buffers we keep for each buffer size:
+POOL_BUFFERS = envint("XPRA_XIMAGE_POOL_BUFFERS", 4)
+#maximum amount of memory held by the free buffers (in MB):
+POOL_SIZE = envint("XPRA_XIMAGE_POOL_SIZE", 128)*1024*1024
+
 
 cdef inline unsigned int roundup(unsigned int n, unsigned int m):
     return (n + m - 1) & ~(m - 1)
@@ -31,7 +39,7 @@ cdef inline unsigned char BYTESPERPIXEL(unsigned int depth):
     #shouldn't happen!
     return roundup(depth, 8)//8
 
-cdef inline unsigned int MIN(unsigned int a, unsigned int b):
+cdef inline unsigned int MIN(unsigned int a, unsigned int b) nogil:
     if a<=b:
         return a
     return b
@@ -44,8 +52,7 @@ cdef extern from "string.h":
     void *memcpy(void * destination, void * source, size_t num) nogil
 
 cdef extern from "stdlib.h":
-    int posix_memalign(void **memptr, size_t alignment, size_t size)
-    void free(void* mem)
+    void free(void* mem) nogil
 
 cdef extern from "sys/ipc.h":
     ctypedef struct key_t:
@@ -238,6 +245,80 @@ cdef const char *r210 = "r210"
 RGB_FORMATS = [XRGB, BGRX, ARGB, BGRA, RGB, RGBA, RGBX, R210, r210, RGB565, BGR565, RLE8]
 
 
+###################################
+# Pixel buffer pool
+###################################
+# The image wrappers copy the pixels out of the XImage (see restride and set_pixels),
+# the windows are usually captured at the same size frame after frame,
+# so we keep the aligned buffers and re-use them instead of allocating
+# and freeing multi-megabyte buffers for every frame.
+pool_lock = Lock()
+#buffer size -> list of free buffers (as uintptr_t):
+cdef object buffer_pool = {}
+cdef size_t pool_size = 0
+cdef unsigned long pool_hits = 0
+cdef unsigned long pool_misses = 0
+
+cdef void *get_pixel_buffer(size_t size) except NULL:
+    global pool_size, pool_hits, pool_misses
+    cdef uintptr_t ptr = 0
+    with pool_lock:
+        buffers = buffer_pool.get(size)
+        if buffers:
+            ptr = buffers.pop()
+            pool_size -= size
+            pool_hits += 1
+        else:
+            pool_misses += 1
+    if ptr:
+        return <void *> ptr
+    cdef void *buf = memalign(size)
+    if buf==NULL:
+        raise MemoryError("failed to allocate %i bytes of memory" % size)
+    return buf
+
+cdef release_pixel_buffer(void *buf, size_t size):
+    global pool_size
+    cdef uintptr_t ptr
+    with pool_lock:
+        if size<=POOL_SIZE:
+            if pool_size+size>POOL_SIZE:
+                #the buffers for other sizes are probably stale
+                #(ie: the window has been resized), so free those first:
+                for bsize, buffers in list(buffer_pool.items()):
+                    if bsize!=size:
+                        for ptr in buffers:
+                            free(<void *> ptr)
+                        pool_size -= bsize*len(buffers)
+                        del buffer_pool[bsize]
+            buffers = buffer_pool.setdefault(size, [])
+            if len(buffers)<POOL_BUFFERS and pool_size+size<=POOL_SIZE:
+                buffers.append(<uintptr_t> buf)
+                pool_size += size
+                return
+    free(buf)
+
+def free_pixel_buffers():
+    global pool_size
+    cdef uintptr_t ptr
+    with pool_lock:
+        for buffers in buffer_pool.values():
+            for ptr in buffers:
+                free(<void *> ptr)
+        buffer_pool.clear()
+        pool_size = 0
+
+def get_pixel_buffers_info():
+    with pool_lock:
+        return {
+                "buffers"   : dict((size, len(buffers)) for size, buffers in buffer_pool.items() if buffers),
+                "size"      : pool_size,
+                "max-size"  : POOL_SIZE,
+                "hits"      : pool_hits,
+                "misses"    : pool_misses,
+                }
+
+
 cdef int ximage_counter = 0
 
 cdef class XImageWrapper(object):
@@ -258,6 +339,7 @@ cdef class XImageWrapper(object):
     cdef unsigned char sub
     cdef object pixel_format
     cdef void *pixels
+    cdef size_t pixels_size
     cdef object del_callback
     cdef uint64_t timestamp
     cdef object palette
@@ -277,6 +359,7 @@ cdef class XImageWrapper(object):
         self.thread_safe = thread_safe
         self.sub = sub
         self.pixels = <void *> pixels
+        self.pixels_size = 0
         self.timestamp = int(monotonic_time()*1000)
         self.palette = palette
 
@@ -428,15 +511,14 @@ cdef class XImageWrapper(object):
         cdef const unsigned char * buf = NULL
         cdef Py_ssize_t buf_len = 0
         assert object_as_buffer(pixels, <const void**> &buf, &buf_len)==0
-        if self.pixels!=NULL:
-            if not self.sub:
-                free(self.pixels)
-            self.pixels = NULL
+        self.free_pixels()
         #Note: we can't free the XImage, because it may
         #still be used somewhere else (see XShmWrapper)
-        if posix_memalign(<void **> &self.pixels, 64, buf_len):
-            raise Exception("posix_memalign failed!")
-        assert self.pixels!=NULL
+        cdef void *new_buf = get_pixel_buffer(buf_len)
+        self.pixels = new_buf
+        self.pixels_size = buf_len
+        #this buffer is ours now, even if we were a sub-image:
+        self.sub = False
         if self.image==NULL:
             self.thread_safe = 1
             #we can now mark this object as thread safe
@@ -444,7 +526,8 @@ cdef class XImageWrapper(object):
             #which needs to be freed from the UI thread
             #but our new buffer is just a malloc buffer,
             #which is safe from any thread
-        memcpy(self.pixels, buf, buf_len)
+        with nogil:
+            memcpy(new_buf, buf, buf_len)
 
 
     def free(self):                                     #@DuplicatedSignature
@@ -464,8 +547,9 @@ cdef class XImageWrapper(object):
         ximagedebug("%s.free_pixels() pixels=%#x", self, <uintptr_t> self.pixels)
         if self.pixels!=NULL:
             if not self.sub:
-                free(self.pixels)
+                release_pixel_buffer(self.pixels, self.pixels_size)
             self.pixels = NULL
+            self.pixels_size = 0
 
     def freeze(self):
         #we don't need to do anything here because the non-XShm version
@@ -498,29 +582,34 @@ cdef class XImageWrapper(object):
         # and convert BGRX to RGB for example (assuming RGB is also supported by the client)
         cdef void *img_buf = self.get_pixels_ptr()
         assert img_buf!=NULL, "this image wrapper is empty!"
-        cdef void *new_buf
-        if posix_memalign(<void **> &new_buf, 64, (newsize+rowstride)):
-            raise Exception("posix_memalign failed!")
+        cdef size_t new_size = newsize+rowstride
+        cdef void *new_buf = get_pixel_buffer(new_size)
         cdef unsigned int ry
         cdef void *to = new_buf
         cdef unsigned int oldstride = self.rowstride                     #using a local variable is faster
+        cdef unsigned int height = self.height
         #Note: we don't zero the buffer,
         #so if the newstride is bigger than oldstride, you get garbage..
         cdef unsigned int cpy_size
-        if oldstride==rowstride:
-            memcpy(to, img_buf, size)
-        else:
-            cpy_size = MIN(rowstride, oldstride)
-            for ry in range(self.height):
-                memcpy(to, img_buf, cpy_size)
-                to += rowstride
-                img_buf += oldstride
+        #the copy does not need the GIL, so the encoding threads can run:
+        with nogil:
+            if oldstride==rowstride:
+                memcpy(to, img_buf, size)
+            else:
+                cpy_size = MIN(rowstride, oldstride)
+                for ry in range(height):
+                    memcpy(to, img_buf, cpy_size)
+                    to += rowstride
+                    img_buf += oldstride
         #we can now free the pixels buffer if present
         #(but not the ximage - this is not running in the UI thread!)
         self.free_pixels()
         #set the new attributes:
         self.rowstride = rowstride
-        self.pixels = <char *> new_buf
+        self.pixels = new_buf
+        self.pixels_size = new_size
+        #this buffer is ours now, even if we were a sub-image:
+        self.sub = False
         #without any X11 image to free, this is now thread safe:
         if self.image==NULL:
             self.thread_safe = 1
@@ -623,6 +712,8 @@ cdef class XShmWrapper(object):
         if y+h>self.height:
             h = self.height-y
         if not self.got_image:
+            #we never call XInitThreads, so the X11 calls must keep the GIL:
+            #this is what serializes them with the UI thread
             if not XShmGetImage(self.display, drawable, self.image, 0, 0, 0xFFFFFFFF):
                 xshmlog("XShmWrapper.get_image(%#x, %i, %i, %i, %i) XShmGetImage failed!", drawable, x, y, w, h)
                 return None
@@ -821,6 +912,7 @@ cdef class PixmapWrapper(object):
 
 cdef get_image(Display * display, Drawable drawable, unsigned int x, unsigned int y, unsigned int width, unsigned int height):
     cdef XImage* ximage
+    #keep the GIL, see XShmWrapper.get_image
     ximage = XGetImage(display, drawable, x, y, width, height, AllPlanes, ZPixmap)
     #log.info("get_pixels(..) ximage==NULL : %s", ximage==NULL)
     if ximage==NULL:
@@ -885,6 +977,14 @@ cdef class _XImageBindings(_X11CoreBindings):
     def has_XShm(self):
         return self.has_xshm
 
+    def get_info(self):
+        return {
+                "XShm"          : bool(self.has_xshm),
+                "ximages"       : ximage_counter,
+                "pixmaps"       : xpixmap_counter,
+                "pixel-buffers" : get_pixel_buffers_info(),
+                }
+
     def get_XShmWrapper(self, xwindow):
         cdef XWindowAttributes attrs
         if XGetWindowAttributes(self.display, xwindow, &attrs)==0:
@@ -370,11 +370,13 @@ class XpraDesktopServer(gobject.GObject, X11ServerBase):
         # which is usually how things work.  (I don't know that anyone cares
         # about this kind of correctness at all, but hey, doesn't hurt.)
         windowlog("send_initial_windows(%s, %s) will send: %s", ss, sharing, self._id_to_window)
+        initial = []
         for wid,window in sorted(self._id_to_window.items()):
             x, y, w, h = window.get_geometry()
             wprops = self.client_properties.get("%s|%s" % (wid, ss.uuid))
             ss.new_window("new-window", wid, window, x, y, w, h, wprops)
-            ss.damage(wid, window, 0, 0, w, h)
+            initial.append((wid, window, x, y, w, h))
+        self.send_initial_damage(ss, initial)
 
 
     def _lost_window(self, window, wm_exiting=False):
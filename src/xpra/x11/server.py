@@ -419,6 +419,8 @@ class XpraServer(gobject.GObject, X11ServerBase):
         # which is usually how things work.  (I don't know that anyone cares
         # about this kind of correctness at all, but hey, doesn't hurt.)
         windowlog("send_initial_windows(%s, %s) will send: %s", ss, sharing, self._id_to_window)
+        #send all the windows first, then refresh the most important ones first:
+        initial = []
         for wid in sorted(self._id_to_window.keys()):
             window = self._id_to_window[wid]
             if not window.is_managed():
@@ -432,7 +434,7 @@ class XpraServer(gobject.GObject, X11ServerBase):
                 w, h = window.get_dimensions()
                 if ss.system_tray:
                     ss.new_tray(wid, window, w, h)
-                    ss.damage(wid, window, 0, 0, w, h)
+                    initial.append((wid, window, 0, 0, w, h))
                 elif not sharing:
                     #park it outside the visible area
                     window.move_resize(-200, -200, w, h)
@@ -441,7 +443,7 @@ class XpraServer(gobject.GObject, X11ServerBase):
                 x, y, w, h = window.get_property("geometry")
                 wprops = self.client_properties.get("%s|%s" % (wid, ss.uuid))
                 ss.new_window("new-override-redirect", wid, window, x, y, w, h, wprops)
-                ss.damage(wid, window, 0, 0, w, h)
+                initial.append((wid, window, x, y, w, h))
             else:
                 #code more or less duplicated from send_new_window_packet:
                 if not sharing:
@@ -449,6 +451,8 @@ class XpraServer(gobject.GObject, X11ServerBase):
                 x, y, w, h = self._desktop_manager.window_geometry(window)
                 wprops = self.client_properties.get("%s|%s" % (wid, ss.uuid))
                 ss.new_window("new-window", wid, window, x, y, w, h, wprops)
+                #no refresh here: the client's "map-window" will request one
+        self.send_initial_damage(ss, initial)
 
 
     def _new_window_signaled(self, wm, window):
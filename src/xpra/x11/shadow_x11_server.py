@@ -116,7 +116,9 @@ class GTKX11RootWindowModel(GTKRootWindowModel):
         self.close_capture()
 
     def get_image(self, x, y, width, height, logger=None):
-        image = None
+        image = self.get_frame_image(x, y, width, height)
+        if image:
+            return image
         if not self.capture:
             ww, wh = self.get_geometry()
             if USE_NVFBC:
@@ -300,6 +300,11 @@ class X11ServerBase(GTKServerBase):
             sinfo["XShm"] = CompositeHelper.XShmEnabled
         except:
             pass
+        try:
+            from xpra.x11.bindings.ximage import XImageBindings     #@UnresolvedImport
+            sinfo["ximage"] = XImageBindings().get_info()
+        except Exception as e:
+            log("no ximage info: %s", e)
         #cursor:
         log("do_get_info: adding cursor=%s", self.last_cursor_data)
         info.setdefault("cursor", {}).update(self.get_cursor_info())